@@ -382,6 +382,10 @@ class BatchSystemSupport(AbstractBatchSystem):
         assert isinstance(info, WorkerCleanupInfo)
         workflowDir = Toil.getLocalWorkflowDir(info.workflowID, info.workDir)
         DeferredFunctionManager.cleanupWorker(workflowDir)
+        if os.path.exists(os.path.join(workflowDir, 'dockerPool')):
+            # Only import Docker support if some job used the container pool
+            from toil.lib.docker import cleanupContainerPool
+            cleanupContainerPool(workflowDir)
         workflowDirContents = os.listdir(workflowDir)
         AbstractFileStore.shutdownFileStore(workflowDir, info.workflowID)
         if (info.cleanWorkDir == 'always'
@@ -17,6 +17,7 @@ from __future__ import absolute_import
 from builtins import str
 from datetime import datetime
 import logging
+import math
 import time
 from threading import Thread, Lock
 from abc import ABCMeta, abstractmethod
@@ -25,10 +26,14 @@ from abc import ABCMeta, abstractmethod
 from six.moves.queue import Empty, Queue
 from future.utils import with_metaclass
 
+from toil import resolveEntryPoint
 from toil.lib.misc import CalledProcessErrorStderr
 from toil.lib.objects import abstractclassmethod
 
+from toil.batchSystems import MemoryString
 from toil.batchSystems.abstractBatchSystem import BatchSystemCleanupSupport, UpdatedBatchJobInfo, BatchJobExitReason
+from toil.batchSystems.pilot import PilotServer
+from toil.common import Toil
 
 logger = logging.getLogger(__name__)
 
@@ -86,7 +91,18 @@ class AbstractGridEngineBatchSystem(BatchSystemCleanupSupport):
             if task is None:
                 return str(job)
             else:
-                return str(job) + "." + str(task)
+                return self.getArrayElementID(job, task)
+
+        def getArrayElementID(self, arrayJobID, index):
+            """
+            Get the batch system's ID for one element of an array job.
+
+            :param: string arrayJobID: batch system ID of the array job, from submitArrayJob()
+            :param: int index: the element's index in the array, starting at 1
+
+            :rtype: string
+            """
+            return str(arrayJobID) + "." + str(index)
 
         def forgetJob(self, jobID):
             """
@@ -102,6 +118,9 @@ class AbstractGridEngineBatchSystem(BatchSystemCleanupSupport):
             """
             Create a new job with the Toil job ID.
 
+            Waiting jobs that need the same resources are submitted together as
+            one array job, if the batch system supports it.
+
             Implementation-specific; called by AbstractGridEngineWorker.run()
 
             :param string newJob: Toil job ID
@@ -114,25 +133,87 @@ class AbstractGridEngineBatchSystem(BatchSystemCleanupSupport):
             while len(self.waitingJobs) > 0 and \
                     len(self.runningJobs) < int(self.boss.config.maxLocalJobs):
                 activity = True
-                jobID, cpu, memory, command, jobName = self.waitingJobs.pop(0)
+                jobs = self._takeArrayOfWaitingJobs()
+                submission = None
+                if len(jobs) > 1:
+                    submission = self.prepareArraySubmission(jobs[0][1], jobs[0][2],
+                                                             [(jobID, command, jobName)
+                                                              for jobID, _, _, command, jobName in jobs])
+                if submission is None:
+                    # Submit them one at a time
+                    for jobID, cpu, memory, command, jobName in jobs:
+                        # prepare job submission command
+                        subLine = self.prepareSubmission(cpu, memory, jobID, command, jobName)
+                        logger.debug("Running %r", subLine)
+                        batchJobID = self.boss.with_retries(self.submitJob, subLine)
+                        logger.debug("Submitted job %s", str(batchJobID))
+                        self._addRunningJob(jobID, batchJobID, None)
+                else:
+                    subLine, script = submission
+                    logger.debug("Running %r", subLine)
+                    batchJobID = self.boss.with_retries(self.submitArrayJob, subLine, script)
+                    logger.debug("Submitted array job %s of %i jobs", str(batchJobID), len(jobs))
+                    for index, job in enumerate(jobs, 1):
+                        self._addRunningJob(job[0], batchJobID, index)
 
-                # prepare job submission command
-                subLine = self.prepareSubmission(cpu, memory, jobID, command, jobName)
-                logger.debug("Running %r", subLine)
-                batchJobID = self.boss.with_retries(self.submitJob, subLine)
-                logger.debug("Submitted job %s", str(batchJobID))
+            return activity
 
-                # Store dict for mapping Toil job ID to batch job ID
-                # TODO: Note that this currently stores a tuple of (batch system
-                # ID, Task), but the second value is None by default and doesn't
-                # seem to be used
-                self.batchJobIDs[jobID] = (batchJobID, None)
+        def _takeArrayOfWaitingJobs(self):
+            """
+            Take the first waiting job off the list of waiting jobs, along with
+            as many of the others that need the same resources as will fit in
+            an array job and under maxLocalJobs.
 
-                # Add to queue of running jobs
-                with self.runningJobsLock:
-                    self.runningJobs.add(jobID)
+            :rtype: list: the waiting jobs taken, oldest first
+            """
+            room = min(int(self.boss.config.maxLocalJobs) - len(self.runningJobs),
+                       self.boss.config.maxArrayJobSize)
+            requirements = self.waitingJobs[0][1:3]
+            taken, left = [], []
+            for job in self.waitingJobs:
+                if len(taken) < room and job[1:3] == requirements:
+                    taken.append(job)
+                else:
+                    left.append(job)
+            self.waitingJobs = left
+            return taken
 
-            return activity
+        def _addRunningJob(self, jobID, batchJobID, task):
+            # Store dict for mapping Toil job ID to batch job ID, and the index
+            # of the job in its array job if it is in one
+            self.batchJobIDs[jobID] = (batchJobID, task)
+
+            # Add to queue of running jobs
+            with self.runningJobsLock:
+                self.runningJobs.add(jobID)
+
+        def arrayJobScript(self, jobs, indexVariable, batchSystem, batchJobIDfmt, header=()):
+            """
+            Make a shell script for an array job, that runs the command of the
+            Toil job at the element's index. Each element writes its output to
+            its own files, named for its Toil job ID.
+
+            :param: list jobs: (jobID, command, jobName) tuples for the elements, in index order
+            :param: string indexVariable: the environment variable that holds the element's
+                    index, starting at 1
+            :param: string batchSystem: name of the batch system, for formatStdOutErrPath()
+            :param: string batchJobIDfmt: shell expression for the element's batch system ID,
+                    for formatStdOutErrPath()
+            :param: list header: lines to put at the top of the script, such as directives
+                    for the batch system
+
+            :rtype: string
+            """
+            lines = ['#!/bin/sh']
+            lines.extend(header)
+            lines.append('case "${%s}" in' % indexVariable)
+            for index, (jobID, command, jobName) in enumerate(jobs, 1):
+                stdoutfile = self.boss.formatStdOutErrPath(jobID, batchSystem, batchJobIDfmt, 'std_output')
+                stderrfile = self.boss.formatStdOutErrPath(jobID, batchSystem, batchJobIDfmt, 'std_error')
+                lines.append('%i) exec %s >"%s" 2>"%s" ;;' % (index, command, stdoutfile, stderrfile))
+            lines.append('*) echo "No Toil job at array index ${%s}" >&2; exit 1 ;;' % indexVariable)
+            lines.append('esac')
+            return '\n'.join(lines) + '\n'
 
         def killJobs(self):
             """
@@ -159,16 +240,16 @@ class AbstractGridEngineBatchSystem(BatchSystemCleanupSupport):
                     # code is redundant w/ other implementations
                     self.killJob(jobID)
                 else:
-                    if jobID in self.waitingJobs:
-                        self.waitingJobs.remove(jobID)
+                    self.waitingJobs = [job for job in self.waitingJobs if job[0] != jobID]
                     self.killedJobsQueue.put(jobID)
                     killList.remove(jobID)
 
             # Wait to confirm the kill
             while killList:
+                statuses = self.boss.with_retries(self.getJobExitCodes,
+                                                  [self.getBatchSystemID(jobID) for jobID in killList])
                 for jobID in list(killList):
-                    batchJobID = self.getBatchSystemID(jobID)
-                    if self.boss.with_retries(self.getJobExitCode, batchJobID) is not None:
+                    if statuses.get(self.getBatchSystemID(jobID)) is not None:
                         logger.debug('Adding jobID %s to killedJobsQueue', jobID)
                         self.killedJobsQueue.put(jobID)
                         killList.remove(jobID)
@@ -189,9 +270,14 @@ class AbstractGridEngineBatchSystem(BatchSystemCleanupSupport):
                 return self._checkOnJobsCache
 
             activity = False
-            for jobID in list(self.runningJobs):
-                batchJobID = self.getBatchSystemID(jobID)
-                status = self.boss.with_retries(self.getJobExitCode, batchJobID)
+            runningJobs = list(self.runningJobs)
+            statuses = {}
+            if runningJobs:
+                # Ask about all the jobs at once, rather than one at a time
+                statuses = self.boss.with_retries(self.getJobExitCodes,
+                                                  [self.getBatchSystemID(jobID) for jobID in runningJobs])
+            for jobID in runningJobs:
+                status = statuses.get(self.getBatchSystemID(jobID))
                 if status is not None and isinstance(status, int):
                     activity = True
                     self.updatedJobsQueue.put(UpdatedBatchJobInfo(jobID=jobID, exitStatus=status, exitReason=None, wallTime=None))
@@ -208,8 +294,11 @@ class AbstractGridEngineBatchSystem(BatchSystemCleanupSupport):
             """return True if more jobs, False is all done"""
             activity = False
             newJob = None
-            if not self.newJobsQueue.empty():
+            # Take all the new jobs at once, so that they can be submitted together
+            while not self.newJobsQueue.empty():
                 activity = True
+                if newJob is not None:
+                    self.waitingJobs.append(newJob)
                 newJob = self.newJobsQueue.get()
                 if newJob is None:
                     logger.debug('Received queue sentinel.')
@@ -260,6 +349,37 @@ class AbstractGridEngineBatchSystem(BatchSystemCleanupSupport):
             """
             raise NotImplementedError()
 
+        def prepareArraySubmission(self, cpu, memory, jobs):
+            """
+            Put together the command line and script for submitting several
+            jobs that need the same resources as one array job (via
+            submitArrayJob()). Element i of the array job must run the i-th of
+            the given jobs, counting from 1.
+
+            By default array jobs are not supported, and this returns None.
+
+            :param: string cpu
+            :param: string memory
+            :param: list jobs: (jobID, command, jobName) tuples for the jobs to submit
+
+            :rtype: tuple: the command line, as a list, and the script to feed it on
+                    standard input; or None to submit the jobs one at a time
+            """
+            return None
+
+        def submitArrayJob(self, subLine, script):
+            """
+            Submit an array job put together by prepareArraySubmission(), and
+            get its batch system job ID.
+
+            :param: list subLine: the command line to be called
+            :param: string script: the script to feed it on standard input
+
+            :rtype: string: batch system job ID of the array job, which will be
+                    passed to getArrayElementID()
+            """
+            raise NotImplementedError()
+
         @abstractmethod
         def getRunningJobIDs(self):
             """
@@ -295,6 +415,22 @@ class AbstractGridEngineBatchSystem(BatchSystemCleanupSupport):
             """
             raise NotImplementedError()
 
+        def getJobExitCodes(self, batchJobIDs):
+            """
+            Get the exit codes of several jobs, as getJobExitCode() would.
+            Called by AbstractGridEngineWorker.checkOnJobs() for all the running
+            jobs at once, so implementations should ask the batch system about
+            them all together where they can.
+
+            By default this calls getJobExitCode() for each job in turn.
+
+            :param list batchJobIDs: batch system job IDs
+
+            :rtype: dict: map from batch system job ID to what getJobExitCode()
+                    would return for it
+            """
+            return {batchJobID: self.getJobExitCode(batchJobID) for batchJobID in batchJobIDs}
+
     def __init__(self, config, maxCores, maxMemory, maxDisk):
         super(AbstractGridEngineBatchSystem, self).__init__(
             config, maxCores, maxMemory, maxDisk)
@@ -318,6 +454,30 @@ class AbstractGridEngineBatchSystem(BatchSystemCleanupSupport):
         self._getRunningBatchJobIDsTimestamp = None
         self._getRunningBatchJobIDsCache = {}
 
+        # In pilot mode, jobs that fit are run by agents in a few big
+        # allocations, rather than each in its own
+        self.pilots = None
+        self.pilotIDs = set()
+        self.pilotLock = Lock()
+        if config.pilotJobs:
+            self.pilotCores = config.pilotCores or self.maxCPU
+            self.pilotMemory = config.pilotMemory or self.maxMEM
+            if isinstance(self.pilotMemory, MemoryString):
+                self.pilotMemory = self.pilotMemory.byteVal()
+            self.pilotMemory = int(self.pilotMemory)
+            if not self.pilotCores or not self.pilotMemory:
+                raise RuntimeError("%s can't tell how big a node is, so --pilotCores and --pilotMemory "
+                                   "must be set to use pilot jobs" % type(self).__name__)
+            # Pilots read the secret from a file that they can see and other
+            # users can't, because the command lines and environments of
+            # submitted jobs are shown to everyone by the scheduler. A file
+            # job store is shared with the nodes, and otherwise the work
+            # directory must be.
+            jobStoreType, jobStorePath = Toil.parseLocator(config.jobStore)
+            secretDir = jobStorePath if jobStoreType == 'file' else Toil.getToilWorkDir(config.workDir)
+            self.pilots = PilotServer(self.updatedJobsQueue, secretDir)
+            logger.debug("Pilot jobs will ask for work from %s", self.pilots.address)
+
     @classmethod
     def supportsWorkerCleanup(cls):
         return False
@@ -326,6 +486,18 @@ class AbstractGridEngineBatchSystem(BatchSystemCleanupSupport):
     def supportsAutoDeployment(cls):
         return False
 
+    # Seconds a pilot waits without work before giving back its allocation
+    pilotIdleTimeout = 60
+
+    @classmethod
+    def setOptions(cls, setOption):
+        from toil.common import iC, fC
+        from toil.lib.humanize import human2bytes
+        setOption("maxArrayJobSize", int, iC(1), 1000)
+        setOption("pilotJobs", int, iC(0), 0)
+        setOption("pilotCores", float, fC(0.0))
+        setOption("pilotMemory", lambda x: human2bytes(str(x)), iC(0))
+
     def issueBatchJob(self, jobDesc):
         # Avoid submitting internal jobs to the batch queue, handle locally
         localID = self.handleLocalJob(jobDesc)
@@ -335,11 +507,47 @@ class AbstractGridEngineBatchSystem(BatchSystemCleanupSupport):
             self.checkResourceRequest(jobDesc.memory, jobDesc.cores, jobDesc.disk)
             jobID = self.getNextJobID()
             self.currentJobs.add(jobID)
-            self.newJobsQueue.put((jobID, jobDesc.cores, jobDesc.memory, jobDesc.command, jobDesc.jobName))
+            if (self.pilots is not None and
+                    jobDesc.cores <= self.pilotCores and jobDesc.memory <= self.pilotMemory):
+                self.pilots.issueJob(jobID, jobDesc.cores, jobDesc.memory, jobDesc.command)
+                self._launchPilots()
+            else:
+                self.newJobsQueue.put((jobID, jobDesc.cores, jobDesc.memory, jobDesc.command, jobDesc.jobName))
             logger.debug("Issued the job command: %s with job id: %s and job name %s", jobDesc.command, str(jobID),
                          jobDesc.jobName)
         return jobID
 
+    def _launchPilots(self):
+        """
+        Submit enough pilots to run the jobs pilots are to run, up to --pilotJobs.
+        """
+        with self.pilotLock:
+            wanted = min(self.config.pilotJobs, int(math.ceil(self.pilots.demand() / self.pilotCores)))
+            while len(self.pilotIDs) < wanted:
+                pilotID = self.getNextJobID()
+                self.pilotIDs.add(pilotID)
+                command = ' '.join([resolveEntryPoint('_toil_pilot'),
+                                    '--leader', self.pilots.address,
+                                    '--secretFile', self.pilots.secretPath,
+                                    '--agentID', str(pilotID),
+                                    '--cores', str(self.pilotCores),
+                                    '--memory', str(self.pilotMemory),
+                                    '--idleTimeout', str(self.pilotIdleTimeout)])
+                logger.debug("Submitting pilot %s", pilotID)
+                self.newJobsQueue.put((pilotID, self.pilotCores, self.pilotMemory, command, 'toil_pilot'))
+
+    def _pilotEnded(self, pilotID, exitStatus):
+        with self.pilotLock:
+            self.pilotIDs.remove(pilotID)
+        if exitStatus == 0:
+            logger.debug("Pilot %s ended", pilotID)
+        else:
+            logger.warning("Pilot %s ended with exit status %s", pilotID, exitStatus)
+        self.pilots.agentEnded(pilotID)
+        if not self.pilots.shuttingDown:
+            # Replace it if there is still work for it
+            self._launchPilots()
+
     def killBatchJobs(self, jobIDs):
         """
         Kills the given jobs, represented as Job ids, then checks they are dead by checking
@@ -348,6 +556,10 @@ class AbstractGridEngineBatchSystem(BatchSystemCleanupSupport):
         self.killLocalJobs(jobIDs)
         jobIDs = set(jobIDs)
         logger.debug('Jobs to be killed: %r', jobIDs)
+        if self.pilots is not None:
+            killedByPilots = self.pilots.killJobs(jobIDs)
+            jobIDs -= killedByPilots
+            self.currentJobs -= killedByPilots
         for jobID in jobIDs:
             self.killQueue.put(jobID)
         while jobIDs:
@@ -383,7 +595,12 @@ class AbstractGridEngineBatchSystem(BatchSystemCleanupSupport):
             batchIds = self.with_retries(self.worker.getRunningJobIDs)
             self._getRunningBatchJobIDsCache = batchIds
             self._getRunningBatchJobIDsTimestamp = datetime.now()
+        batchIds = dict(batchIds)
         batchIds.update(self.getRunningLocalJobIDs())
+        if self.pilots is not None:
+            batchIds.update(self.pilots.getRunningJobIDs())
+            for pilotID in self.pilotIDs:
+                batchIds.pop(pilotID, None)
         return batchIds
 
     def getUpdatedBatchJob(self, maxWait):
@@ -391,19 +608,31 @@ class AbstractGridEngineBatchSystem(BatchSystemCleanupSupport):
         if local_tuple:
             return local_tuple
         else:
-            try:
-                item = self.updatedJobsQueue.get(timeout=maxWait)
-            except Empty:
-                return None
-            logger.debug('UpdatedJobsQueue Item: %s', item)
-            self.currentJobs.remove(item.jobID)
-            return item
+            deadline = time.time() + maxWait
+            while True:
+                try:
+                    item = self.updatedJobsQueue.get(timeout=max(deadline - time.time(), 0))
+                except Empty:
+                    return None
+                logger.debug('UpdatedJobsQueue Item: %s', item)
+                if item.jobID in self.pilotIDs:
+                    # Pilots are ours, not the leader's
+                    self._pilotEnded(item.jobID, item.exitStatus)
+                    continue
+                self.currentJobs.remove(item.jobID)
+                return item
 
     def shutdown(self):
         """
         Signals worker to shutdown (via sentinel) then cleanly joins the thread
         """
         self.shutdownLocal()
+        if self.pilots is not None:
+            # Tell the pilots that are running to stop, and take the rest off
+            # the queue
+            self.pilots.shutdown()
+            self.killBatchJobs(list(self.pilotIDs))
+            self.pilots.close()
         newJobsQueue = self.newJobsQueue
         self.newJobsQueue = None
 
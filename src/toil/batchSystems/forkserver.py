@@ -0,0 +1,349 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A forkserver that starts Toil workers for the single machine batch system.
+
+Starting a worker with a new Python interpreter means importing Toil and the
+user's workflow, and reading the workflow's config and environment from the
+job store, all over again for every job. The forkserver is a long-lived
+process that does all that once, and then forks a copy of itself for each job,
+so each job still runs in its own process with its own memory.
+
+The batch system talks to the forkserver over a pair of pipes, one JSON object
+per line. It asks for jobs to be started and killed, and the forkserver tells
+it the PID of each job it starts and the exit status of each job that stops.
+Only the forkserver can reap the jobs, so only it can kill them without
+risking a reused PID.
+"""
+import json
+import logging
+import os
+import selectors
+import signal
+import subprocess
+import sys
+import traceback
+from threading import Lock
+
+from toil.lib.threading import destroy_all_process_names
+
+log = logging.getLogger(__name__)
+
+
+class Forkserver(object):
+    """
+    Starts and talks to a forkserver process. Used by the single machine batch
+    system's daddy thread, except for kill(), which any thread may call.
+    """
+
+    def __init__(self):
+        requestReader, self.requestWriter = os.pipe()
+        self.replyReader, replyWriter = os.pipe()
+        self.process = subprocess.Popen([sys.executable, '-m', 'toil.batchSystems.forkserver',
+                                         str(requestReader), str(replyWriter)],
+                                        pass_fds=(requestReader, replyWriter))
+        os.close(requestReader)
+        os.close(replyWriter)
+        # Requests may come from the daddy thread and from killers
+        self.requestLock = Lock()
+        # Bytes read from the forkserver that don't make a whole line yet
+        self.buffer = b''
+        # Replies to start requests, in order
+        self.started = []
+        # Map from PID to exit status for jobs that have stopped but have not
+        # been waited on
+        self.exits = {}
+
+    def fileno(self):
+        """
+        :return: The file descriptor that becomes readable when the forkserver
+                 has something to say.
+        """
+        return self.replyReader
+
+    def _send(self, request):
+        data = (json.dumps(request) + '\n').encode('utf-8')
+        with self.requestLock:
+            while data:
+                data = data[os.write(self.requestWriter, data):]
+
+    def _read(self):
+        """
+        Read at least one more reply from the forkserver, blocking until there
+        is one.
+        """
+        while True:
+            data = os.read(self.replyReader, 65536)
+            if not data:
+                raise RuntimeError('The forkserver exited with status %s' % self.process.wait())
+            self.buffer += data
+            lines = self.buffer.split(b'\n')
+            self.buffer = lines.pop()
+            for line in lines:
+                reply = json.loads(line.decode('utf-8'))
+                if 'exitStatus' in reply:
+                    self.exits[reply['pid']] = reply['exitStatus']
+                else:
+                    self.started.append(reply)
+            if lines:
+                return
+
+    def readReplies(self):
+        """
+        Take in what the forkserver has said. Call only when fileno() is
+        readable.
+        """
+        self._read()
+
+    def startJob(self, args, environment):
+        """
+        Fork a worker.
+
+        :param list[str] args: The worker's command line, after the program name.
+        :param dict[str,str] environment: Environment variables to add for the worker.
+
+        :return: A stand-in for the Popen of the worker process.
+        :rtype: ForkedChild
+        """
+        self._send({'args': args, 'environment': environment})
+        while not self.started:
+            self._read()
+        reply = self.started.pop(0)
+        if 'error' in reply:
+            raise RuntimeError('The forkserver could not start a worker: %s' % reply['error'])
+        return ForkedChild(self, reply['pid'])
+
+    def kill(self, pid):
+        """
+        Kill a worker, if it hasn't already stopped.
+        """
+        self._send({'kill': pid})
+
+    def poll(self, pid):
+        """
+        :return: The exit status of the given worker, or None if it has not
+                 been seen to stop.
+        """
+        return self.exits.get(pid)
+
+    def wait(self, pid):
+        """
+        Wait for the given worker to stop, and forget about it.
+
+        :return: The worker's exit status, negated signal number if it was
+                 killed by one, as for a Popen.
+        """
+        while pid not in self.exits:
+            self._read()
+        return self.exits.pop(pid)
+
+    def shutdown(self):
+        """
+        Stop the forkserver, killing any workers it has running.
+        """
+        os.close(self.requestWriter)
+        self.process.wait()
+        os.close(self.replyReader)
+
+
+class ForkedChild(object):
+    """
+    Stands in for the Popen object of a worker started by a forkserver.
+    """
+
+    def __init__(self, forkserver, pid):
+        self.forkserver = forkserver
+        self.pid = pid
+
+    def kill(self):
+        self.forkserver.kill(self.pid)
+
+    def poll(self):
+        return self.forkserver.poll(self.pid)
+
+    def wait(self):
+        return self.forkserver.wait(self.pid)
+
+
+class _Server(object):
+    """
+    The forkserver process itself.
+    """
+
+    def __init__(self, requestFD, replyFD):
+        self.requestFD = requestFD
+        self.replyFD = replyFD
+        # PIDs of the workers we have forked and not reaped
+        self.children = set()
+        # Map from job store locator to the job store and leader environment
+        # that forked workers inherit, or to None if we can't share them
+        self.warmed = {}
+
+    def serve(self):
+        # Import everything a worker needs before we start forking. Leave
+        # importing the user's workflow until we know what it is.
+        from toil import worker  # noqa
+
+        os.set_blocking(self.requestFD, False)
+        # Be woken up when a worker exits
+        wakeupReader, wakeupWriter = os.pipe()
+        os.set_blocking(wakeupReader, False)
+        os.set_blocking(wakeupWriter, False)
+        signal.set_wakeup_fd(wakeupWriter)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.requestFD, selectors.EVENT_READ)
+        selector.register(wakeupReader, selectors.EVENT_READ)
+        buffer = b''
+        try:
+            while True:
+                for key, _ in selector.select():
+                    if key.fd == wakeupReader:
+                        try:
+                            while os.read(wakeupReader, 4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    else:
+                        try:
+                            data = os.read(self.requestFD, 65536)
+                        except BlockingIOError:
+                            continue
+                        if not data:
+                            # The batch system is shutting down.
+                            return
+                        buffer += data
+                        lines = buffer.split(b'\n')
+                        buffer = lines.pop()
+                        for line in lines:
+                            self._handle(json.loads(line.decode('utf-8')))
+                self._reap()
+        finally:
+            for pid in self.children:
+                os.kill(pid, signal.SIGKILL)
+            while self.children:
+                pid, _ = os.waitpid(-1, 0)
+                self.children.discard(pid)
+
+    def _reply(self, reply):
+        data = (json.dumps(reply) + '\n').encode('utf-8')
+        while data:
+            data = data[os.write(self.replyFD, data):]
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.children:
+                self.children.remove(pid)
+                # Report it the way Popen would
+                exitStatus = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                self._reply({'pid': pid, 'exitStatus': exitStatus})
+
+    def _handle(self, request):
+        if 'kill' in request:
+            # We haven't reaped it, so the PID can't have been reused.
+            if request['kill'] in self.children:
+                os.kill(request['kill'], signal.SIGKILL)
+            return
+        try:
+            self._warm(request['args'])
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+        except Exception as e:
+            self._reply({'error': str(e)})
+            return
+        if pid == 0:
+            # We are the worker. Never return from here.
+            exitCode = 1
+            try:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                os.close(self.requestFD)
+                os.close(self.replyFD)
+                os.environ.update(request['environment'])
+                exitCode = self._runWorker(request['args'])
+            except SystemExit as e:
+                exitCode = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                # We skip the exit handlers, but still need to do what they
+                # would do for a worker.
+                destroy_all_process_names()
+                os._exit(exitCode)
+        self.children.add(pid)
+        self._reply({'pid': pid})
+
+    def _warm(self, args):
+        """
+        The first time we see a job store, read what every worker for it will
+        need, and import the user's workflow, so the workers we fork don't
+        have to.
+        """
+        from toil import worker
+        from toil.common import Toil, safeUnpickleFromStream
+        from toil.job import Job
+        from toil.resource import ModuleDescriptor
+
+        options = worker.parse_args(['_toil_worker'] + args)
+        if options.jobStoreLocator in self.warmed:
+            return
+        self.warmed[options.jobStoreLocator] = None
+        if Toil.parseLocator(options.jobStoreLocator)[0] != 'file':
+            # Other job stores may hold connections or state that can't be
+            # shared between processes.
+            return
+        try:
+            jobStore = Toil.resumeJobStore(options.jobStoreLocator)
+            with jobStore.readSharedFileStream('environment.pickle') as fileHandle:
+                environment = safeUnpickleFromStream(fileHandle)
+            # Find the workflow the way the worker would
+            for path in environment.get('PYTHONPATH', '').split(':'):
+                if path != '':
+                    sys.path.append(path)
+            command = jobStore.load(options.jobStoreID).command
+            if command is not None and command.startswith('_toil '):
+                Job._loadUserModule(ModuleDescriptor.fromCommand(command.split()[2:]))
+        except Exception:
+            log.warning('Could not prepare to fork workers for %s; they will start from scratch',
+                        options.jobStoreLocator, exc_info=True)
+            return
+        self.warmed[options.jobStoreLocator] = (jobStore, environment)
+
+    def _runWorker(self, args):
+        from toil import worker
+        from toil.common import Toil
+
+        options = worker.parse_args(['_toil_worker'] + args)
+        warmed = self.warmed.get(options.jobStoreLocator)
+        if warmed is None:
+            jobStore, environment = Toil.resumeJobStore(options.jobStoreLocator), None
+        else:
+            jobStore, environment = warmed
+        with worker.in_contexts(options.context):
+            return worker.workerScript(jobStore, jobStore.config, options.jobName, options.jobStoreID,
+                                       environment=environment)
+
+
+if __name__ == '__main__':
+    _Server(int(sys.argv[1]), int(sys.argv[2])).serve()
@@ -21,9 +21,10 @@ from past.utils import old_div
 import logging
 import os
 from pipes import quote
-from toil.lib.misc import call_command, CalledProcessErrorStderr
+from toil.lib.misc import call_command
 import time
 import math
+import xml.etree.ElementTree as ET
 
 # Python 3 compatibility imports
 from six.moves.queue import Empty, Queue
@@ -43,16 +44,19 @@ class GridEngineBatchSystem(AbstractGridEngineBatchSystem):
         def getRunningJobIDs(self):
             times = {}
             with self.runningJobsLock:
-                currentjobs = dict((str(self.batchJobIDs[x][0]), x) for x in self.runningJobs)
+                currentjobs = dict((self.getBatchSystemID(x), x) for x in self.runningJobs)
             stdout = call_command(["qstat"])
 
             for currline in stdout.split('\n'):
                 items = currline.strip().split()
-                if items:
-                    if items[0] in currentjobs and items[4] == 'r':
+                if items and len(items) > 4 and items[4] == 'r':
+                    # Running array job elements have their task ID after the
+                    # queue and slot count
+                    sgeJobID = items[0] if len(items) < 10 else items[0] + '.' + items[9]
+                    if sgeJobID in currentjobs:
                         jobstart = " ".join(items[5:7])
                         jobstart = time.mktime(time.strptime(jobstart, "%m/%d/%Y %H:%M:%S"))
-                        times[currentjobs[items[0]]] = time.time() - jobstart
+                        times[currentjobs[sgeJobID]] = time.time() - jobstart
 
             return times
 
@@ -68,27 +72,72 @@ class GridEngineBatchSystem(AbstractGridEngineBatchSystem):
             result = int(output)
             return result
 
+        def prepareArraySubmission(self, cpu, memory, jobs):
+            qsubline = self.prepareQsub(cpu, memory, 'array_{}'.format(jobs[0][0]), arraySize=len(jobs))
+            script = self.arrayJobScript(jobs, 'SGE_TASK_ID', 'gridengine', '${JOB_ID}.${SGE_TASK_ID}')
+            return qsubline, script
+
+        def submitArrayJob(self, subLine, script):
+            # qsub reads the script from standard input, and prints the ID of
+            # an array job like '2954103.1-10:1'
+            stdout = call_command(subLine, input=script)
+            output = stdout.split('\n')[0].strip()
+            return int(output.split('.')[0])
+
         def getJobExitCode(self, sgeJobID):
+            return self.getJobExitCodes([sgeJobID])[sgeJobID]
+
+        def getJobExitCodes(self, sgeJobIDs):
             """
-            Get job exist code, checking both qstat and qacct.  Return None if
-            still running.  Higher level should retry on
+            Get job exit codes, checking both qstat and qacct.  Return None for
+            jobs still running.  Higher level should retry on
             CalledProcessErrorStderr, for the case the job has finished and
             qacct result is stale.
             """
+            # First try qstat, once for all the jobs, to see which are still
+            # running, and only get the status of the others from qacct.  Also,
+            # qstat is much faster.
+            queued = self._getQueuedJobIDs()
+            exitCodes = {}
+            for sgeJobID in sgeJobIDs:
+                if str(sgeJobID) in queued:
+                    exitCodes[sgeJobID] = None
+                else:
+                    exitCodes[sgeJobID] = self._getJobExitCodeFromQacct(str(sgeJobID))
+            return exitCodes
+
+        """
+        Implementation-specific helper methods
+        """
+        def _getQueuedJobIDs(self):
+            """
+            Get the IDs of the jobs, and of the array job tasks, that are
+            waiting or running, in the form getBatchSystemID() gives them.
+
+            :rtype: set
+            """
+            queued = set()
+            root = ET.fromstring(call_command(["qstat", "-xml"]))
+            for jobList in root.iter('job_list'):
+                job = jobList.findtext('JB_job_number')
+                tasks = jobList.findtext('tasks')
+                if tasks is None:
+                    queued.add(job)
+                    continue
+                # Waiting tasks are listed as ranges like '2-10:1' or lists
+                # like '3,5,7'
+                for taskRange in tasks.split(','):
+                    bounds, _, step = taskRange.partition(':')
+                    first, _, last = bounds.partition('-')
+                    for task in range(int(first), int(last or first) + 1, int(step or 1)):
+                        queued.add(job + '.' + str(task))
+            return queued
+
+        def _getJobExitCodeFromQacct(self, sgeJobID):
             # the task is set as part of the job ID if using getBatchSystemID()
             job, task = (sgeJobID, None)
             if '.' in sgeJobID:
                 job, task = sgeJobID.split('.', 1)
-            assert task is None, "task ids not currently support by qstat logic below"
-
-            # First try qstat to see if job is still running, if not get the
-            # status qacct.  Also, qstat is much faster.
-            try:
-                call_command(["qstat", "-j", str(job)])
-                return None
-            except CalledProcessErrorStderr as ex:
-                if "Following jobs do not exist" not in ex.stderr:
-                    raise
 
             args = ["qacct", "-j", str(job)]
             if task is not None:
@@ -102,12 +151,14 @@ class GridEngineBatchSystem(AbstractGridEngineBatchSystem):
                     return int(line.split()[1])
             return None
 
-        """
-        Implementation-specific helper methods
-        """
-        def prepareQsub(self, cpu, mem, jobID):
-            qsubline = ['qsub', '-V', '-b', 'y', '-terse', '-j', 'y', '-cwd',
-                        '-N', 'toil_job_' + str(jobID)]
+        def prepareQsub(self, cpu, mem, jobID, arraySize=None):
+            if arraySize is None:
+                qsubline = ['qsub', '-V', '-b', 'y', '-terse', '-j', 'y', '-cwd',
+                            '-N', 'toil_job_' + str(jobID)]
+            else:
+                # The script comes on standard input, rather than a command
+                qsubline = ['qsub', '-V', '-b', 'n', '-S', '/bin/sh', '-terse', '-j', 'y', '-cwd',
+                            '-N', 'toil_job_' + str(jobID), '-t', '1-{}'.format(arraySize)]
 
             if self.boss.environment:
                 qsubline.append('-v')
@@ -141,8 +192,9 @@ class GridEngineBatchSystem(AbstractGridEngineBatchSystem):
                 raise RuntimeError("must specify PE in TOIL_GRIDENGINE_PE environment variable when using multiple CPUs. "
                                    "Run qconf -spl and your local documentation for possible values")
 
-            stdoutfile = self.boss.formatStdOutErrPath(jobID, 'gridengine', '$JOB_ID', 'std_output')
-            stderrfile = self.boss.formatStdOutErrPath(jobID, 'gridengine', '$JOB_ID', 'std_error')
+            batchJobIDfmt = '$JOB_ID' if arraySize is None else '$JOB_ID.$TASK_ID'
+            stdoutfile = self.boss.formatStdOutErrPath(jobID, 'gridengine', batchJobIDfmt, 'std_output')
+            stderrfile = self.boss.formatStdOutErrPath(jobID, 'gridengine', batchJobIDfmt, 'std_error')
             qsubline.extend(['-o', stdoutfile, '-e', stderrfile])
 
             return qsubline
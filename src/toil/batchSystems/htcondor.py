@@ -164,8 +164,38 @@ class HTCondorBatchSystem(AbstractGridEngineBatchSystem):
             schedd.edit(job_spec, 'ToilJobKilled', 'True')
 
         def getJobExitCode(self, batchJobID):
-            logger.debug("Getting exit code for HTCondor job {0}".format(batchJobID))
+            return self.getJobExitCodes([batchJobID])[batchJobID]
 
+        def getJobExitCodes(self, batchJobIDs):
+            logger.debug("Getting exit codes for HTCondor jobs {0}".format(batchJobIDs))
+
+            # Get the ClassAds of all the Toil jobs at once, and only look at
+            # the ones that are ours
+            requirements = '(IsToilJob)'
+            projection = ['ClusterId', 'JobStatus', 'ToilJobKilled', 'ExitCode',
+                              'HoldReason', 'HoldReasonSubCode']
+
+            schedd = self.connectSchedd()
+            ads = {}
+            for ad in schedd.xquery(requirements = requirements,  projection = projection):
+                batchJobID = int(ad['ClusterId'])
+                if batchJobID in ads:
+                    logger.warning(
+                        "Multiple HTCondor ads returned using constraint: (ClusterId == {0})".format(batchJobID))
+                    continue
+                ads[batchJobID] = ad
+
+            exitCodes = {}
+            for batchJobID in batchJobIDs:
+                # Make sure a ClassAd was returned
+                if int(batchJobID) not in ads:
+                    logger.error(
+                        "No HTCondor ads returned using constraint: (ClusterId == {0})".format(batchJobID))
+                    raise RuntimeError("HTCondor has no record of job {0}".format(batchJobID))
+                exitCodes[batchJobID] = self.getJobExitCodeFromAd(schedd, batchJobID, ads[int(batchJobID)])
+            return exitCodes
+
+        def getJobExitCodeFromAd(self, schedd, batchJobID, ad):
             status = {
                 1: 'Idle',
                 2: 'Running',
@@ -176,36 +206,6 @@ class HTCondorBatchSystem(AbstractGridEngineBatchSystem):
                 7: 'Suspended'
             }
 
-            requirements = '(ClusterId == {0})'.format(batchJobID)
-            projection = ['JobStatus', 'ToilJobKilled', 'ExitCode',
-                              'HoldReason', 'HoldReasonSubCode']
-
-            schedd = self.connectSchedd()
-            ads = schedd.xquery(requirements = requirements,  projection = projection)
-
-            # Make sure a ClassAd was returned
-            try:
-                try:
-                    ad = next(ads)
-                except TypeError:
-                    ad = ads.next()
-            except StopIteration:
-                logger.error(
-                    "No HTCondor ads returned using constraint: {0}".format(requirements))
-                raise
-
-            # Make sure only one ClassAd was returned
-            try:
-                try:
-                    next(ads)
-                except TypeError:
-                    ads.next()
-            except StopIteration:
-                pass
-            else:
-                logger.warning(
-                    "Multiple HTCondor ads returned using constraint: {0}".format(requirements))
-
             if ad['ToilJobKilled']:
                 logger.debug("HTCondor job {0} was killed by Toil".format(batchJobID))
 
@@ -36,6 +36,8 @@ import tempfile
 import time
 import uuid
 import urllib3
+from queue import Empty, Queue
+from threading import Condition, Thread
 
 from kubernetes.client.rest import ApiException
 
@@ -48,6 +50,7 @@ from toil.common import Toil
 from toil.lib.bioio import configureRootLogger
 from toil.lib.bioio import setLogLevel
 from toil.lib.humanize import human2bytes
+from toil.lib.throttle import GlobalThrottle
 from toil.resource import Resource
 
 from toil.lib.retry import retry, ErrorCondition
@@ -91,7 +94,149 @@ def utc_now():
     return datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
 
 
+class KubernetesInformer(object):
+    """
+    Keeps a cache of the Kubernetes objects of one kind that belong to a
+    workflow, indexed by Toil job ID, by watching for changes to them instead
+    of listing them over and over.
+
+    The objects are listed once, and then watched from the resourceVersion of
+    the listing. Each time a watch ends, it is resumed from the last
+    resourceVersion seen. If that has become too old for the API server to
+    resume from (410 Gone), the objects are listed again.
+    """
+
+    def __init__(self, listMethodFn, namespace, labelSelector, keyFn, onChange, lock, watchTimeout=60):
+        """
+        :param listMethodFn: Function returning the API method to list and
+               watch the objects with, like list_namespaced_job. Called before
+               every request, so the method can come with fresh credentials.
+        :param str namespace: The namespace the objects are in.
+        :param str labelSelector: Selects the objects to watch.
+        :param keyFn: Function from an object to the Toil job ID to file it
+               under, or None to ignore it.
+        :param onChange: Function called with the Toil job ID and the event
+               type ('ADDED', 'MODIFIED' or 'DELETED') whenever an object
+               changes, with the lock held.
+        :param threading.Condition lock: Guards the cache, and is notified
+               whenever it changes.
+        :param int watchTimeout: Seconds to keep each watch open for.
+        """
+        self.listMethodFn = listMethodFn
+        self.namespace = namespace
+        self.labelSelector = labelSelector
+        self.keyFn = keyFn
+        self.onChange = onChange
+        self.lock = lock
+        self.watchTimeout = watchTimeout
+        # Map from Toil job ID to the latest version of its object
+        self.objects = {}
+        # The resourceVersion to resume watching from, or None if we need to
+        # list the objects again.
+        self.resourceVersion = None
+        self.stopped = False
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop watching. The watch thread ends when its current watch does.
+        """
+        self.stopped = True
+
+    def _run(self):
+        while not self.stopped:
+            try:
+                if self.resourceVersion is None:
+                    self._list()
+                self._watch()
+            except ApiException as e:
+                if e.status == 410:
+                    # Our resourceVersion or continue token is too old
+                    logger.debug('Kubernetes watch expired; listing again')
+                    self.resourceVersion = None
+                else:
+                    logger.warning('Kubernetes watch failed; retrying: %s', e)
+                    time.sleep(1)
+            except Exception as e:
+                if not is_retryable_kubernetes_error(e):
+                    logger.exception('Unexpected error watching Kubernetes; retrying')
+                else:
+                    logger.warning('Kubernetes watch failed; retrying: %s', e)
+                time.sleep(1)
+
+    def _update(self, key, eventType, obj):
+        if eventType == 'DELETED':
+            self.objects.pop(key, None)
+        else:
+            self.objects[key] = obj
+        self.onChange(key, eventType)
+
+    def _list(self):
+        """
+        List all the objects, and replace the cache with them.
+        """
+        listed = {}
+        token = None
+        while True:
+            # We can't just pass e.g. a None continue token when there isn't
+            # one, because the Kubernetes module reads its kwargs dict and
+            # cares about presence/absence. So we build a dict to send.
+            kwargs = {'label_selector': self.labelSelector}
+            if token is not None:
+                kwargs['_continue'] = token
+            results = self.listMethodFn()(self.namespace, **kwargs)
+            for obj in results.items:
+                key = self.keyFn(obj)
+                if key is not None:
+                    listed[key] = obj
+            token = getattr(results.metadata, '_continue', None)
+            if token is None:
+                break
+        with self.lock:
+            for key in list(self.objects):
+                if key not in listed:
+                    self._update(key, 'DELETED', None)
+            for key, obj in listed.items():
+                self._update(key, 'ADDED' if key not in self.objects else 'MODIFIED', obj)
+            # All the pages come from the same snapshot
+            self.resourceVersion = results.metadata.resource_version
+            self.lock.notify_all()
+
+    def _watch(self):
+        """
+        Apply changes to the objects to the cache, until the watch times out.
+        """
+        watch = kubernetes.watch.Watch()
+        for event in watch.stream(self.listMethodFn(), self.namespace,
+                                  label_selector=self.labelSelector,
+                                  resource_version=self.resourceVersion,
+                                  timeout_seconds=self.watchTimeout):
+            if event['type'] == 'ERROR':
+                status = event['raw_object']
+                if status.get('code') == 410:
+                    logger.debug('Kubernetes watch expired; listing again')
+                    self.resourceVersion = None
+                    return
+                raise RuntimeError('Error from Kubernetes watch: %s' % status.get('message'))
+            obj = event['object']
+            key = self.keyFn(obj)
+            with self.lock:
+                self.resourceVersion = obj.metadata.resource_version
+                if key is not None:
+                    self._update(key, event['type'], obj)
+                    self.lock.notify_all()
+            if self.stopped:
+                watch.stop()
+
+
 class KubernetesBatchSystem(BatchSystemCleanupSupport):
+
+    # Seconds between checks for pods stuck out of memory
+    stuckCheckInterval = 30
+
     @classmethod
     def supportsAutoDeployment(cls):
         return True
@@ -162,13 +307,52 @@ class KubernetesBatchSystem(BatchSystemCleanupSupport):
         # TODO: have some way to specify this (env var?)!
         self.awsSecretName = os.environ.get("TOIL_AWS_SECRET_NAME", None)
 
-        # Set this to True to enable the experimental wait-for-job-update code
-        # TODO: Make this an environment variable?
-        self.enableWatching = os.environ.get("KUBE_WATCH_ENABLED", False)
-
         self.runID = 'toil-{}'.format(self.uniqueID)
 
-        self.jobIds = set()
+        # We keep track of our jobs and their pods by watching them. The
+        # watches fill in these caches, and queue up the jobs that finish.
+        # This lock guards everything below.
+        self.watchLock = Condition()
+        # IDs of the jobs we have sent to Kubernetes and not yet reported on
+        # or killed
+        self.issuedJobs = set()
+        # IDs of the issued jobs we have queued up to report on
+        self.reportedJobs = set()
+        # (jobID, reason) for each job to report on, where reason is 'done',
+        # 'failed', 'stuck', 'vanished' or 'unsubmitted'
+        self.finishedJobs = Queue()
+        # When we last looked for pods stuck out of memory
+        self.lastStuckCheck = time.time()
+        labelSelector = 'toil_run={}'.format(self.runID)
+        self.jobInformer = KubernetesInformer(lambda: self._api('batch').list_namespaced_job,
+                                              self.namespace, labelSelector,
+                                              lambda job: self._getIDForJobName(job.metadata.name),
+                                              self._jobChanged, self.watchLock)
+        self.podInformer = KubernetesInformer(lambda: self._api('core').list_namespaced_pod,
+                                              self.namespace, labelSelector,
+                                              lambda pod: self._getIDForJobName((pod.metadata.labels or {}).get('job-name')),
+                                              self._podChanged, self.watchLock)
+        self.jobInformer.start()
+        self.podInformer.start()
+
+        # Volumes and mounts are the same for every job, so make them once
+        self.volumes, self.volumeMounts = self._makeVolumes()
+        # Map from (cores, memory, disk) to the resource requirements for
+        # jobs of that shape
+        self.resourceCache = {}
+
+        # Kubernetes jobs are made and created by a pool of threads, so the
+        # leader doesn't wait on the API to issue jobs. This queue holds
+        # (jobID, job, cores, memory, disk) for each job to submit.
+        self.submitQueue = Queue()
+        # Limits how fast all the threads together create jobs, allowing
+        # bursts of up to a second's worth.
+        self.submitThrottle = GlobalThrottle(min_interval=1.0 / config.kubernetesSubmitRate,
+                                             max_unused=max(int(config.kubernetesSubmitRate), 1))
+        self.submitThreads = [Thread(target=self._submitJobs, daemon=True)
+                              for _ in range(config.kubernetesSubmitThreads)]
+        for thread in self.submitThreads:
+            thread.start()
     
    
     def _api(self, kind, max_age_seconds = 5 * 60):
@@ -271,53 +455,6 @@ class KubernetesBatchSystem(BatchSystemCleanupSupport):
         """
         return method(*args, **kwargs)
                 
-    def _try_kubernetes_stream(self, method, *args, **kwargs):
-        """
-        Kubernetes kubernetes.watch.Watch().stream() streams can fail and raise
-        errors. We don't want to have those errors fail the entire workflow, so
-        we handle them here.
-        
-        When you want to stream the results of a Kubernetes API method, call
-        this instead of stream().
-        
-        To avoid having to do our own timeout logic, we finish the watch early
-        if it produces an error.
-        """
-    
-        w = kubernetes.watch.Watch()
-        
-        # We will set this to bypass our second catch in the case of user errors.
-        userError = False
-    
-        try: 
-            for item in w.stream(method, *args, **kwargs):
-                # For everything the watch stream gives us
-                try:
-                    # Show the item to user code
-                    yield item
-                except Exception as e:
-                    # If we get an error from user code, skip our catch around
-                    # the Kubernetes generator.
-                    userError = True
-                    raise
-        except Exception as e:
-            # If we get an error
-            if userError:
-                # It wasn't from the Kubernetes watch generator. Pass it along.
-                raise
-            else:
-                # It was from the Kubernetes watch generator we manage.
-                if is_retryable_kubernetes_error(e):
-                    # This is just cloud weather.
-                    # TODO: We will also get an APIError if we just can't code good against Kubernetes. So make sure to warn.
-                    logger.warning("Received error from Kubernetes watch stream: %s", e)
-                    # Just end the watch.
-                    return
-                else:
-                    # Something actually weird is happening.
-                    raise
-            
-
     def setUserScript(self, userScript):
         logger.info('Setting user script for deployment: {}'.format(userScript))
         self.userScript = userScript
@@ -341,8 +478,6 @@ class KubernetesBatchSystem(BatchSystemCleanupSupport):
             
             # Make a batch system scope job ID
             jobID = self.getNextJobID()
-            # Make a unique name
-            jobName = self.jobPrefix + str(jobID)
 
             # Make a job dict to send to the executor.
             # First just wrap the command and the environment to run it in
@@ -354,19 +489,73 @@ class KubernetesBatchSystem(BatchSystemCleanupSupport):
                 # If there's a user script resource be sure to send it along
                 job['userScript'] = self.userScript
 
-            # Encode it in a form we can send in a command-line argument.
-            # Pickle in the highest protocol to prevent mixed Python2/3 workflows from trying to work
-            # TODO: Make the appliance use/support Python 3
-            # Make sure it is text so we can ship it to Kubernetes via JSON.
-            encodedJob = base64.b64encode(pickle.dumps(job, pickle.HIGHEST_PROTOCOL)).decode('utf-8')
+            with self.watchLock:
+                self.issuedJobs.add(jobID)
+
+            # Leave making the Kubernetes job, and waiting on the API to
+            # create it, to the submission threads.
+            self.submitQueue.put((jobID, job, jobDesc.cores, jobDesc.memory, jobDesc.disk))
+            logger.debug('Queued job %s for submission', jobID)
+            
+            return jobID
+
+    def _makeVolumes(self):
+        """
+        Make the volumes every job's pod gets, and the mounts for them in the
+        pod's container.
+
+        :return: The volumes and the mounts.
+        :rtype: tuple[list[kubernetes.client.V1Volume],list[kubernetes.client.V1VolumeMount]]
+        """
 
-            # The Kubernetes API makes sense only in terms of the YAML format. Objects
-            # represent sections of the YAML files. Except from our point of view, all
-            # the internal nodes in the YAML structure are named and typed.
+        # Collect volumes and mounts
+        volumes = []
+        mounts = []
+        
+        if self.host_path is not None:
+            # Provision Toil WorkDir from a HostPath volume, to share with other pods
+            host_path_volume_name = 'workdir'
+            # Use type='Directory' to fail if the host directory doesn't exist already.
+            host_path_volume_source = kubernetes.client.V1HostPathVolumeSource(path=self.host_path, type='Directory')
+            host_path_volume = kubernetes.client.V1Volume(name=host_path_volume_name,
+                                                         host_path=host_path_volume_source)
+            volumes.append(host_path_volume)
+            host_path_volume_mount = kubernetes.client.V1VolumeMount(mount_path=self.workerWorkDir, name=host_path_volume_name)
+            mounts.append(host_path_volume_mount)
+        else:
+            # Provision Toil WorkDir as an ephemeral volume
+            ephemeral_volume_name = 'workdir'
+            ephemeral_volume_source = kubernetes.client.V1EmptyDirVolumeSource()
+            ephemeral_volume = kubernetes.client.V1Volume(name=ephemeral_volume_name,
+                                                          empty_dir=ephemeral_volume_source)
+            volumes.append(ephemeral_volume)
+            ephemeral_volume_mount = kubernetes.client.V1VolumeMount(mount_path=self.workerWorkDir, name=ephemeral_volume_name)
+            mounts.append(ephemeral_volume_mount)
+
+        if self.awsSecretName is not None:
+            # Also mount an AWS secret, if provided.
+            # TODO: make this generic somehow
+            secret_volume_name = 's3-credentials'
+            secret_volume_source = kubernetes.client.V1SecretVolumeSource(secret_name=self.awsSecretName)
+            secret_volume = kubernetes.client.V1Volume(name=secret_volume_name,
+                                                       secret=secret_volume_source)
+            volumes.append(secret_volume)
+            secret_volume_mount = kubernetes.client.V1VolumeMount(mount_path='/root/.aws', name=secret_volume_name)
+            mounts.append(secret_volume_mount)
+
+        return volumes, mounts
+
+    def _getResources(self, cores, memory, disk):
+        """
+        Get the resource requirements for a job's container, made once for
+        each shape of job and shared between jobs, since nothing changes them.
 
-            # For docs, start at the root of the job hierarchy:
-            # https://github.com/kubernetes-client/python/blob/master/kubernetes/docs/V1Job.md
+        :rtype: kubernetes.client.V1ResourceRequirements
+        """
 
+        shape = (cores, memory, disk)
+        resources = self.resourceCache.get(shape)
+        if resources is None:
             # Make a definition for the container's resource requirements.
             # Add on a bit for Kubernetes overhead (Toil worker's memory, hot deployed
             # user scripts).
@@ -374,133 +563,110 @@ class KubernetesBatchSystem(BatchSystemCleanupSupport):
             # OOMing. We also want to provision some extra space so that when
             # we test _isPodStuckOOM we never get True unless the job has
             # exceeded jobDesc.memory.
-            requirements_dict = {'cpu': jobDesc.cores,
-                                 'memory': jobDesc.memory + 1024 * 1024 * 512,
-                                 'ephemeral-storage': jobDesc.disk + 1024 * 1024 * 512}
+            requirements_dict = {'cpu': cores,
+                                 'memory': memory + 1024 * 1024 * 512,
+                                 'ephemeral-storage': disk + 1024 * 1024 * 512}
             # Use the requirements as the limits, for predictable behavior, and because
             # the UCSC Kubernetes admins want it that way.
             limits_dict = requirements_dict
             resources = kubernetes.client.V1ResourceRequirements(limits=limits_dict,
                                                                  requests=requirements_dict)
-            
-            # Collect volumes and mounts
-            volumes = []
-            mounts = []
-            
-            if self.host_path is not None:
-                # Provision Toil WorkDir from a HostPath volume, to share with other pods
-                host_path_volume_name = 'workdir'
-                # Use type='Directory' to fail if the host directory doesn't exist already.
-                host_path_volume_source = kubernetes.client.V1HostPathVolumeSource(path=self.host_path, type='Directory')
-                host_path_volume = kubernetes.client.V1Volume(name=host_path_volume_name,
-                                                             host_path=host_path_volume_source)
-                volumes.append(host_path_volume)
-                host_path_volume_mount = kubernetes.client.V1VolumeMount(mount_path=self.workerWorkDir, name=host_path_volume_name)
-                mounts.append(host_path_volume_mount)
-            else:
-                # Provision Toil WorkDir as an ephemeral volume
-                ephemeral_volume_name = 'workdir'
-                ephemeral_volume_source = kubernetes.client.V1EmptyDirVolumeSource()
-                ephemeral_volume = kubernetes.client.V1Volume(name=ephemeral_volume_name,
-                                                              empty_dir=ephemeral_volume_source)
-                volumes.append(ephemeral_volume)
-                ephemeral_volume_mount = kubernetes.client.V1VolumeMount(mount_path=self.workerWorkDir, name=ephemeral_volume_name)
-                mounts.append(ephemeral_volume_mount)
-
-            if self.awsSecretName is not None:
-                # Also mount an AWS secret, if provided.
-                # TODO: make this generic somehow
-                secret_volume_name = 's3-credentials'
-                secret_volume_source = kubernetes.client.V1SecretVolumeSource(secret_name=self.awsSecretName)
-                secret_volume = kubernetes.client.V1Volume(name=secret_volume_name,
-                                                           secret=secret_volume_source)
-                volumes.append(secret_volume)
-                secret_volume_mount = kubernetes.client.V1VolumeMount(mount_path='/root/.aws', name=secret_volume_name)
-                mounts.append(secret_volume_mount)
-
-            # Make a container definition
-            container = kubernetes.client.V1Container(command=['_toil_kubernetes_executor', encodedJob],
-                                                      image=self.dockerImage,
-                                                      name="runner-container",
-                                                      resources=resources,
-                                                      volume_mounts=mounts)
-            # Wrap the container in a spec
-            pod_spec = kubernetes.client.V1PodSpec(containers=[container],
-                                                   volumes=volumes,
-                                                   restart_policy="Never")
-            # Make metadata to label the job/pod with info.
-            metadata = kubernetes.client.V1ObjectMeta(name=jobName,
-                                                    labels={"toil_run": self.runID})
-            
-            # Wrap the spec in a template
-            template = kubernetes.client.V1PodTemplateSpec(spec=pod_spec, metadata=metadata)
-            
-            # Make another spec for the job, asking to run the template with no backoff
-            job_spec = kubernetes.client.V1JobSpec(template=template, backoff_limit=0)
-            
-            # And make the actual job
-            job = kubernetes.client.V1Job(spec=job_spec,
-                                          metadata=metadata,
-                                          api_version="batch/v1",
-                                          kind="Job")
-            
-            # Make the job
-            launched = self._try_kubernetes(self._api('batch').create_namespaced_job, self.namespace, job)
+            self.resourceCache[shape] = resources
+        return resources
 
-            logger.debug('Launched job: %s', jobName)
-            
-            return jobID
-    
-    def _ourJobObject(self, onlySucceeded=False):
+    def _makeJob(self, jobID, job, cores, memory, disk):
         """
-        Yield Kubernetes V1Job objects that we are responsible for that the
-        cluster knows about.
+        Make the Kubernetes job to run a Toil job.
 
-        Doesn't support a free-form selector, because there's only about 3
-        things jobs can be selected on: https://stackoverflow.com/a/55808444
-        
-        :param bool onlySucceeded: restrict results to succeeded jobs.
-        :param int limit: max results to yield.
+        :param int jobID: The batch system's ID for the job.
+        :param dict job: The command, environment and user script to send to
+               the executor.
+
+        :rtype: kubernetes.client.V1Job
         """
+
+        # Encode the job in a form we can send in a command-line argument.
+        # Pickle in the highest protocol to prevent mixed Python2/3 workflows from trying to work
+        # TODO: Make the appliance use/support Python 3
+        # Make sure it is text so we can ship it to Kubernetes via JSON.
+        encodedJob = base64.b64encode(pickle.dumps(job, pickle.HIGHEST_PROTOCOL)).decode('utf-8')
+
+        # The Kubernetes API makes sense only in terms of the YAML format. Objects
+        # represent sections of the YAML files. Except from our point of view, all
+        # the internal nodes in the YAML structure are named and typed.
+
+        # For docs, start at the root of the job hierarchy:
+        # https://github.com/kubernetes-client/python/blob/master/kubernetes/docs/V1Job.md
+
+        # Make a container definition
+        container = kubernetes.client.V1Container(command=['_toil_kubernetes_executor', encodedJob],
+                                                  image=self.dockerImage,
+                                                  name="runner-container",
+                                                  resources=self._getResources(cores, memory, disk),
+                                                  volume_mounts=self.volumeMounts)
+        # Wrap the container in a spec
+        pod_spec = kubernetes.client.V1PodSpec(containers=[container],
+                                               volumes=self.volumes,
+                                               restart_policy="Never")
+        # Make metadata to label the job/pod with info.
+        metadata = kubernetes.client.V1ObjectMeta(name=self.jobPrefix + str(jobID),
+                                                labels={"toil_run": self.runID})
+        
+        # Wrap the spec in a template
+        template = kubernetes.client.V1PodTemplateSpec(spec=pod_spec, metadata=metadata)
         
-        # We need to page through the list from the cluster with a continuation
-        # token. These expire after about 5 minutes. If we use an expired one,
-        # we get a 410 error and a new token, and we can use the new token to
-        # get the rest of the list, but the list will be updated.
-        #
-        # TODO: How to get the new token isn't clear. See
-        # https://github.com/kubernetes-client/python/issues/953. For now we
-        # will just throw an error if we don't get to the end of the list in
-        # time.
+        # Make another spec for the job, asking to run the template with no backoff
+        job_spec = kubernetes.client.V1JobSpec(template=template, backoff_limit=0)
+        
+        # And make the actual job
+        return kubernetes.client.V1Job(spec=job_spec,
+                                       metadata=metadata,
+                                       api_version="batch/v1",
+                                       kind="Job")
 
-        token = None
+    def _submitJobs(self):
+        """
+        Run by each submission thread. Makes and creates the Kubernetes jobs
+        for queued Toil jobs, as fast as the rate limit allows, until it gets
+        a None.
+        """
 
         while True:
-            # We can't just pass e.g. a None continue token when there isn't
-            # one, because the Kubernetes module reads its kwargs dict and
-            # cares about presence/absence. So we build a dict to send.
-            kwargs = {}
-            
-            if token is not None:
-                kwargs['_continue'] = token
-
-            if onlySucceeded: 
-                results =  self._try_kubernetes(self._api('batch').list_namespaced_job, self.namespace, 
-                                                label_selector="toil_run={}".format(self.runID), field_selector="status.successful==1", **kwargs)
-            else:
-                results = self._try_kubernetes(self._api('batch').list_namespaced_job, self.namespace, 
-                                                label_selector="toil_run={}".format(self.runID), **kwargs)
-            for job in results.items:
-                # This job belongs to us
-                yield job
+            item = self.submitQueue.get()
+            if item is None:
+                return
+            jobID, job, cores, memory, disk = item
+            jobName = self.jobPrefix + str(jobID)
+            with self.watchLock:
+                if jobID not in self.issuedJobs:
+                    # It was killed before we got to it
+                    continue
+            self.submitThrottle.throttle()
+            try:
+                self._try_kubernetes(self._api('batch').create_namespaced_job, self.namespace,
+                                     self._makeJob(jobID, job, cores, memory, disk))
+            except Exception:
+                logger.exception('Could not create Kubernetes job %s', jobName)
+                with self.watchLock:
+                    if jobID in self.issuedJobs and jobID not in self.reportedJobs:
+                        self.reportedJobs.add(jobID)
+                        self.finishedJobs.put((jobID, 'unsubmitted'))
+                continue
+            logger.debug('Launched job: %s', jobName)
 
-            # Remember the continuation token, if any
-            token = getattr(results.metadata, 'continue', None)
+            with self.watchLock:
+                killed = jobID not in self.issuedJobs
+            if killed:
+                # It was killed while we were creating it, so killBatchJobs
+                # couldn't find it to delete.
+                try:
+                    self._try_kubernetes_expecting_gone(self._api('batch').delete_namespaced_job, jobName,
+                                                        self.namespace,
+                                                        propagation_policy='Foreground')
+                except ApiException as e:
+                    if e.status != 404:
+                        raise
 
-            if token is None:
-                # There isn't one. We got everything.
-                break
-       
     
     def _ourPodObject(self):
         """
@@ -531,48 +697,6 @@ class KubernetesBatchSystem(BatchSystemCleanupSupport):
                 break
 
 
-    def _getPodForJob(self, jobObject):
-        """
-        Get the pod that belongs to the given job, or None if the job's pod is
-        missing. The pod knows about things like the job's exit code.
-
-        :param kubernetes.client.V1Job jobObject: a Kubernetes job to look up
-                                       pods for.
-
-        :return: The pod for the job, or None if no pod is found.
-        :rtype: kubernetes.client.V1Pod
-        """
-        
-        token = None
-        
-        # Work out what the return code was (which we need to get from the
-        # pods) We get the associated pods by querying on the label selector
-        # `job-name=JOBNAME`
-        query = 'job-name={}'.format(jobObject.metadata.name)
-        
-        while True:
-            # We can't just pass e.g. a None continue token when there isn't
-            # one, because the Kubernetes module reads its kwargs dict and
-            # cares about presence/absence. So we build a dict to send.
-            kwargs = {'label_selector': query}
-            if token is not None:
-                kwargs['_continue'] = token
-            results = self._try_kubernetes(self._api('core').list_namespaced_pod, self.namespace, **kwargs)
-        
-            for pod in results.items:
-                # Return the first pod we find
-                return pod
-                    
-            # Remember the continuation token, if any
-            token = getattr(results.metadata, 'continue', None)
-        
-            if token is None:
-                # There isn't one. We got everything.
-                break
-                
-        # If we get here, no pages had any pods.
-        return None
-
     def _getLogForPod(self, podObject):
         """
         Get the log for a pod.
@@ -654,205 +778,164 @@ class KubernetesBatchSystem(BatchSystemCleanupSupport):
 
 
 
-    def _getIDForOurJob(self, jobObject):
+    def _getIDForJobName(self, jobName):
         """
-        Get the JobID number that belongs to the given job that we own.
+        Get the JobID number that belongs to the Kubernetes job with the given
+        name, if it is one of ours.
 
-        :param kubernetes.client.V1Job jobObject: a Kubernetes job object that is a job we issued.
+        :param str jobName: The name of a Kubernetes job, or None.
 
-        :return: The JobID for the job.
+        :return: The JobID for the job, or None if it is not one we issued.
         :rtype: int
         """
 
-        return int(jobObject.metadata.name[len(self.jobPrefix):])
-    
-
-    def getUpdatedBatchJob(self, maxWait):
-
-        entry = datetime.datetime.now()
-
-        result = self._getUpdatedBatchJobImmediately()
-
-        if result is not None or maxWait == 0:
-            # We got something on the first try, or we only get one try
-            return result
-
-        # Otherwise we need to maybe wait.
-        if self.enableWatching:
-            for event in self._try_kubernetes_stream(self._api('batch').list_namespaced_job, self.namespace, 
-                                                        label_selector="toil_run={}".format(self.runID),
-                                                        timeout_seconds=maxWait):
-                # Grab the metadata data, ID, the list of conditions of the current job, and the total pods
-                jobObject = event['object']
-                jobID = int(jobObject.metadata.name[len(self.jobPrefix):])
-                jobObjectListConditions =jobObject.status.conditions
-                totalPods = jobObject.status.active + jobObject.status.finished + jobObject.status.failed
-                # Exit Reason defaults to 'Successfully Finsihed` unless said otherwise 
-                exitReason = BatchJobExitReason.FINISHED
-                exitCode = 0
-
-                # Check if there are any active pods
-                if jobObject.status.acitve > 0:
-                    logger.info("%s has %d pods running" % jobObject.metadata.name, jobObject.status.active)
-                    continue
-                elif jobObject.status.failed > 0 or jobObject.status.finished > 0:
-                    # No more active pods in the current job ; must be finished
-                    logger.info("%s RESULTS -> Succeeded: %d Failed:%d Active:%d" % jobObject.metadata.name, 
-                                                                jobObject.status.succeeded, jobObject.status.failed, jobObject.status.active)
-                    # Get termination information of job
-                    termination = jobObjectListConditions[0]
-                    # Log out succeess/failure given a reason
-                    logger.info("%s REASON: %s", termination.type, termination.reason)
-
-                    # Log out reason of failure and pod exit code 
-                    if jobObject.status.failed > 0:
-                        exitReason = BatchJobExitReason.FAILED
-                        pod = self._getPodForJob(jobObject)
-                        logger.debug("Failed job %s", str(jobObject))
-                        logger.warning("Failed Job Message: %s", termination.message)
-                        exitCode = pod.status.container_statuses[0].state.terminated.exit_code
-                    
-                    runtime = slow_down((termination.completion_time - termination.start_time).total_seconds())
-                    result = UpdatedBatchJobInfo(jobID=jobID, exitStatus=exitCode, wallTime=runtime, exitReason=exitReason)
-
-                    if (ExiReason == BatchJobExitReason.FAILED) or (jobObject.status.finished == totalPods):
-                        # Cleanup if job is all finished or there was a pod that failed
-                        self._try_kubernetes(self._api('batch').delete_namespaced_job, 
-                                            jobObject.metadata.name,
-                                            self.namespace,
-                                            propagation_policy='Foreground')
-                        self._waitForJobDeath(jobOjbect.metadata.name)
-                        return result
-                    continue
-                else:
-                    # Job is not running/updating ; no active, successful, or failed pods yet
-                    logger.debug("Job %s -> %s" % (jobObject.metadata.name, jobObjectListConditions[0].reason))
-                    # Pod could be pending; don't say it's lost.
-                    continue
-        else:
-            # Try polling instead
-            while result is None and (datetime.datetime.now() - entry).total_seconds() < maxWait:
-                # We still have nothing and we haven't hit the timeout.
-                
-                # Poll
-                result = self._getUpdatedBatchJobImmediately()
+        if jobName is None or not jobName.startswith(self.jobPrefix):
+            return None
+        return int(jobName[len(self.jobPrefix):])
 
-                if result is None:
-                    # Still nothing. Wait a second, or some fraction of our max wait time.
-                    time.sleep(min(maxWait/2, 1.0))
+    def _getFinishReason(self, jobID):
+        """
+        Work out whether an issued job has finished, from our caches of our
+        jobs and pods.
 
-            # When we get here, either we found something or we ran out of time
-            return result
+        :return: 'done', 'failed' or 'stuck', or None if the job is still going.
+        :rtype: str
+        """
 
+        jobObject = self.jobInformer.objects.get(jobID)
+        pod = self.podInformer.objects.get(jobID)
+        if jobObject is not None and jobObject.status is not None:
+            if (jobObject.status.succeeded or 0) > 0:
+                reason = 'done'
+            elif (jobObject.status.failed or 0) > 0:
+                reason = 'failed'
+            else:
+                reason = None
+            if reason is not None:
+                if pod is not None and pod.status is not None and pod.status.phase not in ('Succeeded', 'Failed'):
+                    # Wait until we hear that the pod has stopped too, so we
+                    # can get its exit code.
+                    return None
+                return reason
+        if pod is not None and pod.status is not None:
+            # Containers can get stuck in Waiting with reason ImagePullBackOff
+            containerStatuses = pod.status.container_statuses
+            if containerStatuses:
+                waitingInfo = getattr(getattr(containerStatuses[0], 'state', None), 'waiting', None)
+                if waitingInfo is not None and waitingInfo.reason == 'ImagePullBackOff':
+                    # Assume it will never finish, even if the registry comes back or whatever.
+                    # We can get into this state when we send in a non-existent image.
+                    # See https://github.com/kubernetes/kubernetes/issues/58384
+                    logger.warning('Failing stuck job; did you try to run a non-existent Docker image?'
+                                   ' Check TOIL_APPLIANCE_SELF.')
+                    return 'stuck'
+        return None
 
-    def _getUpdatedBatchJobImmediately(self):
+    def _jobChanged(self, jobID, eventType):
         """
-        Return None if no updated (completed or failed) batch job is currently
-        available, and jobID, exitCode, runtime if such a job can be found.
+        Called by the job informer, with the lock held, when a job changes. Queues the job to be reported on if it has finished.
         """
 
-        # See if a local batch job has updated and is available immediately
-        local_tuple = self.getUpdatedLocalJob(0)
-        if local_tuple:
-            # If so, use it
-            return local_tuple
+        if jobID not in self.issuedJobs or jobID in self.reportedJobs:
+            # Not ours to report on, or already on its way
+            return
+        if eventType == 'DELETED':
+            # Someone else deleted the job from under us.
+            reason = 'vanished'
+        else:
+            reason = self._getFinishReason(jobID)
+        if reason is not None:
+            self.reportedJobs.add(jobID)
+            self.finishedJobs.put((jobID, reason))
 
-        # Otherwise we didn't get a local job.
+    def _podChanged(self, jobID, eventType):
+        """
+        Called by the pod informer, with the lock held, when a job's pod
+        changes.
+        """
 
-        # Go looking for other jobs
-        
-        # Everybody else does this with a queue and some other thread that
-        # is responsible for populating it.
-        # But we can just ask kubernetes now.
-        
-        # Find a job that is done, failed, or stuck
-        jobObject = None
-        # Put 'done', 'failed', or 'stuck' here
-        chosenFor = ''
-
-        for j in self._ourJobObject(onlySucceeded=True):
-            # Look for succeeded jobs because that's the only filter Kubernetes has
-            jobObject = j
-            chosenFor = 'done'
-
-        if jobObject is None:
-            for j in self._ourJobObject():
-                # If there aren't any succeeded jobs, scan all jobs
-                # See how many times each failed
-                failCount = getattr(j.status, 'failed', 0)
-                if failCount is None:
-                    # Make sure it is an int
-                    failCount = 0
-                if failCount > 0:
-                    # Take the first failed one you find
-                    jobObject = j
-                    chosenFor = 'failed'
-                    break
-
-        if jobObject is None:
-            # If no jobs are failed, look for jobs with pods that are stuck for various reasons.
-            for j in self._ourJobObject():
-                pod = self._getPodForJob(j)
-
-                if pod is None:
-                    # Skip jobs with no pod
-                    continue
-                    
-                # Containers can get stuck in Waiting with reason ImagePullBackOff
+        # A change to the pod is a change to the state of the job
+        self._jobChanged(jobID, 'MODIFIED')
 
-                # Get the statuses of the pod's containers
-                containerStatuses = pod.status.container_statuses
-                if containerStatuses is None or len(containerStatuses) == 0:
-                    # Pod exists but has no container statuses
-                    # This happens when the pod is just "Scheduled"
-                    # ("PodScheduled" status event) and isn't actually starting
-                    # to run yet.
-                    # Can't be stuck in ImagePullBackOff
-                    continue
+    def _checkForStuckPods(self):
+        """
+        Pods can get stuck nearly but not quite out of memory, if their memory
+        limits are high and they try to exhaust them. We can't watch for that,
+        so every so often poll the memory use of our running pods, and report
+        any that are stuck.
+        """
 
-                waitingInfo = getattr(getattr(pod.status.container_statuses[0], 'state', None), 'waiting', None)
-                if waitingInfo is not None and waitingInfo.reason == 'ImagePullBackOff':
-                    # Assume it will never finish, even if the registry comes back or whatever.
-                    # We can get into this state when we send in a non-existent image.
-                    # See https://github.com/kubernetes/kubernetes/issues/58384
-                    jobObject = j
-                    chosenFor = 'stuck'
-                    logger.warning('Failing stuck job; did you try to run a non-existent Docker image?'
-                                   ' Check TOIL_APPLIANCE_SELF.')
-                    break
+        if time.time() - self.lastStuckCheck < self.stuckCheckInterval:
+            return
+        self.lastStuckCheck = time.time()
+        with self.watchLock:
+            pods = [(jobID, pod) for jobID, pod in self.podInformer.objects.items()
+                    if jobID in self.issuedJobs and jobID not in self.reportedJobs and
+                    pod.status is not None and pod.status.phase == 'Running']
+        for jobID, pod in pods:
+            if self._isPodStuckOOM(pod):
+                # We found a job that probably should be OOM! Report it as stuck.
+                # Polling function takes care of the logging.
+                with self.watchLock:
+                    if jobID in self.issuedJobs and jobID not in self.reportedJobs:
+                        self.reportedJobs.add(jobID)
+                        self.finishedJobs.put((jobID, 'stuck'))
 
-                # Pods can also get stuck nearly but not quite out of memory,
-                # if their memory limits are high and they try to exhaust them.
+    def getUpdatedBatchJob(self, maxWait):
 
-                if self._isPodStuckOOM(pod):
-                    # We found a job that probably should be OOM! Report it as stuck.
-                    # Polling function takes care of the logging.
-                    jobObject = j
-                    chosenFor = 'stuck'
-                    break
+        deadline = time.time() + maxWait
+        while True:
+            # See if a local batch job has updated and is available immediately
+            local_tuple = self.getUpdatedLocalJob(0)
+            if local_tuple:
+                # If so, use it
+                return local_tuple
+
+            self._checkForStuckPods()
+
+            # Wait for the watches to see a job finish. Keep looking in on the
+            # local jobs and the stuck pods while we wait.
+            wait = min(deadline - time.time(), self.stuckCheckInterval)
+            if self.getIssuedLocalJobIDs():
+                wait = min(wait, 0.1)
+            try:
+                jobID, reason = self.finishedJobs.get(timeout=max(wait, 0))
+            except Empty:
+                if time.time() >= deadline:
+                    return None
+                continue
 
-        if jobObject is None:
-            # Say we couldn't find anything
-            return None
+            with self.watchLock:
+                if jobID not in self.issuedJobs:
+                    # It was killed while in the queue
+                    continue
+                jobObject = self.jobInformer.objects.get(jobID)
+                pod = self.podInformer.objects.get(jobID)
+            return self._reportJob(jobID, reason, jobObject, pod)
 
+    def _reportJob(self, jobID, reason, jobObject, pod):
+        """
+        Work out the exit code and runtime of a job that has finished, from
+        the last we saw of it and its pod, and delete it.
 
-        # Otherwise we got something.
+        :param int jobID: The job's ID.
+        :param str reason: 'done', 'failed', 'stuck', 'vanished' or
+               'unsubmitted'.
+        :param kubernetes.client.V1Job jobObject: The job, or None if it is gone.
+        :param kubernetes.client.V1Pod pod: The job's pod, or None if it is gone.
 
-        # Work out what the job's ID was (whatever came after our name prefix)
-        jobID = int(jobObject.metadata.name[len(self.jobPrefix):])
+        :rtype: UpdatedBatchJobInfo
+        """
 
         # Work out when the job was submitted. If the pod fails before actually
         # running, this is the basis for our runtime.
-        jobSubmitTime = getattr(jobObject.status, 'start_time', None)
+        jobSubmitTime = getattr(getattr(jobObject, 'status', None), 'start_time', None)
         if jobSubmitTime is None:
             # If somehow this is unset, say it was just now.
-            jobSubmitTime = utc_now() 
-
-        # Grab the pod
-        pod = self._getPodForJob(jobObject)
+            jobSubmitTime = utc_now()
 
-        if pod is not None:
-            if chosenFor == 'done' or chosenFor == 'failed':
+        if pod is not None and pod.status is not None:
+            if reason == 'done' or reason == 'failed':
                 # The job actually finished or failed
 
                 # Get the statuses of the pod's containers
@@ -863,8 +946,8 @@ class KubernetesBatchSystem(BatchSystemCleanupSupport):
                 if startTime is None:
                     # If the pod never made it to the kubelet to get a
                     # start_time, say it was when the job was submitted.
-                    startTime = jobSubmitTime 
-                
+                    startTime = jobSubmitTime
+
                 if containerStatuses is None or len(containerStatuses) == 0:
                     # No statuses available.
                     # This happens when a pod is "Scheduled". But how could a
@@ -896,55 +979,54 @@ class KubernetesBatchSystem(BatchSystemCleanupSupport):
                         # created. And we need to look at the pod's end time
                         # because the job only gets a completion time if
                         # successful.
-                        runtime = slow_down((terminatedInfo.finished_at - 
-                                             pod.status.start_time).total_seconds())
+                        runtime = slow_down((terminatedInfo.finished_at -
+                                             startTime).total_seconds())
 
-                        if chosenFor == 'failed':
+                        if reason == 'failed':
                             # Warn the user with the failed pod's log
                             # TODO: cut this down somehow?
                             logger.warning('Log from failed pod: %s', self._getLogForPod(pod))
-            
+
             else:
-                # The job has gotten stuck
+                # The job has gotten stuck, or was deleted by someone else
 
-                assert chosenFor == 'stuck'
-                
                 # Synthesize an exit code
                 exitCode = EXIT_STATUS_UNAVAILABLE_VALUE
                 # Say it ran from when the job was submitted to when the pod got stuck
                 runtime = slow_down((utc_now() - jobSubmitTime).total_seconds())
+        elif reason == 'unsubmitted':
+            # We never managed to make the job.
+            exitCode = EXIT_STATUS_UNAVAILABLE_VALUE
+            runtime = slow_down(0)
         else:
             # The pod went away from under the job.
-            logging.warning('Exit code and runtime unavailable; pod vanished')
+            logger.warning('Exit code and runtime unavailable; pod vanished')
             exitCode = EXIT_STATUS_UNAVAILABLE_VALUE
             # Say it ran from when the job was submitted to when the pod vanished
             runtime = slow_down((utc_now() - jobSubmitTime).total_seconds())
-        
-        
-        try:
-            # Delete the job and all dependents (pods), hoping to get a 404 if it's magically gone
-            self._try_kubernetes_expecting_gone(self._api('batch').delete_namespaced_job, jobObject.metadata.name,
-                                                self.namespace,
-                                                propagation_policy='Foreground')
-                                                
-            # That just kicks off the deletion process. Foreground doesn't
-            # actually block. See
-            # https://kubernetes.io/docs/concepts/workloads/controllers/garbage-collection/#foreground-cascading-deletion
-            # We have to either wait until the deletion is done and we can't
-            # see the job anymore, or ban the job from being "updated" again if
-            # we see it. If we don't block on deletion, we can't use limit=1
-            # on our query for succeeded jobs. So we poll for the job's
-            # non-existence.
-            self._waitForJobDeath(jobObject.metadata.name)
-                    
-        except ApiException as e:
-            if e.status != 404:
-                # Something is wrong, other than the job already being deleted.
-                raise
-            # Otherwise everything is fine and the job is gone. 
+
+        with self.watchLock:
+            self.issuedJobs.discard(jobID)
+            self.reportedJobs.discard(jobID)
+
+        if reason not in ('vanished', 'unsubmitted'):
+            try:
+                # Delete the job and all dependents (pods), hoping to get a 404 if it's magically gone.
+                # We don't need to wait for it to go; we won't report on it again.
+                self._try_kubernetes_expecting_gone(self._api('batch').delete_namespaced_job,
+                                                    self.jobPrefix + str(jobID),
+                                                    self.namespace,
+                                                    propagation_policy='Foreground')
+            except ApiException as e:
+                if e.status != 404:
+                    # Something is wrong, other than the job already being deleted.
+                    raise
+                # Otherwise everything is fine and the job is gone.
 
         # Return the one finished job we found
-        return UpdatedBatchJobInfo(jobID=jobID, exitStatus=exitCode, wallTime=runtime, exitReason=None)
+        exitReason = {'vanished': BatchJobExitReason.LOST, 'unsubmitted': BatchJobExitReason.ERROR}.get(reason)
+        return UpdatedBatchJobInfo(jobID=jobID, exitStatus=exitCode, wallTime=runtime, exitReason=exitReason)
+
 
     def _waitForJobDeath(self, jobName):
         """
@@ -975,6 +1057,21 @@ class KubernetesBatchSystem(BatchSystemCleanupSupport):
         
         # Shutdown local processes first
         self.shutdownLocal()
+
+        # Stop submitting jobs
+        while True:
+            try:
+                self.submitQueue.get_nowait()
+            except Empty:
+                break
+        for _ in self.submitThreads:
+            self.submitQueue.put(None)
+        for thread in self.submitThreads:
+            thread.join()
+
+        # Stop watching our jobs
+        self.jobInformer.stop()
+        self.podInformer.stop()
        
     
         # Kill all of our jobs and clean up pods that are associated with those jobs
@@ -1011,79 +1108,68 @@ class KubernetesBatchSystem(BatchSystemCleanupSupport):
                         logger.error("Exception when calling CoreV1Api->delete_namespaced_pod: %s" % e)
 
 
-    def _getIssuedNonLocalBatchJobIDs(self):
-        """
-        Get the issued batch job IDs that are not for local jobs.
-        """
-        jobIDs = []
-        got_list = self._ourJobObject()
-        for job in got_list:
-            # Get the ID for each job
-            jobIDs.append(self._getIDForOurJob(job))
-        return jobIDs
-
     def getIssuedBatchJobIDs(self):
         # Make sure to send the local jobs also
-        return self._getIssuedNonLocalBatchJobIDs() + list(self.getIssuedLocalJobIDs())
+        with self.watchLock:
+            return list(self.issuedJobs) + list(self.getIssuedLocalJobIDs())
 
     def getRunningBatchJobIDs(self):
         # We need a dict from jobID (integer) to seconds it has been running
         secondsPerJob = dict()
-        for job in self._ourJobObject():
-            # Grab the pod for each job
-            pod = self._getPodForJob(job)
-
-            if pod is None:
-                # Jobs whose pods are gone are not running
-                continue
-
-            if pod.status.phase == 'Running':
-                # The job's pod is running
-
-                # The only time we have handy is when the pod got assigned to a
-                # kubelet, which is technically before it started running.
-                runtime = (utc_now() - pod.status.start_time).total_seconds()
-
-                # Save it under the stringified job ID
-                secondsPerJob[self._getIDForOurJob(job)] = runtime
+        with self.watchLock:
+            for jobID, pod in self.podInformer.objects.items():
+                if jobID in self.issuedJobs and pod.status is not None and pod.status.phase == 'Running':
+                    # The job's pod is running
+
+                    # The only time we have handy is when the pod got assigned to a
+                    # kubelet, which is technically before it started running.
+                    secondsPerJob[jobID] = (utc_now() - pod.status.start_time).total_seconds()
         # Mix in the local jobs
         secondsPerJob.update(self.getRunningLocalJobIDs())
         return secondsPerJob
-            
+
     def killBatchJobs(self, jobIDs):
-        
+
         # Kill all the ones that are local
         self.killLocalJobs(jobIDs)
-        
+
         # Clears workflow's jobs listed in jobIDs.
 
-        # First get the jobs we even issued non-locally
-        issuedOnKubernetes = set(self._getIssuedNonLocalBatchJobIDs())
+        # First get the jobs we even issued non-locally, and forget them so
+        # we never report on them.
+        with self.watchLock:
+            issuedOnKubernetes = [jobID for jobID in jobIDs if jobID in self.issuedJobs]
+            for jobID in issuedOnKubernetes:
+                self.issuedJobs.remove(jobID)
+                self.reportedJobs.discard(jobID)
 
-        for jobID in jobIDs:
-            # For each job we are supposed to kill
-            if jobID not in issuedOnKubernetes:
-                # It never went to Kubernetes (or wasn't there when we just
-                # looked), so we can't kill it on Kubernetes.
-                continue
+        for jobID in issuedOnKubernetes:
             # Work out what the job would be named
             jobName = self.jobPrefix + str(jobID)
 
             # Delete the requested job in the foreground.
             # This doesn't block, but it does delete expeditiously.
-            response = self._try_kubernetes(self._api('batch').delete_namespaced_job, jobName, 
-                                                                self.namespace, 
-                                                                propagation_policy='Foreground')
+            try:
+                self._try_kubernetes_expecting_gone(self._api('batch').delete_namespaced_job, jobName,
+                                                    self.namespace,
+                                                    propagation_policy='Foreground')
+            except ApiException as e:
+                if e.status != 404:
+                    raise
             logger.debug('Killed job by request: %s', jobName)
 
-        for jobID in jobIDs:
-            # Now we need to wait for all the jobs we killed to be gone.
-
-            # Work out what the job would be named
-            jobName = self.jobPrefix + str(jobID)
-
+        # Now we need to wait for all the jobs we killed to be gone. The watch
+        # will tell us, unless it is having trouble, in which case we poll.
+        deadline = time.time() + self.jobInformer.watchTimeout
+        with self.watchLock:
+            while (any(jobID in self.jobInformer.objects for jobID in issuedOnKubernetes) and
+                   time.time() < deadline):
+                self.watchLock.wait(deadline - time.time())
+            stillThere = [jobID for jobID in issuedOnKubernetes if jobID in self.jobInformer.objects]
+        for jobID in stillThere:
             # Block until it doesn't exist
-            self._waitForJobDeath(jobName)
+            self._waitForJobDeath(self.jobPrefix + str(jobID))
+
 
 def executor():
     """
@@ -24,8 +24,9 @@ from builtins import range
 from past.utils import old_div
 import logging
 import math
-from toil.lib.misc import call_command
+from toil.lib.misc import call_command, CalledProcessErrorStderr
 import os
+import subprocess
 import json
 import re
 from random import randint
@@ -54,18 +55,19 @@ class LSFBatchSystem(AbstractGridEngineBatchSystem):
         def getRunningJobIDs(self):
             times = {}
             with self.runningJobsLock:
-                currentjobs = dict((str(self.batchJobIDs[x][0]), x) for x in
+                currentjobs = dict((self.getBatchSystemID(x), x) for x in
                                    self.runningJobs)
 
             if check_lsf_json_output_supported:
-                stdout = call_command(["bjobs","-json","-o", "jobid stat start_time"])
+                stdout = call_command(["bjobs","-json","-o", "jobid jobindex stat start_time"])
 
                 bjobs_records = self.parseBjobs(stdout)
                 if bjobs_records:
                     for single_item in bjobs_records:
-                        if single_item['STAT'] == 'RUN' and single_item['JOBID'] in currentjobs:
+                        lsfJobID = self.getLSFJobID(single_item['JOBID'], single_item.get('JOBINDEX'))
+                        if single_item['STAT'] == 'RUN' and lsfJobID in currentjobs:
                             jobstart = parse(single_item['START_TIME'], default=datetime.now(tzlocal()))
-                            times[currentjobs[single_item['JOBID']]] = datetime.now(tzlocal()) \
+                            times[currentjobs[lsfJobID]] = datetime.now(tzlocal()) \
                             - jobstart
             else:
                 times = self.fallbackRunningJobIDs(currentjobs)
@@ -73,25 +75,49 @@ class LSFBatchSystem(AbstractGridEngineBatchSystem):
 
         def fallbackRunningJobIDs(self, currentjobs):
             times = {}
-            stdout = call_command(["bjobs", "-o", "jobid stat start_time delimiter='|'"])
+            stdout = call_command(["bjobs", "-o", "jobid jobindex stat start_time delimiter='|'"])
             for curline in stdout.split('\n'):
                 items = curline.strip().split('|')
-                if items[0] in currentjobs and items[1] == 'RUN':
-                    jobstart = parse(items[2], default=datetime.now(tzlocal()))
-                    times[currentjobs[items[0]]] = datetime.now(tzlocal()) \
+                if len(items) < 4:
+                    continue
+                lsfJobID = self.getLSFJobID(items[0], items[1])
+                if lsfJobID in currentjobs and items[2] == 'RUN':
+                    jobstart = parse(items[3], default=datetime.now(tzlocal()))
+                    times[currentjobs[lsfJobID]] = datetime.now(tzlocal()) \
                         - jobstart
             return times
 
+        def getLSFJobID(self, jobid, jobindex):
+            """
+            Get the ID we know a job by from the jobid and jobindex fields of
+            bjobs. The jobindex of a job that is not in an array is 0.
+            """
+            if jobindex in (None, '', '0'):
+                return jobid
+            return self.getArrayElementID(jobid, jobindex)
+
         def killJob(self, jobID):
             call_command(['bkill', self.getBatchSystemID(jobID)])
 
         def prepareSubmission(self, cpu, memory, jobID, command, jobName):
             return self.prepareBsub(cpu, memory, jobID) + [command]
 
-        def submitJob(self, subLine):
+        def prepareArraySubmission(self, cpu, memory, jobs):
+            bsubline = self.prepareBsub(cpu, memory, 'array_{}'.format(jobs[0][0]), arraySize=len(jobs))
+            script = self.arrayJobScript(jobs, 'LSB_JOBINDEX', 'lsf', '${LSB_JOBID}[${LSB_JOBINDEX}]')
+            return bsubline, script
+
+        def submitArrayJob(self, subLine, script):
+            # bsub reads the script from standard input
+            return self.submitJob(subLine, script)
+
+        def getArrayElementID(self, arrayJobID, index):
+            return '{}[{}]'.format(arrayJobID, index)
+
+        def submitJob(self, subLine, script=None):
             combinedEnv = self.boss.environment
             combinedEnv.update(os.environ)
-            stdout = call_command(subLine, env=combinedEnv)
+            stdout = call_command(subLine, input=script, env=combinedEnv)
             # Example success: Job <39605914> is submitted to default queue <general>.
             # Example fail: Service class does not exist. Job not submitted.
             result_search = re.search('Job <(.*)> is submitted', stdout)
@@ -107,72 +133,97 @@ class LSFBatchSystem(AbstractGridEngineBatchSystem):
             return result
 
         def getJobExitCode(self, lsfJobID):
-            # the task is set as part of the job ID if using getBatchSystemID()
-            if "NOT_SUBMITTED" in lsfJobID:
-                logger.error("bjobs detected job failed to submit")
-                return 1
-
-            job, task = (lsfJobID, None)
-            if '.' in lsfJobID:
-                job, task = lsfJobID.split('.', 1)
-
-            self.parseMaxMem(job)
-            # first try bjobs to find out job state
+            return self.getJobExitCodes([lsfJobID])[lsfJobID]
+
+        def getJobExitCodes(self, lsfJobIDs):
+            exitCodes = {}
+            # Map from the ID to ask bjobs about to the batch system job ID
+            jobs = {}
+            for lsfJobID in lsfJobIDs:
+                if "NOT_SUBMITTED" in lsfJobID:
+                    logger.error("bjobs detected job failed to submit")
+                    exitCodes[lsfJobID] = 1
+                    continue
+                # the task is set as part of the job ID if using getBatchSystemID()
+                job, task = (lsfJobID, None)
+                if '.' in lsfJobID:
+                    job, task = lsfJobID.split('.', 1)
+                jobs[job] = lsfJobID
+
+            if not jobs:
+                return exitCodes
+            # first try bjobs to find out job state, for all the jobs at once
             if check_lsf_json_output_supported:
                 args = ["bjobs", "-json", "-o",
-                        "user exit_code stat exit_reason pend_reason", str(job)]
-                logger.debug("Checking job exit code for job via bjobs: "
-                             "{}".format(job))
-                stdout = call_command(args)
-                bjobs_records = self.parseBjobs(stdout)
-                if bjobs_records:
-                    process_output = bjobs_records[0]
-                    if 'STAT' in process_output:
-                        process_status = process_output['STAT']
-                        if process_status == 'DONE':
-                            logger.debug(
-                                "bjobs detected job completed for job: {}".format(job))
-                            return 0
-                        if process_status == 'PEND':
-                            pending_info = ""
-                            if 'PEND_REASON' in process_output:
-                                if process_output['PEND_REASON']:
-                                    pending_info = "\n" + \
-                                        process_output['PEND_REASON']
-                            logger.debug(
-                                "bjobs detected job pending with: {}\nfor job: {}".format(pending_info, job))
-                            return None
-                        if process_status == 'EXIT':
-                            exit_code = 1
-                            exit_reason = ""
-                            if 'EXIT_CODE' in process_output:
-                                exit_code_str = process_output['EXIT_CODE']
-                                if exit_code_str:
-                                    exit_code = int(exit_code_str)
-                            if 'EXIT_REASON' in process_output:
-                                exit_reason = process_output['EXIT_REASON']
-                            exit_info = ""
-                            if exit_code:
-                                exit_info = "\nexit code: {}".format(exit_code)
-                            if exit_reason:
-                                exit_info += "\nexit reason: {}".format(exit_reason)
-                            logger.error(
-                                "bjobs detected job failed with: {}\nfor job: {}".format(exit_info, job))
-                            if "TERM_MEMLIMIT" in exit_reason:
-                                return BatchJobExitReason.MEMLIMIT
-                            return exit_code
-                        if process_status == 'RUN':
-                            logger.debug(
-                                "bjobs detected job started but not completed for job: {}".format(job))
-                            return None
-                        if process_status in {'PSUSP', 'USUSP', 'SSUSP'}:
-                            logger.debug(
-                                "bjobs detected job suspended for job: {}".format(job))
-                            return None
-
-                        return self.getJobExitCodeBACCT(job)
+                        "jobid jobindex user exit_code stat exit_reason pend_reason"] + list(jobs)
+                logger.debug("Checking job exit codes for jobs via bjobs: "
+                             "{}".format(' '.join(jobs)))
+                try:
+                    stdout = call_command(args)
+                except CalledProcessErrorStderr as err:
+                    # bjobs fails if it has forgotten any of the jobs, but
+                    # still reports on the rest
+                    stdout = err.output
+                bjobs_records = {}
+                for record in self.parseBjobs(stdout) or []:
+                    if 'STAT' in record:
+                        bjobs_records[self.getLSFJobID(record['JOBID'], record.get('JOBINDEX'))] = record
+                for job, lsfJobID in jobs.items():
+                    if job in bjobs_records:
+                        exitCodes[lsfJobID] = self.getJobExitCodeFromBjobsRecord(job, bjobs_records[job])
+                    else:
+                        exitCodes[lsfJobID] = self.getJobExitCodeBACCT(job)
             else:
-                return self.fallbackGetJobExitCode(job)
+                for job, lsfJobID in jobs.items():
+                    exitCodes[lsfJobID] = self.fallbackGetJobExitCode(job)
+            return exitCodes
+
+        def getJobExitCodeFromBjobsRecord(self, job, process_output):
+            process_status = process_output['STAT']
+            if process_status == 'DONE':
+                logger.debug(
+                    "bjobs detected job completed for job: {}".format(job))
+                self.parseMaxMem(job)
+                return 0
+            if process_status == 'PEND':
+                pending_info = ""
+                if 'PEND_REASON' in process_output:
+                    if process_output['PEND_REASON']:
+                        pending_info = "\n" + \
+                            process_output['PEND_REASON']
+                logger.debug(
+                    "bjobs detected job pending with: {}\nfor job: {}".format(pending_info, job))
+                return None
+            if process_status == 'EXIT':
+                exit_code = 1
+                exit_reason = ""
+                if 'EXIT_CODE' in process_output:
+                    exit_code_str = process_output['EXIT_CODE']
+                    if exit_code_str:
+                        exit_code = int(exit_code_str)
+                if 'EXIT_REASON' in process_output:
+                    exit_reason = process_output['EXIT_REASON']
+                exit_info = ""
+                if exit_code:
+                    exit_info = "\nexit code: {}".format(exit_code)
+                if exit_reason:
+                    exit_info += "\nexit reason: {}".format(exit_reason)
+                logger.error(
+                    "bjobs detected job failed with: {}\nfor job: {}".format(exit_info, job))
+                self.parseMaxMem(job)
+                if "TERM_MEMLIMIT" in exit_reason:
+                    return BatchJobExitReason.MEMLIMIT
+                return exit_code
+            if process_status == 'RUN':
+                logger.debug(
+                    "bjobs detected job started but not completed for job: {}".format(job))
+                return None
+            if process_status in {'PSUSP', 'USUSP', 'SSUSP'}:
+                logger.debug(
+                    "bjobs detected job suspended for job: {}".format(job))
+                return None
+
+            return self.getJobExitCodeBACCT(job)
 
         def getJobExitCodeBACCT(self,job):
             # if not found in bjobs, then try bacct (slower than bjobs)
@@ -238,7 +289,7 @@ class LSFBatchSystem(AbstractGridEngineBatchSystem):
         """
         Implementation-specific helper methods
         """
-        def prepareBsub(self, cpu, mem, jobID):
+        def prepareBsub(self, cpu, mem, jobID, arraySize=None):
             """
             Make a bsub commandline to execute.
 
@@ -246,6 +297,7 @@ class LSFBatchSystem(AbstractGridEngineBatchSystem):
               cpu: number of cores needed
               mem: number of bytes of memory needed
               jobID: ID number of the job
+              arraySize: number of elements, if submitting an array job
             """
             if mem:
                 if per_core_reservation():
@@ -263,11 +315,16 @@ class LSFBatchSystem(AbstractGridEngineBatchSystem):
             else:
                 bsubMem = []
             bsubCpu = [] if cpu is None else ['-n', str(math.ceil(cpu))]
-            bsubline = ["bsub", "-cwd", ".", "-J", "toil_job_{}".format(jobID)]
+            if arraySize is None:
+                bsubline = ["bsub", "-cwd", ".", "-J", "toil_job_{}".format(jobID)]
+                batchJobIDfmt = '%J'
+            else:
+                bsubline = ["bsub", "-cwd", ".", "-J", "toil_job_{}[1-{}]".format(jobID, arraySize)]
+                batchJobIDfmt = '%J[%I]'
             bsubline.extend(bsubMem)
             bsubline.extend(bsubCpu)
-            stdoutfile = self.boss.formatStdOutErrPath(jobID, 'lsf', '%J', 'std_output')
-            stderrfile = self.boss.formatStdOutErrPath(jobID, 'lsf', '%J', 'std_error')
+            stdoutfile = self.boss.formatStdOutErrPath(jobID, 'lsf', batchJobIDfmt, 'std_output')
+            stderrfile = self.boss.formatStdOutErrPath(jobID, 'lsf', batchJobIDfmt, 'std_error')
             bsubline.extend(['-o', stdoutfile, '-e', stderrfile])
             lsfArgs = os.getenv('TOIL_LSF_ARGS')
             if lsfArgs:
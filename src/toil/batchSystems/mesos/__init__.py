@@ -16,8 +16,7 @@ from __future__ import absolute_import
 from future import standard_library
 standard_library.install_aliases()
 from builtins import object
-from queue import Queue
-from collections import namedtuple
+from collections import deque, namedtuple
 from bisect import bisect
 from threading import Lock
 
@@ -52,26 +51,47 @@ class JobQueue(object):
             if jobType not in self.queues:
                 index = bisect(self.sortedTypes, jobType)
                 self.sortedTypes.insert(index, jobType)
-                self.queues[jobType] = Queue()
-            self.queues[jobType].put(job)
+                self.queues[jobType] = deque()
+            self.queues[jobType].append(job)
 
     def jobIDs(self):
         with self.jobLock:
-            return [job.jobID for queue in list(self.queues.values()) for job in list(queue.queue)]
+            return [job.jobID for queue in list(self.queues.values()) for job in queue]
+
+    def jobTypes(self):
+        """
+        :return: The types of the jobs in the queue, in decreasing resource
+                 expense.
+        :rtype: list[MesosShape]
+        """
+        with self.jobLock:
+            return list(self.sortedTypes)
 
     def nextJobOfType(self, jobType):
+        return self.takeJobs(jobType, 1)[0]
+
+    def takeJobs(self, jobType, count):
+        """
+        Take up to the given number of jobs of the given type from the queue,
+        oldest first.
+
+        :rtype: list[ToilJob]
+        """
         with self.jobLock:
-            job = self.queues[jobType].get(block=False)
-            if self.queues[jobType].empty():
+            queue = self.queues.get(jobType)
+            if queue is None:
+                return []
+            jobs = [queue.popleft() for _ in range(min(count, len(queue)))]
+            if not queue:
                 del self.queues[jobType]
                 self.sortedTypes.remove(jobType)
-            return job
+            return jobs
 
     def typeEmpty(self, jobType):
         # without a lock we could get a false negative from this method
-        # if it were called while nextJobOfType was executing
+        # if it were called while takeJobs was executing
         with self.jobLock:
-            return self.queues.get(jobType, Queue()).empty()
+            return not self.queues.get(jobType)
 
 
 class MesosShape(Shape):
@@ -118,6 +118,15 @@ class MesosBatchSystem(BatchSystemLocalSupport,
         # Mesos has no easy way of getting a task's resources so we track them here
         self.taskResources = {}
 
+        # Map from jobID to the encoded, pickled ToilJob to send as each queued
+        # job's task data. Made when the job is issued, so the work isn't done
+        # while we are handling offers.
+        self.taskPayloads = {}
+
+        # Map from (cores, disk, memory) to the Mesos resources to ask for for a
+        # task with those requirements, which are the same for every such task
+        self.mesosResourcesByType = {}
+
         # Queue of jobs whose status has been updated, according to Mesos
         self.updatedJobsQueue = Queue()
 
@@ -180,7 +189,8 @@ class MesosBatchSystem(BatchSystemLocalSupport,
         jobID = self.getNextJobID()
         job = ToilJob(jobID=jobID,
                       name=str(jobNode),
-                      resources=MesosShape(wallTime=0, **jobNode._requirements),
+                      resources=MesosShape(wallTime=0, memory=jobNode.memory, cores=jobNode.cores,
+                                           disk=jobNode.disk, preemptable=jobNode.preemptable),
                       command=jobNode.command,
                       userScript=self.userScript,
                       environment=self.environment.copy(),
@@ -191,6 +201,7 @@ class MesosBatchSystem(BatchSystemLocalSupport,
         # TODO: round all elements of resources
 
         self.taskResources[jobID] = job.resources
+        self.taskPayloads[jobID] = encode_data(pickle.dumps(job))
         self.jobQueues.insertJob(job, jobType)
         log.debug("... queued")
         return jobID
@@ -214,6 +225,8 @@ class MesosBatchSystem(BatchSystemLocalSupport,
             localSet.add(jobID)
             # Record that we meant to kill it, in case it finishes up by itself.
             self.intendedKill.add(jobID)
+            # A job killed while still queued never launches to use its payload
+            self.taskPayloads.pop(jobID, None)
             
             if jobID in self.getIssuedBatchJobIDs():
                 # Since the job has been issued, we have to kill it
@@ -382,17 +395,35 @@ class MesosBatchSystem(BatchSystemLocalSupport,
                 disk += resource.scalar.value
         return cores, memory, disk, preemptable
 
-    def _prepareToRun(self, jobType, offer):
-        # Get the first element to ensure FIFO
-        job = self.jobQueues.nextJobOfType(jobType)
-        task = self._newMesosTask(job, offer)
-        return task
+    def _prepareToRun(self, jobType, offer, count=1):
+        # Take the first elements to ensure FIFO
+        jobs = self.jobQueues.takeJobs(jobType, count)
+        return [self._newMesosTask(job, offer) for job in jobs]
 
-    def _updateStateToRunning(self, offer, runnableTasks):
+    @staticmethod
+    def _howManyFit(jobType, cores, memory, disk):
+        """
+        Work out how many jobs of the given type fit in the given resources,
+        with memory and disk in MiB.
+        """
+        count = None
+        # Toil specifies disk and memory in bytes but Mesos uses MiB
+        for available, needed in ((cores, jobType.cores),
+                                  (memory, toMiB(jobType.memory)),
+                                  (disk, toMiB(jobType.disk))):
+            if needed > 0:
+                fits = int(available // needed)
+                # Don't let rounding put us over what we have
+                while fits > 0 and fits * needed > available:
+                    fits -= 1
+                count = fits if count is None else min(count, fits)
+        # Jobs that need nothing all fit
+        return sys.maxsize if count is None else max(count, 0)
+
+    def _updateStateToRunning(self, offer, runnableTasks, agentIP):
         for task in runnableTasks:
             resourceKey = int(task.task_id.value)
             resources = self.taskResources[resourceKey]
-            agentIP = socket.gethostbyname(offer.hostname)
             try:
                 self.hostToJobIDs[agentIP].append(resourceKey)
             except KeyError:
@@ -411,9 +442,9 @@ class MesosBatchSystem(BatchSystemLocalSupport,
         """
         Invoked when resources have been offered to this framework.
         """
-        self._trackOfferedNodes(offers)
+        agentIPs = self._trackOfferedNodes(offers)
 
-        jobTypes = self.jobQueues.sortedTypes
+        jobTypes = self.jobQueues.jobTypes()
 
         if not jobTypes:
             # Without jobs, we can get stuck with no jobs and no new offers until we decline it.
@@ -436,32 +467,26 @@ class MesosBatchSystem(BatchSystemLocalSupport,
             remainingMemory = offerMemory
             remainingDisk = offerDisk
 
+            # Pack the offer first-fit decreasing. The job types are sorted
+            # from most to least expensive, and we take as many jobs of each
+            # type as will fit in what is left before going on to the next.
             for jobType in jobTypes:
-                runnableTasksOfType = []
-                # Because we are not removing from the list until outside of the while loop, we
-                # must decrement the number of jobs left to run ourselves to avoid an infinite
-                # loop.
-                nextToLaunchIndex = 0
-                # Toil specifies disk and memory in bytes but Mesos uses MiB
-                while ( not self.jobQueues.typeEmpty(jobType)
-                       # On a non-preemptable node we can run any job, on a preemptable node we
-                       # can only run preemptable jobs:
-                       and (not offerPreemptable or jobType.preemptable)
-                       and remainingCores >= jobType.cores
-                       and remainingDisk >= toMiB(jobType.disk)
-                       and remainingMemory >= toMiB(jobType.memory)):
-                    task = self._prepareToRun(jobType, offer)
+                # On a non-preemptable node we can run any job, on a preemptable node we
+                # can only run preemptable jobs:
+                if offerPreemptable and not jobType.preemptable:
+                    continue
+                count = self._howManyFit(jobType, remainingCores, remainingMemory, remainingDisk)
+                runnableTasksOfType = self._prepareToRun(jobType, offer, count) if count > 0 else []
+                for task in runnableTasksOfType:
                     # TODO: this used to be a conditional but Hannes wanted it changed to an assert
                     # TODO: ... so we can understand why it exists.
                     assert int(task.task_id.value) not in self.runningJobMap
-                    runnableTasksOfType.append(task)
                     log.debug("Preparing to launch Mesos task %s with %.2f cores, %.2f MiB memory, and %.2f MiB disk using offer %s ...",
                               task.task_id.value, jobType.cores, toMiB(jobType.memory), toMiB(jobType.disk), offer.id.value)
-                    remainingCores -= jobType.cores
-                    remainingMemory -= toMiB(jobType.memory)
-                    remainingDisk -= toMiB(jobType.disk)
-                    nextToLaunchIndex += 1
-                if not self.jobQueues.typeEmpty(jobType):
+                remainingCores -= len(runnableTasksOfType) * jobType.cores
+                remainingMemory -= len(runnableTasksOfType) * toMiB(jobType.memory)
+                remainingDisk -= len(runnableTasksOfType) * toMiB(jobType.disk)
+                if log.isEnabledFor(logging.DEBUG) and not self.jobQueues.typeEmpty(jobType):
                     # report that remaining jobs cannot be run with the current resourcesq:
                     log.debug('Offer %(offer)s not suitable to run the tasks with requirements '
                               '%(requirements)r. Mesos offered %(memory)s memory, %(cores)s cores '
@@ -477,7 +502,7 @@ class MesosBatchSystem(BatchSystemLocalSupport,
             if runnableTasks:
                 unableToRun = False
                 driver.launchTasks(offer.id, runnableTasks)
-                self._updateStateToRunning(offer, runnableTasks)
+                self._updateStateToRunning(offer, runnableTasks, agentIPs[offer.id.value])
             else:
                 log.debug('Although there are queued jobs, none of them could be run with offer %s '
                           'extended to the framework.', offer.id)
@@ -491,6 +516,13 @@ class MesosBatchSystem(BatchSystemLocalSupport,
                      'job types and offers received.', len(self.runningJobMap))
 
     def _trackOfferedNodes(self, offers):
+        """
+        Note the nodes the offers are for.
+
+        :return: Map from offer ID to the IP of the offered node.
+        :rtype: dict[str,str]
+        """
+        agentIPs = {}
         for offer in offers:
             # All AgentID messages are required to have a value according to the Mesos Protobuf file.
             assert 'value' in offer.agent_id
@@ -499,6 +531,7 @@ class MesosBatchSystem(BatchSystemLocalSupport,
             except:
                 log.debug("Failed to resolve hostname %s" % offer.hostname)
                 raise
+            agentIPs[offer.id.value] = nodeAddress
             self._registerNode(nodeAddress, offer.agent_id.value)
             preemptable = False
             for attribute in offer.attributes:
@@ -511,6 +544,7 @@ class MesosBatchSystem(BatchSystemLocalSupport,
                     pass
             else:
                 self.nonPreemptableNodes.add(offer.agent_id.value)
+        return agentIPs
 
     def _filterOfferedNodes(self, offers):
         if not self.nodeFilter:
@@ -529,19 +563,34 @@ class MesosBatchSystem(BatchSystemLocalSupport,
         task.task_id.value = str(job.jobID)
         task.agent_id.value = offer.agent_id.value
         task.name = job.name
-        task.data = encode_data(pickle.dumps(job))
+        payload = self.taskPayloads.pop(job.jobID, None)
+        task.data = encode_data(pickle.dumps(job)) if payload is None else payload
         task.executor = addict.Dict(self.executor)
+        task.resources = self._mesosResources(job)
+        return task
+
+    def _mesosResources(self, job):
+        """
+        Get the Mesos resources for a task to run the given job in. Every job
+        with the same requirements gets the same list, which must not be
+        changed.
+        """
+        shape = (job.resources.cores, job.resources.disk, job.resources.memory)
+        try:
+            return self.mesosResourcesByType[shape]
+        except KeyError:
+            pass
 
-        task.resources = []
+        resources = []
 
-        task.resources.append(addict.Dict())
-        cpus = task.resources[-1]
+        resources.append(addict.Dict())
+        cpus = resources[-1]
         cpus.name = 'cpus'
         cpus.type = 'SCALAR'
         cpus.scalar.value = job.resources.cores
 
-        task.resources.append(addict.Dict())
-        disk = task.resources[-1]
+        resources.append(addict.Dict())
+        disk = resources[-1]
         disk.name = 'disk'
         disk.type = 'SCALAR'
         if toMiB(job.resources.disk) > 1:
@@ -551,8 +600,8 @@ class MesosBatchSystem(BatchSystemLocalSupport,
                         job.jobID, job.resources.disk)
             disk.scalar.value = 1
         
-        task.resources.append(addict.Dict())
-        mem = task.resources[-1]
+        resources.append(addict.Dict())
+        mem = resources[-1]
         mem.name = 'mem'
         mem.type = 'SCALAR'
         if toMiB(job.resources.memory) > 1:
@@ -561,7 +610,9 @@ class MesosBatchSystem(BatchSystemLocalSupport,
             log.warning("Job %s uses less memory than Mesos requires. Rounding %s up to 1 MiB.",
                         job.jobID, job.resources.memory)
             mem.scalar.value = 1
-        return task
+
+        self.mesosResourcesByType[shape] = resources
+        return resources
 
     def statusUpdate(self, driver, update):
         """
@@ -53,6 +53,10 @@ def _singleMachineOptions(addOptionFn, config):
                 help=("A scaling factor to change the value of all submitted "
                       "tasks's submitted cores. Used in singleMachine batch "
                       "system. default=%s" % 1))
+    addOptionFn("--forkWorkers", dest="forkWorkers", default=None, action="store_true",
+                help=("Start the workers of the singleMachine batch system by forking a process "
+                      "that has Toil and the workflow already loaded, instead of starting a new "
+                      "Python interpreter for each job. default=false"))
     if config.cwl:
         addOptionFn(
             "--noLinkImports", dest="linkImports", default=True,
@@ -92,11 +96,37 @@ def _mesosOptions(addOptionFn, config=None):
 def _kubernetesOptions(addOptionFn, config=None):
     addOptionFn("--kubernetesHostPath", dest="kubernetesHostPath", default=None,
                 help=("Path on Kubernetes hosts to use as shared inter-pod temp directory (default: %(default)s)"))
+    addOptionFn("--kubernetesSubmitThreads", dest="kubernetesSubmitThreads", default=None,
+                help=("The most Kubernetes jobs to be creating at once. default=%i" % 8))
+    addOptionFn("--kubernetesSubmitRate", dest="kubernetesSubmitRate", default=None,
+                help=("The most Kubernetes jobs to create per second, to avoid overloading the "
+                      "Kubernetes API server. default=%i" % 20))
+
+def _gridEngineOptions(addOptionFn, config=None):
+    addOptionFn("--maxArrayJobSize", dest="maxArrayJobSize", default=None,
+                help=("For grid engine batch systems (gridEngine, lsf, slurm, torque), the most "
+                      "jobs that need the same resources to submit together as one array job. "
+                      "Set to 1 to submit every job on its own. default=%i" % 1000))
+    addOptionFn("--pilotJobs", dest="pilotJobs", default=None,
+                help=("For grid engine batch systems (gridEngine, lsf, slurm, torque), the most "
+                      "pilot jobs to submit. Each pilot job takes a whole allocation of "
+                      "--pilotCores and --pilotMemory, and runs as many of the workflow's jobs at "
+                      "once as fit in it, asking the leader for more as they finish. Jobs too "
+                      "big for a pilot are submitted on their own. Set to 0 to submit every job "
+                      "on its own. default=%i" % 0))
+    addOptionFn("--pilotCores", dest="pilotCores", default=None,
+                help=("The cores to ask for for each pilot job. default=the most cores of any "
+                      "node, if the batch system can tell"))
+    addOptionFn("--pilotMemory", dest="pilotMemory", default=None,
+                help=("The memory to ask for for each pilot job. Standard suffixes like K, Ki, "
+                      "M, Mi, G or Gi are supported. default=the most memory of any node, if the "
+                      "batch system can tell"))
 
 # Built in batch systems that have options
 _options = [
     _parasolOptions,
     _singleMachineOptions,
+    _gridEngineOptions,
     _mesosOptions,
     _kubernetesOptions
     ]
@@ -154,6 +184,10 @@ def setDefaultOptions(config):
     config.statePollingWait = None
     config.maxLocalJobs = cpu_count()
     config.manualMemArgs = False
+    config.maxArrayJobSize = 1000
+    config.pilotJobs = 0
+    config.pilotCores = None
+    config.pilotMemory = None
 
     # parasol
     config.parasolCommand = 'parasol'
@@ -161,6 +195,7 @@ def setDefaultOptions(config):
 
     # single machine
     config.scale = 1
+    config.forkWorkers = False
     config.linkImports = False
     config.moveExports = False
 
@@ -169,5 +204,7 @@ def setDefaultOptions(config):
     
     # Kubernetes
     config.kubernetesHostPath = None
+    config.kubernetesSubmitThreads = 8
+    config.kubernetesSubmitRate = 20
 
     
@@ -18,14 +18,16 @@ from builtins import next
 from builtins import str
 from past.utils import old_div
 from future.utils import listitems
+import ctypes
 import logging
 import os
 import re
+import select
 import sys
 import subprocess
 import tempfile
 import time
-from threading import Thread
+from threading import Lock, Thread
 
 # Python 3 compatibility imports
 from six.moves.queue import Empty, Queue
@@ -41,6 +43,60 @@ from toil.common import Toil
 logger = logging.getLogger(__name__)
 
 
+class DirectoryWatcher(object):
+    """
+    Waits for files in a directory to be created or written to. Uses inotify
+    where the C library has it, and otherwise just sleeps.
+
+    Inotify only sees changes made by this machine, so a wait always ends
+    after its timeout, whether or not anything changed.
+    """
+
+    # From <sys/inotify.h>
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+
+    def __init__(self, path):
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+            if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, 'inotify_add_watch failed')
+        except (AttributeError, OSError) as e:
+            logger.debug('Polling %s, since inotify is not available: %s', path, e)
+        else:
+            self.fd = fd
+
+    def wait(self, timeout):
+        """
+        Wait until something in the directory changes, or the timeout passes.
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            # We don't care what happened, only that something did.
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
 class ParasolBatchSystem(BatchSystemSupport):
     """
     The interface for Parasol.
@@ -79,6 +135,8 @@ class ParasolBatchSystem(BatchSystemSupport):
         # memory) tuples for each batch. A new batch is created whenever a job has a new unique
         # combination of cpu and memory requirements.
         self.resultsFiles = dict()
+        # The worker thread reads the results files while new ones are added
+        self.resultsFilesLock = Lock()
         self.maxBatches = config.parasolMaxBatches
 
         # Allows the worker process to send back the IDs of jobs that have finished, so the batch
@@ -91,16 +149,17 @@ class ParasolBatchSystem(BatchSystemSupport):
         # Use this to stop the worker when shutting down
         self.running = True
 
+        # Map from the ID of each job that has been issued, but isn't known to have finished or
+        # been killed yet, to its results file. Jobs that end by themselves are removed in
+        # getUpdatedBatchJob, and jobs that are killed are removed in killBatchJobs.
+        self.issuedJobs = {}
+        self.issuedJobsLock = Lock()
+
         self.worker = Thread(target=self.updatedJobWorker, args=())
         self.worker.start()
         self.usedCpus = 0
         self.jobIDsToCpu = {}
 
-        # Set of jobs that have been issued but aren't known to have finished or been killed yet.
-        #  Jobs that end by themselves are removed in getUpdatedJob, and jobs that are killed are
-        #  removed in killBatchJobs.
-        self.runningJobs = set()
-
     def _runParasol(self, command, autoRetry=True):
         """
         Issues a parasol command using popen to capture the output. If the command fails then it
@@ -144,13 +203,14 @@ class ParasolBatchSystem(BatchSystemSupport):
         # the memory rounded down to the nearest megabyte. Rounding down
         # meams the new job can't ever decrease the memory requirements
         # of jobs already in the batch.
-        if len(self.resultsFiles) >= self.maxBatches:
-            raise RuntimeError( 'Number of batches reached limit of %i' % self.maxBatches)
-        try:
-            results = self.resultsFiles[(truncatedMemory, jobDesc.cores)]
-        except KeyError:
-            results = getTempFile(rootDir=self.parasolResultsDir)
-            self.resultsFiles[(truncatedMemory, jobDesc.cores)] = results
+        with self.resultsFilesLock:
+            if len(self.resultsFiles) >= self.maxBatches:
+                raise RuntimeError( 'Number of batches reached limit of %i' % self.maxBatches)
+            try:
+                results = self.resultsFiles[(truncatedMemory, jobDesc.cores)]
+            except KeyError:
+                results = getTempFile(rootDir=self.parasolResultsDir)
+                self.resultsFiles[(truncatedMemory, jobDesc.cores)] = results
 
         # Prefix the command with environment overrides, optionally looking them up from the
         # current environment if the value is None
@@ -187,7 +247,8 @@ class ParasolBatchSystem(BatchSystemSupport):
             else:
                 jobID = int(match.group(1))
                 self.jobIDsToCpu[jobID] = jobDesc.cores
-                self.runningJobs.add(jobID)
+                with self.issuedJobsLock:
+                    self.issuedJobs[jobID] = results
                 logger.debug("Got the parasol job id: %s from line: %s" % (jobID, line))
                 return jobID
 
@@ -203,15 +264,16 @@ class ParasolBatchSystem(BatchSystemSupport):
         """Kills the given jobs, represented as Job ids, then checks they are dead by checking
         they are not in the list of issued jobs.
         """
+        with self.issuedJobsLock:
+            for jobID in jobIDs:
+                self.issuedJobs.pop(jobID, None)
         while True:
             for jobID in jobIDs:
-                if jobID in self.runningJobs:
-                    self.runningJobs.remove(jobID)
                 exitValue = self._runParasol(['remove', 'job', str(jobID)],
                                              autoRetry=False)[0]
                 logger.debug("Tried to remove jobID: %i, with exit value: %i" % (jobID, exitValue))
-            runningJobs = self.getIssuedBatchJobIDs()
-            if set(jobIDs).difference(set(runningJobs)) == set(jobIDs):
+            # Our own records already say the jobs are gone, so ask Parasol.
+            if not set(jobIDs).intersection(self._listJobIDs()):
                 break
             logger.warning( 'Tried to kill some jobs, but something happened and they are still '
                          'going, will try againin 5s.')
@@ -223,29 +285,36 @@ class ParasolBatchSystem(BatchSystemSupport):
 
     runningPattern = re.compile(r'r\s+([0-9]+)\s+[\S]+\s+[\S]+\s+([0-9]+)\s+[\S]+')
 
-    def getJobIDsForResultsFile(self, resultsFile):
+    def _listJobIDs(self):
         """
-        Get all queued and running jobs for a results file.
+        Ask Parasol for the queued and running jobs in all of our results files.
+
+        :rtype: set[int]
         """
-        jobIDs = []
+        with self.resultsFilesLock:
+            resultsFiles = set(itervalues(self.resultsFiles))
+        jobIDs = set()
         for line in self._runParasol(['-extended', 'list', 'jobs'])[1]:
             fields = line.strip().split()
-            if len(fields) == 0 or fields[-1] != resultsFile:
+            if len(fields) == 0 or fields[-1] not in resultsFiles:
                 continue
-            jobID = fields[0]
-            jobIDs.append(int(jobID))
-        return set(jobIDs)
+            jobIDs.add(int(fields[0]))
+        return jobIDs
+
+    def getJobIDsForResultsFile(self, resultsFile):
+        """
+        Get all queued and running jobs for a results file.
+        """
+        with self.issuedJobsLock:
+            return {jobID for jobID, results in self.issuedJobs.items() if results == resultsFile}
 
     def getIssuedBatchJobIDs(self):
         """
         Gets the list of jobs issued to parasol in all results files, but not including jobs
         created by other users.
         """
-        issuedJobs = set()
-        for resultsFile in itervalues(self.resultsFiles):
-            issuedJobs.update(self.getJobIDsForResultsFile(resultsFile))
-
-        return list(issuedJobs)
+        with self.issuedJobsLock:
+            return list(self.issuedJobs)
 
     def getRunningBatchJobIDs(self):
         """
@@ -255,7 +324,7 @@ class ParasolBatchSystem(BatchSystemSupport):
         # r 5410186 benedictpaten worker 1247029663 localhost
         # r 5410324 benedictpaten worker 1247030076 localhost
         runningJobs = {}
-        issuedJobs = self.getIssuedBatchJobIDs()
+        issuedJobs = set(self.getIssuedBatchJobIDs())
         for line in self._runParasol(['pstat2'])[1]:
             if line != '':
                 match = self.runningPattern.match(line)
@@ -272,13 +341,11 @@ class ParasolBatchSystem(BatchSystemSupport):
                 item = self.updatedJobsQueue.get(timeout=maxWait)
             except Empty:
                 return None
-            try:
-                self.runningJobs.remove(item.jobID)
-            except KeyError:
-                # We tried to kill this job, but it ended by itself instead, so skip it.
-                pass
-            else:
-                return item
+            with self.issuedJobsLock:
+                if self.issuedJobs.pop(item.jobID, None) is None:
+                    # We tried to kill this job, but it ended by itself instead, so skip it.
+                    continue
+            return item
 
     def updatedJobWorker(self):
         """
@@ -300,59 +367,77 @@ class ParasolBatchSystem(BatchSystemSupport):
         char *errFile;    /* Location of stderr file on host */
 
         Plus you finally have the command name.
+
+        Each results file is read from where we left off, so a line is only
+        ever parsed once, however long the file gets.
         """
-        resultsFiles = set()
-        resultsFileHandles = []
+        # Map from results file path to the open results file, and the start
+        # of a line that is still being written to it
+        tails = {}
+        watcher = DirectoryWatcher(self.parasolResultsDir)
         try:
             while self.running:
-                # Look for any new results files that have been created, and open them
-                newResultsFiles = set(os.listdir(self.parasolResultsDir)).difference(resultsFiles)
-                for newFile in newResultsFiles:
-                    newFilePath = os.path.join(self.parasolResultsDir, newFile)
-                    resultsFileHandles.append(open(newFilePath, 'r'))
-                    resultsFiles.add(newFile)
-                for fileHandle in resultsFileHandles:
-                    while self.running:
-                        line = fileHandle.readline()
-                        if not line:
-                            break
-                        assert line[-1] == '\n'
-                        (status, host, jobId, exe, usrTicks, sysTicks, submitTime, startTime,
-                         endTime, user, errFile, command) = line[:-1].split(None, 11)
-                        status = int(status)
-                        jobId = int(jobId)
-                        if os.WIFEXITED(status):
-                            status = os.WEXITSTATUS(status)
-                        else:
-                            status = -status
-                        self.cpuUsageQueue.put(jobId)
-                        startTime = int(startTime)
-                        endTime = int(endTime)
-                        if endTime == startTime:
-                            # Both, start and end time is an integer so to get sub-second
-                            # accuracy we use the ticks reported by Parasol as an approximation.
-                            # This isn't documented but what Parasol calls "ticks" is actually a
-                            # hundredth of a second. Parasol does the unit conversion early on
-                            # after a job finished. Search paraNode.c for ticksToHundreths. We
-                            # also cheat a little by always reporting at least one hundredth of a
-                            # second.
-                            usrTicks = int(usrTicks)
-                            sysTicks = int(sysTicks)
-                            wallTime = float( max( 1, usrTicks + sysTicks) ) * 0.01
-                        else:
-                            wallTime = float(endTime - startTime)
-                        self.updatedJobsQueue.put(UpdatedBatchJobInfo(jobID=jobId, exitStatus=status, wallTime=wallTime, exitReason=None))
-                time.sleep(1)
+                with self.resultsFilesLock:
+                    resultsFiles = list(itervalues(self.resultsFiles))
+                for results in resultsFiles:
+                    if results not in tails:
+                        try:
+                            tails[results] = [open(results, 'rb'), b'']
+                        except FileNotFoundError:
+                            continue
+                    tail = tails[results]
+                    data = tail[0].read()
+                    if not data:
+                        continue
+                    lines = (tail[1] + data).split(b'\n')
+                    # Leave any partial line for next time
+                    tail[1] = lines.pop()
+                    for line in lines:
+                        self._processResultsLine(line.decode('utf-8'))
+                watcher.wait(1)
         except:
             logger.warning("Error occurred while parsing parasol results files.")
             raise
         finally:
-            for fileHandle in resultsFileHandles:
+            watcher.close()
+            for fileHandle, _ in itervalues(tails):
                 fileHandle.close()
 
+    def _processResultsLine(self, line):
+        """
+        Report the job in a line of a results file as finished.
+        """
+        (status, host, jobId, exe, usrTicks, sysTicks, submitTime, startTime,
+         endTime, user, errFile, command) = line.split(None, 11)
+        status = int(status)
+        jobId = int(jobId)
+        if os.WIFEXITED(status):
+            status = os.WEXITSTATUS(status)
+        else:
+            status = -status
+        self.cpuUsageQueue.put(jobId)
+        startTime = int(startTime)
+        endTime = int(endTime)
+        if endTime == startTime:
+            # Both, start and end time is an integer so to get sub-second
+            # accuracy we use the ticks reported by Parasol as an approximation.
+            # This isn't documented but what Parasol calls "ticks" is actually a
+            # hundredth of a second. Parasol does the unit conversion early on
+            # after a job finished. Search paraNode.c for ticksToHundreths. We
+            # also cheat a little by always reporting at least one hundredth of a
+            # second.
+            usrTicks = int(usrTicks)
+            sysTicks = int(sysTicks)
+            wallTime = float( max( 1, usrTicks + sysTicks) ) * 0.01
+        else:
+            wallTime = float(endTime - startTime)
+        self.updatedJobsQueue.put(UpdatedBatchJobInfo(jobID=jobId, exitStatus=status, wallTime=wallTime, exitReason=None))
+
     def shutdown(self):
         self.killBatchJobs(self.getIssuedBatchJobIDs())  # cleanup jobs
-        for results in itervalues(self.resultsFiles):
+        with self.resultsFilesLock:
+            resultsFiles = list(itervalues(self.resultsFiles))
+        for results in resultsFiles:
             exitValue = self._runParasol(['-results=' + results, 'clear', 'sick'],
                                          autoRetry=False)[0]
             if exitValue is not None:
@@ -365,7 +450,7 @@ class ParasolBatchSystem(BatchSystemSupport):
         logger.debug('Joining worker thread...')
         self.worker.join()
         logger.debug('... joined worker thread.')
-        for results in list(self.resultsFiles.values()):
+        for results in resultsFiles:
             os.remove(results)
         os.rmdir(self.parasolResultsDir)
 
@@ -0,0 +1,337 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Pilot jobs for grid engine batch systems.
+
+Rather than submit each Toil job to the scheduler on its own, and wait for the
+scheduler to find room for each one, a grid engine batch system in pilot mode
+submits a few large allocations, each of which runs a pilot agent. The agents
+ask the leader for jobs that fit in the room they have left, run several of
+them at once, and tell the leader how they went.
+
+The leader and the agents talk over TCP, one JSON object per line, with one
+request and one reply per connection, so that the leader doesn't have to keep
+track of connections to agents that come and go. Each request carries a
+secret the leader makes up for the run, and the leader ignores requests
+without it. The agents read the secret from a file only the workflow's user
+can read, since anything on a command line or in a job's environment can be
+seen by other users of the cluster.
+"""
+import argparse
+import hmac
+import json
+import logging
+import os
+import secrets
+import signal
+import socket
+import socketserver
+import subprocess
+import tempfile
+import time
+from threading import Condition, Thread
+
+from toil.batchSystems.abstractBatchSystem import (BatchJobExitReason,
+                                                   EXIT_STATUS_UNAVAILABLE_VALUE,
+                                                   UpdatedBatchJobInfo)
+from toil.batchSystems.options import getPublicIP
+
+logger = logging.getLogger(__name__)
+
+
+class PilotServer(object):
+    """
+    The leader's side of pilot mode. Holds the jobs waiting for room on an
+    agent, hands them out to agents that ask, and reports the jobs the agents
+    finish to the batch system's queue of updated jobs.
+    """
+
+    def __init__(self, updatedJobsQueue, secretDir):
+        """
+        :param Queue updatedJobsQueue: Where to put an UpdatedBatchJobInfo for
+               each job that finishes.
+        :param str secretDir: A directory the agents can see, to write the
+               file with the secret in.
+        """
+        self.updatedJobsQueue = updatedJobsQueue
+        # Guards everything below, and is notified when jobs stop running
+        self.lock = Condition()
+        # (jobID, cores, memory, command) tuples for jobs no agent has taken
+        # yet, oldest first
+        self.waitingJobs = []
+        # Map from jobID to the ID of the agent running it, the time it was
+        # started, and its cores
+        self.runningJobs = {}
+        # IDs of running jobs that agents should kill, and not report on
+        self.killing = set()
+        self.shuttingDown = False
+        # Agents must send this with every request. mkstemp makes the file
+        # readable only by us.
+        self.secret = secrets.token_hex(32)
+        fd, self.secretPath = tempfile.mkstemp(prefix='pilot-secret-', dir=secretDir)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.secret)
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline().decode('utf-8'))
+                    secret = str(request['secret'])
+                except (ValueError, TypeError, KeyError):
+                    secret = ''
+                if not hmac.compare_digest(secret.encode('utf-8'), server.secret.encode('utf-8')):
+                    logger.warning('Ignoring a pilot request from %s without the secret', self.client_address[0])
+                    return
+                reply = server._handle(request)
+                self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+        self.server = socketserver.ThreadingTCPServer(('0.0.0.0', 0), Handler)
+        self.server.daemon_threads = True
+        self.address = '%s:%i' % (getPublicIP(), self.server.server_address[1])
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def issueJob(self, jobID, cores, memory, command):
+        """
+        Queue a job to be run by the first agent with room for it.
+        """
+        with self.lock:
+            self.waitingJobs.append((jobID, cores, memory, command))
+
+    def killJobs(self, jobIDs):
+        """
+        Kill the given jobs, if they are ours, and wait for them to stop.
+
+        :param set jobIDs: The IDs of jobs to kill, which may include jobs not
+               run by pilots.
+        :return: The IDs of the jobs that were ours.
+        :rtype: set
+        """
+        with self.lock:
+            ours = {job[0] for job in self.waitingJobs if job[0] in jobIDs}
+            self.waitingJobs = [job for job in self.waitingJobs if job[0] not in jobIDs]
+            running = {jobID for jobID in jobIDs if jobID in self.runningJobs}
+            self.killing.update(running)
+            while any(jobID in self.runningJobs for jobID in running):
+                self.lock.wait()
+        return ours | running
+
+    def agentEnded(self, agentID):
+        """
+        Note that the allocation an agent was running in has ended. Whatever
+        it was still running is reported as lost.
+        """
+        with self.lock:
+            for jobID, (runningAgentID, _, _) in list(self.runningJobs.items()):
+                if runningAgentID == agentID:
+                    del self.runningJobs[jobID]
+                    if jobID in self.killing:
+                        self.killing.remove(jobID)
+                    else:
+                        logger.warning('Pilot %s ended while running job %s', agentID, jobID)
+                        self.updatedJobsQueue.put(UpdatedBatchJobInfo(jobID=jobID,
+                                                                      exitStatus=EXIT_STATUS_UNAVAILABLE_VALUE,
+                                                                      exitReason=BatchJobExitReason.LOST,
+                                                                      wallTime=None))
+            self.lock.notify_all()
+
+    def getRunningJobIDs(self):
+        """
+        :return: Map from the ID of each running job to how long it has been
+                 running, in seconds.
+        :rtype: dict
+        """
+        now = time.time()
+        with self.lock:
+            return {jobID: now - started for jobID, (_, started, _) in self.runningJobs.items()}
+
+    def demand(self):
+        """
+        :return: The cores wanted by the jobs that are waiting or running.
+        :rtype: float
+        """
+        with self.lock:
+            return (sum(job[1] for job in self.waitingJobs) +
+                    sum(cores for _, _, cores in self.runningJobs.values()))
+
+    def shutdown(self):
+        """
+        Tell agents to stop when they next ask for work, and stop listening.
+        """
+        with self.lock:
+            self.shuttingDown = True
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        try:
+            os.unlink(self.secretPath)
+        except FileNotFoundError:
+            pass
+
+    def _handle(self, request):
+        """
+        Take in what an agent has finished, and tell it what to start and kill.
+        """
+        agentID = request['agent']
+        with self.lock:
+            for jobID, exitStatus, wallTime in request['finished']:
+                if self.runningJobs.get(jobID, (None,))[0] != agentID:
+                    continue
+                del self.runningJobs[jobID]
+                if jobID in self.killing:
+                    # The leader has already forgotten it
+                    self.killing.remove(jobID)
+                else:
+                    self.updatedJobsQueue.put(UpdatedBatchJobInfo(jobID=jobID, exitStatus=exitStatus,
+                                                                  exitReason=None, wallTime=wallTime))
+            self.lock.notify_all()
+
+            kill = [jobID for jobID in self.killing if self.runningJobs[jobID][0] == agentID]
+            start = []
+            if not self.shuttingDown:
+                freeCores, freeMemory = request['freeCores'], request['freeMemory']
+                stillWaiting = []
+                for job in self.waitingJobs:
+                    jobID, cores, memory, command = job
+                    if cores <= freeCores and memory <= freeMemory:
+                        freeCores -= cores
+                        freeMemory -= memory
+                        self.runningJobs[jobID] = (agentID, time.time(), cores)
+                        start.append({'jobID': jobID, 'cores': cores, 'memory': memory, 'command': command})
+                    else:
+                        stillWaiting.append(job)
+                self.waitingJobs = stillWaiting
+        if start:
+            logger.debug('Starting jobs %s on pilot %s', [job['jobID'] for job in start], agentID)
+        return {'start': start, 'kill': kill, 'shutdown': self.shuttingDown}
+
+
+class PilotAgent(object):
+    """
+    Runs in an allocation from the scheduler, and runs jobs from the leader in
+    it until the leader says to stop or there has been no work for a while.
+    """
+
+    # Seconds between requests to the leader when nothing finishes
+    pollInterval = 1
+
+    def __init__(self, leaderAddress, secret, agentID, cores, memory, idleTimeout):
+        host, port = leaderAddress.rsplit(':', 1)
+        self.leaderAddress = (host, int(port))
+        self.secret = secret
+        self.agentID = agentID
+        self.cores = cores
+        self.memory = memory
+        self.idleTimeout = idleTimeout
+        # Map from jobID to the Popen, start time, cores and memory of each
+        # running job
+        self.running = {}
+
+    def _request(self, request):
+        with socket.create_connection(self.leaderAddress, timeout=60) as sock:
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            with sock.makefile('rb') as f:
+                return json.loads(f.readline().decode('utf-8'))
+
+    def _kill(self, jobID):
+        popen = self.running[jobID][0]
+        try:
+            # Jobs run in their own process groups, so we can kill all of a
+            # job's processes.
+            os.killpg(popen.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _waitForJobs(self):
+        """
+        Wait up to pollInterval for running jobs to finish.
+
+        :return: [jobID, exitStatus, wallTime] for each job that finished
+        :rtype: list
+        """
+        deadline = time.time() + self.pollInterval
+        while True:
+            finished = []
+            for jobID, (popen, started, _, _) in list(self.running.items()):
+                exitStatus = popen.poll()
+                if exitStatus is not None:
+                    del self.running[jobID]
+                    finished.append([jobID, exitStatus, time.time() - started])
+            if finished or time.time() >= deadline:
+                return finished
+            time.sleep(0.05)
+
+    def run(self):
+        finished = []
+        lastBusy = time.time()
+        lastHeard = time.time()
+        while True:
+            freeCores = self.cores - sum(cores for _, _, cores, _ in self.running.values())
+            freeMemory = self.memory - sum(memory for _, _, _, memory in self.running.values())
+            try:
+                reply = self._request({'secret': self.secret, 'agent': self.agentID, 'finished': finished,
+                                       'freeCores': freeCores, 'freeMemory': freeMemory})
+            except (OSError, ValueError) as e:
+                if time.time() - lastHeard > self.idleTimeout:
+                    logger.error('Lost touch with the leader: %s', e)
+                    break
+                logger.warning('Could not reach the leader, trying again: %s', e)
+                time.sleep(self.pollInterval)
+                continue
+            lastHeard = time.time()
+            finished = []
+            if reply['shutdown']:
+                break
+            for jobID in reply['kill']:
+                if jobID in self.running:
+                    self._kill(jobID)
+            for job in reply['start']:
+                logger.debug('Starting job %s: %s', job['jobID'], job['command'])
+                popen = subprocess.Popen(job['command'], shell=True, start_new_session=True)
+                self.running[job['jobID']] = (popen, time.time(), job['cores'], job['memory'])
+            if self.running or reply['start']:
+                lastBusy = time.time()
+            elif time.time() - lastBusy > self.idleTimeout:
+                # Give back the allocation. The leader won't give us more work
+                # now, since it only hands out work when asked.
+                logger.info('No work for %i seconds, stopping', self.idleTimeout)
+                return
+            finished = self._waitForJobs()
+        for jobID in list(self.running):
+            self._kill(jobID)
+        for popen, _, _, _ in self.running.values():
+            popen.wait()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Run Toil jobs from a leader in a grid engine allocation.')
+    parser.add_argument('--leader', required=True, help='The host:port the leader listens on.')
+    parser.add_argument('--secretFile', required=True, help="The file with the leader's secret in.")
+    parser.add_argument('--agentID', required=True, type=int, help='The ID the leader knows this pilot by.')
+    parser.add_argument('--cores', required=True, type=float, help='The cores to run jobs in.')
+    parser.add_argument('--memory', required=True, type=int, help='The bytes of memory to run jobs in.')
+    parser.add_argument('--idleTimeout', default=60, type=float,
+                        help='Seconds to wait without work before stopping.')
+    options = parser.parse_args()
+    with open(options.secretFile) as f:
+        secret = f.read().strip()
+    PilotAgent(options.leader, secret, options.agentID, options.cores, options.memory, options.idleTimeout).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,8 +14,10 @@
 
 from past.utils import old_div
 from contextlib import contextmanager
+import collections
 import logging
 import os
+import selectors
 import time
 import math
 import subprocess
@@ -27,6 +29,7 @@ from six.moves.queue import Empty, Queue
 
 import toil
 from toil.batchSystems.abstractBatchSystem import BatchSystemSupport, EXIT_STATUS_UNAVAILABLE_VALUE, UpdatedBatchJobInfo
+from toil.batchSystems.forkserver import Forkserver, ForkedChild
 from toil.lib.threading import cpu_count
 from toil import worker as toil_worker
 from toil.common import Toil
@@ -44,13 +47,24 @@ class SingleMachineBatchSystem(BatchSystemSupport):
     Communication with the daddy thread happens via two queues: one queue of
     jobs waiting to be run (the input queue), and one queue of jobs that are
     finished/stopped and need to be returned by getUpdatedBatchJob (the output
-    queue).
+    queue). The daddy thread sleeps until a job is put on the input queue or
+    one of its children exits.
+
+    Jobs that cannot start yet wait in a queue for each combination of
+    resources they need. Jobs that fit are packed in biggest-first, and a job
+    that has waited longer than reservationDelay has resources held back for
+    it, so that it is not starved by smaller jobs that keep fitting in first.
 
     When the batch system is shut down, the daddy thread is stopped.
 
     If running in debug-worker mode, jobs are run immediately as they are sent
     to the batch system, in the sending thread, and the daddy thread is not
     run. But the queues are still used.
+
+    If the forkWorkers option is set, Toil workers are forked from a
+    forkserver process that has Toil and the workflow already loaded, instead
+    of each being started from scratch. Other commands are still run through
+    the shell.
     """
 
     @classmethod
@@ -70,6 +84,13 @@ class SingleMachineBatchSystem(BatchSystemSupport):
     """
     physicalMemory = toil.physicalMemory()
 
+    reservationDelay = 60
+    """
+    The number of seconds the longest-waiting job can be passed over by jobs
+    that fit in before it. After that, nothing starts that would use resources
+    it is waiting for.
+    """
+
     def __init__(self, config, maxCores, maxMemory, maxDisk):
         
         # Limit to the smaller of the user-imposed limit and what we actually
@@ -124,6 +145,11 @@ class SingleMachineBatchSystem(BatchSystemSupport):
         # A queue of jobs waiting to be executed. Consumed by the daddy thread.
         self.inputQueue = Queue()
 
+        # A dict from (coreFractions, memory, disk) to a deque of the
+        # WaitingJobs that need those resources, oldest first. Only used by
+        # the daddy thread.
+        self.waitingJobs = {}
+
         # A queue of finished jobs. Produced by the daddy thread.
         self.outputQueue = Queue()
 
@@ -146,6 +172,13 @@ class SingleMachineBatchSystem(BatchSystemSupport):
         """
         :type: dict[int,str]
         """
+        # A dict mapping child PIDs to the pidfds we watch them exit through,
+        # if the platform has them.
+        self.childToPidfd = {}
+        """
+        :type: dict[int,int]
+        """
+        self.usePidfds = hasattr(os, 'pidfd_open')
 
         # A pool representing available CPU in units of minCores
         self.coreFractions = ResourcePool(int(old_div(self.maxCores, self.minCores)), 'cores')
@@ -166,9 +199,24 @@ class SingleMachineBatchSystem(BatchSystemSupport):
         # If it breaks it will fill this in
         self.daddyException = None
 
+        # The daddy thread waits for children and for wake-ups with this
+        self.selector = None
+        # The pipe we write to to wake the daddy thread
+        self.wakeupReader, self.wakeupWriter = None, None
+        # The forkserver we start workers from, if we use one
+        self.forkserver = None
+
         if self.debugWorker:
             log.debug('Started in worker debug mode.')
         else:
+            self.selector = selectors.DefaultSelector()
+            self.wakeupReader, self.wakeupWriter = os.pipe()
+            os.set_blocking(self.wakeupReader, False)
+            os.set_blocking(self.wakeupWriter, False)
+            self.selector.register(self.wakeupReader, selectors.EVENT_READ)
+            if config.forkWorkers:
+                self.forkserver = Forkserver()
+                self.selector.register(self.forkserver, selectors.EVENT_READ, self.forkserver)
             self.daddyThread = Thread(target=self.daddy, daemon=True)
             self.daddyThread.start()
             log.debug('Started in normal mode.')
@@ -194,47 +242,16 @@ class SingleMachineBatchSystem(BatchSystemSupport):
             while not self.shuttingDown.is_set():
                 # Main loop
 
-                while not self.shuttingDown.is_set():
-                    # Try to start as many jobs as we can try to start
-                    try:
-                        # Grab something from the input queue if available.
-                        args = self.inputQueue.get_nowait()
-                        jobCommand, jobID, jobCores, jobMemory, jobDisk, environment = args
+                # Take the newly issued jobs, and start what we can.
+                self._takeNewJobs()
+                self._startWaitingJobs()
 
-                        coreFractions = int(old_div(jobCores, self.minCores))
-                        
-                        # Try to start the child
-                        result = self._startChild(jobCommand, jobID,
-                            coreFractions, jobMemory, jobDisk, environment)
-
-                        if result is None:
-                            # We did not get the resources to run this job.
-                            # Requeue last, so we can look at the next job.
-                            # TODO: Have some kind of condition the job can wait on,
-                            # but without threads (queues for jobs needing
-                            # cores/memory/disk individually)?
-                            self.inputQueue.put(args)
-                            break
-
-                        # Otherwise it's a PID if it succeeded, or False if it couldn't
-                        # start. But we don't care either way here.
-
-                    except Empty:
-                        # Nothing to run. Stop looking in the queue.
-                        break
-
-                # Now check on our children.
-                for done_pid in self._pollForDoneChildrenIn(self.children):
+                # Then sleep until there is a new job or a finished child.
+                for done_pid in self._waitForEvents():
                     # A child has actually finished.
                     # Clean up after it.
                     self._handleChild(done_pid)
 
-                # Then loop again: start and collect more jobs.
-                # TODO: It would be good to be able to wait on a new job or a finished child, whichever comes first.
-                # For now we just sleep and loop.
-                time.sleep(0.01)
-                    
-
             # When we get here, we are shutting down.
             
             for popen in self.children.values():
@@ -243,6 +260,9 @@ class SingleMachineBatchSystem(BatchSystemSupport):
             for popen in self.children.values():
                 # Reap all the children
                 popen.wait()
+            for pidfd in self.childToPidfd.values():
+                os.close(pidfd)
+            self.childToPidfd.clear()
             
             # Then exit the thread.
             return
@@ -252,6 +272,142 @@ class SingleMachineBatchSystem(BatchSystemSupport):
             self.daddyException = e
             raise
 
+    def _wakeDaddy(self):
+        """
+        Make the daddy thread look at the input queue and its children.
+        """
+        try:
+            os.write(self.wakeupWriter, b'\0')
+        except BlockingIOError:
+            # The pipe is full, so the daddy thread has a wake-up coming anyway.
+            pass
+
+    def _waitForEvents(self):
+        """
+        Sleep until a new job is issued, we are shutting down, or a child
+        exits.
+
+        Return a collection of the PIDs of the children that have finished.
+        """
+        done = set()
+        # Without pidfds we can't be woken by children exiting, so we have to
+        # poll them.
+        timeout = None if self.usePidfds else 0.01
+        if self.forkserver is not None and self.forkserver.exits:
+            # We heard about some children exiting while starting others.
+            timeout = 0
+        for key, _ in self.selector.select(timeout):
+            if key.fd == self.wakeupReader:
+                try:
+                    while os.read(self.wakeupReader, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            elif key.data is self.forkserver:
+                self.forkserver.readReplies()
+            else:
+                # A child's pidfd is readable, so the child has exited.
+                done.add(key.data)
+        if self.forkserver is not None:
+            done.update(self.forkserver.exits)
+        if not self.usePidfds:
+            done.update(self._pollForDoneChildrenIn(self.children))
+        return done
+
+    def _watchChild(self, popen):
+        """
+        Arrange for the daddy thread to be woken when the given child exits.
+        """
+        if not self.usePidfds or isinstance(popen, ForkedChild):
+            # The forkserver tells us when its children exit.
+            return
+        try:
+            pidfd = os.pidfd_open(popen.pid)
+        except OSError as e:
+            # The kernel is too old, or we are out of file descriptors. Either
+            # way, fall back on polling for all our children.
+            log.warning('Cannot watch child %d with a pidfd, polling for children instead: %s',
+                        popen.pid, e)
+            self.usePidfds = False
+            return
+        self.childToPidfd[popen.pid] = pidfd
+        self.selector.register(pidfd, selectors.EVENT_READ, popen.pid)
+
+    def _takeNewJobs(self):
+        """
+        Move the jobs on the input queue to the queues of waiting jobs.
+        """
+        while True:
+            try:
+                jobCommand, jobID, jobCores, jobMemory, jobDisk, environment = self.inputQueue.get_nowait()
+            except Empty:
+                return
+            resources = (int(old_div(jobCores, self.minCores)), jobMemory, jobDisk)
+            if resources not in self.waitingJobs:
+                self.waitingJobs[resources] = collections.deque()
+            self.waitingJobs[resources].append(WaitingJob(time.time(), jobCommand, jobID, environment))
+
+    def _share(self, resources):
+        """
+        Return the biggest fraction of any of our resources that a job needing
+        the given (coreFractions, memory, disk) would use.
+        """
+        coreFractions, jobMemory, jobDisk = resources
+        return max(old_div(coreFractions, int(old_div(self.maxCores, self.minCores))),
+                   old_div(jobMemory, self.maxMemory),
+                   old_div(jobDisk, self.maxDisk))
+
+    def _shortOf(self, resources, reserved):
+        """
+        Return the name of a resource there is not enough of, after what is
+        reserved, to start a job needing the given (coreFractions, memory,
+        disk). Return None if the job fits.
+        """
+        for pool, needed, held in zip((self.coreFractions, self.memory, self.disk), resources, reserved):
+            if needed > max(pool.value - held, 0):
+                return pool.resourceType
+        return None
+
+    def _startWaitingJobs(self):
+        """
+        Start as many of the waiting jobs as we can.
+
+        The biggest jobs are started first, so that small jobs fill in the
+        gaps they leave. If the job that has waited longest has waited more
+        than reservationDelay seconds and cannot start, the resources it
+        needs are held back for it: other jobs only start in what is left over.
+        """
+        if not self.waitingJobs:
+            return
+
+        reserved = (0, 0, 0)
+        oldest = min(self.waitingJobs, key=lambda resources: self.waitingJobs[resources][0].time)
+        waited = time.time() - self.waitingJobs[oldest][0].time
+        if waited >= self.reservationDelay and self._shortOf(oldest, reserved) is not None:
+            reserved = oldest
+            self._setSchedulingStatusMessage('Holding resources for job %s, which has waited %i seconds'
+                                             % (self.waitingJobs[oldest][0].jobID, waited))
+
+        for resources in sorted(self.waitingJobs, key=self._share, reverse=True):
+            queue = self.waitingJobs[resources]
+            while queue:
+                waiting = queue[0]
+                shortOf = self._shortOf(resources, reserved)
+                if shortOf is not None:
+                    if resources != reserved:
+                        self._setSchedulingStatusMessage('Not enough %s to run job %s' % (shortOf, waiting.jobID))
+                    # The rest of this queue needs the same, so won't fit either.
+                    break
+                queue.popleft()
+                # This returns a PID if it succeeded, or False if it couldn't
+                # start. But we don't care either way here.
+                result = self._startChild(waiting.jobCommand, waiting.jobID, *resources,
+                                          environment=waiting.environment)
+                # We checked that the job fits, and only we take resources.
+                assert result is not None
+            if not queue:
+                del self.waitingJobs[resources]
+
     def _checkOnDaddy(self):
         if self.daddyException is not None:
             # The daddy thread broke and we cannot do our job
@@ -390,9 +546,13 @@ class SingleMachineBatchSystem(BatchSystemSupport):
 
                     try:
                         # Launch the job
-                        popen = subprocess.Popen(jobCommand,
-                                                 shell=True,
-                                                 env=dict(os.environ, **environment))
+                        commandTokens = jobCommand.split()
+                        if self.forkserver is not None and os.path.basename(commandTokens[0]) == '_toil_worker':
+                            popen = self.forkserver.startJob(commandTokens[1:], environment)
+                        else:
+                            popen = subprocess.Popen(jobCommand,
+                                                     shell=True,
+                                                     env=dict(os.environ, **environment))
                     except Exception:
                         # If the job can't start, make sure we release resources now
                         self.coreFractions.release(coreFractions)
@@ -404,11 +564,6 @@ class SingleMachineBatchSystem(BatchSystemSupport):
                         # Report as failed.
                         self.outputQueue.put(UpdatedBatchJobInfo(jobID=jobID, exitStatus=EXIT_STATUS_UNAVAILABLE_VALUE, wallTime=0, exitReason=None))
 
-                        # Free resources
-                        self.coreFractions.release(coreFractions)
-                        self.memory.release(jobMemory)
-                        self.disk.release(jobDisk)
-
                         # Complain it broke.
                         return False
                     else:
@@ -416,6 +571,8 @@ class SingleMachineBatchSystem(BatchSystemSupport):
                         self.children[popen.pid] = popen
                         # Make sure we can look it up by PID later
                         self.childToJob[popen.pid] = jobID
+                        # And that we hear about it finishing
+                        self._watchChild(popen)
                         # Record that the job is running, and the resources it is using
                         info = Info(startTime, popen, (coreFractions, jobMemory, jobDisk), killIntended=False)
                         self.runningJobs[jobID] = info
@@ -464,6 +621,10 @@ class SingleMachineBatchSystem(BatchSystemSupport):
         self.runningJobs.pop(jobID)
         self.childToJob.pop(pid)
         self.children.pop(pid)
+        pidfd = self.childToPidfd.pop(pid, None)
+        if pidfd is not None:
+            self.selector.unregister(pidfd)
+            os.close(pidfd)
         
         # See how the child did, and reap it.
         statusCode = popen.wait()
@@ -513,6 +674,7 @@ class SingleMachineBatchSystem(BatchSystemSupport):
             # Queue the job for later
             self.inputQueue.put((jobDesc.command, jobID, cores, jobDesc.memory,
                                 jobDesc.disk, self.environment.copy()))
+            self._wakeDaddy()
             
 
         return jobID
@@ -560,8 +722,14 @@ class SingleMachineBatchSystem(BatchSystemSupport):
         if self.daddyThread is not None:
             # Tell the daddy thread to stop.
             self.shuttingDown.set()
+            self._wakeDaddy()
             # Wait for it to stop.
             self.daddyThread.join()
+            self.selector.close()
+            os.close(self.wakeupReader)
+            os.close(self.wakeupWriter)
+            if self.forkserver is not None:
+                self.forkserver.shutdown()
 
         BatchSystemSupport.workerCleanup(self.workerCleanupInfo)
 
@@ -581,6 +749,7 @@ class SingleMachineBatchSystem(BatchSystemSupport):
     @classmethod
     def setOptions(cls, setOption):
         setOption("scale", default=1)
+        setOption("forkWorkers", default=False)
 
 
 class Info(object):
@@ -599,6 +768,20 @@ class Info(object):
         self.killIntended = killIntended
 
 
+class WaitingJob(object):
+    """
+    Record for a job waiting for the resources to run.
+
+    Stores the time the daddy thread took the job from the input queue, and
+    the command, ID and environment to start the job with.
+    """
+    def __init__(self, waitTime, jobCommand, jobID, environment):
+        self.time = waitTime
+        self.jobCommand = jobCommand
+        self.jobID = jobID
+        self.environment = environment
+
+
 class ResourcePool(object):
     """
     Represents an integral amount of a resource (such as memory bytes).
@@ -30,8 +30,9 @@ class SlurmBatchSystem(AbstractGridEngineBatchSystem):
             # Should return a dictionary of Job IDs and number of seconds
             times = {}
             with self.runningJobsLock:
-                currentjobs = dict((str(self.batchJobIDs[x][0]), x) for x in self.runningJobs)
-            # currentjobs is a dictionary that maps a slurm job id (string) to our own internal job id
+                currentjobs = dict((self.getBatchSystemID(x), x) for x in self.runningJobs)
+            # currentjobs is a dictionary that maps a slurm job id (string) to our own internal job id.
+            # Array job elements are listed as <array job id>_<index>, as they are in currentjobs.
             # squeue arguments:
             # -h for no header
             # --format to get jobid i, state %t and time days-hours:minutes:seconds
@@ -54,9 +55,9 @@ class SlurmBatchSystem(AbstractGridEngineBatchSystem):
         def prepareSubmission(self, cpu, memory, jobID, command, jobName):
             return self.prepareSbatch(cpu, memory, jobID, jobName) + ['--wrap={}'.format(command)]
 
-        def submitJob(self, subLine):
+        def submitJob(self, subLine, script=None):
             try:
-                output = call_command(subLine)
+                output = call_command(subLine, input=script)
                 # sbatch prints a line like 'Submitted batch job 2954103'
                 result = int(output.strip().split()[-1])
                 logger.debug("sbatch submitted job %d", result)
@@ -65,98 +66,124 @@ class SlurmBatchSystem(AbstractGridEngineBatchSystem):
                 logger.error("sbatch command failed")
                 raise e
 
+        def prepareArraySubmission(self, cpu, memory, jobs):
+            jobID, _, jobName = jobs[0]
+            sbatch_line = self.prepareSbatch(cpu, memory, 'array_{}'.format(jobID), jobName,
+                                             arraySize=len(jobs))
+            script = self.arrayJobScript(jobs, 'SLURM_ARRAY_TASK_ID', 'slurm',
+                                         '${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}')
+            return sbatch_line, script
+
+        def submitArrayJob(self, subLine, script):
+            # sbatch reads the script from standard input
+            return self.submitJob(subLine, script)
+
+        def getArrayElementID(self, arrayJobID, index):
+            return '{}_{}'.format(arrayJobID, index)
+
         def getJobExitCode(self, slurmJobID):
-            logger.debug("Getting exit code for slurm job %d", int(slurmJobID))
+            return self.getJobExitCodes([slurmJobID])[slurmJobID]
+
+        def getJobExitCodes(self, slurmJobIDs):
+            logger.debug("Getting exit codes for slurm jobs %s", ','.join(map(str, slurmJobIDs)))
 
             try:
-                state, rc = self._getJobDetailsFromSacct(slurmJobID)
+                details = self._getJobDetailsFromSacct(slurmJobIDs)
             except CalledProcessErrorStderr:
                 # no accounting system or some other error
-                state, rc = self._getJobDetailsFromScontrol(slurmJobID)
-
-            logger.debug("s job state is %s", state)
-            # If Job is in a running state, return None to indicate we don't have an update
-            if state in ('PENDING', 'RUNNING', 'CONFIGURING', 'COMPLETING', 'RESIZING', 'SUSPENDED'):
-                return None
+                details = self._getJobDetailsFromScontrol(slurmJobIDs)
 
-            return rc
-
-        def _getJobDetailsFromSacct(self, slurmJobID):
-            # SLURM job exit codes are obtained by running sacct.
+            exitCodes = {}
+            for slurmJobID in slurmJobIDs:
+                state, rc = details.get(str(slurmJobID), (None, None))
+                logger.debug("s job %s state is %s", slurmJobID, state)
+                # If Job is in a running state, return None to indicate we don't have an update
+                if state in ('PENDING', 'RUNNING', 'CONFIGURING', 'COMPLETING', 'RESIZING', 'SUSPENDED'):
+                    rc = None
+                exitCodes[slurmJobID] = rc
+            return exitCodes
+
+        def _parseExitCode(self, exitcode):
+            status, signal = [int(n) for n in exitcode.split(':')]
+            if signal > 0:
+                # A non-zero signal may indicate e.g. an out-of-memory killed job
+                status = 128 + signal
+            return status
+
+        def _getJobDetailsFromSacct(self, slurmJobIDs):
+            # SLURM job exit codes are obtained by running sacct, once for all the jobs.
             args = ['sacct',
                     '-n', # no header
-                    '-j', str(slurmJobID), # job
-                    '--format', 'State,ExitCode', # specify output columns
+                    '-j', ','.join(map(str, slurmJobIDs)), # jobs
+                    '--format', 'JobID,State,ExitCode', # specify output columns
                     '-P', # separate columns with pipes
                     '-S', '1970-01-01'] # override start time limit
 
             stdout = call_command(args)
+            details = {}
             for line in stdout.split('\n'):
                 logger.debug("%s output %s", args[0], line)
                 values = line.strip().split('|')
-                if len(values) < 2:
+                if len(values) < 3:
                     continue
-                state, exitcode = values
-                logger.debug("sacct job state is %s", state)
-                # If Job is in a running state, return None to indicate we don't have an update
-                status, signal = [int(n) for n in exitcode.split(':')]
-                if signal > 0:
-                    # A non-zero signal may indicate e.g. an out-of-memory killed job
-                    status = 128 + signal
-                logger.debug("sacct exit code is %s, returning status %d", exitcode, status)
-                return state, status
-            logger.debug("Did not find exit code for job in sacct output")
-            return None, None
-
-        def _getJobDetailsFromScontrol(self, slurmJobID):
+                slurmJobID, state, exitcode = values
+                if '.' in slurmJobID or slurmJobID in details:
+                    # This is a step of a job, like its batch script, or an earlier record of the job
+                    continue
+                status = self._parseExitCode(exitcode)
+                logger.debug("sacct job %s state is %s, exit code is %s, returning status %d",
+                             slurmJobID, state, exitcode, status)
+                details[slurmJobID] = (state, status)
+            if not details:
+                logger.debug("Did not find exit codes for jobs in sacct output")
+            return details
+
+        def _getJobDetailsFromScontrol(self, slurmJobIDs):
+            # scontrol lists every job slurmctld still remembers, one per line
             args = ['scontrol',
+                    '--oneliner',
                     'show',
-                    'job',
-                    str(slurmJobID)]
+                    'job']
 
             stdout = call_command(args)
-            job = dict()
-            for line in stdout:
+            wanted = set(map(str, slurmJobIDs))
+            details = {}
+            for line in stdout.split('\n'):
                 logger.debug("%s output %s", args[0], line)
-                values = line.strip().split()
-
-                # If job information is not available an error is issued:
-                # slurm_load_jobs error: Invalid job id specified
-                # There is no job information, so exit.
-                if len(values) > 0 and values[0] == 'slurm_load_jobs':
-                    return (None, None)
-
-                # Output is in the form of many key=value pairs, multiple pairs on each line
-                # and multiple lines in the output. Each pair is pulled out of each line and
-                # added to a dictionary
-                for v in values:
-                    bits = v.split('=')
-                    job[bits[0]] = bits[1]
-
-            state = job['JobState']
-            try:
-                exitcode = job['ExitCode']
-                if exitcode is not None:
-                    status, signal = [int(n) for n in exitcode.split(':')]
-                    if signal > 0:
-                        # A non-zero signal may indicate e.g. an out-of-memory killed job
-                        status = 128 + signal
-                    logger.debug("scontrol exit code is %s, returning status %d", exitcode, status)
-                    rc = status
-                else:
-                    rc = None
-            except KeyError:
+                # Output is in the form of many key=value pairs on each line.
+                # Each pair is pulled out of the line and added to a dictionary
+                job = dict()
+                for v in line.strip().split():
+                    bits = v.split('=', 1)
+                    if len(bits) == 2:
+                        job[bits[0]] = bits[1]
+                if 'JobId' not in job:
+                    continue
+                slurmJobID = job['JobId']
+                if 'ArrayTaskId' in job:
+                    # Array job elements each have their own JobId, but we know them by their index
+                    slurmJobID = '{}_{}'.format(job['ArrayJobId'], job['ArrayTaskId'])
+                if slurmJobID not in wanted:
+                    continue
+
+                state = job.get('JobState')
                 rc = None
+                if job.get('ExitCode') is not None:
+                    rc = self._parseExitCode(job['ExitCode'])
+                    logger.debug("scontrol exit code is %s, returning status %d", job['ExitCode'], rc)
+                details[slurmJobID] = (state, rc)
 
-            return state, rc
+            return details
 
         """
         Implementation-specific helper methods
         """
 
-        def prepareSbatch(self, cpu, mem, jobID, jobName):
+        def prepareSbatch(self, cpu, mem, jobID, jobName, arraySize=None):
             #  Returns the sbatch command line before the script to run
             sbatch_line = ['sbatch', '-J', 'toil_job_{}_{}'.format(jobID, jobName)]
+            if arraySize is not None:
+                sbatch_line.append('--array=1-{}'.format(arraySize))
 
             if self.boss.environment:
                 argList = []
@@ -173,8 +200,10 @@ class SlurmBatchSystem(AbstractGridEngineBatchSystem):
             if cpu is not None:
                 sbatch_line.append(f'--cpus-per-task={math.ceil(cpu)}')
 
-            stdoutfile = self.boss.formatStdOutErrPath(jobID, 'slurm', '%j', 'std_output')
-            stderrfile = self.boss.formatStdOutErrPath(jobID, 'slurm', '%j', 'std_error')
+            # Array job elements share these files unless they are told apart
+            batchJobIDfmt = '%j' if arraySize is None else '%A_%a'
+            stdoutfile = self.boss.formatStdOutErrPath(jobID, 'slurm', batchJobIDfmt, 'std_output')
+            stderrfile = self.boss.formatStdOutErrPath(jobID, 'slurm', batchJobIDfmt, 'std_error')
             sbatch_line.extend(['-o', stdoutfile, '-e', stderrfile])
 
             # "Native extensions" for SLURM (see DRMAA or SAGA)
@@ -66,18 +66,19 @@ class TorqueBatchSystem(AbstractGridEngineBatchSystem):
         def getRunningJobIDs(self):
             times = {}
             with self.runningJobsLock:
-                currentjobs = dict((str(self.batchJobIDs[x][0].strip()), x) for x in self.runningJobs)
+                currentjobs = dict((self.getBatchSystemID(x), x) for x in self.runningJobs)
             logger.debug("getRunningJobIDs current jobs are: " + str(currentjobs))
             # Skip running qstat if we don't have any current jobs
             if not currentjobs:
                 return times
             # Only query for job IDs to avoid clogging the batch system on heavily loaded clusters
             # PBS plain qstat will return every running job on the system.
+            # -t lists the elements of array jobs.
             jobids = sorted(list(currentjobs.keys()))
             if self._version == "pro":
-                stdout = call_command(['qstat', '-x'] + jobids)
+                stdout = call_command(['qstat', '-x', '-t'] + jobids)
             elif self._version == "oss":
-                stdout = call_command(['qstat'] + jobids)
+                stdout = call_command(['qstat', '-t'] + jobids)
 
             # qstat supports XML output which is more comprehensive, but PBSPro does not support it
             # so instead we stick with plain commandline qstat tabular outputs
@@ -121,31 +122,81 @@ class TorqueBatchSystem(AbstractGridEngineBatchSystem):
             return self.prepareQsub(cpu, memory, jobID) + [self.generateTorqueWrapper(command, jobID)]
 
         def submitJob(self, subLine):
-            return call_command(subLine)
+            return call_command(subLine).strip()
+
+        def prepareArraySubmission(self, cpu, memory, jobs):
+            jobID = 'array_{}'.format(jobs[0][0])
+            qsubline = self.prepareQsub(cpu, memory, jobID)
+            # PBS Pro and Torque name the array and the index variable differently
+            if self._version == "pro":
+                qsubline += ['-J', '1-{}'.format(len(jobs))]
+                indexVariable = 'PBS_ARRAY_INDEX'
+            else:
+                qsubline += ['-t', '1-{}'.format(len(jobs))]
+                indexVariable = 'PBS_ARRAYID'
+            stdoutfile = self.boss.formatStdOutErrPath(jobID, 'torque', r'${PBS_JOBID}', 'std_output')
+            stderrfile = self.boss.formatStdOutErrPath(jobID, 'torque', r'${PBS_JOBID}', 'std_error')
+            script = self.arrayJobScript(jobs, indexVariable, 'torque', r'${PBS_JOBID}',
+                                         header=['#PBS -o {}'.format(stdoutfile),
+                                                 '#PBS -e {}'.format(stderrfile),
+                                                 'cd $PBS_O_WORKDIR'])
+            return qsubline, script
+
+        def submitArrayJob(self, subLine, script):
+            # qsub reads the script from standard input, and prints the ID of
+            # an array job like '2954103[].server'
+            return call_command(subLine, input=script).strip()
+
+        def getArrayElementID(self, arrayJobID, index):
+            return arrayJobID.replace('[]', '[{}]'.format(index), 1)
 
         def getJobExitCode(self, torqueJobID):
+            return self.getJobExitCodes([torqueJobID])[torqueJobID]
+
+        def getJobExitCodes(self, torqueJobIDs):
+            # qstat knows the jobs by the number before the server name, and
+            # reports on all of them at once
+            jobs = dict((str(torqueJobID).split('.')[0], torqueJobID) for torqueJobID in torqueJobIDs)
             if self._version == "pro":
-                args = ["qstat", "-x", "-f", str(torqueJobID).split('.')[0]]
+                args = ["qstat", "-x", "-f"] + list(jobs)
             elif self._version == "oss":
-                args = ["qstat", "-f", str(torqueJobID).split('.')[0]]
+                args = ["qstat", "-f"] + list(jobs)
 
-            stdout = call_command(args)
+            try:
+                stdout = call_command(args)
+            except CalledProcessErrorStderr as err:
+                # qstat fails if any of the jobs is unknown, but still reports
+                # on the rest
+                if 'unknown job id' not in err.stderr.lower():
+                    raise
+                stdout = err.output + '\n' + err.stderr
+
+            exitCodes = dict((torqueJobID, None) for torqueJobID in torqueJobIDs)
+            job = None
             for line in stdout.split('\n'):
                 line = line.strip()
+                if line.startswith("Job Id:"):
+                    job = jobs.get(line.split(':', 1)[1].strip().split('.')[0])
+                    continue
+                if 'unknown job id' in line.lower():
+                    # some clusters configure Torque to forget everything about just
+                    # finished jobs instantly, apparently for performance reasons
+                    unknownJob = jobs.get(line.split()[-1].split('.')[0])
+                    if unknownJob is not None:
+                        logger.debug('Batch system no longer remembers about job {}'.format(unknownJob))
+                        # return assumed success; status files should reveal failure
+                        exitCodes[unknownJob] = 0
+                    continue
+                if job is None or exitCodes[job] is not None:
+                    continue
                 # Case differences due to PBSPro vs OSS Torque qstat outputs
                 if line.startswith("failed") or line.startswith("FAILED") and int(line.split()[1]) == 1:
-                    return 1
-                if line.startswith("exit_status") or line.startswith("Exit_status"):
+                    exitCodes[job] = 1
+                elif line.startswith("exit_status") or line.startswith("Exit_status"):
                     status = line.split(' = ')[1]
                     logger.debug('Exit Status: ' + status)
-                    return int(status)
-                if 'unknown job id' in line.lower():
-                    # some clusters configure Torque to forget everything about just
-                    # finished jobs instantly, apparently for performance reasons
-                    logger.debug('Batch system no longer remembers about job {}'.format(torqueJobID))
-                    # return assumed success; status files should reveal failure
-                    return 0
-            return None
+                    exitCodes[job] = int(status)
+            return exitCodes
 
         """
         Implementation-specific helper methods
@@ -107,11 +107,20 @@ class Config:
         self.doubleMem = False
         self.maxJobDuration = sys.maxsize
         self.rescueJobsFrequency = 3600
+        self.leaderCheckpointInterval = 600
 
         # Misc
         self.disableCaching = False
+        self.cacheEvictionPolicy = 'lru'
+        self.peerCaching = False
+        self.disablePrefetch = False
+        self.deduplicateFiles = False
         self.disableChaining = False
+        self.maxChainedJobs = 32
+        self.jobScheduler = 'fifo'
+        self.maxIssuedJobs = sys.maxsize
         self.disableJobStoreChecksumVerification = False
+        self.jobDescriptionFormat = 'pickle'
         self.maxLogFileSize = 64000
         self.writeLogs = None
         self.writeLogsGzip = None
@@ -159,7 +168,7 @@ class Config:
 
         def parseJobStore(s):
             name, rest = Toil.parseLocator(s)
-            if name == 'file':
+            if name in ('file', 'packedfile'):
                 # We need to resolve relative paths early, on the leader, because the worker process
                 # may have a different working directory than the leader, e.g. under Mesos.
                 return Toil.buildLocator(name, os.path.abspath(rest))
@@ -202,12 +211,15 @@ class Config:
         setBatchOptions(self, setOption)
         setOption("disableAutoDeployment")
         setOption("scale", float, fC(0.0))
+        setOption("forkWorkers")
         setOption("parasolCommand")
         setOption("parasolMaxBatches", int, iC(1))
         setOption("linkImports")
         setOption("moveExports")
         setOption("mesosMasterAddress")
         setOption("kubernetesHostPath")
+        setOption("kubernetesSubmitThreads", int, iC(1))
+        setOption("kubernetesSubmitRate", float, lambda x: x > 0)
         setOption("environment", parseSetEnv)
 
         # Autoscaling options
@@ -266,12 +278,21 @@ class Config:
         setOption("doubleMem")
         setOption("maxJobDuration", int, iC(1))
         setOption("rescueJobsFrequency", int, iC(1))
+        setOption("leaderCheckpointInterval", int, iC(0))
 
         # Misc
         setOption("maxLocalJobs", int)
         setOption("disableCaching")
+        setOption("cacheEvictionPolicy")
+        setOption("peerCaching")
+        setOption("disablePrefetch")
+        setOption("deduplicateFiles")
         setOption("disableChaining")
+        setOption("maxChainedJobs", int, iC(0))
+        setOption("jobScheduler")
+        setOption("maxIssuedJobs", int, iC(1))
         setOption("disableJobStoreChecksumVerification")
+        setOption("jobDescriptionFormat")
         setOption("maxLogFileSize", h2b, iC(1))
         setOption("writeLogs")
         setOption("writeLogsGzip")
@@ -311,6 +332,9 @@ jobStoreLocatorHelp = ("A job store holds persistent information about the jobs
                        "job store implementation, the location should be formatted according to "
                        "one of the following schemes:\n\n"
                        "file:<path> where <path> points to a directory on the file systen\n\n"
+                       "packedfile:<path> where <path> points to a directory on the file system, "
+                       "and job descriptions are packed into a few log files rather than a "
+                       "directory per job, for shared file systems with slow metadata operations\n\n"
                        "aws:<region>:<prefix> where <region> is the name of an AWS region like "
                        "us-west-2 and <prefix> will be prepended to the names of any top-level "
                        "AWS resources in use by job store, e.g. S3 buckets.\n\n "
@@ -558,6 +582,12 @@ def _addOptions(addGroupFn, config):
                 help=("Period of time to wait (in seconds) between checking for "
                       "missing/overlong jobs, that is jobs which get lost by the batch "
                       "system. Expert parameter. default=%s" % config.rescueJobsFrequency))
+    addOptionFn("--leaderCheckpointInterval", dest="leaderCheckpointInterval", default=None,
+                help=("Minimum period of time (in seconds) between checkpoints of the leader's "
+                      "view of the workflow, which let --restart resume without scanning the whole "
+                      "job store. Jobs issued after a checkpoint are journaled, and a new checkpoint "
+                      "is only taken once the journal gets long. Set to 0 to disable. "
+                      "default=%s" % config.leaderCheckpointInterval))
 
     #
     # Misc options
@@ -567,14 +597,58 @@ def _addOptions(addGroupFn, config):
                 type='bool', nargs='?', const=True, default=False,
                 help='Disables caching in the file store. This flag must be set to use '
                      'a batch system that does not support cleanup, such as Parasol.')
+    addOptionFn('--cacheEvictionPolicy', dest='cacheEvictionPolicy', default=None,
+                choices=['lru', 'lfu', 'gdsf'],
+                help="Which files to evict first when the file store's cache is full. 'lru' "
+                     "evicts the least recently used files, 'lfu' the least often used, and "
+                     "'gdsf' (GreedyDual-Size-Frequency) the files with the fewest uses for "
+                     "their size, aging out files that were popular long ago. "
+                     "default=%s" % config.cacheEvictionPolicy)
+    addOptionFn('--peerCaching', dest='peerCaching',
+                type='bool', nargs='?', const=True, default=False,
+                help="Share each node's file store cache with the other nodes of the cluster. On a "
+                     "cache miss, a file another node has cached is fetched from that node, and "
+                     "checked against its checksum, before falling back to the job store. Nodes "
+                     "must be able to reach each other over TCP.")
+    addOptionFn('--disablePrefetch', dest='disablePrefetch',
+                type='bool', nargs='?', const=True, default=False,
+                help="Disables fetching a job's input files into the file store's cache while "
+                     "the job is being loaded. By default, the files passed to a job are fetched "
+                     "ahead of time if they fit in the cache's free space.")
+    addOptionFn('--deduplicateFiles', dest='deduplicateFiles',
+                type='bool', nargs='?', const=True, default=False,
+                help="Store files written to the job store by their content, so that files with "
+                     "the same content share one stored copy, which is deleted when the last of "
+                     "them is. Files are hashed as they are written.")
     addOptionFn('--disableChaining', dest='disableChaining', action='store_true', default=False,
                 help="Disables chaining of jobs (chaining uses one job's resource allocation "
                 "for its successor job if possible).")
+    addOptionFn('--maxChainedJobs', dest='maxChainedJobs', default=None,
+                help="The maximum number of successor jobs a worker will run in its own resource "
+                     "allocation, beyond a simple chain of jobs, before leaving the rest to the "
+                     "leader. Successors that fit together are run in parallel. Set to 0 to only "
+                     "chain single successors. default=%s" % config.maxChainedJobs)
+    addOptionFn("--jobScheduler", dest="jobScheduler", default=None,
+                choices=['fifo', 'criticalPath'],
+                help=("The order in which the leader issues jobs that are ready to run. 'fifo' "
+                      "issues them in the order they became ready. 'criticalPath' issues first "
+                      "the jobs with the most work estimated to be left after them, using the "
+                      "job graph and the runtimes of completed jobs. default=%s" % config.jobScheduler))
+    addOptionFn("--maxIssuedJobs", dest="maxIssuedJobs", default=None,
+                help=("The maximum number of jobs, not counting service jobs, to have issued to "
+                      "the batch system at once. Jobs beyond this wait in the leader, in the order "
+                      "given by --jobScheduler. default=%s" % config.maxIssuedJobs))
     addOptionFn("--disableJobStoreChecksumVerification", dest="disableJobStoreChecksumVerification",
                 default=False, action="store_true",
                 help=("Disables checksum verification for files transferred to/from the job store. "
                       "Checksum verification is a safety check to ensure the data is not corrupted "
                       "during transfer. Currently only supported for non-streaming AWS files."))
+    addOptionFn("--jobDescriptionFormat", dest="jobDescriptionFormat", default=None,
+                choices=['pickle', 'binary'],
+                help=("The format in which to save job descriptions to the job store. 'binary' "
+                      "is a compact, versioned encoding that is faster to load and store than "
+                      "'pickle'. Job descriptions the binary format cannot represent are always "
+                      "pickled. default=%s" % config.jobDescriptionFormat))
     addOptionFn("--maxLogFileSize", dest="maxLogFileSize", default=None,
                 help=("The maximum size of a job log file to keep (in bytes), log files "
                       "larger than this will be truncated to the last X bytes. Setting "
@@ -872,9 +946,17 @@ class Toil(object):
         try:
             self._setBatchSystemEnvVars()
             self._serialiseEnv()
-            self._cacheAllJobs()
+            restoredJobs = None
+            if self.config.leaderCheckpointInterval > 0:
+                from toil.leaderCheckpoint import LeaderCheckpoint
+                restoredJobs = LeaderCheckpoint.restore(self._jobStore)
+            if restoredJobs is None:
+                self._cacheAllJobs()
+            else:
+                self._jobCache = restoredJobs
             self._setProvisioner()
-            rootJobDescription = self._jobStore.clean(jobCache=self._jobCache)
+            rootJobDescription = self._jobStore.clean(jobCache=self._jobCache,
+                                                      partialCache=restoredJobs is not None)
             return self._runMainLoop(rootJobDescription)
         finally:
             self._shutdownBatchSystem()
@@ -905,6 +987,9 @@ class Toil(object):
         if name == 'file':
             from toil.jobStores.fileJobStore import FileJobStore
             return FileJobStore(rest)
+        elif name == 'packedfile':
+            from toil.jobStores.packedFileJobStore import PackedFileJobStore
+            return PackedFileJobStore(rest)
         elif name == 'aws':
             from toil.jobStores.aws.jobStore import AWSJobStore
             return AWSJobStore(rest)
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from abc import abstractmethod, ABCMeta
+from concurrent.futures import Future
 from contextlib import contextmanager
 from threading import Semaphore, Event
 from future.utils import with_metaclass
@@ -498,6 +499,34 @@ class AbstractFileStore(with_metaclass(ABCMeta, object)):
         """
         raise NotImplementedError()
 
+    def getUploadFuture(self, fileStoreID):
+        """
+        Get a Future that completes when the given file, if it was written on
+        this worker, is safely in the job store. Fails with the upload's error
+        if it could not be uploaded.
+
+        File stores that upload files as they are written have nothing to
+        wait for, and return a Future that has already completed.
+
+        :param toil.fileStores.FileID or str fileStoreID: The file to wait for.
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+        future.set_result(str(fileStoreID))
+        return future
+
+    def prefetch(self, fileStoreIDs):
+        """
+        Start fetching files that the job is expected to read, so that they
+        are already local by the time it does. Does not block.
+
+        File stores without a local cache have nowhere to put the files, and
+        do nothing.
+
+        :param list fileStoreIDs: The files to fetch, as FileIDs or strings.
+        """
+        pass
+
     @abstractclassmethod
     def shutdown(cls, dir_):
         """
@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
 import errno
 import hashlib
@@ -90,6 +91,90 @@ class InvalidSourceCacheError(CacheError):
         super(InvalidSourceCacheError, self).__init__(message)
 
 
+class CacheEvictionPolicy(object):
+    """
+    Decides which files to evict from the cache first.
+
+    A policy orders the files in the cache database with an SQL ORDER BY
+    clause over the files table, and files that come first are evicted
+    first. It can also keep its own state in the files table's columns, and
+    in the properties table.
+    """
+
+    # The name of the policy for --cacheEvictionPolicy
+    name = None
+
+    # ORDER BY clause putting the files to evict first first
+    order = None
+
+    def accessOperations(self, fileID, now):
+        """
+        Get the database operations that record that a file was put in the
+        cache or read from it.
+
+        :param str fileID: The file that was accessed.
+        :param float now: The time of the access.
+        :rtype: list
+        """
+        return [('UPDATE files SET last_access = ?, hit_count = hit_count + 1 WHERE id = ?',
+                 (now, fileID))]
+
+    def evictionOperations(self, victims):
+        """
+        Get the database operations that record that files are being evicted.
+
+        :param list victims: (id, size, gd_value) rows for the files.
+        :rtype: list
+        """
+        return []
+
+
+class LRUEvictionPolicy(CacheEvictionPolicy):
+    """
+    Evicts the least recently used files first.
+    """
+    name = 'lru'
+    order = 'files.last_access'
+
+
+class LFUEvictionPolicy(CacheEvictionPolicy):
+    """
+    Evicts the least often used files first, and the least recently used of
+    those.
+    """
+    name = 'lfu'
+    order = 'files.hit_count, files.last_access'
+
+
+class GreedyDualSizeEvictionPolicy(CacheEvictionPolicy):
+    """
+    GreedyDual-Size-Frequency. Each file is worth its hit count over its size,
+    plus the worth of the last file evicted when it was last used, which ages
+    out files that were popular long ago. Evicts the files worth least first,
+    which favours keeping many small, popular files over a few big ones.
+    """
+    name = 'gdsf'
+    order = 'files.gd_value, files.last_access'
+
+    def accessOperations(self, fileID, now):
+        return [("""
+            UPDATE files SET last_access = ?, hit_count = hit_count + 1,
+            gd_value = COALESCE((SELECT value FROM properties WHERE name = 'gdClock'), 0)
+                       + (hit_count + 1) * 1.0 / MAX(size, 1)
+            WHERE id = ?
+            """, (now, fileID))]
+
+    def evictionOperations(self, victims):
+        return [("INSERT OR REPLACE INTO properties VALUES ('gdClock', ?)",
+                 (max(gdValue for _, _, gdValue in victims),))]
+
+
+# Map from --cacheEvictionPolicy name to policy class
+evictionPolicies = {policy.name: policy for policy in (LRUEvictionPolicy,
+                                                       LFUEvictionPolicy,
+                                                       GreedyDualSizeEvictionPolicy)}
+
+
 class CachingFileStore(AbstractFileStore):
     """
     A cache-enabled file store.
@@ -109,7 +194,8 @@ class CachingFileStore(AbstractFileStore):
     files contains one entry for each file in the cache. Each entry knows the
     path to its data on disk. It also knows its global file ID, its state, and
     its owning worker PID. If the owning worker dies, another worker will pick
-    it up. It also knows its size.
+    it up. It also knows its size, and when and how often it has been used,
+    which the cache eviction policy uses to choose files to evict.
 
     File states are:
 
@@ -170,6 +256,20 @@ class CachingFileStore(AbstractFileStore):
 
     """
 
+    # How many files to upload to the job store at once
+    uploadThreads = 8
+
+    # Map from the ID of each file written in this process that has not made
+    # it to the job store yet to a Future that completes when it has. Shared
+    # between the file stores of jobs run one after another in the worker, so
+    # that a job can wait on just the files it needs from an earlier job whose
+    # commit is still going.
+    _uploadFutures = {}
+    _uploadFuturesLock = threading.Lock()
+
+    # How many files to fetch ahead of the job at once
+    prefetchThreads = 4
+
     def __init__(self, jobStore, jobDesc, localTempDir, waitForPreviousCommit):
         super(CachingFileStore, self).__init__(jobStore, jobDesc, localTempDir, waitForPreviousCommit)
 
@@ -207,6 +307,9 @@ class CachingFileStore(AbstractFileStore):
         # We need to track what attempt of the workflow we are, to prevent crosstalk between attempts' caches.
         self.workflowAttemptNumber = self.jobStore.config.workflowAttemptNumber
 
+        # Decide which cached files are evicted first
+        self.evictionPolicy = evictionPolicies[getattr(self.jobStore.config, 'cacheEvictionPolicy', 'lru')]()
+
         # Make sure the cache directory exists
         os.makedirs(self.localCacheDir, exist_ok=True)
 
@@ -233,6 +336,14 @@ class CachingFileStore(AbstractFileStore):
         freeSpace, _ = getFileSystemSize(self.localCacheDir)
         self._write([('INSERT OR IGNORE INTO properties VALUES (?, ?)', ('maxSpace', freeSpace))])
 
+        # If we are sharing our cache with other nodes, make sure it is being
+        # served, and get ready to fetch from theirs.
+        self.peerCache = None
+        if getattr(self.jobStore.config, 'peerCaching', False):
+            from toil.fileStores.peerCache import PeerCacheClient, startPeerCacheServer
+            startPeerCacheServer(self.dbPath, self.jobStore.config.jobStore)
+            self.peerCache = PeerCacheClient(self.localCacheDir)
+
         # Space used by caching and by jobs is accounted with queries
 
         # We maintain an asynchronous upload thread, which gets kicked off when
@@ -245,6 +356,12 @@ class CachingFileStore(AbstractFileStore):
         # time.
         self.commitThread = None
 
+        # Files that prefetch() has started fetching for the job, by ID, and
+        # the executor fetching them. The fetches use their own database
+        # connections.
+        self._prefetches = {}
+        self._prefetchExecutor = None
+
     
     @staticmethod
     @retry(infinite_retries=True,
@@ -342,7 +459,10 @@ class CachingFileStore(AbstractFileStore):
                 path TEXT UNIQUE NOT NULL,
                 size INT NOT NULL,
                 state TEXT NOT NULL,
-                owner TEXT
+                owner TEXT,
+                last_access REAL NOT NULL DEFAULT 0,
+                hit_count INT NOT NULL DEFAULT 0,
+                gd_value REAL NOT NULL DEFAULT 0
             )
         """, """
             CREATE TABLE IF NOT EXISTS refs (
@@ -727,11 +847,26 @@ class CachingFileStore(AbstractFileStore):
         :param sqlite3.Cursor cur: Cursor in the cache database.
         """
 
+        with ThreadPoolExecutor(max_workers=self.uploadThreads) as executor:
+            uploads = self._startPendingUploads(con, cur, executor)
+            return self._finishPendingUploads(con, cur, uploads)
+
+    def _startPendingUploads(self, con, cur, executor):
+        """
+        Start uploading all files in uploadable state that we own, in the
+        given executor.
+
+        :param sqlite3.Connection con: Connection to the cache database.
+        :param sqlite3.Cursor cur: Cursor in the cache database.
+        :param concurrent.futures.Executor executor: Where to run the uploads.
+        :return: Map from the Future for each upload to the ID of the file.
+        :rtype: dict
+        """
+
         # Work out who we are
         me = get_process_name(self.workDir)
 
-        # Record how many files we upload
-        uploadedCount = 0
+        uploads = {}
         while True:
             # Try and find a file we might want to upload
             fileID = None
@@ -754,25 +889,193 @@ class CachingFileStore(AbstractFileStore):
                 # Try again to see if there is something else to grab.
                 continue
 
-            # Upload the file
+            # Upload the file, giving anyone who waits on it from now a fresh
+            # chance if an earlier try failed
             logger.debug('Actually executing upload for file %s', fileID)
+            self._uploadPending(fileID)
+            uploads[executor.submit(self.jobStore.updateFile, fileID, filePath)] = fileID
+
+        return uploads
+
+    def _finishPendingUploads(self, con, cur, uploads):
+        """
+        Wait for uploads started by _startPendingUploads, and record them in
+        the database as they finish.
+
+        If any upload fails, raises its error once all the others are done.
+
+        :param sqlite3.Connection con: Connection to the cache database.
+        :param sqlite3.Cursor cur: Cursor in the cache database.
+        :param dict uploads: Map from the Future for each upload to the ID of the file.
+        :return: The number of files that were uploaded.
+        :rtype: int
+        """
+
+        # Record how many files we upload
+        uploadedCount = 0
+        error = None
+        for future in as_completed(uploads):
+            fileID = uploads[future]
             try:
-                self.jobStore.updateFile(fileID, filePath)
-            except:
+                future.result()
+            except Exception as e:
                 # We need to set the state back to 'uploadable' in case of any failures to ensure
                 # we can retry properly.
                 self._staticWrite(con, cur, [('UPDATE files SET state = ? WHERE id = ? AND state = ?', ('uploadable', fileID, 'uploading'))])
-                raise
+                self._uploadFinished(fileID, e)
+                error = error or e
+                continue
 
             # Count it for the total uploaded files value we need to return
             uploadedCount += 1
 
             # Remember that we uploaded it in the database
             self._staticWrite(con, cur, [('UPDATE files SET state = ?, owner = NULL WHERE id = ?', ('cached', fileID))])
+            self._uploadFinished(fileID)
+
+        if error is not None:
+            raise error
 
         return uploadedCount
 
+    @classmethod
+    def _uploadPending(cls, fileID):
+        """
+        Note that a file written in this process is yet to be uploaded, or is
+        about to be tried again.
+        """
+        with cls._uploadFuturesLock:
+            future = cls._uploadFutures.get(fileID)
+            if future is None or future.done():
+                cls._uploadFutures[fileID] = Future()
 
+    @classmethod
+    def _uploadFinished(cls, fileID, error=None):
+        """
+        Note that a file written in this process has been uploaded, or could
+        not be, and let anyone waiting on it know.
+
+        A failed upload is remembered until the file is tried again, so that
+        anyone waiting on it later gets the error too.
+        """
+        with cls._uploadFuturesLock:
+            if error is None:
+                future = cls._uploadFutures.pop(fileID, None)
+            else:
+                future = cls._uploadFutures.get(fileID)
+        if future is None or future.done():
+            return
+        if error is None:
+            future.set_result(fileID)
+        else:
+            future.set_exception(error)
+
+    def getUploadFuture(self, fileStoreID):
+        with self._uploadFuturesLock:
+            future = self._uploadFutures.get(str(fileStoreID))
+        return future if future is not None else super().getUploadFuture(fileStoreID)
+
+    def _waitForUpload(self, fileStoreID):
+        """
+        Make sure a file written on this node is in the job store, before we
+        read it from there. Uploads it now if nobody has started to.
+        """
+        future = self.getUploadFuture(fileStoreID)
+        if not future.done():
+            self._executePendingUploads(self.con, self.cur)
+            future.result()
+
+    def prefetch(self, fileStoreIDs):
+        fileStoreIDs = [fileStoreID for fileStoreID in fileStoreIDs
+                        if str(fileStoreID) not in self.filesToDelete and str(fileStoreID) not in self._prefetches]
+        if not fileStoreIDs:
+            return
+
+        # Work this out now, since it may need to write to the database
+        free = self.cachingIsFree()
+
+        if self._prefetchExecutor is None:
+            self._prefetchExecutor = ThreadPoolExecutor(max_workers=self.prefetchThreads)
+        for fileStoreID in fileStoreIDs:
+            logger.debug('Prefetching file %s', fileStoreID)
+            self._prefetches[str(fileStoreID)] = self._prefetchExecutor.submit(self._prefetchToCache,
+                                                                               fileStoreID, free)
+
+    def _prefetchToCache(self, fileStoreID, free):
+        """
+        Download a file into the cache, without making any reference to it, if
+        nobody has it or is getting it already and it fits in the free cache
+        space. Never evicts anything to make room.
+
+        Runs in a prefetch thread, with its own database connection.
+
+        :param toil.fileStores.FileID fileStoreID: job store id for the file
+        :param bool free: Whether caching is free.
+        :return: True if we fetched the file, and False otherwise.
+        :rtype: bool
+        """
+
+        me = get_process_name(self.workDir)
+        cachedPath = self._getNewCachingPath(fileStoreID)
+        size = self.getGlobalFileSize(fileStoreID)
+
+        con = sqlite3.connect(self.dbPath, timeout=SQLITE_TIMEOUT_SECS)
+        cur = con.cursor()
+        try:
+            # Make a downloading entry if there isn't one and there is space,
+            # keeping back the space for our job, which hasn't been allocated
+            # yet. We know the entry is ours, and not from a read by the job,
+            # by its path.
+            self._staticWrite(con, cur, [("""
+                INSERT OR IGNORE INTO files (id, path, size, state, owner)
+                SELECT ?, ?, ?, ?, ? WHERE ? OR (
+                    (SELECT value FROM properties WHERE name = 'maxSpace') -
+                    (SELECT TOTAL(size) FROM files) -
+                    ((SELECT TOTAL(disk) FROM jobs) -
+                    (SELECT TOTAL(files.size) FROM refs INNER JOIN files ON refs.file_id = files.id WHERE refs.state = 'immutable'))
+                ) >= ?
+                """, (fileStoreID, cachedPath, size, 'downloading', me, int(free), size + self.jobDesc.disk))])
+            cur.execute('SELECT COUNT(*) FROM files WHERE id = ? AND path = ? AND state = ? AND owner = ?',
+                        (fileStoreID, cachedPath, 'downloading', me))
+            if cur.fetchone()[0] == 0:
+                logger.debug('Not prefetching file %s, which is cached already or does not fit', fileStoreID)
+                return False
+
+            try:
+                self._downloadToCache(fileStoreID, cachedPath)
+            except Exception as e:
+                # The job will have to read it itself
+                logger.warning('Could not prefetch file %s: %s', fileStoreID, e)
+                self._staticWrite(con, cur, [('DELETE FROM files WHERE id = ? AND path = ?', (fileStoreID, cachedPath))])
+                if os.path.exists(cachedPath):
+                    os.unlink(cachedPath)
+                return False
+
+            self._staticWrite(con, cur, [('UPDATE files SET state = ?, owner = NULL WHERE id = ? AND path = ?',
+                                          ('cached', fileStoreID, cachedPath))])
+            logger.debug('Prefetched file %s', fileStoreID)
+            return True
+        finally:
+            con.close()
+
+    def _waitForPrefetch(self, fileStoreID):
+        """
+        Make sure we are not still prefetching a file before the job works on
+        it. If the fetch hasn't started, it is cancelled.
+        """
+        future = self._prefetches.get(str(fileStoreID))
+        if future is not None and not future.cancel():
+            future.result()
+
+    def _finishPrefetches(self):
+        """
+        Cancel the prefetches that haven't started, and wait for the rest.
+        """
+        for future in self._prefetches.values():
+            future.cancel()
+        if self._prefetchExecutor is not None:
+            self._prefetchExecutor.shutdown(wait=True)
+            self._prefetchExecutor = None
 
     def _allocateSpaceForJob(self, newJobReqs):
         """
@@ -884,48 +1187,70 @@ class CachingFileStore(AbstractFileStore):
             return True
 
         # Otherwise, not enough files could be found in deleting state to solve our problem.
-        # We need to put something into the deleting state.
+        # We need to put some things into the deleting state.
         # TODO: give other people time to finish their in-progress
         # evictions before starting more, or we might evict everything as
         # soon as we hit the cache limit.
 
-        # Find something that has no non-mutable references and is not already being deleted.
-        self.cur.execute("""
-            SELECT files.id FROM files WHERE files.state = 'cached' AND NOT EXISTS (
-                SELECT NULL FROM refs WHERE refs.file_id = files.id AND refs.state != 'mutable'
-            ) LIMIT 1
-        """)
-        row = self.cur.fetchone()
-        if row is None:
+        # Find enough things to free the space we need, in the order the
+        # eviction policy wants them gone, that have no non-mutable references
+        # and are not already being deleted.
+        victims = self._chooseEvictionVictims(self.cur, self.evictionPolicy, -self.getCacheAvailable())
+        if not victims:
             # Nothing can be evicted by us.
             # Someone else might be in the process of evicting something that will free up space for us too.
             # Or someone mught be uploading something and we have to wait for them to finish before it can be deleted.
             logger.debug('Could not find anything to evict! Cannot free up space!')
             return False
 
-        # Otherwise we found an eviction candidate.
-        fileID = row[0]
-
         # Work out who we are
         me = get_process_name(self.workDir)
 
-        # Try and grab it for deletion, subject to the condition that nothing has started reading it
+        # Try and grab them all for deletion, subject to the condition that nothing has started reading them
         self._write([("""
             UPDATE files SET owner = ?, state = ? WHERE id = ? AND state = ?
             AND owner IS NULL AND NOT EXISTS (
                 SELECT NULL FROM refs WHERE refs.file_id = files.id AND refs.state != 'mutable'
             )
             """,
-            (me, 'deleting', fileID, 'cached'))])
+            (me, 'deleting', fileID, 'cached')) for fileID, _, _ in victims] +
+            self.evictionPolicy.evictionOperations(victims))
 
-        logger.debug('Evicting file %s', fileID)
+        logger.debug('Evicting %d files using %d bytes', len(victims), sum(size for _, size, _ in victims))
 
-        # Whether we actually got it or not, try deleting everything we have to delete
+        # Whether we actually got them or not, try deleting everything we have to delete
         if self._executePendingDeletions(self.workDir, self.con, self.cur) > 0:
             # We deleted something
             logger.debug('Successfully executed pending deletions to free space')
             return True
 
+    @staticmethod
+    def _chooseEvictionVictims(cur, policy, neededBytes):
+        """
+        Choose the files to evict to free up the given number of bytes, or as
+        many as can be evicted if that isn't enough. Always chooses at least
+        one file, if any can be evicted.
+
+        :param sqlite3.Cursor cur: Cursor in the cache database.
+        :param CacheEvictionPolicy policy: The policy to order the files by.
+        :param int neededBytes: The bytes to free.
+        :return: (id, size, gd_value) rows for the chosen files.
+        :rtype: list
+        """
+        cur.execute("""
+            SELECT files.id, files.size, files.gd_value FROM files WHERE files.state = 'cached' AND NOT EXISTS (
+                SELECT NULL FROM refs WHERE refs.file_id = files.id AND refs.state != 'mutable'
+            ) ORDER BY %s
+        """ % policy.order)
+        victims = []
+        freedBytes = 0
+        for row in cur:
+            victims.append(row)
+            freedBytes += row[1]
+            if freedBytes >= neededBytes:
+                break
+        return victims
+
     def _freeUpSpace(self):
         """
         If disk space is overcomitted, block and evict eligible things from the
@@ -1019,6 +1344,9 @@ class CachingFileStore(AbstractFileStore):
             os.chdir(startingDir)
             self.cleanupInProgress = True
 
+            # Don't leave any fetches running for a job that is done
+            self._finishPrefetches()
+
             # Record that our job is no longer using its space, and clean up
             # its temp dir and database entry.
             self._deallocateSpaceForJob()
@@ -1045,10 +1373,15 @@ class CachingFileStore(AbstractFileStore):
         # Work out where the file ought to go in the cache
         cachePath = self._getNewCachingPath(fileID)
 
+        # Let later jobs wait on it getting to the job store
+        self._uploadPending(fileID)
+
         # Create a file in uploadable state and a reference, in the same transaction.
         # Say the reference is an immutable reference
-        self._write([('INSERT INTO files VALUES (?, ?, ?, ?, ?)', (fileID, cachePath, fileSize, 'uploadable', me)),
-            ('INSERT INTO refs VALUES (?, ?, ?, ?)', (absLocalFileName, fileID, creatorID, 'immutable'))])
+        self._write([('INSERT INTO files (id, path, size, state, owner) VALUES (?, ?, ?, ?, ?)',
+                       (fileID, cachePath, fileSize, 'uploadable', me)),
+            ('INSERT INTO refs VALUES (?, ?, ?, ?)', (absLocalFileName, fileID, creatorID, 'immutable'))] +
+            self.evictionPolicy.accessOperations(fileID, time.time()))
 
         if absLocalFileName.startswith(self.localTempDir) and not os.path.islink(absLocalFileName):
             # We should link into the cache, because the upload is coming from our local temp dir (and not via a symlink in there)
@@ -1090,7 +1423,12 @@ class CachingFileStore(AbstractFileStore):
 
             # Save the file to the job store right now
             logger.debug('Actually executing upload immediately for file %s', fileID)
-            self.jobStore.updateFile(fileID, absLocalFileName)
+            try:
+                self.jobStore.updateFile(fileID, absLocalFileName)
+            except Exception as e:
+                self._uploadFinished(fileID, e)
+                raise
+            self._uploadFinished(fileID)
 
         # Ship out the completed FileID object with its real size.
         return FileID.forPath(fileID, absLocalFileName)
@@ -1101,6 +1439,9 @@ class CachingFileStore(AbstractFileStore):
             # File has already been deleted
             raise FileNotFoundError('Attempted to read deleted file: {}'.format(fileStoreID))
 
+        # If we started fetching it ahead of time, let that finish
+        self._waitForPrefetch(fileStoreID)
+
         if userPath is not None:
             # Validate the destination we got
             localFilePath = self._resolveAbsoluteLocalPath(userPath)
@@ -1123,7 +1464,11 @@ class CachingFileStore(AbstractFileStore):
         else:
             # We do not want to use the cache
             finalPath = self._readGlobalFileWithoutCache(fileStoreID, localFilePath, mutable, symlink, readerID)
-            
+
+        if cache:
+            # Tell the eviction policy
+            self._write(self.evictionPolicy.accessOperations(fileStoreID, time.time()))
+
         # Record access in case the job crashes and we have to log it
         self.logAccess(fileStoreID, finalPath)
         return finalPath
@@ -1219,6 +1564,10 @@ class CachingFileStore(AbstractFileStore):
             # Wait around to simulate a big file for testing
             time.sleep(self.forceDownloadDelay)
 
+        if self.peerCache is not None and self.peerCache.fetch(fileStoreID, cachedPath):
+            # Another node had it
+            return
+
         if self.forceNonFreeCaching:
             # Always copy
             with self.jobStore.readFileStream(fileStoreID) as inStream:
@@ -1248,7 +1597,7 @@ class CachingFileStore(AbstractFileStore):
         while True:
             # Try and create a downloading entry if no entry exists
             logger.debug('Trying to make file record for id %s', fileStoreID)
-            self._write([('INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?, ?)',
+            self._write([('INSERT OR IGNORE INTO files (id, path, size, state, owner) VALUES (?, ?, ?, ?, ?)',
                 (fileStoreID, cachedPath, self.getGlobalFileSize(fileStoreID), 'downloading', me))])
 
             # See if we won the race
@@ -1507,7 +1856,7 @@ class CachingFileStore(AbstractFileStore):
             # Make sure to create a reference at the same time if it succeeds, to bill it against our job's space.
             # Don't create the mutable reference yet because we might not necessarily be able to clear that space.
             logger.debug('Trying to make file downloading file record and reference for id %s', fileStoreID)
-            self._write([('INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?, ?)',
+            self._write([('INSERT OR IGNORE INTO files (id, path, size, state, owner) VALUES (?, ?, ?, ?, ?)',
                 (fileStoreID, cachedPath, self.getGlobalFileSize(fileStoreID), 'downloading', me)),
                 ('INSERT INTO refs SELECT ?, id, ?, ? FROM files WHERE id = ? AND state = ? AND owner = ?',
                 (localFilePath, readerID, 'immutable', fileStoreID, 'downloading', me))])
@@ -1605,7 +1954,11 @@ class CachingFileStore(AbstractFileStore):
             raise FileNotFoundError('Attempted to read deleted file: {}'.format(fileStoreID))
         
         self.logAccess(fileStoreID)
-        
+
+        # If an earlier job on this node wrote the file, it might still be on
+        # its way to the job store.
+        self._waitForUpload(fileStoreID)
+
         # TODO: can we fulfil this from the cache if the file is in the cache?
         # I think we can because if a job is keeping the file data on disk due to having it open, it must be paying for it itself.
         return self.jobStore.readFileStream(fileStoreID)
@@ -1660,6 +2013,9 @@ class CachingFileStore(AbstractFileStore):
             raise IllegalDeletionCacheError(missingFile)
 
     def deleteGlobalFile(self, fileStoreID):
+        # Don't delete the file out from under a prefetch
+        self._waitForPrefetch(fileStoreID)
+
         try:
             # Delete local copies of the file
             self.deleteLocalFile(fileStoreID)
@@ -1682,6 +2038,9 @@ class CachingFileStore(AbstractFileStore):
         # Pop the file into deleting state owned by us if it exists
         self._write([('UPDATE files SET state = ?, owner = ? WHERE id = ?', ('deleting', me, fileStoreID))])
 
+        # Nobody should wait for it to be uploaded now
+        self._uploadFinished(str(fileStoreID))
+
         # Finish the delete if the file is present
         self._executePendingDeletions(self.workDir, self.con, self.cur)
 
@@ -1699,8 +2058,10 @@ class CachingFileStore(AbstractFileStore):
         # uploading it because we aren't supposed to have the ID from them
         # until they are done.
 
-        # For safety and simplicity, we just execute all pending uploads now.
+        # For safety and simplicity, we just execute all pending uploads now,
+        # and wait for the file if a committing job is uploading it.
         self._executePendingUploads(self.con, self.cur)
+        self.getUploadFuture(jobStoreFileID).result()
 
         # Then we let the job store export. TODO: let the export come from the
         # cache? How would we write the URL?
@@ -1750,30 +2111,35 @@ class CachingFileStore(AbstractFileStore):
 
             logger.debug('Committing file uploads asynchronously')
 
-            # Finish all uploads
-            self._executePendingUploads(con, cur)
-            # Finish all deletions out of the cache (not from the job store)
-            self._executePendingDeletions(self.workDir, con, cur)
-
-            if jobState:
-                # Do all the things that make this job not redoable
-
-                logger.debug('Committing file deletes and job state changes asynchronously')
-
-                # Indicate any files that should be deleted once the update of
-                # the job wrapper is completed.
-                self.jobDesc.filesToDelete = list(self.filesToDelete)
-                # Complete the job
-                self.jobStore.update(self.jobDesc)
-                # Delete any remnant jobs
-                list(map(self.jobStore.delete, self.jobsToDelete))
-                # Delete any remnant files
-                list(map(self.jobStore.deleteFile, self.filesToDelete))
-                # Remove the files to delete list, having successfully removed the files
-                if len(self.filesToDelete) > 0:
-                    self.jobDesc.filesToDelete = []
-                    # Update, removing emptying files to delete
+            with ThreadPoolExecutor(max_workers=self.uploadThreads) as executor:
+                # Start all uploads
+                uploads = self._startPendingUploads(con, cur, executor)
+                # Finish all deletions out of the cache (not from the job store)
+                # while they go
+                self._executePendingDeletions(self.workDir, con, cur)
+                # Finish all uploads
+                self._finishPendingUploads(con, cur, uploads)
+
+                if jobState:
+                    # Do all the things that make this job not redoable
+
+                    logger.debug('Committing file deletes and job state changes asynchronously')
+
+                    # Indicate any files that should be deleted once the update of
+                    # the job wrapper is completed.
+                    self.jobDesc.filesToDelete = list(self.filesToDelete)
+                    # Complete the job
                     self.jobStore.update(self.jobDesc)
+                    # Delete any remnant jobs, and then any remnant files
+                    for delete, items in ((self.jobStore.delete, self.jobsToDelete),
+                                          (self.jobStore.deleteFile, self.filesToDelete)):
+                        for future in [executor.submit(delete, item) for item in items]:
+                            future.result()
+                    # Remove the files to delete list, having successfully removed the files
+                    if len(self.filesToDelete) > 0:
+                        self.jobDesc.filesToDelete = []
+                        # Update, removing emptying files to delete
+                        self.jobStore.update(self.jobDesc)
         except:
             self._terminateEvent.set()
             raise
@@ -1846,6 +2212,10 @@ class CachingFileStore(AbstractFileStore):
             else:
                 logger.debug('No caching database found in %s', dir_)
             
+            # Stop serving the cache to other nodes, if we were
+            from toil.fileStores.peerCache import stopPeerCacheServer
+            stopPeerCacheServer(dir_)
+
             # Whether or not we found a database, we need to clean up the cache
             # directory. Delete the state DB if any and everything cached.
             robust_rmtree(dir_)
@@ -0,0 +1,476 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Sharing of the caching file store's caches between the nodes of a cluster.
+
+With --peerCaching, each node runs a peer cache server next to its cache. The
+server serves the files in the cache over HTTP, and every so often publishes
+an index of them, with their sizes and checksums, as a shared file in the job
+store. It also reads the indexes the other nodes have published, so that when
+a job on its node misses the cache, the job can ask the server which other
+nodes have the file, and fetch it from one of them instead of from the job
+store. Files fetched from peers are checked against the size and checksum in
+the index, and the job store is used if none of the peers comes through.
+
+Servers only answer requests carrying the workflow's peer secret, which is
+kept in the job store, so that only the workflow's own nodes can read the
+files in their caches.
+
+The server outlives the workers that start it, and stops when the batch
+system cleans up the node, or when the cache goes away.
+"""
+import argparse
+import fcntl
+import hashlib
+import hmac
+import http.client
+import http.server
+import json
+import logging
+import os
+import random
+import secrets
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from threading import Lock, Thread
+from urllib.parse import quote, unquote
+from uuid import uuid4
+
+from toil.batchSystems.options import getPublicIP
+from toil.fileStores.cachingFileStore import SQLITE_TIMEOUT_SECS
+from toil.jobStores.abstractJobStore import NoSuchFileException
+
+logger = logging.getLogger(__name__)
+
+# The shared file in the job store listing the IDs of the nodes with servers
+PEER_REGISTRY = 'peerCache.nodes'
+# The shared file in the job store holding a node's index, by node ID
+PEER_INDEX = 'peerCache.%s'
+# The lock a node's server holds, with its PID in it, in the cache directory
+SERVER_LOCK = 'peerCache.lock'
+# The shared file in the job store holding the secret servers want to see
+PEER_SECRET = 'peerCache.secret'
+# The header requests to servers carry the secret in
+SECRET_HEADER = 'X-Toil-Peer-Secret'
+# Where the server says which address it listens on, and the secret, in the
+# cache directory
+SERVER_ADDRESS = 'peerCache.address'
+# The server's log, in the cache directory
+SERVER_LOG = 'peerCache.log'
+# Seconds between a server publishing its index and reading everyone else's
+PUBLISH_INTERVAL = 30
+# How many publish intervals an index can go without being published again
+# before we take the node to be gone
+PUBLISH_INTERVALS_TO_EXPIRY = 4
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def fileChecksum(path):
+    """
+    :return: The SHA-256 of the file at the given path, in hex.
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PeerCacheServer(object):
+    """
+    Serves the files in a node's cache to other nodes, and keeps track of the
+    files other nodes have in theirs.
+    """
+
+    def __init__(self, dbPath, jobStore, publishInterval=PUBLISH_INTERVAL):
+        """
+        :param str dbPath: The path to the cache's database.
+        :param toil.jobStores.abstractJobStore.AbstractJobStore jobStore: The
+               job store to publish indexes in.
+        :param float publishInterval: Seconds between publishing our index and
+               reading everyone else's.
+        """
+        self.dbPath = dbPath
+        self.jobStore = jobStore
+        self.publishInterval = publishInterval
+        self.nodeID = uuid4().hex
+        # Map from the ID of each file we have published to the path, size
+        # and mtime of the copy we checksummed, and its checksum
+        self.checksums = {}
+        # Map from file ID to [address, size, checksum] for each other node
+        # with the file, and the lock guarding it
+        self.peerFiles = {}
+        self.peerFilesLock = Lock()
+        # The secret requests must carry, once we have read it
+        self.secret = None
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._handle(self)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.httpServer = http.server.ThreadingHTTPServer(('0.0.0.0', 0), Handler)
+        self.httpServer.daemon_threads = True
+        self.address = '%s:%i' % (getPublicIP(), self.httpServer.server_address[1])
+
+    def _handle(self, request):
+        """
+        Answer a request for /files/<file ID>, with the file's contents, or for
+        /peers/<file ID>, with the nodes that have the file as JSON.
+        """
+        secret = request.headers.get(SECRET_HEADER, '')
+        if self.secret is None or not hmac.compare_digest(secret.encode('utf-8'), self.secret.encode('utf-8')):
+            logger.warning('Refusing a request from %s without the peer secret', request.client_address[0])
+            request.send_error(403)
+            return
+        kind, _, fileID = request.path.lstrip('/').partition('/')
+        fileID = unquote(fileID)
+        if kind == 'peers':
+            with self.peerFilesLock:
+                body = json.dumps(self.peerFiles.get(fileID, [])).encode('utf-8')
+            request.send_response(200)
+            request.send_header('Content-Type', 'application/json')
+            request.send_header('Content-Length', str(len(body)))
+            request.end_headers()
+            request.wfile.write(body)
+        elif kind == 'files':
+            try:
+                # Once it is open, it can't be evicted out from under us.
+                f = open(self._cachedPath(fileID), 'rb')
+            except (OSError, TypeError):
+                request.send_error(404)
+                return
+            with f:
+                request.send_response(200)
+                request.send_header('Content-Type', 'application/octet-stream')
+                request.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+                request.end_headers()
+                shutil.copyfileobj(f, request.wfile, CHUNK_SIZE)
+        else:
+            request.send_error(404)
+
+    def _query(self, query, args=()):
+        con = sqlite3.connect(self.dbPath, timeout=SQLITE_TIMEOUT_SECS)
+        try:
+            return con.execute(query, args).fetchall()
+        finally:
+            con.close()
+
+    def _cachedPath(self, fileID):
+        """
+        :return: The path to the given file in the cache, or None if it is not
+                 cached here.
+        """
+        for path, in self._query('SELECT path FROM files WHERE id = ? AND state = ?', (fileID, 'cached')):
+            return path
+        return None
+
+    def _checksum(self, fileID, path):
+        """
+        Get the checksum of a cached file, remembering it for as long as the
+        file stays the same.
+        """
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if fileID not in self.checksums or self.checksums[fileID][0] != key:
+            self.checksums[fileID] = (key, fileChecksum(path))
+        return self.checksums[fileID][1]
+
+    def _readShared(self, name, default):
+        try:
+            with self.jobStore.readSharedFileStream(name) as f:
+                return json.loads(f.read().decode('utf-8'))
+        except NoSuchFileException:
+            return default
+
+    def _writeShared(self, name, value):
+        with self.jobStore.writeSharedFileStream(name) as f:
+            f.write(json.dumps(value).encode('utf-8'))
+
+    def _loadSecret(self):
+        """
+        Read the workflow's peer secret, making it up if nobody has yet, and
+        tell the clients on this node about it if it has changed.
+        """
+        secret = self._readShared(PEER_SECRET, None)
+        if secret is None:
+            # Servers starting at once can each write their own, but they
+            # all pick up the one that stuck the next time they publish.
+            self._writeShared(PEER_SECRET, secrets.token_hex(32))
+            secret = self._readShared(PEER_SECRET, None)
+        if secret != self.secret:
+            self.secret = secret
+            cacheDir = os.path.dirname(self.dbPath)
+            # Only we can read it, since mkstemp makes it private
+            fd, tempPath = tempfile.mkstemp(dir=cacheDir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'address': self.address, 'secret': self.secret}, f)
+            os.rename(tempPath, os.path.join(cacheDir, SERVER_ADDRESS))
+
+    def publish(self):
+        """
+        Publish the index of our cache, and read everyone else's.
+        """
+        self._loadSecret()
+        index = {}
+        for fileID, path, size in self._query('SELECT id, path, size FROM files WHERE state = ?', ('cached',)):
+            try:
+                index[fileID] = [size, self._checksum(fileID, path)]
+            except OSError:
+                # It was evicted
+                pass
+        for fileID in set(self.checksums) - set(index):
+            del self.checksums[fileID]
+        self._writeShared(PEER_INDEX % self.nodeID, {'address': self.address, 'time': time.time(),
+                                                     'files': index})
+
+        nodes = self._readShared(PEER_REGISTRY, [])
+        if self.nodeID not in nodes:
+            # Nodes registering at the same time can lose each other's
+            # updates, but they will see that and try again next time.
+            self._writeShared(PEER_REGISTRY, nodes + [self.nodeID])
+
+        peerFiles = {}
+        expiry = time.time() - self.publishInterval * PUBLISH_INTERVALS_TO_EXPIRY
+        for nodeID in nodes:
+            if nodeID == self.nodeID:
+                continue
+            peer = self._readShared(PEER_INDEX % nodeID, None)
+            if peer is None or peer['time'] < expiry:
+                continue
+            for fileID, (size, checksum) in peer['files'].items():
+                peerFiles.setdefault(fileID, []).append([peer['address'], size, checksum])
+        with self.peerFilesLock:
+            self.peerFiles = peerFiles
+        logger.debug('Published %i files, and know of %i on other nodes', len(index), len(peerFiles))
+
+    def withdraw(self):
+        """
+        Stop telling other nodes about our cache.
+        """
+        self._writeShared(PEER_INDEX % self.nodeID, {'address': self.address, 'time': 0, 'files': {}})
+        nodes = self._readShared(PEER_REGISTRY, [])
+        if self.nodeID in nodes:
+            nodes.remove(self.nodeID)
+            self._writeShared(PEER_REGISTRY, nodes)
+
+    def serve(self):
+        """
+        Serve until the cache goes away or we are told to stop.
+        """
+        self._loadSecret()
+        Thread(target=self.httpServer.serve_forever, daemon=True).start()
+        cacheDir = os.path.dirname(self.dbPath)
+        logger.info('Serving the cache in %s at %s', cacheDir, self.address)
+        try:
+            while os.path.exists(self.dbPath):
+                try:
+                    self.publish()
+                except Exception:
+                    logger.warning('Could not publish the cache index', exc_info=True)
+                time.sleep(self.publishInterval)
+        finally:
+            self.httpServer.shutdown()
+            try:
+                self.withdraw()
+            except Exception:
+                logger.debug('Could not withdraw the cache index', exc_info=True)
+
+
+class PeerCacheClient(object):
+    """
+    Fetches files from the caches of other nodes, using what the peer cache
+    server on this node knows about them.
+    """
+
+    def __init__(self, cacheDir, timeout=60):
+        """
+        :param str cacheDir: The cache directory on this node.
+        :param float timeout: Seconds to wait on a peer that has stopped
+               sending.
+        """
+        self.cacheDir = cacheDir
+        self.timeout = timeout
+
+    def _server(self):
+        """
+        :return: The address of the server on this node and the peer secret,
+                 or None if the server hasn't started yet.
+        :rtype: dict
+        """
+        try:
+            with open(os.path.join(self.cacheDir, SERVER_ADDRESS)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _open(self, address, kind, fileID, secret):
+        request = urllib.request.Request('http://%s/%s/%s' % (address, kind, quote(fileID, safe='')),
+                                         headers={SECRET_HEADER: secret})
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def peers(self, fileID, server=None):
+        """
+        :return: [address, size, checksum] for each other node that has the
+                 given file cached.
+        :rtype: list
+        """
+        server = server or self._server()
+        if server is None:
+            # The server hasn't started yet
+            return []
+        try:
+            with self._open(server['address'], 'peers', fileID, server['secret']) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            logger.warning('Could not ask the peer cache server about file %s: %s', fileID, e)
+            return []
+
+    def fetch(self, fileID, path):
+        """
+        Try to fetch a file from another node's cache.
+
+        :param str fileID: The file to fetch.
+        :param str path: Where to put it. Must not exist.
+        :return: True if the file was fetched, or False if the job store
+                 should be used instead.
+        :rtype: bool
+        """
+        server = self._server()
+        if server is None:
+            return False
+        peers = self.peers(fileID, server)
+        # Spread the load when many nodes want a file at once
+        random.shuffle(peers)
+        for address, size, checksum in peers:
+            if self._fetchFrom(address, server['secret'], fileID, size, checksum, path):
+                return True
+        return False
+
+    def _fetchFrom(self, address, secret, fileID, size, checksum, path):
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            digest = hashlib.sha256()
+            received = 0
+            with os.fdopen(fd, 'wb') as f:
+                with self._open(address, 'files', fileID, secret) as response:
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                        received += len(chunk)
+                        f.write(chunk)
+            if received != size or digest.hexdigest() != checksum:
+                logger.warning('File %s from the cache at %s does not match its checksum', fileID, address)
+                return False
+            os.rename(tempPath, path)
+            tempPath = None
+        except (OSError, http.client.HTTPException) as e:
+            logger.debug('Could not fetch file %s from the cache at %s: %s', fileID, address, e)
+            return False
+        finally:
+            if tempPath is not None:
+                os.unlink(tempPath)
+        logger.debug('Fetched file %s from the cache at %s', fileID, address)
+        return True
+
+
+def startPeerCacheServer(dbPath, jobStoreLocator, publishInterval=PUBLISH_INTERVAL):
+    """
+    Make sure a peer cache server is running for the cache with the given
+    database, starting one if there isn't.
+
+    :param str dbPath: The path to the cache's database.
+    :param str jobStoreLocator: The job store to publish the cache's index in.
+    :param float publishInterval: Seconds between publishing the cache's index.
+    """
+    cacheDir = os.path.dirname(dbPath)
+    with open(os.path.join(cacheDir, SERVER_LOCK), 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # A server has it
+            return
+    # If several of us get here at once, all but one of the servers will find
+    # the lock taken, and stop.
+    with open(os.path.join(cacheDir, SERVER_LOG), 'a') as log:
+        subprocess.Popen([sys.executable, '-m', 'toil.fileStores.peerCache', '--database', dbPath,
+                          '--jobStore', jobStoreLocator, '--publishInterval', str(publishInterval)],
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                         start_new_session=True)
+
+
+def stopPeerCacheServer(cacheDir):
+    """
+    Stop the peer cache server for the cache in the given directory, if there
+    is one.
+    """
+    try:
+        f = open(os.path.join(cacheDir, SERVER_LOCK), 'r+')
+    except FileNotFoundError:
+        return
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # It is running, so the PID in the lock is still its own, if it
+            # has got as far as writing it.
+            pid = f.read().strip()
+            if pid:
+                try:
+                    os.kill(int(pid), signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Serve a node's Toil cache to other nodes.")
+    parser.add_argument('--database', required=True, help="The path to the cache's database.")
+    parser.add_argument('--jobStore', required=True, help='The job store to publish the index in.')
+    parser.add_argument('--publishInterval', type=float, default=PUBLISH_INTERVAL,
+                        help='Seconds between publishing the index.')
+    options = parser.parse_args()
+
+    lock = open(os.path.join(os.path.dirname(options.database), SERVER_LOCK), 'r+')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.info('Another server already has the cache')
+        return
+    lock.truncate()
+    lock.write(str(os.getpid()))
+    lock.flush()
+
+    def stop(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+
+    from toil.common import Toil
+    PeerCacheServer(options.database, Toil.resumeJobStore(options.jobStore), options.publishInterval).serve()
+
+
+if __name__ == '__main__':
+    main()
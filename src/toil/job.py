@@ -22,12 +22,14 @@ from builtins import str
 import collections
 import copy
 import enum
+import functools
 import importlib
 import inspect
 import itertools
 import logging
 import os
 import shutil
+import struct
 import sys
 import time
 import dill
@@ -118,12 +120,31 @@ class TemporaryID:
     def __ne__(self, other):
         return not isinstance(other, TemporaryID) or self._value != other._value
 
+@functools.lru_cache(maxsize=None)
+def _allSlots(cls):
+    """
+    Get the names of all the slots declared by the given class and its bases.
+
+    :rtype: tuple(str)
+    """
+    return tuple(name for klass in reversed(cls.__mro__)
+                 for name in klass.__dict__.get('__slots__', ())
+                 if name not in ('__dict__', '__weakref__'))
+
 class Requirer:
     """
     Base class implementing the storage and presentation of requirements for
     cores, memory, disk, and preemptability as properties.
+
+    Requirements are kept in slots rather than in a dict, since the leader
+    holds one of these for every job it knows about.
     """
-    
+
+    # The requirements we know how to store.
+    REQUIREMENTS = ('cores', 'memory', 'disk', 'preemptable')
+
+    __slots__ = ('_config', '_cores', '_memory', '_disk', '_preemptable')
+
     def __init__(self, requirements):
         """
         Parse and save the given requirements.
@@ -145,8 +166,13 @@ class Requirer:
         self._config = None
         
         # Save requirements, parsing and validating anything that needs parsing or validating.
-        # Don't save Nones.
-        self._requirementOverrides = {k: self._parseResource(k, v) for (k, v) in requirements.items() if v is not None}
+        # Unset requirements are stored as None.
+        for name in self.REQUIREMENTS:
+            setattr(self, '_' + name, None)
+        for name, value in requirements.items():
+            if name not in self.REQUIREMENTS:
+                raise ValueError(f"Unknown requirement '{name}'")
+            setattr(self, '_' + name, self._parseResource(name, value))
         
     def assignConfig(self, config):
         """
@@ -163,32 +189,42 @@ class Requirer:
         
     def __getstate__(self):
         """
-        Return the dict to use as the instance's __dict__ when pickling.
+        Return the dict of attribute values to use as the instance's state
+        when pickling, covering both slots and any instance __dict__.
         """
-        
+        state = {name: getattr(self, name) for name in _allSlots(type(self)) if hasattr(self, name)}
+        if hasattr(self, '__dict__'):
+            state.update(self.__dict__)
         # We want to exclude the config from pickling.
-        state = self.__dict__.copy()
         state['_config'] = None
         return state
+
+    def __setstate__(self, state):
+        """
+        Restore the instance's attributes from a state dict made by
+        :meth:`__getstate__`.
+
+        Also accepts the state of instances pickled before requirements were
+        kept in slots, so that old job stores can still be restarted.
+        """
+        state = dict(state)
+        for name, value in state.pop('_requirementOverrides', {}).items():
+            state['_' + name] = value
+        for name in _allSlots(type(self)):
+            # Slots that did not exist when the object was saved come back as None.
+            setattr(self, name, state.pop(name, None))
+        if state:
+            # Anything left over belongs in the instance dict of a subclass
+            # without slots.
+            self.__dict__.update(state)
    
     def __copy__(self):
         """
         Return a semantically-shallow copy of the object, for :meth:`copy.copy`.
         """
-        
-        # See https://stackoverflow.com/a/40484215 for how to do an override
-        # that uses the base implementation
-        
-        # Hide this override
-        implementation = self.__copy__
-        self.__copy__ = None
-        
-        # Do the copy which omits the config via __getstate__ override
-        clone = copy.copy(self)
-        
-        # Put back the override on us and the copy
-        self.__copy__ = implementation
-        clone.__copy__ = implementation
+        clone = type(self).__new__(type(self))
+        # Copy via our state, which omits the config
+        clone.__setstate__(self.__getstate__())
         
         if self._config is not None:
             # Share a config reference
@@ -200,20 +236,10 @@ class Requirer:
         """
         Return a semantically-deep copy of the object, for :meth:`copy.deepcopy`.
         """
-        
-        # See https://stackoverflow.com/a/40484215 for how to do an override
-        # that uses the base implementation
-        
-        # Hide this override
-        implementation = self.__deepcopy__
-        self.__deepcopy__ = None
-        
-        # Do the deepcopy which omits the config via __getstate__ override
-        clone = copy.deepcopy(self, memo)
-        
-        # Put back the override on us and the copy
-        self.__deepcopy__ = implementation
-        clone.__deepcopy__ = implementation
+        clone = type(self).__new__(type(self))
+        memo[id(self)] = clone
+        # Copy via our state, which omits the config
+        clone.__setstate__(copy.deepcopy(self.__getstate__(), memo))
         
         if self._config is not None:
             # Share a config reference
@@ -299,10 +325,8 @@ class Requirer:
         :param str requirement: The name of the resource
         :rtype: int|float|bool|None
         """
-        if requirement in self._requirementOverrides:
-            value = self._requirementOverrides[requirement]
-            if value is None:
-             raise AttributeError(f"Encountered explicit None for '{requirement}' requirement of {self}")
+        value = getattr(self, '_' + requirement)
+        if value is not None:
             return value
         elif self._config is not None:
             value = getattr(self._config, 'default' + requirement.capitalize())
@@ -319,7 +343,8 @@ class Requirer:
         
         :rtype: dict
         """
-        return dict(self._requirementOverrides)
+        return {name: getattr(self, '_' + name) for name in self.REQUIREMENTS
+                if getattr(self, '_' + name) is not None}
     
     @property
     def disk(self):
@@ -331,7 +356,7 @@ class Requirer:
         return self._fetchRequirement('disk')
     @disk.setter
     def disk(self, val):
-         self._requirementOverrides['disk'] = self._parseResource('disk', val)
+         self._disk = self._parseResource('disk', val)
 
     @property
     def memory(self):
@@ -343,7 +368,7 @@ class Requirer:
         return self._fetchRequirement('memory')
     @memory.setter
     def memory(self, val):
-         self._requirementOverrides['memory'] = self._parseResource('memory', val)
+         self._memory = self._parseResource('memory', val)
 
     @property
     def cores(self):
@@ -355,7 +380,7 @@ class Requirer:
         return self._fetchRequirement('cores')
     @cores.setter
     def cores(self, val):
-         self._requirementOverrides['cores'] = self._parseResource('cores', val)
+         self._cores = self._parseResource('cores', val)
 
     @property
     def preemptable(self):
@@ -367,7 +392,7 @@ class Requirer:
         return self._fetchRequirement('preemptable')
     @preemptable.setter
     def preemptable(self, val):
-         self._requirementOverrides['preemptable'] = self._parseResource('preemptable', val)
+         self._preemptable = self._parseResource('preemptable', val)
 
 class JobDescription(Requirer):
     """
@@ -382,7 +407,56 @@ class JobDescription(Requirer):
     
     Subclassed into variants for checkpoint jobs and service jobs that have
     their specific parameters.
+
+    Besides pickling, a JobDescription can be saved in a compact, versioned
+    binary format with :meth:`toBinary` and loaded back with
+    :meth:`fromBinary`.
     """
+
+    __slots__ = ('jobName', 'unitName', 'displayName', 'jobStoreID', 'command',
+                 '_remainingTryCount', 'filesToDelete', 'jobsToDelete',
+                 'predecessorNumber', 'predecessorsFinished', 'childIDs',
+                 'followOnIDs', 'serviceTree', 'logJobStoreFileID', 'chainedJobs',
+                 'inputFileIDs',
+                 # Only allocated if someone sets an ad hoc attribute.
+                 '__dict__')
+
+    # Leading bytes of every binary-encoded JobDescription. Pickles never
+    # start with these.
+    BINARY_MAGIC = b'TJD'
+
+    # Version of the binary layout we write. Bump it whenever the fields
+    # below change, and keep reading the old versions. Version 2 added
+    # inputFileIDs.
+    BINARY_VERSION = 2
+
+    # Type code stored in the binary encoding to identify the class.
+    _binaryKind = 0
+
+    # Optional string fields, in encoding order.
+    _binaryStringFields = ('jobName', 'unitName', 'displayName', 'jobStoreID',
+                           'command', 'logJobStoreFileID')
+
+    # Optional collections of strings, in encoding order, with the type to
+    # rebuild them as.
+    _binaryCollectionFields = (('filesToDelete', list), ('jobsToDelete', list),
+                               ('predecessorsFinished', set), ('childIDs', set),
+                               ('followOnIDs', set), ('chainedJobs', list))
+
+    # Header: magic, version, kind, flags, memory, disk, cores,
+    # remaining try count, predecessor number, number of counts, number of
+    # strings. Followed by the counts and the string lengths as 32-bit ints,
+    # and then the UTF-8 string data.
+    _binaryHeader = struct.Struct('<3sBBBqqdqqII')
+
+    # Bits of the flags byte in the header.
+    _FLAG_MEMORY = 1 << 0
+    _FLAG_DISK = 1 << 1
+    _FLAG_CORES = 1 << 2
+    _FLAG_CORES_FLOAT = 1 << 3
+    _FLAG_PREEMPTABLE = 1 << 4
+    _FLAG_PREEMPTABLE_VALUE = 1 << 5
+    _FLAG_TRY_COUNT = 1 << 6
     
     def __init__(self, requirements, jobName, unitName='', displayName='', command=None):
         """
@@ -409,8 +483,10 @@ class JobDescription(Requirer):
         super().__init__(requirements)
         
         # Save names, making sure they are strings and not e.g. bytes.
+        # Names are shared by many jobs, so intern them.
         def makeString(x):
-            return x if not isinstance(x, bytes) else x.decode('utf-8', errors='replace')
+            x = x if not isinstance(x, bytes) else x.decode('utf-8', errors='replace')
+            return sys.intern(x) if type(x) is str else x
         self.jobName = makeString(jobName)
         self.unitName = makeString(unitName)
         self.displayName = makeString(displayName)
@@ -448,6 +524,11 @@ class JobDescription(Requirer):
         # job, and which should be deleted when this job finally is deleted.
         self.jobsToDelete = []
         
+        # Holds the FileIDs, with known sizes, that were passed to the job's
+        # body when it was saved, which it will probably read when it runs.
+        # The worker starts fetching them while it loads the body.
+        self.inputFileIDs = []
+        
         # The number of direct predecessors of the job. Needs to be stored at
         # the JobDescription to support dynamically-created jobs with multiple
         # predecessors. Otherwise, we could reach a job by one path down from
@@ -482,6 +563,195 @@ class JobDescription(Requirer):
         # A jobStoreFileID of the log file for a job. This will be None unless the job failed and
         # the logging has been captured to be reported on the leader.
         self.logJobStoreFileID = None 
+
+        # Human-readable names of jobs that were run as part of this job's
+        # invocation, starting with this job. Set by the worker when it chains
+        # jobs, and None otherwise.
+        self.chainedJobs = None
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        # Names from the job store are duplicated across many jobs; intern
+        # them again after loading.
+        for name in ('jobName', 'unitName', 'displayName'):
+            value = getattr(self, name)
+            if type(value) is str:
+                setattr(self, name, sys.intern(value))
+
+    def toBinary(self):
+        """
+        Encode this JobDescription in the versioned binary format.
+
+        The config reference is not saved. ID strings are saved as plain
+        strings, so str subclasses such as FileID come back as str, except
+        for inputFileIDs, which keep their sizes.
+
+        :raises TypeError: if this JobDescription cannot be represented in the
+            binary format, for example because it is of a subclass the format
+            does not know about, has ad hoc attributes, or still has a
+            TemporaryID.
+        :rtype: bytes
+        """
+        if _BINARY_CLASSES.get(type(self)._binaryKind) is not type(self):
+            raise TypeError(f"No binary encoding for {type(self).__name__}")
+        if self.__dict__:
+            raise TypeError(f"No binary encoding for extra attributes {list(self.__dict__)} of {self}")
+
+        flags = 0
+        memory = disk = predecessorNumber = remainingTryCount = 0
+        cores = 0.0
+        if self._memory is not None:
+            flags |= self._FLAG_MEMORY
+            memory = self._memory
+        if self._disk is not None:
+            flags |= self._FLAG_DISK
+            disk = self._disk
+        if self._cores is not None:
+            flags |= self._FLAG_CORES
+            if isinstance(self._cores, float):
+                flags |= self._FLAG_CORES_FLOAT
+            cores = float(self._cores)
+        if self._preemptable is not None:
+            flags |= self._FLAG_PREEMPTABLE
+            if self._preemptable:
+                flags |= self._FLAG_PREEMPTABLE_VALUE
+        if self._remainingTryCount is not None:
+            flags |= self._FLAG_TRY_COUNT
+            remainingTryCount = self._remainingTryCount
+        predecessorNumber = self.predecessorNumber
+
+        counts = []
+        strings = []
+        for name in self._binaryStringFields:
+            strings.append(getattr(self, name))
+        for name, _ in self._binaryCollectionFields:
+            collection = getattr(self, name)
+            counts.append(-1 if collection is None else len(collection))
+            if collection is not None:
+                strings.extend(collection)
+        # The service tree is a dict from host ID to list of host IDs.
+        counts.append(len(self.serviceTree))
+        for hostID, childHostIDs in self.serviceTree.items():
+            counts.append(len(childHostIDs))
+            strings.append(hostID)
+            strings.extend(childHostIDs)
+        # Input files keep their sizes, packed in with their IDs.
+        inputFileIDs = self.inputFileIDs or []
+        counts.append(len(inputFileIDs))
+        strings.extend(fileID.pack() for fileID in inputFileIDs)
+
+        encoded = []
+        lengths = []
+        for string in strings:
+            if string is None:
+                lengths.append(-1)
+            elif isinstance(string, str):
+                data = string.encode('utf-8')
+                lengths.append(len(data))
+                encoded.append(data)
+            else:
+                raise TypeError(f"Cannot binary-encode {string!r} in {self}")
+
+        try:
+            header = self._binaryHeader.pack(self.BINARY_MAGIC, self.BINARY_VERSION,
+                                             self._binaryKind, flags, memory, disk, cores,
+                                             remainingTryCount, predecessorNumber,
+                                             len(counts), len(lengths))
+            body = struct.pack('<%di%di' % (len(counts), len(lengths)), *counts, *lengths)
+        except struct.error as e:
+            raise TypeError(f"Cannot binary-encode {self}: {e}")
+        return b''.join([header, body] + encoded)
+
+    @staticmethod
+    def isBinary(data):
+        """
+        Return True if the given bytes look like the output of :meth:`toBinary`
+        rather than a pickle.
+
+        :param bytes data: Serialized JobDescription
+        :rtype: bool
+        """
+        return data[:len(JobDescription.BINARY_MAGIC)] == JobDescription.BINARY_MAGIC
+
+    @staticmethod
+    def fromBinary(data):
+        """
+        Decode a JobDescription produced by :meth:`toBinary`.
+
+        The result has no config assigned.
+
+        :param bytes data: Binary-encoded JobDescription
+        :raises ValueError: if the data is not a JobDescription in a binary
+            format version that we understand.
+        :rtype: toil.job.JobDescription
+        """
+        header = JobDescription._binaryHeader
+        try:
+            (magic, version, kind, flags, memory, disk, cores, remainingTryCount,
+             predecessorNumber, numCounts, numStrings) = header.unpack_from(data)
+        except struct.error as e:
+            raise ValueError(f"Truncated binary JobDescription: {e}")
+        if magic != JobDescription.BINARY_MAGIC:
+            raise ValueError("Data is not a binary JobDescription")
+        if not 1 <= version <= JobDescription.BINARY_VERSION:
+            raise ValueError(f"Unsupported binary JobDescription version {version}")
+        if kind not in _BINARY_CLASSES:
+            raise ValueError(f"Unknown binary JobDescription kind {kind}")
+        cls = _BINARY_CLASSES[kind]
+
+        offset = header.size
+        try:
+            numbers = struct.unpack_from('<%di%di' % (numCounts, numStrings), data, offset)
+        except struct.error as e:
+            raise ValueError(f"Truncated binary JobDescription: {e}")
+        offset += 4 * (numCounts + numStrings)
+        counts = iter(numbers[:numCounts])
+        strings = []
+        for length in numbers[numCounts:]:
+            if length < 0:
+                strings.append(None)
+            else:
+                strings.append(data[offset:offset + length].decode('utf-8'))
+                offset += length
+        if offset != len(data):
+            raise ValueError("Binary JobDescription has the wrong length")
+        strings = iter(strings)
+
+        F = JobDescription
+        self = cls.__new__(cls)
+        self._config = None
+        self._memory = memory if flags & F._FLAG_MEMORY else None
+        self._disk = disk if flags & F._FLAG_DISK else None
+        if flags & F._FLAG_CORES:
+            self._cores = cores if flags & F._FLAG_CORES_FLOAT else int(cores)
+        else:
+            self._cores = None
+        if flags & F._FLAG_PREEMPTABLE:
+            self._preemptable = bool(flags & F._FLAG_PREEMPTABLE_VALUE)
+        else:
+            self._preemptable = None
+        self._remainingTryCount = remainingTryCount if flags & F._FLAG_TRY_COUNT else None
+        self.predecessorNumber = predecessorNumber
+
+        for name in cls._binaryStringFields:
+            setattr(self, name, next(strings))
+        for name, collectionType in cls._binaryCollectionFields:
+            count = next(counts)
+            setattr(self, name, None if count < 0 else collectionType(itertools.islice(strings, count)))
+        self.serviceTree = {}
+        for _ in range(next(counts)):
+            hostID = next(strings)
+            self.serviceTree[hostID] = list(itertools.islice(strings, next(counts)))
+        if version >= 2:
+            self.inputFileIDs = [FileID.unpack(packed) for packed in itertools.islice(strings, next(counts))]
+        else:
+            self.inputFileIDs = []
+
+        for name in ('jobName', 'unitName', 'displayName'):
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, sys.intern(value))
+        return self
     
     def serviceHostIDsInBatches(self):
         """
@@ -833,13 +1103,18 @@ class JobDescription(Requirer):
     # a time, keyed by jobStoreID.
 
     def __repr__(self):
-        return '%s( **%r )' % (self.__class__.__name__, self.__dict__)
+        return '%s( **%r )' % (self.__class__.__name__, self.__getstate__())
         
         
 class ServiceJobDescription(JobDescription):
     """
     A description of a job that hosts a service.
     """
+
+    __slots__ = ('terminateJobStoreID', 'startJobStoreID', 'errorJobStoreID')
+
+    _binaryKind = 1
+    _binaryStringFields = JobDescription._binaryStringFields + __slots__
     
     def __init__(self, *args, **kwargs):
         """
@@ -877,6 +1152,12 @@ class CheckpointJobDescription(JobDescription):
     """
     A description of a job that is a checkpoint.
     """
+
+    __slots__ = ('checkpoint', 'checkpointFilesToDelete')
+
+    _binaryKind = 2
+    _binaryStringFields = JobDescription._binaryStringFields + ('checkpoint',)
+    _binaryCollectionFields = JobDescription._binaryCollectionFields + (('checkpointFilesToDelete', list),)
     
     def __init__(self, *args, **kwargs):
         """
@@ -947,6 +1228,28 @@ class CheckpointJobDescription(JobDescription):
                 jobStore.update(self)
         return successorsDeleted
 
+# Map from binary encoding type code to JobDescription class.
+_BINARY_CLASSES = {cls._binaryKind: cls for cls in (JobDescription, ServiceJobDescription, CheckpointJobDescription)}
+
+class FileIDRecordingPickler(pickle.Pickler):
+    """
+    Pickler that remembers the FileIDs it comes across, so that saving a job's
+    body can also tell us what files the job is going to read.
+
+    Only FileIDs that know their sizes are remembered.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fileIDs = []
+        self._seen = set()
+
+    def persistent_id(self, obj):
+        if isinstance(obj, FileID) and obj.size is not None and obj not in self._seen:
+            self._seen.add(obj)
+            self.fileIDs.append(obj)
+        # Pickle everything normally
+        return None
+
 class Job:
     """
     Class represents a unit of work in toil.
@@ -2071,9 +2374,10 @@ class Job:
                 self._registry = {description.jobStoreID: self}
                 self._directPredecessors = set()
             
-                # Save the body of the job
+                # Save the body of the job, noting the files it was given
                 with jobStore.writeFileStream(description.jobStoreID, cleanup=True) as (fileHandle, fileStoreID):
-                    pickle.dump(self, fileHandle, pickle.HIGHEST_PROTOCOL)
+                    pickler = FileIDRecordingPickler(fileHandle, pickle.HIGHEST_PROTOCOL)
+                    pickler.dump(self)
             finally:
                 # Restore important fields (before handling errors)
                 self._directPredecessors = directPredecessors 
@@ -2085,6 +2389,9 @@ class Job:
                 # Add ourselves as the recipient job that wanted the promise.
                 e = JobPromiseConstraintError(e.promisingJob, self)
             raise e
+        
+        # Record what the job will want to read
+        self._description.inputFileIDs = pickler.fileIDs
             
         # Find the user script.
         # Note that getUserScript() may have been overridden. This is intended. If we used
@@ -2161,27 +2468,29 @@ class Job:
             # Fulfil promises for return values (even if value is None)
             self._fulfillPromises(returnValues, jobStore)
             
-        for job in ordering:
-            logger.info("Processing job %s", job.description)
-            for serviceBatch in reversed(list(job.description.serviceHostIDsInBatches())):
-                # For each batch of service host jobs in reverse order they start
-                for serviceID in serviceBatch:
-                    logger.info("Processing service %s", serviceID)
-                    if serviceID in self._registry:
-                        # It's a new service
-                        
-                        # Find the actual job
-                        serviceJob = self._registry[serviceID]
-                        logger.info("Saving service %s", serviceJob.description)
-                        # Pickle the service body, which triggers all the promise stuff
-                        serviceJob.saveBody(jobStore)
-            if job != self or saveSelf:
-                # Now pickle the job itself
-                job.saveBody(jobStore)
-            
-        # Now that the job data is on disk, commit the JobDescriptions in
-        # reverse execution order, in a batch if supported.
+        # Save the job bodies and then the JobDescriptions as one batch, so
+        # job stores that can write them together do so. The bodies go out
+        # before any of the descriptions that point to them.
         with jobStore.batch():
+            for job in ordering:
+                logger.info("Processing job %s", job.description)
+                for serviceBatch in reversed(list(job.description.serviceHostIDsInBatches())):
+                    # For each batch of service host jobs in reverse order they start
+                    for serviceID in serviceBatch:
+                        logger.info("Processing service %s", serviceID)
+                        if serviceID in self._registry:
+                            # It's a new service
+                        
+                            # Find the actual job
+                            serviceJob = self._registry[serviceID]
+                            logger.info("Saving service %s", serviceJob.description)
+                            # Pickle the service body, which triggers all the promise stuff
+                            serviceJob.saveBody(jobStore)
+                if job != self or saveSelf:
+                    # Now pickle the job itself
+                    job.saveBody(jobStore)
+
+            # Now commit the JobDescriptions in reverse execution order.
             for job in ordering:
                 for serviceBatch in job.description.serviceHostIDsInBatches():
                     for serviceID in serviceBatch:
@@ -11,11 +11,16 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import hashlib
 import shutil
 import re
+import sys
+import time
+import itertools
 import pickle
 import logging
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager, closing
 from datetime import timedelta
 from uuid import uuid4
@@ -23,7 +28,6 @@ from requests.exceptions import HTTPError
 from http.client import BadStatusLine
 
 # Python 3 compatibility imports
-from six import itervalues
 from six.moves.urllib.request import urlopen
 import six.moves.urllib.parse as urlparse
 
@@ -31,10 +35,11 @@ from toil.lib.retry import retry, ErrorCondition
 
 from toil.common import safeUnpickleFromStream
 from toil.fileStores import FileID
-from toil.job import JobException, CheckpointJobDescription, ServiceJobDescription
+from toil.job import JobException, JobDescription, CheckpointJobDescription, ServiceJobDescription
 from toil.lib.memoize import memoize
 from toil.lib.misc import WriteWatchingStream
 from toil.lib.objects import abstractclassmethod
+from toil.lib.throttle import LocalThrottle
 from future.utils import with_metaclass
 
 
@@ -105,6 +110,40 @@ class JobStoreExistsException(Exception):
             "the job store with 'toil clean' to start the workflow from scratch." % locator)
 
 
+class _Progress(object):
+    """
+    Logs how far a long-running job store operation has got, and how fast it
+    is going, every so often.
+    """
+
+    # Seconds between progress messages
+    interval = 10
+
+    def __init__(self, message):
+        """
+        :param str message: Message with a placeholder for the number of items
+               done so far.
+        """
+        self.message = message
+        self.count = 0
+        self.start = time.time()
+        self.throttle = LocalThrottle(self.interval)
+        # Don't log until the first interval has passed
+        self.throttle.throttle(wait=False)
+
+    def add(self, count):
+        self.count += count
+        if self.throttle.throttle(wait=False):
+            self._log()
+
+    def done(self):
+        self._log()
+
+    def _log(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        logger.info(self.message + ' (%.0f per second)', self.count, self.count / elapsed)
+
+
 class AbstractJobStore(with_metaclass(ABCMeta, object)):
     """
     Represents the physical storage for the jobs and files in a Toil workflow.
@@ -462,94 +501,147 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
 
     # Cleanup functions
 
-    def clean(self, jobCache=None):
+    def clean(self, jobCache=None, partialCache=False):
         """
         Function to cleanup the state of a job store after a restart.
         Fixes jobs that might have been partially updated. Resets the try counts and removes jobs
         that are not successors of the current root job.
 
+        Reachability is worked out on a graph of job IDs built from a single pass over the jobs,
+        and orphaned jobs are deleted, and repaired jobs updated, in batches on a pool of
+        threads.
+
         :param dict[str,toil.job.JobDescription] jobCache: if a value it must be a dict
                from job ID keys to JobDescription object values. Jobs will be loaded from the cache
-               (which can be downloaded from the job store in a batch) instead of piecemeal when
-               recursed into.
+               (which can be downloaded from the job store in a batch) instead of listed again.
+
+        :param bool partialCache: if True, jobCache only holds the part of the job graph between
+               the root and the jobs that have yet to run, as restored from a leader checkpoint.
+               Only that part of the graph is cleaned: the walk stops at jobs that still have a
+               command to run, since nothing below them can have run yet, and jobs missing from
+               the cache are loaded in bulk. Orphaned jobs are not looked for.
         """
+        assert jobCache is not None or not partialCache
+
+        # Map from the ID of every job to the IDs of its successors and
+        # services, when we have seen every job
+        jobGraph = None
+
         if jobCache is None:
-            logger.warning("Cleaning jobStore recursively. This may be slow.")
+            # List the jobs once. Only the jobs we might have to repair are
+            # kept whole; for the rest, typically the bulk of the jobs that
+            # have yet to run, we just keep the edges.
+            jobCache = {}
+            jobGraph = {}
+            progress = _Progress('Listed %i jobs')
+            for jobDescription in self.jobs():
+                jobGraph[sys.intern(jobDescription.jobStoreID)] = self._jobEdges(jobDescription)
+                if self._mayNeedRepair(jobDescription):
+                    jobCache[jobDescription.jobStoreID] = jobDescription
+                progress.add(1)
+            progress.done()
+        elif not partialCache:
+            jobGraph = {jobStoreID: self._jobEdges(jobDescription)
+                        for jobStoreID, jobDescription in jobCache.items()}
 
         # Functions to get and check the existence of jobs, using the jobCache
         # if present
         def getJobDescription(jobId):
-            if jobCache is not None:
-                try:
-                    return jobCache[jobId]
-                except KeyError:
-                    return self.load(jobId)
-            else:
+            try:
+                return jobCache[jobId]
+            except KeyError:
                 return self.load(jobId)
 
+        # IDs of jobs we have looked for in bulk and found to be gone
+        missingJobs = set()
+
         def haveJob(jobId):
             assert len(jobId) > 1, "Job ID {} too short; is a string being used as a list?".format(jobId)
-            if jobCache is not None:
-                if jobId in jobCache:
-                    return True
-                else:
-                    return self.exists(jobId)
+            if jobGraph is not None:
+                return jobId in jobGraph
+            elif jobId in jobCache:
+                return True
+            elif jobId in missingJobs:
+                return False
             else:
                 return self.exists(jobId)
-                
-        def deleteJob(jobId):
-            if jobCache is not None:
-                if jobId in jobCache:
-                    del jobCache[jobId]
-            self.delete(jobId)
-            
+
+        # Repaired jobs, to be written back at the end
+        jobsToUpdate = {}
+
         def updateJobDescription(jobDescription):
             jobCache[jobDescription.jobStoreID] = jobDescription
-            self.update(jobDescription)
-
-        def getJobDescriptions():
-            if jobCache is not None:
-                return itervalues(jobCache)
-            else:
-                return self.jobs()
+            jobsToUpdate[jobDescription.jobStoreID] = jobDescription
 
         # Iterate from the root JobDescription and collate all jobs that are reachable from it
-        # All other jobs returned by self.jobs() are orphaned and can be removed
+        # All other jobs are orphaned and can be removed
         reachableFromRoot = set()
 
-        def getConnectedJobs(jobDescription):
-            if jobDescription.jobStoreID in reachableFromRoot:
-                return
-            reachableFromRoot.add(jobDescription.jobStoreID)
-            # Traverse jobs in stack
-            for jobs in jobDescription.stack:
-                for successorJobStoreID in jobs:
-                    if (successorJobStoreID not in reachableFromRoot
-                        and haveJob(successorJobStoreID)):
-                        getConnectedJobs(getJobDescription(successorJobStoreID))
-            # Traverse service jobs
-            for serviceJobStoreID in jobDescription.services:
-                if haveJob(serviceJobStoreID):
-                    assert serviceJobStoreID not in reachableFromRoot
-                    reachableFromRoot.add(serviceJobStoreID)
+        def getConnectedJobs(rootJobStoreID):
+            toVisit = [rootJobStoreID]
+            while toVisit:
+                jobStoreID = toVisit.pop()
+                if jobStoreID not in reachableFromRoot and jobStoreID in jobGraph:
+                    reachableFromRoot.add(jobStoreID)
+                    toVisit.extend(jobGraph[jobStoreID])
+
+        def getConnectedJobsToFrontier(rootJob):
+            # Walk a level of the graph at a time so that the successors
+            # missing from the cache can be loaded together. Jobs that still
+            # have a command have not run, so neither have their successors.
+            level = [rootJob]
+            while level:
+                successorIDs = []
+                for jobDescription in level:
+                    reachableFromRoot.add(jobDescription.jobStoreID)
+                    for serviceJobStoreID in jobDescription.services:
+                        if haveJob(serviceJobStoreID):
+                            reachableFromRoot.add(serviceJobStoreID)
+                    if jobDescription.command is None:
+                        for jobs in jobDescription.stack:
+                            successorIDs.extend(successorJobStoreID for successorJobStoreID in jobs
+                                                if successorJobStoreID not in reachableFromRoot)
+                successorIDs = list(dict.fromkeys(successorIDs))
+                toLoad = [jobId for jobId in successorIDs
+                          if jobId not in jobCache and jobId not in missingJobs]
+                loaded = self.loadExisting(toLoad)
+                jobCache.update(loaded)
+                missingJobs.update(jobId for jobId in toLoad if jobId not in loaded)
+                level = [jobCache[jobId] for jobId in successorIDs if jobId in jobCache]
 
         logger.debug("Checking job graph connectivity...")
-        getConnectedJobs(self.loadRootJob())
+        rootJob = self.loadRootJob()
+        if partialCache:
+            getConnectedJobsToFrontier(jobCache.setdefault(rootJob.jobStoreID, rootJob))
+        else:
+            getConnectedJobs(rootJob.jobStoreID)
         logger.debug("%d jobs reachable from root." % len(reachableFromRoot))
 
-        # Cleanup jobs that are not reachable from the root, and therefore orphaned
-        jobsToDelete = [x for x in getJobDescriptions() if x.jobStoreID not in reachableFromRoot]
-        for jobDescription in jobsToDelete:
-            # clean up any associated files before deletion
-            for fileID in jobDescription.filesToDelete:
-                # Delete any files that should already be deleted
-                logger.warning("Deleting file '%s'. It is marked for deletion but has not yet been "
-                            "removed.", fileID)
-                self.deleteFile(fileID)
-            # Delete the job from us and the cache
-            deleteJob(jobDescription.jobStoreID)
-
-        jobDescriptionsReachableFromRoot = {id: getJobDescription(id) for id in reachableFromRoot}
+        # Cleanup jobs that are not reachable from the root, and therefore
+        # orphaned. We can only tell which jobs those are if we have seen them all.
+        if jobGraph is not None:
+            orphans = [jobStoreID for jobStoreID in jobGraph if jobStoreID not in reachableFromRoot]
+            if orphans:
+                logger.info("Deleting %i jobs that are not reachable from the root.", len(orphans))
+            # Delete any files that should already be deleted. Jobs
+            # with such files are among those we kept whole.
+            for jobStoreID in orphans:
+                if jobStoreID in jobCache:
+                    for fileID in jobCache[jobStoreID].filesToDelete:
+                        logger.warning("Deleting file '%s'. It is marked for deletion but has not yet been "
+                                       "removed.", fileID)
+                        self.deleteFile(fileID)
+            self._inParallelBatches(self.deleteMany, orphans, 'Deleted %i orphaned jobs')
+            for jobStoreID in orphans:
+                jobCache.pop(jobStoreID, None)
+            # The graph is only needed to say whether jobs exist from here on
+            jobGraph = set(reachableFromRoot)
+
+        if partialCache:
+            jobDescriptionsReachableFromRoot = {id: getJobDescription(id) for id in reachableFromRoot}
+        else:
+            # Jobs we did not keep have nothing to repair
+            jobDescriptionsReachableFromRoot = {id: jobCache[id] for id in reachableFromRoot if id in jobCache}
 
         # Clean up any checkpoint jobs -- delete any successors it
         # may have launched, and restore the job to a pristine
@@ -568,7 +660,11 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
                 jobsDeletedByCheckpoints |= set(deletedThisRound)
                 updateJobDescription(jobDescription)
         for jobID in jobsDeletedByCheckpoints:
-            del jobDescriptionsReachableFromRoot[jobID]
+            jobDescriptionsReachableFromRoot.pop(jobID, None)
+            jobCache.pop(jobID, None)
+            jobsToUpdate.pop(jobID, None)
+            if jobGraph is not None:
+                jobGraph.discard(jobID)
 
         # Clean up jobs that are in reachable from the root
         for jobDescription in jobDescriptionsReachableFromRoot.values():
@@ -670,6 +766,9 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
                 logger.critical("Repairing job: %s" % jobDescription.jobStoreID)
                 updateJobDescription(jobDescription)
 
+        self._inParallelBatches(lambda jobs: [self.update(job) for job in jobs],
+                                list(jobsToUpdate.values()), 'Saved %i repaired jobs')
+
         # Remove any crufty stats/logging files from the previous run
         logger.debug("Discarding old statistics and logs...")
         # We have to manually discard the stream to avoid getting
@@ -703,9 +802,14 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
     @contextmanager
     def batch(self):
         """
-        If supported by the batch system, calls to create() with this context
+        If supported by the job store, calls to create() with this context
         manager active will be performed in a batch after the context manager
-        is released.
+        is released. Job stores may also hold back the contents of files
+        written with writeFileStream() until then, in which case they are
+        written before any of the batched jobs, and can't be read before the
+        batch ends. If the context is left with an exception, the batched jobs
+        are not created.
+
         :rtype: None
         """
         yield
@@ -783,6 +887,128 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
         """
         raise NotImplementedError()
 
+    def loadMany(self, jobStoreIDs):
+        """
+        Loads the descriptions of all the jobs referenced by the given IDs, as
+        if by :meth:`load`. Job stores that can fetch many jobs in fewer round
+        trips than one per job should override this; the default simply calls
+        :meth:`load` for each ID.
+
+        :param Iterable[str] jobStoreIDs: the IDs of the jobs to load
+
+        :raise NoSuchJobException: if there is no job with one of the given IDs
+
+        :return: a map from each of the given IDs to its JobDescription
+        :rtype: dict[str, toil.job.JobDescription]
+        """
+        return {jobStoreID: self.load(jobStoreID) for jobStoreID in jobStoreIDs}
+
+    # The number of jobs clean() hands to each deleteMany() or batch of updates
+    jobsPerCleanBatch = 100
+
+    # The number of batches clean() works on at once. Job stores whose
+    # connections cannot be shared between threads need to give each thread
+    # its own.
+    cleanThreads = 16
+
+    @staticmethod
+    def _jobEdges(jobDescription):
+        """
+        :return: the IDs of the successors and services of the given job,
+                 which is all clean() needs to know to find orphaned jobs.
+        :rtype: tuple[str]
+        """
+        return tuple(sys.intern(jobStoreID) for jobStoreID in
+                     itertools.chain(itertools.chain.from_iterable(jobDescription.stack),
+                                     jobDescription.services))
+
+    @staticmethod
+    def _mayNeedRepair(jobDescription):
+        """
+        Says whether clean() might have to repair the given job, or look at
+        more of it than its edges. Jobs that have yet to run, with no services
+        and nothing left over from an earlier attempt, are left alone.
+
+        :rtype: bool
+        """
+        return (jobDescription.command is None or
+                len(jobDescription.filesToDelete) > 0 or
+                len(jobDescription.services) > 0 or
+                isinstance(jobDescription, (ServiceJobDescription, CheckpointJobDescription)) or
+                jobDescription.logJobStoreFileID is not None or
+                jobDescription._remainingTryCount is not None)
+
+    def _inParallelBatches(self, fn, items, message):
+        """
+        Call fn on batches of jobsPerCleanBatch of the given items, with up
+        to cleanThreads batches in flight at once, and log progress.
+
+        :param fn: Function to call with each list of items.
+        :param list items: The items to work through.
+        :param str message: Progress message, with a placeholder for the
+               number of items done so far.
+        """
+        if not items:
+            return
+        batches = [items[i:i + self.jobsPerCleanBatch] for i in range(0, len(items), self.jobsPerCleanBatch)]
+        progress = _Progress(message)
+        with ThreadPoolExecutor(max_workers=min(self.cleanThreads, len(batches))) as executor:
+            futures = [executor.submit(fn, batch) for batch in batches]
+            for future, batch in zip(futures, batches):
+                # Raises the first failure, once the batches in flight are done
+                future.result()
+                progress.add(len(batch))
+        progress.done()
+
+    def loadExisting(self, jobStoreIDs):
+        """
+        Like :meth:`loadMany`, but leaves out the IDs of jobs that no longer
+        exist instead of raising.
+
+        :param Iterable[str] jobStoreIDs: the IDs of the jobs to load
+
+        :return: a map from each of the given IDs that has a job to its JobDescription
+        :rtype: dict[str, toil.job.JobDescription]
+        """
+        jobStoreIDs = list(jobStoreIDs)
+        try:
+            return self.loadMany(jobStoreIDs)
+        except NoSuchJobException:
+            # Fall back on finding out which ones are gone one at a time
+            return {jobStoreID: self.load(jobStoreID) for jobStoreID in jobStoreIDs
+                    if self.exists(jobStoreID)}
+
+    def _serializeJob(self, jobDescription):
+        """
+        Serialize the given JobDescription for storage, in the format selected
+        by the jobDescriptionFormat config option. JobDescriptions that the
+        binary format cannot represent are pickled instead.
+
+        :param toil.job.JobDescription jobDescription: the job to serialize
+
+        :rtype: bytes
+        """
+        if getattr(self.__config, 'jobDescriptionFormat', 'pickle') == 'binary':
+            try:
+                return jobDescription.toBinary()
+            except TypeError as e:
+                logger.debug('Pickling job %s instead: %s', jobDescription, e)
+        return pickle.dumps(jobDescription, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _deserializeJob(data):
+        """
+        Deserialize a JobDescription produced by :meth:`_serializeJob`, in
+        whichever format it was written. Does not assign a config.
+
+        :param bytes data: the serialized job
+
+        :rtype: toil.job.JobDescription
+        """
+        if JobDescription.isBinary(data):
+            return JobDescription.fromBinary(data)
+        return pickle.loads(data)
+
     @abstractmethod
     def update(self, jobDescription):
         """
@@ -806,6 +1032,17 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
         """
         raise NotImplementedError()
 
+    def deleteMany(self, jobStoreIDs):
+        """
+        Removes all the given jobs from the store, as if by :meth:`delete`.
+        Job stores that can delete many jobs with fewer round trips than one
+        per job should override this.
+
+        :param list[str] jobStoreIDs: the IDs of the jobs to delete
+        """
+        for jobStoreID in jobStoreIDs:
+            self.delete(jobStoreID)
+
     def jobs(self):
         """
         Best effort attempt to return iterator on JobDescriptions for all jobs
@@ -825,6 +1062,36 @@ class AbstractJobStore(with_metaclass(ABCMeta, object)):
     # associated with a given job.
     ##########################################
 
+    def _deduplicateFiles(self):
+        """
+        Return True if files should be stored by their content, so that files
+        with the same content share one stored copy, as requested with the
+        deduplicateFiles config option.
+
+        Job stores that support this keep a count of the files referencing each
+        stored copy, and only delete it when the last of them is deleted. File
+        IDs stay unique, so files can still be updated and deleted one by one.
+
+        :rtype: bool
+        """
+        return self.config is not None and getattr(self.config, 'deduplicateFiles', False)
+
+    @staticmethod
+    def _hashFile(localFilePath):
+        """
+        Get the SHA-256 digest of a local file, which stands for its content
+        when files are deduplicated.
+
+        :param str localFilePath: The file to hash.
+        :return: The digest, in lowercase hex.
+        :rtype: str
+        """
+        hasher = hashlib.sha256()
+        with open(localFilePath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
     @abstractmethod
     def writeFile(self, localFilePath, jobStoreID=None, cleanup=False):
         """
@@ -21,19 +21,16 @@ from builtins import str
 from builtins import range
 from contextlib import contextmanager, closing
 import logging
-
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
+import os
 import re
+import tempfile
 import time
 import uuid
 import base64
 import hashlib
 import itertools
 import reprlib
+import threading
 import urllib.parse
 import urllib.request, urllib.parse, urllib.error
 from io import BytesIO
@@ -44,6 +41,8 @@ from toil.lib.objects import InnerClass
 import boto3
 import boto.s3
 import boto.sdb
+from boto.s3.bucket import Bucket
+from boto.sdb.domain import Domain
 from boto.exception import S3CreateError
 from boto.exception import SDBResponseError, S3ResponseError
 import botocore.session
@@ -139,11 +138,11 @@ class AWSJobStore(AbstractJobStore):
         self.region = region
         self.namePrefix = namePrefix
         self.partSize = partSize
-        self.jobsDomain = None
-        self.filesDomain = None
-        self.filesBucket = None
-        self.db = self._connectSimpleDB()
-        self.s3 = self._connectS3()
+        # The domains and bucket as bound by _bind(), from whichever thread
+        self._bound = dict(jobsDomain=None, filesDomain=None, filesBucket=None)
+        self._threadLocal = threading.local()
+        # Connect this thread now, so a bad region is caught straight away
+        self._connections()
 
     def initialize(self, config):
         if self._registered:
@@ -272,13 +271,13 @@ class AWSJobStore(AbstractJobStore):
         else:
             binary, _ = SDBHelper.attributesToBinary(item)
             assert binary is not None
-        job = pickle.loads(binary)
+        job = self._deserializeJob(binary)
         if job is not None:
             job.assignConfig(self.config)
         return job
 
     def _awsJobToItem(self, job):
-        binary = pickle.dumps(job, protocol=pickle.HIGHEST_PROTOCOL)
+        binary = self._serializeJob(job)
         if len(binary) > SDBHelper.maxBinarySize(extraReservedChunks=1):
             # Store as an overlarge job in S3
             with self.writeFileStream() as (writable, fileID):
@@ -295,16 +294,18 @@ class AWSJobStore(AbstractJobStore):
     @contextmanager
     def batch(self):
         self._batchedUpdates = []
-        yield
-        batches = [self._batchedUpdates[i:i + self.jobsPerBatchInsert] for i in
-                   range(0, len(self._batchedUpdates), self.jobsPerBatchInsert)]
+        try:
+            yield
+            batches = [self._batchedUpdates[i:i + self.jobsPerBatchInsert] for i in
+                       range(0, len(self._batchedUpdates), self.jobsPerBatchInsert)]
 
-        for batch in batches:
-            items = {compat_bytes(jobDescription.jobStoreID): self._awsJobToItem(jobDescription) for jobDescription in batch}
-            for attempt in retry_sdb():
-                with attempt:
-                    assert self.jobsDomain.batch_put_attributes(items)
-        self._batchedUpdates = None
+            for batch in batches:
+                items = {compat_bytes(jobDescription.jobStoreID): self._awsJobToItem(jobDescription) for jobDescription in batch}
+                for attempt in retry_sdb():
+                    with attempt:
+                        assert self.jobsDomain.batch_put_attributes(items)
+        finally:
+            self._batchedUpdates = None
 
     def assignID(self, jobDescription):
         jobStoreID = self._newJobID()
@@ -351,6 +352,31 @@ class AWSJobStore(AbstractJobStore):
         log.debug("Loaded job %s", jobStoreID)
         return job
 
+    # SimpleDB allows at most 20 comparisons in a select expression
+    jobsPerBatchSelect = 20
+
+    def loadMany(self, jobStoreIDs):
+        jobStoreIDs = list(jobStoreIDs)
+        jobs = {}
+        for i in range(0, len(jobStoreIDs), self.jobsPerBatchSelect):
+            batch = jobStoreIDs[i:i + self.jobsPerBatchSelect]
+            query = "select * from `%s` where itemName() in (%s)" % (
+                self.jobsDomain.name, ', '.join("'%s'" % jobStoreID for jobStoreID in batch))
+            items = None
+            for attempt in retry_sdb():
+                with attempt:
+                    items = list(self.jobsDomain.select(consistent_read=True, query=query))
+            assert items is not None
+            for item in items:
+                job = self._awsJobFromItem(item)
+                if job is not None:
+                    jobs[compat_plain(item.name)] = job
+        for jobStoreID in jobStoreIDs:
+            if jobStoreID not in jobs:
+                raise NoSuchJobException(jobStoreID)
+        log.debug("Loaded %d jobs", len(jobs))
+        return jobs
+
     def update(self, jobDescription):
         log.debug("Updating job %s", jobDescription.jobStoreID)
         item = self._awsJobToItem(jobDescription)
@@ -381,11 +407,56 @@ class AWSJobStore(AbstractJobStore):
             with attempt:
                 items = list(self.filesDomain.select(
                     consistent_read=True,
-                    query="select version from `%s` where ownerID='%s'" % (
+                    query="select version, contentKey from `%s` where ownerID='%s'" % (
                         self.filesDomain.name, jobStoreID)))
         assert items is not None
         if items:
             log.debug("Deleting %d file(s) associated with job %s", len(items), jobStoreID)
+            self._deleteFileItems(items)
+
+    def deleteMany(self, jobStoreIDs):
+        jobStoreIDs = list(jobStoreIDs)
+        log.debug("Deleting %d jobs", len(jobStoreIDs))
+        for i in range(0, len(jobStoreIDs), self.jobsPerBatchSelect):
+            batch = jobStoreIDs[i:i + self.jobsPerBatchSelect]
+            inList = ', '.join("'%s'" % jobStoreID for jobStoreID in batch)
+            # If any of the jobs are overlarge, delete their files from the filestore
+            items = None
+            for attempt in retry_sdb():
+                with attempt:
+                    items = list(self.jobsDomain.select(
+                        consistent_read=True,
+                        query="select overlargeID from `%s` where itemName() in (%s)" % (
+                            self.jobsDomain.name, inList)))
+            assert items is not None
+            for item in items:
+                if item.get("overlargeID"):
+                    self.deleteFile(item["overlargeID"])
+            for attempt in retry_sdb():
+                with attempt:
+                    self.jobsDomain.batch_delete_attributes({compat_bytes(jobStoreID): None
+                                                             for jobStoreID in batch})
+            items = None
+            for attempt in retry_sdb():
+                with attempt:
+                    items = list(self.filesDomain.select(
+                        consistent_read=True,
+                        query="select version, contentKey from `%s` where ownerID in (%s)" % (
+                            self.filesDomain.name, inList)))
+            assert items is not None
+            if items:
+                log.debug("Deleting %d file(s) associated with %d jobs", len(items), len(batch))
+                self._deleteFileItems(items)
+
+    def _deleteFileItems(self, items):
+        """
+        Delete the given items from the files domain, and their contents from
+        the bucket.
+
+        :param list items: SimpleDB items with the version and content key of
+               each file
+        """
+        if items:
             n = self.itemsPerBatchDelete
             batches = [items[i:i + n] for i in range(0, len(items), n)]
             for batch in batches:
@@ -395,6 +466,10 @@ class AWSJobStore(AbstractJobStore):
                         self.filesDomain.batch_delete_attributes(itemsDict)
             for item in items:
                 version = item.get('version')
+                if item.get('contentKey'):
+                    # The content is shared with other files
+                    self._releaseContent(item['contentKey'])
+                    continue
                 for attempt in retry_s3():
                     with attempt:
                         if version:
@@ -402,6 +477,102 @@ class AWSJobStore(AbstractJobStore):
                         else:
                             self.filesBucket.delete_key(key_name=compat_bytes(item.name))
 
+    def _referenceContent(self, contentKey):
+        """
+        Take a reference to the stored content under the given key, if there
+        is any.
+
+        The references to each piece of content are counted by an item in
+        the files domain named after its key, holding the count and the
+        version of the S3 object with the content.
+
+        :param str contentKey: The key the content is stored under.
+        :return: The version of the content, or None if there is none stored.
+        :rtype: str|None
+        """
+        while True:
+            item = None
+            for attempt in retry_sdb():
+                with attempt:
+                    item = self.filesDomain.get_attributes(item_name=compat_bytes(contentKey),
+                                                           consistent_read=True)
+            if not item:
+                return None
+            refs = item['refs']
+            try:
+                for attempt in retry_sdb():
+                    with attempt:
+                        self.filesDomain.put_attributes(item_name=compat_bytes(contentKey),
+                                                        attributes=dict(refs=str(int(refs) + 1)),
+                                                        expected_value=['refs', refs])
+                return str(item['version'])
+            except SDBResponseError as e:
+                if e.error_code != 'ConditionalCheckFailed':
+                    raise
+                # Someone else changed the count, so try again
+
+    def _registerContent(self, contentKey, version):
+        """
+        Record that there is content stored under the given key, with one
+        reference to it, unless someone else stored it first.
+
+        :param str contentKey: The key the content is stored under.
+        :param str version: The version of the S3 object holding the content.
+        :return: True if the content was registered, False if some other
+                 content under the key already was.
+        :rtype: bool
+        """
+        try:
+            for attempt in retry_sdb():
+                with attempt:
+                    self.filesDomain.put_attributes(item_name=compat_bytes(contentKey),
+                                                    attributes=dict(refs='1', version=version),
+                                                    expected_value=['refs', False])
+            return True
+        except SDBResponseError as e:
+            if e.error_code != 'ConditionalCheckFailed':
+                raise
+            return False
+
+    def _releaseContent(self, contentKey):
+        """
+        Drop a reference to the stored content under the given key, and
+        delete the content if that was the last one.
+
+        :param str contentKey: The key the content is stored under.
+        """
+        while True:
+            item = None
+            for attempt in retry_sdb():
+                with attempt:
+                    item = self.filesDomain.get_attributes(item_name=compat_bytes(contentKey),
+                                                           consistent_read=True)
+            if not item:
+                log.warning('Content %s was released more often than it was referenced.', contentKey)
+                return
+            refs = item['refs']
+            try:
+                for attempt in retry_sdb():
+                    with attempt:
+                        if int(refs) > 1:
+                            self.filesDomain.put_attributes(item_name=compat_bytes(contentKey),
+                                                            attributes=dict(refs=str(int(refs) - 1)),
+                                                            expected_value=['refs', refs])
+                        else:
+                            self.filesDomain.delete_attributes(item_name=compat_bytes(contentKey),
+                                                               expected_values=['refs', refs])
+            except SDBResponseError as e:
+                if e.error_code != 'ConditionalCheckFailed':
+                    raise
+                # Someone else changed the count, so try again
+                continue
+            if int(refs) <= 1:
+                for attempt in retry_s3():
+                    with attempt:
+                        self.filesBucket.delete_key(key_name=compat_bytes(contentKey),
+                                                    version_id=item['version'])
+            return
+
     def getEmptyFileStoreID(self, jobStoreID=None, cleanup=False, basename=None):
         info = self.FileInfo.create(jobStoreID if cleanup else None)
         with info.uploadStream() as _:
@@ -540,7 +711,8 @@ class AWSJobStore(AbstractJobStore):
 
     def writeFile(self, localFilePath, jobStoreID=None, cleanup=False):
         info = self.FileInfo.create(jobStoreID if cleanup else None)
-        info.upload(localFilePath, not self.config.disableJobStoreChecksumVerification)
+        info.upload(localFilePath, not self.config.disableJobStoreChecksumVerification,
+                    deduplicate=self._deduplicateFiles())
         info.save()
         log.debug("Wrote %r of from %r", info, localFilePath)
         return info.fileID
@@ -548,7 +720,7 @@ class AWSJobStore(AbstractJobStore):
     @contextmanager
     def writeFileStream(self, jobStoreID=None, cleanup=False, basename=None):
         info = self.FileInfo.create(jobStoreID if cleanup else None)
-        with info.uploadStream() as writable:
+        with info.uploadStream(deduplicate=self._deduplicateFiles()) as writable:
             yield writable, info.fileID
         info.save()
         log.debug("Wrote %r.", info)
@@ -566,14 +738,15 @@ class AWSJobStore(AbstractJobStore):
 
     def updateFile(self, jobStoreFileID, localFilePath):
         info = self.FileInfo.loadOrFail(jobStoreFileID)
-        info.upload(localFilePath, not self.config.disableJobStoreChecksumVerification)
+        info.upload(localFilePath, not self.config.disableJobStoreChecksumVerification,
+                    deduplicate=self._deduplicateFiles())
         info.save()
         log.debug("Wrote %r from path %r.", info, localFilePath)
 
     @contextmanager
     def updateFileStream(self, jobStoreFileID):
         info = self.FileInfo.loadOrFail(jobStoreFileID)
-        with info.uploadStream() as writable:
+        with info.uploadStream(deduplicate=self._deduplicateFiles()) as writable:
             yield writable
         info.save()
         log.debug("Wrote %r from stream.", info)
@@ -660,7 +833,7 @@ class AWSJobStore(AbstractJobStore):
                 f.write(info.content)
         for attempt in retry_s3():
             with attempt:
-                key = self.filesBucket.get_key(key_name=compat_bytes(jobStoreFileID), version_id=info.version)
+                key = self.filesBucket.get_key(key_name=compat_bytes(info.keyName), version_id=info.version)
                 key.set_canned_acl('public-read')
                 url = key.generate_url(query_auth=False,
                                        expires_in=self.publicUrlExpiration.total_seconds())
@@ -680,6 +853,84 @@ class AWSJobStore(AbstractJobStore):
         self._requireValidSharedFileName(sharedFileName)
         return self.getPublicUrl(self._sharedFileID(sharedFileName))
 
+    def _connections(self):
+        """
+        boto connections can't be shared between threads, so each thread using
+        the job store gets its own, made the first time it needs them.
+
+        :return: this thread's local state, with its own SimpleDB connection in
+                 db, S3 connection in s3, and a dict of handles on the bound
+                 domains and bucket made through them in bound
+        """
+        local = self._threadLocal
+        if not hasattr(local, 'db'):
+            local.db = self._connectSimpleDB()
+            local.s3 = self._connectS3()
+            local.bound = {}
+        return local
+
+    @property
+    def db(self):
+        """
+        :rtype: SDBConnection
+        """
+        return self._connections().db
+
+    @property
+    def s3(self):
+        """
+        :rtype: S3Connection
+        """
+        return self._connections().s3
+
+    def _boundForThisThread(self, name):
+        """
+        :param str name: jobsDomain, filesDomain or filesBucket
+        :return: a handle on the named domain or bucket that talks through this
+                 thread's connection, or None if it isn't bound
+        :rtype: Domain|Bucket|None
+        """
+        shared = self._bound[name]
+        if shared is None:
+            return None
+        local = self._connections()
+        connection = local.s3 if name == 'filesBucket' else local.db
+        if shared.connection is connection:
+            return shared
+        cached = local.bound.get(name)
+        # Rebind if the shared one has been replaced since
+        if cached is None or cached[0] is not shared:
+            if name == 'filesBucket':
+                handle = Bucket(connection=connection, name=shared.name)
+            else:
+                handle = Domain(connection=connection, name=shared.name)
+            cached = local.bound[name] = (shared, handle)
+        return cached[1]
+
+    @property
+    def jobsDomain(self):
+        return self._boundForThisThread('jobsDomain')
+
+    @jobsDomain.setter
+    def jobsDomain(self, value):
+        self._bound['jobsDomain'] = value
+
+    @property
+    def filesDomain(self):
+        return self._boundForThisThread('filesDomain')
+
+    @filesDomain.setter
+    def filesDomain(self, value):
+        self._bound['filesDomain'] = value
+
+    @property
+    def filesBucket(self):
+        return self._boundForThisThread('filesBucket')
+
+    @filesBucket.setter
+    def filesBucket(self, value):
+        self._bound['filesBucket'] = value
+
     def _connectSimpleDB(self):
         """
         :rtype: SDBConnection
@@ -850,7 +1101,8 @@ class AWSJobStore(AbstractJobStore):
         """
 
         def __init__(self, fileID, ownerID, encrypted,
-                     version=None, content=None, numContentChunks=0,  checksum=None):
+                     version=None, content=None, numContentChunks=0,  checksum=None,
+                     contentKey=None):
             """
             :type fileID: str
             :param fileID: the file's ID
@@ -876,6 +1128,11 @@ class AWSJobStore(AbstractJobStore):
             :param checksum: the checksum of the file, if available. Formatted
             as <algorithm>$<lowercase hex hash>.
 
+            :type contentKey: str|None
+            :param contentKey: the S3 key of the object storing this file's content if the
+            content is shared with other files with the same content, None or empty string
+            if it is stored under the file's ID.
+
             inlined content. Note that an inlined empty string still occupies one chunk.
             """
             super(AWSJobStore.FileInfo, self).__init__()
@@ -887,6 +1144,8 @@ class AWSJobStore(AbstractJobStore):
             self._content = content
             self._checksum = checksum
             self._numContentChunks = numContentChunks
+            self.contentKey = contentKey or ''
+            self._previousContentKey = self.contentKey
 
         @property
         def fileID(self):
@@ -912,6 +1171,13 @@ class AWSJobStore(AbstractJobStore):
         def previousVersion(self):
             return self._previousVersion
 
+        @property
+        def keyName(self):
+            """
+            The S3 key of the object storing this file's content.
+            """
+            return self.contentKey or self.fileID
+
         @property
         def content(self):
             return self._content
@@ -1005,6 +1271,7 @@ class AWSJobStore(AbstractJobStore):
             else:
                 version = strOrNone(item['version'])
                 checksum = strOrNone(item.get('checksum'))
+                contentKey = strOrNone(item.get('contentKey'))
                 encrypted = strict_bool(encrypted)
                 content, numContentChunks = cls.attributesToBinary(item)
                 if encrypted:
@@ -1014,7 +1281,8 @@ class AWSJobStore(AbstractJobStore):
                     if content is not None:
                         content = encryption.decrypt(content, sseKeyPath)
                 self = cls(fileID=item.name, ownerID=ownerID, encrypted=encrypted, version=version,
-                           content=content, numContentChunks=numContentChunks, checksum=checksum)
+                           content=content, numContentChunks=numContentChunks, checksum=checksum,
+                           contentKey=contentKey)
                 return self
 
         def toItem(self):
@@ -1039,12 +1307,13 @@ class AWSJobStore(AbstractJobStore):
             attributes.update(dict(ownerID=self.ownerID,
                                    encrypted=self.encrypted,
                                    version=self.version or '',
-                                   checksum=self.checksum or ''))
+                                   checksum=self.checksum or '',
+                                   contentKey=self.contentKey))
             return attributes, numChunks
 
         @classmethod
         def _reservedAttributes(cls):
-            return 3 + super(AWSJobStore.FileInfo, cls)._reservedAttributes()
+            return 4 + super(AWSJobStore.FileInfo, cls)._reservedAttributes()
 
         @staticmethod
         def maxInlinedSize():
@@ -1061,12 +1330,17 @@ class AWSJobStore(AbstractJobStore):
                                                                      attributes=attributes,
                                                                      expected_value=expected)
                 # clean up the old version of the file if necessary and safe
-                if self.previousVersion and (self.previousVersion != self.version):
+                if self._previousContentKey:
+                    # The file always takes a new reference when uploaded, so
+                    # the old one has to go even if the content is the same.
+                    self.outer._releaseContent(self._previousContentKey)
+                elif self.previousVersion and (self.previousVersion != self.version):
                     for attempt in retry_s3():
                         with attempt:
                             self.outer.filesBucket.delete_key(compat_bytes(self.fileID),
                                                               version_id=self.previousVersion)
                 self._previousVersion = self._version
+                self._previousContentKey = self.contentKey
                 if numNewContentChunks < self._numContentChunks:
                     residualChunks = range(numNewContentChunks, self._numContentChunks)
                     attributes = [self._chunkName(i) for i in residualChunks]
@@ -1081,13 +1355,22 @@ class AWSJobStore(AbstractJobStore):
                 else:
                     raise
 
-        def upload(self, localFilePath, calculateChecksum=True):
+        def upload(self, localFilePath, calculateChecksum=True, deduplicate=False):
+            """
+            Upload the content of a local file to this file.
+
+            :param bool deduplicate: if True, and the file is too big to inline, share the
+                   stored content with any other deduplicated files with the same content.
+            """
             file_size, file_time = fileSizeAndTime(localFilePath)
+            self.contentKey = ''
             if file_size <= self.maxInlinedSize():
                 with open(localFilePath, 'rb') as f:
                     self.content = f.read()
                 # Clear out any old checksum in case of overwrite
                 self.checksum = ''
+            elif deduplicate:
+                self._uploadDeduplicated(localFilePath)
             else:
                 headers = self._s3EncryptionHeaders()
                 self.checksum = self._get_file_checksum(localFilePath) if calculateChecksum else None
@@ -1095,6 +1378,31 @@ class AWSJobStore(AbstractJobStore):
                                               bucket=self.outer.filesBucket, fileID=compat_bytes(self.fileID),
                                               headers=headers)
 
+        def _uploadDeduplicated(self, localFilePath):
+            """
+            Upload the content of a local file to be shared by all the files with the same
+            content, or take a reference to it if it is already stored.
+            """
+            store = self.outer
+            self.checksum = self._get_file_checksum(localFilePath, algorithm='sha256')
+            contentKey = 'content-' + self.checksum.split('$')[1]
+            while True:
+                version = store._referenceContent(contentKey)
+                if version is not None:
+                    log.debug('Reusing stored content %s', contentKey)
+                    break
+                version = uploadFromPath(localFilePath, partSize=store.partSize,
+                                         bucket=store.filesBucket, fileID=compat_bytes(contentKey),
+                                         headers=self._s3EncryptionHeaders())
+                if store._registerContent(contentKey, version):
+                    break
+                # Someone else stored the same content while we were uploading
+                for attempt in retry_s3():
+                    with attempt:
+                        store.filesBucket.delete_key(compat_bytes(contentKey), version_id=version)
+            self.version = version
+            self.contentKey = contentKey
+
         def _start_checksum(self, to_match=None, algorithm='sha1'):
             """
             Get a hasher that can be used with _update_checksum and
@@ -1150,9 +1458,9 @@ class AWSJobStore(AbstractJobStore):
             
             
         
-        def _get_file_checksum(self, localFilePath, to_match=None):
+        def _get_file_checksum(self, localFilePath, to_match=None, algorithm='sha1'):
             with open(localFilePath, 'rb') as f:
-                hasher = self._start_checksum(to_match=to_match)
+                hasher = self._start_checksum(to_match=to_match, algorithm=algorithm)
                 contents = f.read(1024 * 1024)
                 while contents != b'':
                     self._update_checksum(hasher, contents)
@@ -1160,10 +1468,23 @@ class AWSJobStore(AbstractJobStore):
                 return self._finish_checksum(hasher)
 
         @contextmanager
-        def uploadStream(self, multipart=True, allowInlining=True):
+        def uploadStream(self, multipart=True, allowInlining=True, deduplicate=False):
             """
             Context manager that gives out a binary-mode upload stream to upload data.
+
+            :param bool deduplicate: if True, share the stored content with any other
+                   deduplicated files with the same content, as upload() does. The data is
+                   spooled to a local file so it can be hashed before it is uploaded.
             """
+            if deduplicate:
+                fd, localFilePath = tempfile.mkstemp()
+                try:
+                    with os.fdopen(fd, 'wb') as writable:
+                        yield writable
+                    self.upload(localFilePath, deduplicate=True)
+                finally:
+                    os.unlink(localFilePath)
+                return
 
             # Note that we have to handle already having a content or a version
             # if we are overwriting something.
@@ -1173,6 +1494,7 @@ class AWSJobStore(AbstractJobStore):
 
             info = self
             store = self.outer
+            self.contentKey = ''
 
             class MultiPartPipe(WritablePipe):
                 def readFrom(self, readable):
@@ -1321,6 +1643,7 @@ class AWSJobStore(AbstractJobStore):
             :param srcKey: The key that will be copied from
             """
             assert srcKey.size is not None
+            self.contentKey = ''
             if srcKey.size <= self.maxInlinedSize():
                 self.content = srcKey.get_contents_as_string()
             else:
@@ -1346,9 +1669,9 @@ class AWSJobStore(AbstractJobStore):
                 for attempt in retry_s3():
                     encrypted = True if self.outer.sseKeyPath else False
                     if encrypted:
-                        srcKey = self.outer.filesBucket.get_key(compat_bytes(self.fileID), headers=self._s3EncryptionHeaders())
+                        srcKey = self.outer.filesBucket.get_key(compat_bytes(self.keyName), headers=self._s3EncryptionHeaders())
                     else:
-                        srcKey = self.outer.filesBucket.get_key(compat_bytes(self.fileID))
+                        srcKey = self.outer.filesBucket.get_key(compat_bytes(self.keyName))
                     srcKey.version_id = self.version
                     with attempt:
                         copyKeyMultipart(srcBucketName=compat_plain(srcKey.bucket.name),
@@ -1368,7 +1691,7 @@ class AWSJobStore(AbstractJobStore):
                         f.write(self.content)
             elif self.version:
                 headers = self._s3EncryptionHeaders()
-                key = self.outer.filesBucket.get_key(compat_bytes(self.fileID), validate=False)
+                key = self.outer.filesBucket.get_key(compat_bytes(self.keyName), validate=False)
                 for attempt in retry_s3(predicate=lambda e: retryable_s3_errors(e) or isinstance(e, ChecksumError)):
                     with attempt:
                         with AtomicFileCreate(localFilePath) as tmpPath:
@@ -1398,7 +1721,7 @@ class AWSJobStore(AbstractJobStore):
                         writable.write(info.content)
                     elif info.version:
                         headers = info._s3EncryptionHeaders()
-                        key = info.outer.filesBucket.get_key(compat_bytes(info.fileID), validate=False)
+                        key = info.outer.filesBucket.get_key(compat_bytes(info.keyName), validate=False)
                         for attempt in retry_s3():
                             with attempt:
                                 key.get_contents_to_file(writable,
@@ -1450,7 +1773,9 @@ class AWSJobStore(AbstractJobStore):
                         store.filesDomain.delete_attributes(
                             compat_bytes(self.fileID),
                             expected_values=['version', self.previousVersion])
-                if self.previousVersion:
+                if self._previousContentKey:
+                    store._releaseContent(self._previousContentKey)
+                elif self.previousVersion:
                     for attempt in retry_s3():
                         with attempt:
                             store.filesBucket.delete_key(key_name=compat_bytes(self.fileID),
@@ -1465,7 +1790,7 @@ class AWSJobStore(AbstractJobStore):
             elif self.version:
                 for attempt in retry_s3():
                     with attempt:
-                        key = self.outer.filesBucket.get_key(compat_bytes(self.fileID), validate=False)
+                        key = self.outer.filesBucket.get_key(compat_bytes(self.keyName), validate=False)
                         return key.size
             else:
                 return 0
@@ -1501,6 +1826,7 @@ class AWSJobStore(AbstractJobStore):
                  ('previousVersion', r(self.previousVersion)),
                  ('content', r(self.content)),
                  ('checksum', r(self.checksum)),
+                 ('contentKey', r(self.contentKey)),
                  ('_numContentChunks', r(self._numContentChunks)))
             return "{}({})".format(type(self).__name__,
                                    ', '.join('%s=%s' % (k, v) for k, v in d))
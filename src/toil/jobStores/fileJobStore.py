@@ -17,6 +17,7 @@ from __future__ import absolute_import
 from builtins import range
 
 # standard library
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import logging
 import random
@@ -26,12 +27,14 @@ import re
 import tempfile
 import stat
 import errno
+import fcntl
+import hashlib
+import io
+import itertools
+import struct
+import threading
 import time
 import uuid
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 
 # toil dependencies
 from toil.fileStores import FileID
@@ -46,6 +49,12 @@ from toil.job import JobDescription, TemporaryID
 
 logger = logging.getLogger( __name__ )
 
+# Segment files being written by this process. Segments are locked while
+# their writers work on them, but a process's own locks don't keep it out, and
+# closing any other handle to the file would drop them.
+_segmentsInProgress = set()
+_segmentsInProgressLock = threading.Lock()
+
 
 class FileJobStore(AbstractJobStore):
     """
@@ -91,12 +100,27 @@ class FileJobStore(AbstractJobStore):
         self.jobFilesDir = os.path.join(self.jobStoreDir, 'files/for-job')
         # Directory where shared files go
         self.sharedFilesDir = os.path.join(self.jobStoreDir, 'files/shared')
+        # Directory where file content is kept by its hash when files are
+        # deduplicated. Files with the same content are hard links to the copy
+        # in here, which has a directory next to it with a reference for each
+        # of them. Each file has a symlink next to it pointing to the copy.
+        # Only created if files are deduplicated.
+        self.contentDir = os.path.join(self.jobStoreDir, 'files/by-content')
+        # Directory where packed segments of batch-created jobs go while they
+        # are being unpacked
+        self.segmentsDir = os.path.join(self.jobStoreDir, 'segments')
 
         self.fanOut = fanOut
 
         self.linkImports = None
         self.moveExports = None
 
+        # Jobs created and files written inside a batch() context, waiting to
+        # be written out when it ends
+        self._batchedUpdates = None
+        self._batchedFiles = None
+        self._batchedFileBytes = 0
+
     def __repr__(self):
         return 'FileJobStore({})'.format(self.jobStoreDir)
 
@@ -145,7 +169,7 @@ class FileJobStore(AbstractJobStore):
         jobDescription.jobStoreID = self._getJobIdFromDir(absJobDir)
         
     def create(self, jobDescription):
-        if hasattr(self, "_batchedUpdates") and self._batchedUpdates is not None:
+        if self._batchedUpdates is not None:
             # Save it later
             self._batchedUpdates.append(jobDescription)
         else:
@@ -153,13 +177,230 @@ class FileJobStore(AbstractJobStore):
             self.update(jobDescription)
         return jobDescription
 
+    # How many files to write at once when a batch is flushed
+    writesPerParallelFlush = 32
+
+    # How many bytes of file data a batch may hold in memory before writing it
+    # out early. Files are always written before any of the batch's jobs.
+    maxBatchedFileBytes = 64 * 1024 * 1024
+
+    # Segment records are a job ID length and a job data length, followed by
+    # the job ID and the serialized job.
+    _segmentRecord = struct.Struct('<II')
+
     @contextmanager
     def batch(self):
+        """
+        Collects the jobs created, and the contents of the files written with
+        writeFileStream(), while the context is active.
+
+        When it ends, the files are written in parallel, and then the jobs are
+        written to a single packed segment file, renamed into place atomically
+        and unpacked into the jobs' own job files. If the context is left with
+        an exception, none of the jobs are written.
+
+        Files written during the batch can't be read until it ends.
+        """
+        if self._batchedUpdates is not None:
+            # Already in a batch, which will do the writing
+            yield
+            return
         self._batchedUpdates = []
-        yield
-        for jobDescription in self._batchedUpdates:
-            self.update(jobDescription)
-        self._batchedUpdates = None
+        self._batchedFiles = []
+        self._batchedFileBytes = 0
+        try:
+            yield
+            self._flushBatchedFiles()
+            self._writeJobSegment(self._batchedUpdates)
+        finally:
+            self._batchedUpdates = None
+            self._batchedFiles = None
+            self._batchedFileBytes = 0
+
+    def _parallelWrite(self, writeFn, items):
+        """
+        Calls writeFn on each item, using threads if there is more than one.
+        """
+        if len(items) <= 1:
+            for item in items:
+                writeFn(item)
+            return
+        with ThreadPoolExecutor(max_workers=min(self.writesPerParallelFlush, len(items))) as executor:
+            # Consume the results so that errors are raised here
+            for _ in executor.map(writeFn, items):
+                pass
+
+    def _flushBatchedFiles(self):
+        """
+        Writes out the file contents held by the current batch.
+        """
+        def writeFile(item):
+            absPath, data = item
+            with open(absPath, 'wb') as f:
+                f.write(data)
+
+        files, self._batchedFiles, self._batchedFileBytes = self._batchedFiles, [], 0
+        self._parallelWrite(writeFile, files)
+
+    def _writeJobSegment(self, jobDescriptions):
+        """
+        Writes the given jobs to the job store together.
+
+        The jobs are first packed into a segment file, which is renamed into
+        place when complete. Once it is there, the jobs' files are written
+        from it in place, without a rename each, since they are new and
+        nobody else knows their IDs yet. If the writer dies part way
+        through, jobs() writes the rest from the segment, along with any it
+        left half written. The segment is locked until it has been unpacked,
+        so that nobody takes it for one left by a dead writer.
+
+        :param list[toil.job.JobDescription] jobDescriptions: the jobs to write
+        """
+        if len(jobDescriptions) <= 1:
+            for jobDescription in jobDescriptions:
+                self.update(jobDescription)
+            return
+        records = []
+        for jobDescription in jobDescriptions:
+            assert not isinstance(jobDescription.jobStoreID, TemporaryID), \
+                f"Tried to create job {jobDescription} without an assigned ID"
+            records.append((jobDescription.jobStoreID, self._serializeJob(jobDescription)))
+
+        os.makedirs(self.segmentsDir, exist_ok=True)
+        while True:
+            segmentPath = os.path.join(self.segmentsDir, 'segment-' + uuid.uuid4().hex)
+            with _segmentsInProgressLock:
+                _segmentsInProgress.add(segmentPath)
+            fd = os.open(segmentPath + '.new', os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_nlink > 0:
+                break
+            # Someone took it for a dead writer's before we could lock it.
+            os.close(fd)
+            with _segmentsInProgressLock:
+                _segmentsInProgress.discard(segmentPath)
+        try:
+            # Closing the file drops the lock, once the segment is gone.
+            with os.fdopen(fd, 'wb') as f:
+                for jobStoreID, data in records:
+                    encodedID = jobStoreID.encode('utf-8')
+                    f.write(self._segmentRecord.pack(len(encodedID), len(data)))
+                    f.write(encodedID)
+                    f.write(data)
+                f.flush()
+                # All the jobs now exist, as far as a restarted leader is concerned.
+                os.rename(segmentPath + '.new', segmentPath)
+                self._unpackJobSegment(segmentPath, records)
+        finally:
+            with _segmentsInProgressLock:
+                _segmentsInProgress.discard(segmentPath)
+
+    def _readJobSegment(self, segmentPath):
+        """
+        :return: the job ID and serialized job for each job in a segment file
+        :rtype: list[tuple[str, bytes]]
+        """
+        with open(segmentPath, 'rb') as f:
+            data = f.read()
+        records = []
+        offset = 0
+        while offset < len(data):
+            idLength, dataLength = self._segmentRecord.unpack_from(data, offset)
+            offset += self._segmentRecord.size
+            jobStoreID = data[offset:offset + idLength].decode('utf-8')
+            offset += idLength
+            records.append((jobStoreID, data[offset:offset + dataLength]))
+            offset += dataLength
+        return records
+
+    def _unpackJobSegment(self, segmentPath, records, recovering=False):
+        """
+        Writes out the job files for the jobs in a segment file, and then
+        removes it.
+
+        :param list[tuple[str, bytes]] records: the segment's contents
+        :param bool recovering: True if the segment's writer died while
+               unpacking it. Job files it finished, and ones updated since,
+               are left alone, and ones it left half written are replaced
+               atomically, since the jobs may be in use by now.
+        """
+        def writeJobFile(record):
+            jobStoreID, data = record
+            if not os.path.isdir(self._getJobDirFromId(jobStoreID)):
+                # The job has already been deleted.
+                return
+            jobFile = self._getJobFileName(jobStoreID)
+            if not recovering:
+                try:
+                    with open(jobFile, 'xb') as f:
+                        f.write(data)
+                except FileExistsError:
+                    # Someone recovering the segment got there first.
+                    pass
+                return
+            try:
+                with open(jobFile, 'rb') as f:
+                    written = f.read()
+            except FileNotFoundError:
+                written = b''
+            if len(written) == len(data) or written != data[:len(written)]:
+                # It was finished, or has been updated since.
+                return
+            with AtomicFileCreate(jobFile) as tmpPath:
+                with open(tmpPath, 'wb') as f:
+                    f.write(data)
+
+        self._parallelWrite(writeJobFile, records)
+        try:
+            os.remove(segmentPath)
+        except FileNotFoundError:
+            # Someone else recovering it got there first.
+            pass
+
+    def _recoverJobSegments(self):
+        """
+        Finishes unpacking any segment files left behind by writers that died
+        while unpacking them, and removes any that were never completed.
+
+        Segments whose writers are still at work are locked by them, and left
+        alone.
+        """
+        try:
+            segments = os.listdir(self.segmentsDir)
+        except FileNotFoundError:
+            return
+        for segment in segments:
+            segmentPath = os.path.join(self.segmentsDir, segment)
+            with _segmentsInProgressLock:
+                if (segmentPath[:-len('.new')] if segment.endswith('.new') else segmentPath) in _segmentsInProgress:
+                    continue
+            try:
+                fd = os.open(segmentPath, os.O_RDWR)
+            except FileNotFoundError:
+                # Its writer has finished with it.
+                continue
+            try:
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError as e:
+                    if e.errno in (errno.EACCES, errno.EAGAIN):
+                        # Its writer is still at work.
+                        continue
+                    raise
+                segmentStat = os.fstat(fd)
+                if segmentStat.st_nlink == 0:
+                    # Its writer, or someone else recovering it, finished
+                    # with it while we were opening it.
+                    continue
+                if segment.endswith('.new'):
+                    # The writer died before any of its jobs were created.
+                    os.remove(segmentPath)
+                else:
+                    logger.warning('Recovering jobs from unfinished batch %s', segment)
+                    self._unpackJobSegment(segmentPath, self._readJobSegment(segmentPath),
+                                           recovering=True)
+            finally:
+                os.close(fd)
 
     def _waitForExists(self, jobStoreID, maxTries=35, sleepTime=1):
         """
@@ -215,10 +456,62 @@ class FileJobStore(AbstractJobStore):
 
     def load(self, jobStoreID):
         self._checkJobStoreIdExists(jobStoreID)
-        # Load a valid version of the job
+        return self._loadJobFile(jobStoreID)
+
+    # How many job files to read at once when loading jobs in bulk. Job files
+    # are small, so on a shared filesystem the time goes on round trips.
+    jobsPerParallelLoad = 32
+
+    def loadMany(self, jobStoreIDs):
+        jobStoreIDs = list(jobStoreIDs)
+        jobs = dict(zip(jobStoreIDs, self._loadJobFiles(jobStoreIDs)))
+        for jobStoreID, job in jobs.items():
+            if job is None:
+                # Give the filesystem a chance to catch up, as load() would.
+                jobs[jobStoreID] = self.load(jobStoreID)
+        return jobs
+
+    def loadExisting(self, jobStoreIDs):
+        jobStoreIDs = list(jobStoreIDs)
+        return {jobStoreID: job for jobStoreID, job in zip(jobStoreIDs, self._loadJobFiles(jobStoreIDs))
+                if job is not None}
+
+    def _loadJobFiles(self, jobStoreIDs):
+        """
+        Loads the given jobs' files in parallel, without waiting for any of
+        them to appear.
+
+        :param list[str] jobStoreIDs: the IDs of the jobs to load
+        :return: the JobDescription for each ID in order, or None for jobs
+                 without a job file
+        :rtype: list[toil.job.JobDescription]
+        """
+        def loadOrNone(jobStoreID):
+            try:
+                return self._loadJobFile(jobStoreID)
+            except NoSuchJobException:
+                return None
+
+        if len(jobStoreIDs) <= 1:
+            return [loadOrNone(jobStoreID) for jobStoreID in jobStoreIDs]
+        with ThreadPoolExecutor(max_workers=min(self.jobsPerParallelLoad, len(jobStoreIDs))) as executor:
+            return list(executor.map(loadOrNone, jobStoreIDs))
+
+    def _loadJobFile(self, jobStoreID):
+        """
+        Loads a valid version of the job from its job file.
+
+        :raise NoSuchJobException: if the job file does not exist
+        :rtype: toil.job.JobDescription
+        """
         jobFile = self._getJobFileName(jobStoreID)
-        with open(jobFile, 'rb') as fileHandle:
-            job = pickle.load(fileHandle)
+        try:
+            with open(jobFile, 'rb') as fileHandle:
+                job = self._deserializeJob(fileHandle.read())
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                raise NoSuchJobException(jobStoreID)
+            raise
         
         # Pass along the current config, which is the JobStore's responsibility.
         job.assignConfig(self.config)
@@ -240,7 +533,7 @@ class FileJobStore(AbstractJobStore):
         # Atomicity guarantees use the fact the underlying file systems "move"
         # function is atomic.
         with open(self._getJobFileName(job.jobStoreID) + ".new", 'wb') as f:
-            pickle.dump(job, f)
+            f.write(self._serializeJob(job))
         # This should be atomic for the file system
         os.rename(self._getJobFileName(job.jobStoreID) + ".new", self._getJobFileName(job.jobStoreID))
 
@@ -250,26 +543,37 @@ class FileJobStore(AbstractJobStore):
         if self.exists(jobStoreID):
             # Remove the job-associated files in need of cleanup, which may or
             # may not live under the job's directory.
-            robust_rmtree(self._getJobFilesCleanupDir(jobStoreID))
+            self._deleteJobFiles(jobStoreID)
             # Remove the job's directory itself.
             robust_rmtree(self._getJobDirFromId(jobStoreID))
 
     def jobs(self):
+        # Make sure all the jobs from interrupted batches are there to be found.
+        self._recoverJobSegments()
+
         # Walk through list of temporary directories searching for jobs.
         # Jobs are files that start with 'job'.
         # Note that this also catches jobWhatever.new which exists if an update
         # is in progress.
-        for tempDir in self._jobDirectories():
-            for i in os.listdir(tempDir):
-                if i.startswith(self.JOB_DIR_PREFIX):
-                    # This is a job instance directory
-                    jobId = self._getJobIdFromDir(os.path.join(tempDir, i))
-                    try:
-                        if self.exists(jobId):
-                            yield self.load(jobId)
-                    except NoSuchJobException:
-                        # An orphaned job may leave an empty or incomplete job file which we can safely ignore
-                        pass
+        def jobStoreIDs():
+            for tempDir in self._jobDirectories():
+                for i in os.listdir(tempDir):
+                    if i.startswith(self.JOB_DIR_PREFIX):
+                        # This is a job instance directory
+                        yield self._getJobIdFromDir(os.path.join(tempDir, i))
+
+        # Jobs are spread thinly over many directories, so gather up their IDs
+        # and load them in bulk rather than a directory at a time.
+        idIterator = jobStoreIDs()
+        while True:
+            chunk = list(itertools.islice(idIterator, self.jobsPerParallelLoad * 32))
+            if not chunk:
+                break
+            for job in self._loadJobFiles(chunk):
+                # An orphaned job may leave an empty or incomplete job file
+                # which we can safely ignore
+                if job is not None:
+                    yield job
 
     ##########################################
     # Functions that deal with temporary files associated with jobs
@@ -405,7 +709,11 @@ class FileJobStore(AbstractJobStore):
     def writeFile(self, localFilePath, jobStoreID=None, cleanup=False):
         absPath = self._getUniqueFilePath(localFilePath, jobStoreID, cleanup)
         relPath = self._getFileIdFromPath(absPath)
-        atomic_copy(localFilePath, absPath)
+        if self._deduplicateFiles():
+            with open(localFilePath, 'rb') as f:
+                self._writeDeduplicated(f, absPath)
+        else:
+            atomic_copy(localFilePath, absPath)
         return relPath
 
     @contextmanager
@@ -414,6 +722,20 @@ class FileJobStore(AbstractJobStore):
             basename = 'stream'
         absPath = self._getUniqueFilePath(basename, jobStoreID, cleanup)
         relPath = self._getFileIdFromPath(absPath)
+        if self._batchedFiles is not None:
+            # Hold on to the data until the batch is flushed
+            buffer = io.BytesIO()
+            yield buffer, relPath
+            data = buffer.getvalue()
+            self._batchedFiles.append((absPath, data))
+            self._batchedFileBytes += len(data)
+            if self._batchedFileBytes > self.maxBatchedFileBytes:
+                self._flushBatchedFiles()
+            return
+        if self._deduplicateFiles():
+            with self._deduplicatedStream(absPath) as f:
+                yield f, relPath
+            return
         with open(absPath, 'wb') as f:
             # Don't yield while holding an open file descriptor to the temp
             # file. That can result in temp files still being open when we try
@@ -432,7 +754,12 @@ class FileJobStore(AbstractJobStore):
             # The files are already the same file. We can't copy on eover the other.
             return
 
-        atomic_copy(localFilePath, jobStoreFilePath)
+        if self._deduplicateFiles():
+            with open(localFilePath, 'rb') as f:
+                self._writeDeduplicated(f, jobStoreFilePath)
+        else:
+            atomic_copy(localFilePath, jobStoreFilePath)
+            self._unlinkContent(jobStoreFilePath)
 
     def readFile(self, jobStoreFileID, localFilePath, symlink=False):
         self._checkJobStoreFileID(jobStoreFileID)
@@ -469,8 +796,11 @@ class FileJobStore(AbstractJobStore):
                 else:
                     raise
 
-        # If we get here, symlinking isn't an option.
-        if os.stat(jobStoreFilePath).st_dev == os.stat(localDirPath).st_dev:
+        # If we get here, symlinking isn't an option. Nor is hard linking if
+        # the file shares its content with others: the reader may change the
+        # file in place.
+        if (self._getLinkedContent(jobStoreFilePath) is None and
+                os.stat(jobStoreFilePath).st_dev == os.stat(localDirPath).st_dev):
             # It is possible that we can hard link the file.
             # Note that even if the device numbers match, we can end up trying
             # to create a "cross-device" link.
@@ -506,7 +836,9 @@ class FileJobStore(AbstractJobStore):
     def deleteFile(self, jobStoreFileID):
         if not self.fileExists(jobStoreFileID):
             return
-        os.remove(self._getFilePathFromId(jobStoreFileID))
+        absPath = self._getFilePathFromId(jobStoreFileID)
+        os.remove(absPath)
+        self._unlinkContent(absPath)
 
     def fileExists(self, jobStoreFileID):
         absPath = self._getFilePathFromId(jobStoreFileID)
@@ -544,10 +876,19 @@ class FileJobStore(AbstractJobStore):
     @contextmanager
     def updateFileStream(self, jobStoreFileID):
         self._checkJobStoreFileID(jobStoreFileID)
+        absPath = self._getFilePathFromId(jobStoreFileID)
+        if self._deduplicateFiles():
+            with self._deduplicatedStream(absPath) as f:
+                yield f
+            return
+        if self._getLinkedContent(absPath) is not None:
+            # Don't write over content that other files share
+            os.remove(absPath)
+            self._unlinkContent(absPath)
         # File objects are context managers (CM) so we could simply return what open returns.
         # However, it is better to wrap it in another CM so as to prevent users from accessing
         # the file object directly, without a with statement.
-        with open(self._getFilePathFromId(jobStoreFileID), 'wb') as f:
+        with open(absPath, 'wb') as f:
             yield f
 
     @contextmanager
@@ -556,6 +897,198 @@ class FileJobStore(AbstractJobStore):
         with open(self._getFilePathFromId(jobStoreFileID), 'rb') as f:
             yield f
 
+    def _deleteJobFiles(self, jobStoreID):
+        """
+        Remove the files to be cleaned up with the given job, letting go of
+        any content they share with other files.
+        """
+        cleanupDir = self._getJobFilesCleanupDir(jobStoreID)
+        linkedContent = list(self._walkLinkedContent(cleanupDir))
+        robust_rmtree(cleanupDir)
+        for absPath, contentPath in linkedContent:
+            self._releaseContent(contentPath, absPath)
+
+    def _writeDeduplicated(self, readable, absPath):
+        """
+        Copy everything from the given stream into the job store, hashing it as
+        it goes, and make the file at the given path share the stored copy of
+        that content.
+
+        :param readable: Binary stream to copy from.
+        :param str absPath: Path of the file in the job store.
+        """
+        os.makedirs(self.contentDir, exist_ok=True)
+        fd, tempPath = tempfile.mkstemp(dir=self.contentDir, prefix='tmp')
+        try:
+            hasher = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: readable.read(self.BUFFER_SIZE), b''):
+                    hasher.update(chunk)
+                    f.write(chunk)
+            self._linkContent(tempPath, hasher.hexdigest(), absPath)
+        finally:
+            os.unlink(tempPath)
+
+    @contextmanager
+    def _deduplicatedStream(self, absPath):
+        """
+        Context manager yielding a stream to write the content of a file to,
+        which the file shares with any others with that content once the
+        stream is done.
+
+        :param str absPath: Path of the file in the job store.
+        """
+        os.makedirs(self.contentDir, exist_ok=True)
+        fd, tempPath = tempfile.mkstemp(dir=self.contentDir, prefix='tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+            self._linkContent(tempPath, self._hashFile(tempPath), absPath)
+        finally:
+            os.unlink(tempPath)
+
+    def _getContentPath(self, digest):
+        """
+        Get the path where content with the given hash is kept.
+
+        :rtype: str
+        """
+        return os.path.join(self.contentDir, digest[:2], digest)
+
+    def _getContentReferencePath(self, contentPath, absPath):
+        """
+        Get the path of the reference that the file at absPath holds to the
+        content at contentPath.
+
+        :rtype: str
+        """
+        name = hashlib.sha1(self._getFileIdFromPath(absPath).encode('utf-8')).hexdigest()
+        return os.path.join(contentPath + '.refs', name)
+
+    def _getLinkedContent(self, absPath):
+        """
+        Get the path of the content that the file at absPath shares, or None
+        if it doesn't share any.
+
+        :rtype: str or None
+        """
+        try:
+            target = os.readlink(absPath + '.content')
+        except OSError:
+            return None
+        return os.path.normpath(os.path.join(os.path.dirname(absPath), target))
+
+    def _walkLinkedContent(self, directory):
+        """
+        Find the files under a directory that share content.
+
+        :return: Iterator over the path of each file and the path of its content.
+        """
+        if not os.path.isdir(self.contentDir):
+            # Nothing has ever been deduplicated
+            return
+        for dirPath, _, fileNames in os.walk(directory):
+            for fileName in fileNames:
+                if fileName.endswith('.content'):
+                    absPath = os.path.join(dirPath, fileName[:-len('.content')])
+                    contentPath = self._getLinkedContent(absPath)
+                    if contentPath is not None:
+                        yield absPath, contentPath
+
+    def _linkContent(self, tempPath, digest, absPath):
+        """
+        Make the file at absPath a hard link to the stored copy of the content
+        in the file at tempPath, which becomes that copy if there isn't one
+        yet. Lets go of any content the file shared before.
+
+        Files are always hard links to their content, so if we race with the
+        last reference to a copy going away, the worst that can happen is
+        that the copy is forgotten and later files get a new one.
+
+        :param str tempPath: File holding the content, on the same file system.
+        :param str digest: Hash of the content.
+        :param str absPath: Path of the file in the job store.
+        """
+        contentPath = self._getContentPath(digest)
+        # Reference the content before linking to it, so nobody takes it to be
+        # unused and removes it in the meantime.
+        referencePath = self._getContentReferencePath(contentPath, absPath)
+        while True:
+            os.makedirs(os.path.dirname(referencePath), exist_ok=True)
+            try:
+                open(referencePath, 'w').close()
+                break
+            except FileNotFoundError:
+                # The last reference to the content before ours just went,
+                # and took the directory with it
+                pass
+
+        linkPath = absPath + '.link'
+        while True:
+            try:
+                # Adopt the copy of the content that is there
+                os.link(contentPath, linkPath)
+                break
+            except FileNotFoundError:
+                # There isn't one, so ours becomes it
+                try:
+                    os.link(tempPath, contentPath)
+                except FileExistsError:
+                    pass
+            except FileExistsError:
+                # Left over from an interrupted write
+                os.unlink(linkPath)
+
+        oldContentPath = self._getLinkedContent(absPath)
+        os.symlink(os.path.relpath(contentPath, os.path.dirname(absPath)), linkPath + '.content')
+        os.replace(linkPath + '.content', absPath + '.content')
+        os.replace(linkPath, absPath)
+        if oldContentPath is not None and oldContentPath != contentPath:
+            self._releaseContent(oldContentPath, absPath)
+
+    def _unlinkContent(self, absPath):
+        """
+        Forget that the file at absPath shares content, if it does, and let go
+        of the content.
+
+        :param str absPath: Path of the file in the job store.
+        """
+        contentPath = self._getLinkedContent(absPath)
+        if contentPath is not None:
+            os.unlink(absPath + '.content')
+            self._releaseContent(contentPath, absPath)
+
+    def _releaseContent(self, contentPath, absPath):
+        """
+        Drop the reference that the file at absPath has to some stored
+        content, and delete the content if nothing else references it.
+
+        :param str contentPath: The stored content.
+        :param str absPath: Path of the file in the job store.
+        """
+        referencePath = self._getContentReferencePath(contentPath, absPath)
+        referenceDir = os.path.dirname(referencePath)
+        try:
+            os.unlink(referencePath)
+        except FileNotFoundError:
+            pass
+        try:
+            if os.listdir(referenceDir):
+                return
+            os.unlink(contentPath)
+        except FileNotFoundError:
+            # Someone else deleted it
+            pass
+        try:
+            os.rmdir(referenceDir)
+        except FileNotFoundError:
+            # Someone else deleted it
+            pass
+        except OSError as e:
+            # Someone referenced the content again, and keeps the directory
+            if e.errno != errno.ENOTEMPTY:
+                raise
+
     ##########################################
     # The following methods deal with shared files, i.e. files not associated
     # with specific jobs.
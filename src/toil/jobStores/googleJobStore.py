@@ -11,13 +11,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from contextlib import contextmanager
+import io
 import uuid
 import logging
+import tempfile
 import time
 import os
-from toil import pickle
 from toil.lib.misc import AtomicFileCreate
 from toil.lib.retry import old_retry
 from toil.lib.compatibility import compat_bytes
@@ -104,6 +106,12 @@ class GoogleJobStore(AbstractJobStore):
 
         self.sseKey = None
 
+        # Jobs created and files written inside a batch() context, waiting to
+        # be uploaded when it ends
+        self._batchedUpdates = None
+        self._batchedFiles = None
+        self._batchedFileBytes = 0
+
         # Determine if we have an override environment variable for our credentials.
         # We don't pull out the filename; we just see if a name is there.
         self.credentialsFromEnvironment = bool(os.getenv('GOOGLE_APPLICATION_CREDENTIALS', False))
@@ -176,10 +184,72 @@ class GoogleJobStore(AbstractJobStore):
         jobDescription.jobStoreID = jobStoreID
 
     def create(self, jobDescription):
-        # TODO: we don't implement batching, but we probably should.
-        self._writeString(jobDescription.jobStoreID, pickle.dumps(jobDescription, protocol=pickle.HIGHEST_PROTOCOL))
+        if self._batchedUpdates is not None:
+            self._batchedUpdates.append(jobDescription)
+        else:
+            self._writeString(jobDescription.jobStoreID, self._serializeJob(jobDescription))
         return jobDescription
 
+    # How many blobs to upload at once when a batch is flushed
+    uploadsPerParallelFlush = 16
+
+    # How many bytes of file data a batch may hold in memory before uploading
+    # it early. Files are always uploaded before any of the batch's jobs.
+    maxBatchedFileBytes = 64 * 1024 * 1024
+
+    @contextmanager
+    def batch(self):
+        """
+        Collects the jobs created, and the contents of the files written with
+        writeFileStream(), while the context is active, and uploads them in
+        parallel when it ends: all of the files first, and then all of the
+        jobs. If the context is left with an exception, none of the jobs are
+        uploaded.
+
+        Files written during the batch can't be read until it ends.
+        """
+        if self._batchedUpdates is not None:
+            # Already in a batch, which will do the uploading
+            yield
+            return
+        self._batchedUpdates = []
+        self._batchedFiles = []
+        self._batchedFileBytes = 0
+        try:
+            yield
+            self._flushBatchedFiles()
+            self._parallelUpload([(jobDescription.jobStoreID, self._serializeJob(jobDescription))
+                                  for jobDescription in self._batchedUpdates])
+        finally:
+            self._batchedUpdates = None
+            self._batchedFiles = None
+            self._batchedFileBytes = 0
+
+    def _flushBatchedFiles(self):
+        """
+        Uploads the file contents held by the current batch.
+        """
+        files, self._batchedFiles, self._batchedFileBytes = self._batchedFiles, [], 0
+        self._parallelUpload(files)
+
+    def _parallelUpload(self, items):
+        """
+        Uploads new blobs, from a list of blob name and content pairs.
+        """
+        @googleRetry
+        def upload(item):
+            name, data = item
+            self._writeFile(name, io.BytesIO(data))
+
+        if len(items) <= 1:
+            for item in items:
+                upload(item)
+            return
+        with ThreadPoolExecutor(max_workers=min(self.uploadsPerParallelFlush, len(items))) as executor:
+            # Consume the results so that errors are raised here
+            for _ in executor.map(upload, items):
+                pass
+
     @googleRetry
     def exists(self, jobStoreID):
         return self.bucket.blob(compat_bytes(jobStoreID), encryption_key=self.sseKey).exists()
@@ -189,6 +259,7 @@ class GoogleJobStore(AbstractJobStore):
         blob = self.bucket.get_blob(compat_bytes(fileName), encryption_key=self.sseKey)
         if blob is None:
             raise NoSuchFileException(fileName)
+        blob = self._getContentBlob(blob)
         return blob.generate_signed_url(self.publicUrlExpiration)
 
     def getSharedPublicUrl(self, sharedFileName):
@@ -199,7 +270,7 @@ class GoogleJobStore(AbstractJobStore):
             jobString = self._readContents(jobStoreID)
         except NoSuchFileException:
             raise NoSuchJobException(jobStoreID)
-        job = pickle.loads(jobString) 
+        job = self._deserializeJob(jobString)
         # It is our responsibility to make sure that the JobDescription is
         # connected to the current config on this machine, for filling in
         # defaults. The leader and worker should never see config-less
@@ -207,8 +278,19 @@ class GoogleJobStore(AbstractJobStore):
         job.assignConfig(self.config)
         return job
 
+    # How many job blobs to download at once when loading jobs in bulk
+    jobsPerParallelLoad = 16
+
+    def loadMany(self, jobStoreIDs):
+        # GCS has no multi-object get, so spread the round trips over threads.
+        jobStoreIDs = list(jobStoreIDs)
+        if len(jobStoreIDs) <= 1:
+            return super(GoogleJobStore, self).loadMany(jobStoreIDs)
+        with ThreadPoolExecutor(max_workers=min(self.jobsPerParallelLoad, len(jobStoreIDs))) as executor:
+            return dict(zip(jobStoreIDs, executor.map(self.load, jobStoreIDs)))
+
     def update(self, job):
-        self._writeString(job.jobStoreID, pickle.dumps(job, protocol=pickle.HIGHEST_PROTOCOL), update=True)
+        self._writeString(job.jobStoreID, self._serializeJob(job), update=True)
 
     @googleRetry
     def delete(self, jobStoreID):
@@ -235,13 +317,16 @@ class GoogleJobStore(AbstractJobStore):
 
     @googleRetry
     def jobs(self):
-        for blob in self.bucket.list_blobs(prefix=b'job'):
-            jobStoreID = blob.name
-            if len(jobStoreID) == 39:  # 'job' + uuid length
-                yield self.load(jobStoreID)
+        jobStoreIDs = [blob.name for blob in self.bucket.list_blobs(prefix=b'job')
+                       if len(blob.name) == 39]  # 'job' + uuid length
+        for job in self.loadMany(jobStoreIDs).values():
+            yield job
 
     def writeFile(self, localFilePath, jobStoreID=None, cleanup=False):
         fileID = self._newID(isFile=True, jobStoreID=jobStoreID if cleanup else None)
+        if self._deduplicateFiles():
+            self._writeDeduplicated(fileID, localFilePath)
+            return fileID
         with open(localFilePath) as f:
             self._writeFile(fileID, f)
         return fileID
@@ -249,6 +334,20 @@ class GoogleJobStore(AbstractJobStore):
     @contextmanager
     def writeFileStream(self, jobStoreID=None, cleanup=False, basename=None):
         fileID = self._newID(isFile=True, jobStoreID=jobStoreID if cleanup else None)
+        if self._batchedFiles is not None:
+            # Hold on to the data until the batch is flushed
+            buffer = io.BytesIO()
+            yield buffer, fileID
+            data = buffer.getvalue()
+            self._batchedFiles.append((fileID, data))
+            self._batchedFileBytes += len(data)
+            if self._batchedFileBytes > self.maxBatchedFileBytes:
+                self._flushBatchedFiles()
+            return
+        if self._deduplicateFiles():
+            with self._deduplicatedStream(fileID) as writable:
+                yield writable, fileID
+            return
         with self._uploadStream(fileID, update=False) as writable:
             yield writable, fileID
 
@@ -266,6 +365,7 @@ class GoogleJobStore(AbstractJobStore):
         with AtomicFileCreate(localFilePath) as tmpPath:
             with open(tmpPath, 'w') as writeable:
                 blob = self.bucket.get_blob(compat_bytes(jobStoreFileID), encryption_key=self.sseKey)
+                blob = self._getContentBlob(blob)
                 blob.download_to_file(writeable)
 
     @contextmanager
@@ -284,16 +384,30 @@ class GoogleJobStore(AbstractJobStore):
     def getFileSize(self, jobStoreFileID):
         if not self.fileExists(jobStoreFileID):
             return 0
-        return self.bucket.get_blob(compat_bytes(jobStoreFileID), encryption_key=self.sseKey).size
+        blob = self.bucket.get_blob(compat_bytes(jobStoreFileID), encryption_key=self.sseKey)
+        return self._getContentBlob(blob).size
 
     def updateFile(self, jobStoreFileID, localFilePath):
+        if self._deduplicateFiles():
+            self._writeDeduplicated(jobStoreFileID, localFilePath, update=True)
+            return
+        contentName = self._getLinkedContent(jobStoreFileID)
         with open(localFilePath) as f:
             self._writeFile(jobStoreFileID, f, update=True)
+        if contentName is not None:
+            self._releaseContent(contentName)
 
     @contextmanager
     def updateFileStream(self, jobStoreFileID):
+        if self._deduplicateFiles():
+            with self._deduplicatedStream(jobStoreFileID, update=True) as writable:
+                yield writable
+            return
+        contentName = self._getLinkedContent(jobStoreFileID)
         with self._uploadStream(jobStoreFileID, update=True) as writable:
             yield writable
+        if contentName is not None:
+            self._releaseContent(contentName)
 
     @contextmanager
     def writeSharedFileStream(self, sharedFileName, isProtected=True):
@@ -420,10 +534,144 @@ class GoogleJobStore(AbstractJobStore):
 
     @googleRetry
     def _delete(self, jobStoreFileID):
-        if self.fileExists(jobStoreFileID):
-            self.bucket.get_blob(compat_bytes(jobStoreFileID)).delete()
+        blob = self.bucket.get_blob(compat_bytes(jobStoreFileID))
         # remember, this is supposed to be idempotent, so we don't do anything
         # if the file doesn't exist
+        if blob is not None:
+            blob.delete()
+            contentName = (blob.metadata or {}).get('content')
+            if contentName is not None:
+                self._releaseContent(contentName)
+
+    # Deduplicated files are empty blobs whose 'content' metadata names a blob
+    # holding their content, under content/<sha256 of the content>/. Each
+    # content blob counts the files pointing at it in its 'refs' metadata,
+    # which is only ever changed conditionally on its metageneration. Racing
+    # writers of the same content may each make a content blob, which is
+    # wasteful but safe.
+
+    def _writeDeduplicated(self, fileID, localFilePath, update=False):
+        """
+        Make the given file point at stored content shared with all the
+        deduplicated files with the same content as the given local file,
+        uploading the content if none of them is stored.
+
+        :param str fileID: The file to write.
+        :param str localFilePath: The local file with the content.
+        :param bool update: Whether the file is to be updated.
+        """
+        digest = self._hashFile(localFilePath)
+        contentName = self._referenceContent(digest)
+        if contentName is None:
+            contentName = self._uploadContent(digest, localFilePath)
+        oldContentName = self._getLinkedContent(fileID)
+        blob = self.bucket.blob(compat_bytes(fileID), encryption_key=self.sseKey)
+        blob.metadata = {'content': contentName}
+        self._writeFile(fileID, io.BytesIO(), update=update, blob=blob)
+        if oldContentName is not None:
+            self._releaseContent(oldContentName)
+
+    @contextmanager
+    def _deduplicatedStream(self, fileID, update=False):
+        """
+        Like :meth:`_writeDeduplicated`, but yields a stream for the content,
+        which is spooled to a local file to be hashed.
+        """
+        fd, localFilePath = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as writable:
+                yield writable
+            self._writeDeduplicated(fileID, localFilePath, update=update)
+        finally:
+            os.unlink(localFilePath)
+
+    @googleRetry
+    def _getLinkedContent(self, fileID):
+        """
+        Get the name of the content blob that the given file points at, or
+        None if the file keeps its own content.
+        """
+        blob = self.bucket.get_blob(compat_bytes(fileID))
+        if blob is None:
+            return None
+        return (blob.metadata or {}).get('content')
+
+    @googleRetry
+    def _getContentBlob(self, blob):
+        """
+        Get the blob holding the content of the given file blob, which is the
+        blob itself unless its content is shared.
+        """
+        contentName = (blob.metadata or {}).get('content')
+        if contentName is None:
+            return blob
+        return self.bucket.get_blob(compat_bytes(contentName), encryption_key=self.sseKey)
+
+    @googleRetry
+    def _uploadContent(self, digest, localFilePath):
+        """
+        Store content with one reference to it.
+
+        :return: The name of the new content blob.
+        """
+        contentName = 'content/%s/%s' % (digest, uuid.uuid4())
+        blob = self.bucket.blob(compat_bytes(contentName), encryption_key=self.sseKey)
+        blob.metadata = {'refs': '1'}
+        with open(localFilePath, 'rb') as f:
+            blob.upload_from_file(f)
+        return contentName
+
+    def _referenceContent(self, digest):
+        """
+        Take a reference to stored content with the given hash, if there is
+        any.
+
+        :return: The name of the content blob, or None if there is none.
+        """
+        for blob in self.bucket.list_blobs(prefix=compat_bytes('content/%s/' % digest)):
+            while blob is not None:
+                refs = int(blob.metadata['refs'])
+                if self._modifyContent(blob, refs + 1):
+                    return blob.name
+                # Someone else changed it, so look again
+                blob = self.bucket.get_blob(blob.name)
+        return None
+
+    def _releaseContent(self, contentName):
+        """
+        Drop a reference to the given content blob, and delete it if that was
+        the last one.
+        """
+        while True:
+            blob = self.bucket.get_blob(compat_bytes(contentName))
+            if blob is None:
+                log.warning('Content %s was released more often than it was referenced.', contentName)
+                return
+            if self._modifyContent(blob, int(blob.metadata['refs']) - 1):
+                return
+
+    @googleRetry
+    def _modifyContent(self, blob, refs):
+        """
+        Set the reference count of a content blob, deleting it if there are
+        no references left, unless the blob changed since it was loaded.
+
+        :return: False if the blob changed or is gone, True otherwise.
+        """
+        # The client library we use can't make requests conditional on the
+        # metageneration itself.
+        query = {'ifMetagenerationMatch': blob.metageneration}
+        try:
+            if refs > 0:
+                self.storageClient._connection.api_request(method='PATCH', path=blob.path,
+                                                           data={'metadata': {'refs': str(refs)}},
+                                                           query_params=query)
+            else:
+                self.storageClient._connection.api_request(method='DELETE', path=blob.path,
+                                                           query_params=query)
+        except (exceptions.PreconditionFailed, exceptions.NotFound):
+            return False
+        return True
 
     @googleRetry
     def _readContents(self, jobStoreID):
@@ -440,8 +688,9 @@ class GoogleJobStore(AbstractJobStore):
         return job.download_as_string()
 
     @googleRetry
-    def _writeFile(self, jobStoreID, fileObj, update=False, encrypt=True):
-        blob = self.bucket.blob(compat_bytes(jobStoreID), encryption_key=self.sseKey if encrypt else None)
+    def _writeFile(self, jobStoreID, fileObj, update=False, encrypt=True, blob=None):
+        if blob is None:
+            blob = self.bucket.blob(compat_bytes(jobStoreID), encryption_key=self.sseKey if encrypt else None)
         if not update:
             # TODO: should probably raise a special exception and be added to all jobStores
             assert not blob.exists()
@@ -500,6 +749,7 @@ class GoogleJobStore(AbstractJobStore):
         blob = self.bucket.get_blob(compat_bytes(fileName), encryption_key=self.sseKey if encrypt else None)
         if blob is None:
             raise NoSuchFileException(fileName)
+        blob = self._getContentBlob(blob)
 
         class DownloadPipe(ReadablePipe):
             def writeTo(self, writable):
@@ -0,0 +1,608 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from contextlib import contextmanager
+import logging
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+from toil.jobStores.abstractJobStore import NoSuchJobException
+from toil.jobStores.fileJobStore import FileJobStore
+from toil.job import TemporaryID
+
+logger = logging.getLogger(__name__)
+
+
+class PackedFileJobStore(FileJobStore):
+    """
+    A job store on a shared file system that keeps JobDescriptions in
+    append-only segment files instead of in a directory per job, to save on
+    the metadata operations that are slow on network file systems.
+
+    Each process appends job records to segment files of its own, and a small
+    SQLite index maps each job to its latest record. A record only takes
+    effect once the index points at it, so a writer that dies part way
+    through leaves the jobs it was writing as they were. If the index is
+    lost, it is rebuilt from the records in the segments. That can also bring
+    back the last records of a process killed before it could index them, but
+    cleaning the job store removes any such jobs that are unreachable.
+    Segments that are mostly dead records are compacted when the leader
+    cleans the job store.
+
+    Files are stored in the same way as in the FileJobStore. The index needs
+    a file system with working POSIX locks, such as NFSv4, or Lustre mounted
+    with flock.
+    """
+
+    # Record kinds
+    _PUT = 1
+    _DELETE = 2
+
+    # Each record is a kind, a job ID length, a data length, a sequence number
+    # that orders records across segments, and a CRC32 of the job ID and the
+    # data, followed by the job ID and the data.
+    _recordHeader = struct.Struct('<BIIQI')
+
+    # Job IDs look like FileJobStore ones, but are not directories.
+    _jobIDPattern = re.compile(r'^%s[^/]+/[0-9a-f]{2}/%s[0-9a-f]{32}$' % (re.escape(FileJobStore.JOB_NAME_DIR_PREFIX),
+                                                                           re.escape(FileJobStore.JOB_DIR_PREFIX)))
+
+    # Start a new segment once ours gets this big
+    maxSegmentSize = 64 * 1024 * 1024
+
+    # How many seconds to wait for another process's index transaction
+    indexTimeout = 600
+
+    # Whether to sync each append to disk before indexing it. Network file
+    # systems may not show the data to other nodes before this.
+    syncWrites = True
+
+    # How many jobs to list from the index at a time in jobs()
+    jobsPerListing = 1000
+
+    # How old a segment file that never made it into the index must be before
+    # compaction removes it
+    staleSegmentAge = 3600
+
+    def __init__(self, path, fanOut=1000):
+        super(PackedFileJobStore, self).__init__(path, fanOut=fanOut)
+        # Directory holding the job segments and their index
+        self.packedDir = os.path.join(self.jobStoreDir, 'packed')
+        self.indexPath = os.path.join(self.packedDir, 'index.sqlite')
+
+        # The process that owns our index connection and segment. Neither can
+        # be used from a forked child.
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+        self._connection = None
+        # The name and file descriptor of the segment we are appending to, if any
+        self._segment = None
+        self._segmentSize = 0
+
+    def __repr__(self):
+        return 'PackedFileJobStore({})'.format(self.jobStoreDir)
+
+    def initialize(self, config):
+        super(PackedFileJobStore, self).initialize(config)
+        os.makedirs(self.packedDir, exist_ok=True)
+        self._openIndex()
+
+    def resume(self):
+        super(PackedFileJobStore, self).resume()
+        os.makedirs(self.packedDir, exist_ok=True)
+        self._openIndex()
+
+    def destroy(self):
+        self._close()
+        super(PackedFileJobStore, self).destroy()
+
+    ##########################################
+    # The index and segments
+    ##########################################
+
+    def _close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+            if self._segment is not None:
+                os.close(self._segment[1])
+                self._segment = None
+
+    @contextmanager
+    def _index(self):
+        """
+        Yields the connection to the index, holding the lock that protects it
+        from our other threads.
+        """
+        if self._pid != os.getpid():
+            # We are a forked child, and the parent's lock, connection and
+            # segment are not ours to use.
+            if self._segment is not None:
+                os.close(self._segment[1])
+            self._pid = os.getpid()
+            self._lock = threading.RLock()
+            self._connection = None
+            self._segment = None
+        with self._lock:
+            if self._connection is None:
+                self._connection = sqlite3.connect(self.indexPath, timeout=self.indexTimeout,
+                                                   isolation_level=None, check_same_thread=False)
+                # Keep the journal file around between transactions, rather
+                # than creating and deleting it every time.
+                self._connection.execute('PRAGMA journal_mode=PERSIST')
+            yield self._connection
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Yields the connection to the index inside a transaction that holds
+        the index's write lock, and commits it if there is no exception.
+        """
+        with self._index() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            segment, segmentSize = self._segment, self._segmentSize
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                # Take back anything we appended, so rebuilding the index can't
+                # resurrect it.
+                if self._segment is not None and self._segment == segment:
+                    os.ftruncate(self._segment[1], segmentSize)
+                    self._segmentSize = segmentSize
+                elif self._segment is not None:
+                    # We started this segment, and it is no longer indexed.
+                    os.close(self._segment[1])
+                    os.remove(self._segmentPath(self._segment[0]))
+                    self._segment = None
+                raise
+            else:
+                connection.execute('COMMIT')
+
+    def _openIndex(self):
+        """
+        Makes sure the index exists, rebuilding it from the segments if it has
+        gone missing or is corrupt.
+        """
+        missing = not os.path.exists(self.indexPath)
+        try:
+            self._createIndex()
+        except sqlite3.DatabaseError as e:
+            self._close()
+            corruptPath = '%s.corrupt-%d' % (self.indexPath, time.time())
+            logger.warning('Job store index is unreadable (%s); moving it to %s', e, corruptPath)
+            os.rename(self.indexPath, corruptPath)
+            missing = True
+            self._createIndex()
+        if missing and self._segmentFiles():
+            self._rebuildIndex()
+
+    def _createIndex(self):
+        with self._transaction() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS jobs '
+                               '(id TEXT PRIMARY KEY, segment TEXT NOT NULL, '
+                               'offset INTEGER NOT NULL, length INTEGER NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS jobsBySegment ON jobs (segment)')
+            connection.execute('CREATE TABLE IF NOT EXISTS segments (name TEXT PRIMARY KEY)')
+            connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            connection.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('sequence', 1)")
+
+    def _segmentFiles(self):
+        """
+        :return: the names of all the segment files, indexed or not
+        :rtype: list[str]
+        """
+        return sorted(name for name in os.listdir(self.packedDir)
+                      if name.startswith('segment-') and name.endswith('.log'))
+
+    def _segmentPath(self, name):
+        return os.path.join(self.packedDir, name)
+
+    def _currentSegment(self, connection):
+        """
+        Gets the segment this process should append to, starting a new one if
+        we don't have one, ours is full, or ours has been compacted away.
+
+        Must be called inside a transaction, so that compaction can't remove
+        the segment before the caller has indexed what it appends.
+
+        :return: the segment's name and an append-mode file descriptor for it
+        :rtype: tuple[str, int]
+        """
+        if self._segment is not None:
+            name, fd = self._segment
+            if (self._segmentSize >= self.maxSegmentSize or
+                    connection.execute('SELECT 1 FROM segments WHERE name = ?', (name,)).fetchone() is None):
+                os.close(fd)
+                self._segment = None
+        if self._segment is None:
+            name = 'segment-%s.log' % uuid.uuid4().hex
+            fd = os.open(self._segmentPath(name), os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o644)
+            connection.execute('INSERT INTO segments (name) VALUES (?)', (name,))
+            self._segment = (name, fd)
+            self._segmentSize = 0
+        return self._segment
+
+    def _nextSequence(self, connection, count):
+        """
+        Reserves count consecutive sequence numbers, and returns the first.
+        Must be called inside a transaction.
+        """
+        connection.execute("UPDATE counters SET value = value + ? WHERE name = 'sequence'", (count,))
+        return connection.execute("SELECT value FROM counters WHERE name = 'sequence'").fetchone()[0] - count
+
+    def _appendRecords(self, connection, records):
+        """
+        Appends records to this process's segment. Must be called inside a
+        transaction, which should index the records before it commits.
+
+        :param list[tuple[int, str, bytes, int]] records: the kind, job ID,
+               data and sequence number of each record
+        :return: the segment, offset and length where each record was put
+        :rtype: list[tuple[str, int, int]]
+        """
+        name, fd = self._currentSegment(connection)
+        buffer = bytearray()
+        placements = []
+        for kind, jobStoreID, data, sequence in records:
+            encodedID = jobStoreID.encode('utf-8')
+            header = self._recordHeader.pack(kind, len(encodedID), len(data), sequence,
+                                             zlib.crc32(data, zlib.crc32(encodedID)))
+            placements.append((name, self._segmentSize + len(buffer), len(header) + len(encodedID) + len(data)))
+            buffer += header
+            buffer += encodedID
+            buffer += data
+        try:
+            view = memoryview(buffer)
+            while view:
+                view = view[os.write(fd, view):]
+            if self.syncWrites:
+                os.fsync(fd)
+        except:
+            # Don't leave part of a record behind, or append after one.
+            try:
+                os.ftruncate(fd, self._segmentSize)
+            except OSError:
+                pass
+            os.close(fd)
+            self._segment = None
+            raise
+        self._segmentSize += len(buffer)
+        return placements
+
+    def _parseRecord(self, buffer, offset):
+        """
+        Parses the record at the given offset in the buffer.
+
+        :return: the kind, job ID, data and sequence number of the record, and
+                 the offset of the end of the record, or None if the record is
+                 incomplete or corrupt
+        :rtype: tuple[int, str, bytes, int, int] or None
+        """
+        if offset + self._recordHeader.size > len(buffer):
+            return None
+        kind, idLength, dataLength, sequence, checksum = self._recordHeader.unpack_from(buffer, offset)
+        idStart = offset + self._recordHeader.size
+        dataStart = idStart + idLength
+        end = dataStart + dataLength
+        if kind not in (self._PUT, self._DELETE) or end > len(buffer):
+            return None
+        encodedID = bytes(buffer[idStart:dataStart])
+        data = bytes(buffer[dataStart:end])
+        if zlib.crc32(data, zlib.crc32(encodedID)) != checksum:
+            return None
+        return kind, encodedID.decode('utf-8'), data, sequence, end
+
+    def _readRecord(self, fileHandle, jobStoreID, offset, length):
+        """
+        Reads an indexed record from an open segment file.
+
+        :return: the kind, data and sequence number of the record
+        :rtype: tuple[int, bytes, int]
+        """
+        fileHandle.seek(offset)
+        parsed = self._parseRecord(fileHandle.read(length), 0)
+        if parsed is None or parsed[1] != jobStoreID or parsed[4] != length:
+            raise RuntimeError('The record for job %s in job store segment %s is corrupt'
+                               % (jobStoreID, fileHandle.name))
+        kind, _, data, sequence, _ = parsed
+        return kind, data, sequence
+
+    def _scanSegment(self, name):
+        """
+        Yields the kind, job ID, sequence number, offset and length of each
+        intact record in a segment file, stopping at any torn or corrupt tail.
+        """
+        with open(self._segmentPath(name), 'rb') as fileHandle:
+            buffer = fileHandle.read()
+        offset = 0
+        while offset < len(buffer):
+            parsed = self._parseRecord(buffer, offset)
+            if parsed is None:
+                logger.warning('Ignoring %d bytes of incomplete records at the end of job store segment %s',
+                               len(buffer) - offset, name)
+                return
+            kind, jobStoreID, _, sequence, end = parsed
+            yield kind, jobStoreID, sequence, offset, end - offset
+            offset = end
+
+    def _rebuildIndex(self):
+        """
+        Rebuilds the index from the records in the segment files. The latest
+        record for each job wins.
+        """
+        logger.warning('Rebuilding the job store index from its segments')
+        latest = {}
+        maxSequence = 0
+        names = self._segmentFiles()
+        for name in names:
+            for kind, jobStoreID, sequence, offset, length in self._scanSegment(name):
+                maxSequence = max(maxSequence, sequence)
+                if jobStoreID not in latest or latest[jobStoreID][0] < sequence:
+                    latest[jobStoreID] = (sequence, kind, name, offset, length)
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM jobs')
+            connection.execute('DELETE FROM segments')
+            connection.executemany('INSERT INTO segments (name) VALUES (?)', ((name,) for name in names))
+            connection.executemany('INSERT INTO jobs (id, segment, offset, length) VALUES (?, ?, ?, ?)',
+                                   ((jobStoreID, name, offset, length)
+                                    for jobStoreID, (_, kind, name, offset, length) in latest.items()
+                                    if kind == self._PUT))
+            connection.execute("UPDATE counters SET value = ? WHERE name = 'sequence'", (maxSequence + 1,))
+        logger.warning('Recovered %d jobs from %d job store segments',
+                       sum(1 for record in latest.values() if record[1] == self._PUT), len(names))
+
+    def compact(self, minLiveFraction=0.5):
+        """
+        Rewrites the live records of segments that are mostly dead records
+        into this process's segment, and deletes those segments. Also deletes
+        segment files that were abandoned before they were ever indexed.
+
+        :param float minLiveFraction: compact segments in which less than this
+               fraction of the space holds live records
+        :return: the number of bytes reclaimed
+        :rtype: int
+        """
+        with self._index() as connection:
+            indexed = [row[0] for row in connection.execute('SELECT name FROM segments')]
+            liveBytes = dict(connection.execute('SELECT segment, SUM(length) FROM jobs GROUP BY segment'))
+            ours = self._segment[0] if self._segment is not None else None
+        reclaimed = 0
+        for name in indexed:
+            if name == ours:
+                continue
+            try:
+                size = os.path.getsize(self._segmentPath(name))
+            except FileNotFoundError:
+                size = 0
+            if size > 0 and liveBytes.get(name, 0) >= size * minLiveFraction:
+                continue
+            reclaimed += self._compactSegment(name)
+
+        indexed = set(indexed)
+        for name in self._segmentFiles():
+            path = self._segmentPath(name)
+            if name not in indexed and name != ours:
+                try:
+                    if time.time() - os.path.getmtime(path) > self.staleSegmentAge:
+                        reclaimed += os.path.getsize(path)
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return reclaimed
+
+    def _compactSegment(self, name):
+        """
+        Moves a segment's live records to this process's segment and deletes
+        it.
+
+        :return: the number of bytes reclaimed
+        :rtype: int
+        """
+        path = self._segmentPath(name)
+        with self._transaction() as connection:
+            rows = connection.execute('SELECT id, offset, length FROM jobs WHERE segment = ? ORDER BY offset',
+                                      (name,)).fetchall()
+            if rows:
+                records = []
+                with open(path, 'rb') as fileHandle:
+                    for jobStoreID, offset, length in rows:
+                        kind, data, sequence = self._readRecord(fileHandle, jobStoreID, offset, length)
+                        # Keep the original sequence number, so the copy
+                        # doesn't win over newer records if the index is rebuilt.
+                        records.append((kind, jobStoreID, data, sequence))
+                placements = self._appendRecords(connection, records)
+                connection.executemany('UPDATE jobs SET segment = ?, offset = ?, length = ? WHERE id = ?',
+                                       ((segment, offset, length, row[0])
+                                        for row, (segment, offset, length) in zip(rows, placements)))
+            connection.execute('DELETE FROM segments WHERE name = ?', (name,))
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            size = 0
+        return max(size - sum(row[2] for row in rows), 0)
+
+    def clean(self, jobCache=None, partialCache=False):
+        rootJobDescription = super(PackedFileJobStore, self).clean(jobCache=jobCache, partialCache=partialCache)
+        reclaimed = self.compact()
+        if reclaimed:
+            logger.info('Compacted the job store segments, reclaiming %d bytes.', reclaimed)
+        return rootJobDescription
+
+    ##########################################
+    # The following methods deal with creating/loading/updating/writing/checking for the
+    # existence of jobs
+    ##########################################
+
+    def assignID(self, jobDescription):
+        # Group jobs by name like the FileJobStore does, but only to organize
+        # their files. Nothing is made on disk until the job is created.
+        usefulFilename = self._makeStringFilenameSafe(jobDescription.jobName)
+        instance = uuid.uuid4().hex
+        jobDescription.jobStoreID = '%s%s/%s/%s%s' % (self.JOB_NAME_DIR_PREFIX, usefulFilename, instance[:2],
+                                                      self.JOB_DIR_PREFIX, instance)
+
+    def _writeJobs(self, jobDescriptions):
+        """
+        Appends the given jobs to our segment and indexes them, all at once.
+
+        :param list[toil.job.JobDescription] jobDescriptions: the jobs to write
+        """
+        if not jobDescriptions:
+            return
+        for job in jobDescriptions:
+            assert job.jobStoreID is not None, f"Tried to update job {job} without an ID"
+            assert not isinstance(job.jobStoreID, TemporaryID), f"Tried to update job {job} without an assigned ID"
+        serialized = [(job.jobStoreID, self._serializeJob(job)) for job in jobDescriptions]
+        with self._transaction() as connection:
+            sequence = self._nextSequence(connection, len(serialized))
+            placements = self._appendRecords(connection, [(self._PUT, jobStoreID, data, sequence + i)
+                                                          for i, (jobStoreID, data) in enumerate(serialized)])
+            connection.executemany('INSERT OR REPLACE INTO jobs (id, segment, offset, length) VALUES (?, ?, ?, ?)',
+                                   ((jobStoreID, segment, offset, length)
+                                    for (jobStoreID, _), (segment, offset, length) in zip(serialized, placements)))
+
+    def _writeJobSegment(self, jobDescriptions):
+        # A batch goes into our own segment like anything else we write.
+        self._writeJobs(jobDescriptions)
+
+    def update(self, job):
+        self._writeJobs([job])
+
+    def exists(self, jobStoreID):
+        with self._index() as connection:
+            return connection.execute('SELECT 1 FROM jobs WHERE id = ?', (jobStoreID,)).fetchone() is not None
+
+    def load(self, jobStoreID):
+        return self.loadMany([jobStoreID])[jobStoreID]
+
+    def loadMany(self, jobStoreIDs):
+        jobStoreIDs = list(jobStoreIDs)
+        jobs = self._loadJobs(jobStoreIDs)
+        for jobStoreID in jobStoreIDs:
+            if jobStoreID not in jobs:
+                raise NoSuchJobException(jobStoreID)
+        return jobs
+
+    def loadExisting(self, jobStoreIDs):
+        return self._loadJobs(list(jobStoreIDs))
+
+    def _locate(self, jobStoreIDs):
+        """
+        :return: the segment, offset and length of the record for each of the
+                 given jobs that exists
+        :rtype: dict[str, tuple[str, int, int]]
+        """
+        locations = {}
+        jobStoreIDs = list(jobStoreIDs)
+        with self._index() as connection:
+            # Stay under SQLite's limit on query parameters
+            for i in range(0, len(jobStoreIDs), 500):
+                chunk = jobStoreIDs[i:i + 500]
+                query = 'SELECT id, segment, offset, length FROM jobs WHERE id IN (%s)' % ','.join('?' * len(chunk))
+                for jobStoreID, segment, offset, length in connection.execute(query, chunk):
+                    locations[jobStoreID] = (segment, offset, length)
+        return locations
+
+    def _loadJobs(self, jobStoreIDs, locations=None):
+        """
+        Loads whichever of the given jobs exist, reading each segment once.
+
+        :param dict[str, tuple[str, int, int]] locations: where the jobs'
+               records are, if already looked up
+        :rtype: dict[str, toil.job.JobDescription]
+        """
+        if locations is None:
+            locations = self._locate(jobStoreIDs)
+        jobs = {}
+        for attempt in range(3):
+            bySegment = {}
+            for jobStoreID, (segment, offset, length) in locations.items():
+                bySegment.setdefault(segment, []).append((offset, length, jobStoreID))
+            moved = []
+            for segment, records in bySegment.items():
+                try:
+                    with open(self._segmentPath(segment), 'rb') as fileHandle:
+                        for offset, length, jobStoreID in sorted(records):
+                            _, data, _ = self._readRecord(fileHandle, jobStoreID, offset, length)
+                            job = self._deserializeJob(data)
+                            # Pass along the current config, which is the JobStore's responsibility.
+                            job.assignConfig(self.config)
+                            jobs[jobStoreID] = job
+                except FileNotFoundError:
+                    # The segment was compacted after we looked the jobs up.
+                    moved.extend(jobStoreID for _, _, jobStoreID in records)
+            if not moved:
+                break
+            locations = self._locate(moved)
+        else:
+            raise RuntimeError('Job store segments kept moving while loading jobs %s' % list(locations))
+        # Keep the order the jobs were asked for in.
+        return {jobStoreID: jobs[jobStoreID] for jobStoreID in jobStoreIDs if jobStoreID in jobs}
+
+    def delete(self, jobStoreID):
+        with self._transaction() as connection:
+            if connection.execute('SELECT 1 FROM jobs WHERE id = ?', (jobStoreID,)).fetchone() is None:
+                return
+            # Leave a tombstone so that rebuilding the index doesn't bring the job back.
+            sequence = self._nextSequence(connection, 1)
+            self._appendRecords(connection, [(self._DELETE, jobStoreID, b'', sequence)])
+            connection.execute('DELETE FROM jobs WHERE id = ?', (jobStoreID,))
+        # Remove the job-associated files in need of cleanup.
+        self._deleteJobFiles(jobStoreID)
+
+    def deleteMany(self, jobStoreIDs):
+        # Tombstone the jobs that exist in a single transaction.
+        jobStoreIDs = list(self._locate(jobStoreIDs))
+        if jobStoreIDs:
+            with self._transaction() as connection:
+                sequence = self._nextSequence(connection, len(jobStoreIDs))
+                self._appendRecords(connection, [(self._DELETE, jobStoreID, b'', sequence + i)
+                                                 for i, jobStoreID in enumerate(jobStoreIDs)])
+                connection.executemany('DELETE FROM jobs WHERE id = ?', ((jobStoreID,) for jobStoreID in jobStoreIDs))
+        for jobStoreID in jobStoreIDs:
+            self._deleteJobFiles(jobStoreID)
+
+    def jobs(self):
+        # Page through the index rather than holding it all in memory.
+        lastID = ''
+        while True:
+            with self._index() as connection:
+                rows = connection.execute('SELECT id, segment, offset, length FROM jobs WHERE id > ? '
+                                          'ORDER BY id LIMIT ?', (lastID, self.jobsPerListing)).fetchall()
+            if not rows:
+                return
+            lastID = rows[-1][0]
+            locations = {jobStoreID: (segment, offset, length) for jobStoreID, segment, offset, length in rows}
+            # Jobs deleted since we listed them are skipped.
+            for job in self._loadJobs(list(locations), locations).values():
+                yield job
+
+    def _checkJobStoreIdAssigned(self, jobStoreID):
+        # Assigning an ID doesn't record anything, so all we can check is
+        # that the ID is one of ours.
+        if not self._jobIDPattern.match(jobStoreID):
+            raise NoSuchJobException(jobStoreID)
+
+    def _checkJobStoreIdExists(self, jobStoreID):
+        if not self.exists(jobStoreID):
+            raise NoSuchJobException(jobStoreID)
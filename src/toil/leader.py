@@ -24,12 +24,16 @@ from builtins import str
 from builtins import object
 from builtins import super
 import base64
+import enum
 import logging
 import time
 import os
 import pickle
 import sys
 import glob
+import itertools
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
 
 from toil.lib.humanize import bytes2human
 from toil import resolveEntryPoint
@@ -42,7 +46,9 @@ from toil.batchSystems.abstractBatchSystem import BatchJobExitReason
 from toil.jobStores.abstractJobStore import NoSuchJobException
 from toil.batchSystems import DeadlockException
 from toil.lib.throttle import LocalThrottle
-from toil.provisioners.clusterScaler import ScalerThread
+from toil.leaderCheckpoint import LeaderCheckpoint
+from toil.leaderScheduler import CriticalPathQueue, ReadyJobQueue
+from toil.provisioners.clusterScaler import JobRuntimes, ScalerThread
 from toil.serviceManager import ServiceManager
 from toil.statsAndLogging import StatsAndLogging
 from toil.job import Job, JobDescription, ServiceJobDescription, CheckpointJobDescription
@@ -98,7 +104,82 @@ class FailedJobsException(Exception):
         Stringify the exception, including the message.
         """
         return self.msg
-    
+
+
+####################################################
+# Things that can wake the leader up
+####################################################
+
+class WakeupReason(enum.Enum):
+    BATCH_UPDATE = 1  # The batch system has an updated job for us.
+    SERVICES = 2  # The service manager has new output for us.
+    THREAD_EXIT = 3  # A helper thread has quit and needs to be checked on.
+    ERROR = 4  # Something went wrong in a helper thread. Payload is the exception.
+
+
+class BatchSystemPump(Thread):
+    """
+    Thread that waits on the batch system for updated jobs and forwards each
+    one to the leader's wakeup queue, so that the leader can sleep on a single
+    queue for batch system, service manager and helper thread events, instead
+    of polling each of them in turn.
+    """
+    def __init__(self, batchSystem, wakeups, pollInterval=1):
+        """
+        :param toil.batchSystems.abstractBatchSystem.AbstractBatchSystem batchSystem:
+        :param queue.Queue wakeups: The leader's wakeup queue. Gets (WakeupReason, payload) tuples.
+        :param float pollInterval: How long to block in the batch system at a time.
+               Bounds how long shutdown() takes.
+        """
+        super().__init__(daemon=True)
+        self.batchSystem = batchSystem
+        self.wakeups = wakeups
+        self.pollInterval = pollInterval
+        self._stopping = Event()
+        # Batch system IDs of updates we took from the batch system that the
+        # leader has not consumed yet. The batch system has forgotten about
+        # them, but the leader hasn't heard about them, so they shouldn't be
+        # considered missing.
+        self._inFlight = set()
+        self._inFlightLock = Lock()
+
+    def run(self):
+        try:
+            while not self._stopping.is_set():
+                updatedJobTuple = self.batchSystem.getUpdatedBatchJob(maxWait=self.pollInterval)
+                if updatedJobTuple is not None:
+                    with self._inFlightLock:
+                        self._inFlight.add(updatedJobTuple.jobID)
+                    self.wakeups.put((WakeupReason.BATCH_UPDATE, updatedJobTuple))
+        except Exception as e:
+            logger.exception('Unhandled exception while waiting on the batch system')
+            # Hand the exception over to the leader so it can stop.
+            self.wakeups.put((WakeupReason.ERROR, e))
+
+    def consumed(self, jobBatchSystemID):
+        """
+        Note that the leader has taken the update for the given job off the
+        wakeup queue.
+        """
+        with self._inFlightLock:
+            self._inFlight.discard(jobBatchSystemID)
+
+    def inFlight(self):
+        """
+        :return: Batch system IDs of updated jobs that are on their way to the leader.
+        :rtype: set(int)
+        """
+        with self._inFlightLock:
+            return set(self._inFlight)
+
+    def shutdown(self):
+        """
+        Stop waiting on the batch system and join the thread.
+        """
+        self._stopping.set()
+        if self.is_alive():
+            self.join()
+
 
 ####################################################
 ##Following class represents the leader
@@ -166,11 +247,35 @@ class Leader(object):
         if self.provisioner is not None and len(self.provisioner.nodeTypes) > 0:
             self.clusterScaler = ScalerThread(self.provisioner, self, self.config)
 
+        # The runtimes of completed jobs, shared with the cluster scaler if
+        # there is one
+        if self.clusterScaler is not None:
+            self.jobRuntimes = self.clusterScaler.scaler.runtimes
+        else:
+            self.jobRuntimes = JobRuntimes()
+
+        # The jobs we have decided to run but not yet issued, because of the
+        # limit on issued jobs, in the order they should be issued
+        if self.config.jobScheduler == 'criticalPath':
+            self.readyJobs = CriticalPathQueue(self.jobRuntimes)
+        else:
+            self.readyJobs = ReadyJobQueue()
+
+        # The queue that the main loop sleeps on. The batch system, the service
+        # manager and the helper threads all put (WakeupReason, payload)
+        # tuples in here when they have something for the leader.
+        self.wakeups = Queue()
+
+        # A thread to feed updated jobs from the batch system into the wakeup queue
+        self.batchSystemPump = BatchSystemPump(self.batchSystem, self.wakeups)
+
         # A service manager thread to start and terminate services
-        self.serviceManager = ServiceManager(jobStore, self.toilState)
+        self.serviceManager = ServiceManager(jobStore, self.toilState,
+                                             wakeUp=lambda: self.wakeups.put((WakeupReason.SERVICES, None)))
 
         # A thread to manage the aggregation of statistics and logging from the run
-        self.statsAndLogging = StatsAndLogging(self.jobStore, self.config)
+        self.statsAndLogging = StatsAndLogging(self.jobStore, self.config,
+                                               wakeUp=lambda: self.wakeups.put((WakeupReason.THREAD_EXIT, None)))
 
         # Set used to monitor deadlocked jobs
         self.potentialDeadlockedJobs = set()
@@ -187,6 +292,25 @@ class Leader(object):
         self.deadlockThrottler = LocalThrottle(self.config.deadlockCheckInterval)
         
         self.statusThrottler = LocalThrottle(self.config.statusWait)
+
+        # How often to look in on our helper threads if none of them has told
+        # us it quit
+        self.threadCheckThrottler = LocalThrottle(1)
+
+        # Saves our view of the workflow, and journals the jobs we issue after,
+        # so that a restart can pick up from there. A new checkpoint is only
+        # taken once the journal gets long, and no more often than this allows.
+        self.checkpointer = None
+        if self.config.leaderCheckpointInterval > 0:
+            self.checkpointer = LeaderCheckpoint(jobStore)
+        self.checkpointThrottler = LocalThrottle(self.config.leaderCheckpointInterval)
+
+        # How often to write out the journal of issued jobs
+        self.journalThrottler = LocalThrottle(1)
+
+        # How long to sleep waiting for a wakeup when there is nothing to do,
+        # before we go looking for lost jobs and deadlocks
+        self.idleWakeupInterval = 2
         
         # For fancy console UI, we use an Enlighten counter that displays running / queued jobs
         # This gets filled in in run() and updated periodically.
@@ -234,8 +358,14 @@ class Leader(object):
                         self.clusterScaler.start()
 
                     try:
-                        # Run the main loop
-                        self.innerLoop()
+                        # Start listening to the batch system
+                        self.batchSystemPump.start()
+                        try:
+                            # Run the main loop
+                            self.innerLoop()
+                        finally:
+                            # Stop listening before anyone shuts the batch system down
+                            self.batchSystemPump.shutdown()
                     finally:
                         if self.clusterScaler is not None:
                             logger.debug('Waiting for workers to shutdown.')
@@ -395,6 +525,7 @@ class Leader(object):
 
         # For each successor schedule if all predecessors have been completed
         successors = []
+        allSuccessors = []
         for successorID in predecessor.stack[-1]:
             try:
                 successor = self.jobStore.load(successorID)
@@ -403,8 +534,10 @@ class Leader(object):
                 logger.warning("Job %s is a successor of %s but is already done and gone.", successorID, predecessor.jobStoreID)
                 # Don't try and run it
                 continue
+            allSuccessors.append(successor)
             if self._makeJobSuccessorReadyToRun(successor, predecessor):
                 successors.append(successor)
+        self.readyJobs.addSuccessors(predecessor, allSuccessors)
         self.issueJobs(successors)
 
     def _processFailedSuccessors(self, predecessor):
@@ -604,29 +737,93 @@ class Leader(object):
                 # This means we'll try again in a minute, providing things are quiet
                 self.timeSinceJobsLastRescued += 60
 
+    def _waitForWakeups(self, timeout):
+        """
+        Sleep until something is put in the wakeup queue, or the timeout
+        expires, and then take everything that is ready.
+
+        :param float timeout: Maximum number of seconds to wait. 0 means just
+               take what is there.
+        :return: A list of (WakeupReason, payload) tuples, possibly empty.
+        :rtype: list
+        """
+        wakeups = []
+        try:
+            if timeout > 0:
+                wakeups.append(self.wakeups.get(timeout=timeout))
+            else:
+                wakeups.append(self.wakeups.get_nowait())
+            while True:
+                # Drain everything that arrived along with the first wakeup, so
+                # we can handle it all in one pass around the loop.
+                wakeups.append(self.wakeups.get_nowait())
+        except Empty:
+            pass
+        return wakeups
+
+    def _checkHelperThreads(self):
+        """
+        Check on the associated threads and raise if a failure is detected.
+        """
+        self.statsAndLogging.check()
+        self.serviceManager.check()
+        # the cluster scaler object will only be instantiated if autoscaling is enabled
+        if self.clusterScaler is not None:
+            self.clusterScaler.check()
+
     def innerLoop(self):
         """
         The main loop for processing jobs by the leader.
+
+        Sleeps on the wakeup queue, and on each wakeup handles every batch
+        system update, service manager event and thread exit that is ready.
         """
         self.timeSinceJobsLastRescued = time.time()
 
+        # We need to look at the service manager's output on the first pass.
+        servicesUpdated = True
+
+        if self.checkpointer is not None:
+            # Replace whatever checkpoint an earlier leader left behind
+            self._checkpoint(force=True)
+
         while self.toilState.updatedJobs or \
+              self.readyJobs or \
               self.getNumberOfJobsIssued() or \
               self.serviceManager.jobsIssuedToServiceManager:
 
             if self.toilState.updatedJobs:
                 self._processReadyJobs()
 
-            # deal with service-related jobs
-            self._startServiceJobs()
-            self._processJobsWithRunningServices()
-            self._processJobsWithFailedServices()
-
-            # check in with the batch system
-            updatedJobTuple = self.batchSystem.getUpdatedBatchJob(maxWait=2)
-            if updatedJobTuple is not None:
-                self._gatherUpdatedJobs(updatedJobTuple)
-            else:
+            # Issue what we can of the jobs that are ready to go
+            self._issueReadyJobs()
+
+            # deal with service-related jobs, if the service manager has told
+            # us something, or we have service jobs waiting for room to be issued
+            if servicesUpdated or self.serviceJobsToBeIssued or self.preemptableServiceJobsToBeIssued:
+                self._startServiceJobs()
+                self._processJobsWithRunningServices()
+                self._processJobsWithFailedServices()
+            servicesUpdated = False
+
+            # Sleep until something happens, unless we have work already
+            wakeups = self._waitForWakeups(0 if self.toilState.updatedJobs else self.idleWakeupInterval)
+
+            batchUpdates = 0
+            threadExited = False
+            for reason, payload in wakeups:
+                if reason == WakeupReason.BATCH_UPDATE:
+                    self.batchSystemPump.consumed(payload.jobID)
+                    self._gatherUpdatedJobs(payload)
+                    batchUpdates += 1
+                elif reason == WakeupReason.SERVICES:
+                    servicesUpdated = True
+                elif reason == WakeupReason.THREAD_EXIT:
+                    threadExited = True
+                elif reason == WakeupReason.ERROR:
+                    raise payload
+
+            if batchUpdates == 0 and not self.toilState.updatedJobs and not servicesUpdated:
                 # If nothing is happening, see if any jobs have wandered off
                 self._processLostJobs()
 
@@ -635,22 +832,26 @@ class Leader(object):
                     # enough since we last checked. Check for deadlocks.
                     self.checkForDeadlocks()
 
-            # Check on the associated threads and exit if a failure is detected
-            self.statsAndLogging.check()
-            self.serviceManager.check()
-            # the cluster scaler object will only be instantiated if autoscaling is enabled
-            if self.clusterScaler is not None:
-                self.clusterScaler.check()
+            if threadExited or self.threadCheckThrottler.throttle(wait=False):
+                # Check on the associated threads and exit if a failure is detected
+                self._checkHelperThreads()
             
             if self.statusThrottler.throttle(wait=False):
                 # Time to tell the user how things are going
                 self._reportWorkflowStatus()
                 
+            if self.checkpointer is not None:
+                self._checkpoint()
+
             # Make sure to keep elapsed time and ETA up to date even when no jobs come in
             self.progress_overall.update(incr=0)
 
         logger.debug("Finished the main loop: no jobs left to run.")
 
+        if self.checkpointer is not None:
+            # Don't lose the last jobs issued if we are restarted after all
+            self.checkpointer.flushJournal()
+
         # Consistency check the toil state
         assert self.toilState.updatedJobs == {} 
         assert self.toilState.successorCounts == {}
@@ -660,6 +861,39 @@ class Leader(object):
         # assert self.toilState.jobsToBeScheduledWithMultiplePredecessors # These are not properly emptied yet
         # assert self.toilState.hasFailedSuccessors == set() # These are not properly emptied yet
 
+    def _checkpoint(self, force=False):
+        """
+        Write out the journal of jobs issued since it was last written, or, if
+        it has grown too long and the last checkpoint is old enough, save a new
+        checkpoint of the jobs we are tracking to replace it.
+
+        :param bool force: If True, save a checkpoint whether or not one is due.
+        """
+        if force or (self.checkpointer.isJournalFull() and self.checkpointThrottler.throttle(wait=False)):
+            jobDescriptions = {}
+            for jobDesc in itertools.chain(self.toilState.allJobDescriptions(),
+                                           itertools.chain.from_iterable(
+                                               self.toilState.successorJobStoreIDToPredecessorJobs.values()),
+                                           self.serviceJobsToBeIssued,
+                                           self.preemptableServiceJobsToBeIssued,
+                                           self.readyJobs.jobs(),
+                                           self.jobBatchSystemIDToIssuedJob.values()):
+                jobDescriptions[jobDesc.jobStoreID] = jobDesc
+            # Workers change the jobs we issue. Our own copies of jobs differ
+            # from the job store where we have dropped running services or
+            # failed successors, or given a started checkpoint job its
+            # checkpointed command back.
+            staleJobStoreIDs = set(jobDesc.jobStoreID for jobDesc in self.jobBatchSystemIDToIssuedJob.values())
+            staleJobStoreIDs.update(self.toilState.servicesIssued)
+            staleJobStoreIDs.update(self.toilState.hasFailedSuccessors)
+            staleJobStoreIDs.update(jobStoreID for jobStoreID, jobDesc in jobDescriptions.items()
+                                    if isinstance(jobDesc, CheckpointJobDescription) and
+                                    jobDesc.checkpoint is not None)
+            self.checkpointer.save(jobDescriptions.values(), staleJobStoreIDs)
+            logger.debug('Saved a leader checkpoint of %i jobs', len(jobDescriptions))
+        elif self.journalThrottler.throttle(wait=False):
+            self.checkpointer.flushJournal()
+
     def checkForDeadlocks(self):
         """
         Checks if the system is deadlocked running service jobs.
@@ -728,7 +962,25 @@ class Leader(object):
             self.potentialDeadlockTime = 0
 
     def issueJob(self, jobNode):
-        """Add a job to the queue of jobs."""
+        """
+        Add a job to the queue of jobs. It is issued to the batch system by
+        _issueReadyJobs(), once there is room for it under --maxIssuedJobs.
+        """
+        self.readyJobs.push(jobNode)
+
+    def _issueReadyJobs(self):
+        """
+        Issue queued jobs, most urgent first, until the limit on issued
+        jobs is reached. Service jobs are limited separately and don't count.
+        """
+        while self.readyJobs and self._getNumberOfJobsIssuedTowardsLimit() < self.config.maxIssuedJobs:
+            self._issueJobNow(self.readyJobs.pop())
+
+    def _getNumberOfJobsIssuedTowardsLimit(self):
+        return self.getNumberOfJobsIssued() - self.serviceJobsIssued - self.preemptableServiceJobsIssued
+
+    def _issueJobNow(self, jobNode):
+        """Issue a job to the batch system."""
         
         workerCommand = [resolveEntryPoint('_toil_worker'),
                          jobNode.jobName,
@@ -745,6 +997,12 @@ class Leader(object):
         # jobBatchSystemID is an int that is an incremented counter for each job
         jobBatchSystemID = self.batchSystem.issueBatchJob(jobNode)
         self.jobBatchSystemIDToIssuedJob[jobBatchSystemID] = jobNode
+        if self.checkpointer is not None:
+            self.checkpointer.journal(jobNode.jobStoreID)
+            if jobNode.jobStoreID in self.toilState.serviceJobStoreIDToPredecessorJob:
+                # The service's predecessor will have its services dropped
+                # from our copy once they are running.
+                self.checkpointer.journal(self.toilState.serviceJobStoreIDToPredecessorJob[jobNode.jobStoreID].jobStoreID)
         if jobNode.preemptable:
             # len(jobBatchSystemIDToIssuedJob) should always be greater than or equal to preemptableJobsIssued,
             # so increment this value after the job is added to the issuedJob dict
@@ -780,10 +1038,10 @@ class Leader(object):
     def issueQueingServiceJobs(self):
         """Issues any queuing service jobs up to the limit of the maximum allowed."""
         while len(self.serviceJobsToBeIssued) > 0 and self.serviceJobsIssued < self.config.maxServiceJobs:
-            self.issueJob(self.serviceJobsToBeIssued.pop())
+            self._issueJobNow(self.serviceJobsToBeIssued.pop())
             self.serviceJobsIssued += 1
         while len(self.preemptableServiceJobsToBeIssued) > 0 and self.preemptableServiceJobsIssued < self.config.maxPreemptableServiceJobs:
-            self.issueJob(self.preemptableServiceJobsToBeIssued.pop())
+            self._issueJobNow(self.preemptableServiceJobsToBeIssued.pop())
             self.preemptableServiceJobsIssued += 1
 
     def getNumberOfJobsIssued(self, preemptable=None):
@@ -819,7 +1077,10 @@ class Leader(object):
         issuedJobCount = self.getNumberOfJobsIssued()
         runningJobCount = len(self.batchSystem.getRunningBatchJobIDs())
         
-        return "%d jobs are running, %d jobs are issued and waiting to run" % (runningJobCount, issuedJobCount - runningJobCount)
+        hint = "%d jobs are running, %d jobs are issued and waiting to run" % (runningJobCount, issuedJobCount - runningJobCount)
+        if self.readyJobs:
+            hint += ", %d jobs are waiting to be issued" % len(self.readyJobs)
+        return hint
         
     def _reportWorkflowStatus(self):
         """
@@ -923,6 +1184,8 @@ class Leader(object):
         """
         issuedJobs = set(self.batchSystem.getIssuedBatchJobIDs())
         jobBatchSystemIDsSet = set(list(self.jobBatchSystemIDToIssuedJob.keys()))
+        # Jobs whose updates are sitting in the wakeup queue are not missing
+        issuedJobs.update(self.batchSystemPump.inFlight() & jobBatchSystemIDsSet)
         #Clean up the reissueMissingJobs_missingHash hash, getting rid of jobs that have turned up
         missingJobIDsSet = set(list(self.reissueMissingJobs_missingHash.keys()))
         for jobBatchSystemID in missingJobIDsSet.difference(jobBatchSystemIDsSet):
@@ -964,8 +1227,8 @@ class Leader(object):
         """
         issuedJob = self.removeJob(batchSystemID)
         jobStoreID = issuedJob.jobStoreID
-        if wallTime is not None and self.clusterScaler is not None:
-            self.clusterScaler.addCompletedJob(issuedJob, wallTime)
+        if wallTime is not None:
+            self.jobRuntimes.addCompletedJob(issuedJob, wallTime)
         if self.jobStore.exists(jobStoreID):
             logger.debug("Job %s continues to exist (i.e. has more to do)", issuedJob)
             try:
@@ -1194,6 +1457,7 @@ class Leader(object):
         """
         Update status of predecessors for finished (possibly failed) successor job.
         """
+        self.readyJobs.forget(jobStoreID)
         if jobStoreID in self.toilState.serviceJobStoreIDToPredecessorJob:
             # Is a service job
             predecessorJob = self.toilState.serviceJobStoreIDToPredecessorJob.pop(jobStoreID)
@@ -1203,8 +1467,13 @@ class Leader(object):
                 self.toilState.servicesIssued.pop(predecessorJob.jobStoreID) # The job has no running services
                 
                 logger.debug('Job %s is no longer waiting on services', predecessorJob)
-                
-                if predecessorJob.jobStoreID not in self.toilState.updatedJobs:
+
+                if predecessorJob.jobStoreID in self.toilState.successorCounts:
+                    # A service can finish on its own while the job's
+                    # successors are still running. The job will come back
+                    # when the last of them is done.
+                    logger.debug('Job %s is still waiting on successors', predecessorJob)
+                elif predecessorJob.jobStoreID not in self.toilState.updatedJobs:
                     # Now we know the job is done we can add it to the list of
                     # updated job files
                     self.toilState.updatedJobs[predecessorJob.jobStoreID] = (predecessorJob, 0)
@@ -0,0 +1,183 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import pickle
+
+from toil.common import safeUnpickleFromStream
+from toil.jobStores.abstractJobStore import NoSuchFileException
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderCheckpoint(object):
+    """
+    Saves the leader's view of a running workflow in the job store, so that a
+    restarted leader can pick up from it instead of scanning every job.
+
+    A checkpoint holds the JobDescriptions the leader is tracking, which are
+    the jobs between the root and the ones it has issued, as the leader has
+    them in memory. Those copies are ahead of the job store where the leader
+    has seen successors finish. The checkpoint also names the jobs whose
+    stored descriptions may have moved on: the issued jobs, and the jobs
+    whose services are running. After that, the leader only journals the IDs
+    of the jobs it issues, which is enough to bring the checkpoint up to date.
+    The checkpoint is only taken again, compacting the journal into it, once
+    the journal has grown past :meth:`isJournalFull`.
+
+    To restore, the journaled and possibly stale jobs are reloaded over the
+    checkpointed copies. Anything workers have created since then is found
+    through their successors by
+    :meth:`toil.jobStores.abstractJobStore.AbstractJobStore.clean`, and the
+    ToilState is rebuilt from the result.
+
+    The checkpoint and journal entries are job store files. They are found
+    through a small shared file that is rewritten whenever either changes.
+    """
+
+    sharedFileName = 'leaderCheckpoint'
+
+    formatVersion = 1
+
+    # Number of journal files after which a new checkpoint should be taken,
+    # to keep the shared file short
+    maxJournalFiles = 1000
+
+    # Number of journaled jobs after which a new checkpoint should be taken,
+    # unless the checkpoint holds more jobs than this, since up to then
+    # replaying the journal on restart costs no more than the checkpoint does
+    minCompactionJobs = 1000
+
+    def __init__(self, jobStore):
+        """
+        :param toil.jobStores.abstractJobStore.AbstractJobStore jobStore:
+        """
+        self.jobStore = jobStore
+        self.checkpointFileID = None
+        self.journalFileIDs = []
+        # IDs of jobs issued since the journal was last flushed
+        self.unjournaled = []
+        # Sizes of the last checkpoint and of the journal since, in jobs
+        self.checkpointedJobs = 0
+        self.journaledJobs = 0
+
+    def journal(self, jobStoreID):
+        """
+        Note that a job has been issued. It will be written to the journal on
+        the next call to :meth:`flushJournal`.
+        """
+        self.unjournaled.append(jobStoreID)
+
+    def isJournalFull(self):
+        """
+        :return: True if a new checkpoint should be taken to start a new journal.
+        :rtype: bool
+        """
+        return (len(self.journalFileIDs) >= self.maxJournalFiles or
+                self.journaledJobs >= max(self.minCompactionJobs, self.checkpointedJobs))
+
+    def flushJournal(self):
+        """
+        Write the IDs of the jobs issued since the last flush to the journal.
+        """
+        if not self.unjournaled or self.checkpointFileID is None:
+            return
+        with self.jobStore.writeFileStream() as (stream, fileID):
+            pickle.dump(self.unjournaled, stream, protocol=pickle.HIGHEST_PROTOCOL)
+        self.journalFileIDs.append(fileID)
+        self.journaledJobs += len(self.unjournaled)
+        self.unjournaled = []
+        self._writeIndex()
+
+    def save(self, jobDescriptions, staleJobStoreIDs):
+        """
+        Take a new checkpoint, replacing the last one and its journal.
+
+        :param Iterable[toil.job.JobDescription] jobDescriptions: the jobs the
+               leader is tracking, as it has them in memory.
+        :param Iterable[str] staleJobStoreIDs: IDs of jobs whose descriptions
+               in the job store may change, or already have, without the
+               leader's copies following.
+        """
+        jobDescriptions = list(jobDescriptions)
+        with self.jobStore.writeFileStream() as (stream, fileID):
+            pickle.dump({'version': self.formatVersion,
+                         'jobs': jobDescriptions,
+                         'stale': list(staleJobStoreIDs)},
+                        stream, protocol=pickle.HIGHEST_PROTOCOL)
+        obsoleteFileIDs = self.journalFileIDs
+        if self.checkpointFileID is not None:
+            obsoleteFileIDs.append(self.checkpointFileID)
+        self.checkpointFileID = fileID
+        self.checkpointedJobs = len(jobDescriptions)
+        self.journalFileIDs = []
+        self.journaledJobs = 0
+        self.unjournaled = []
+        self._writeIndex()
+        for obsoleteFileID in obsoleteFileIDs:
+            self.jobStore.deleteFile(obsoleteFileID)
+
+    def _writeIndex(self):
+        with self.jobStore.writeSharedFileStream(self.sharedFileName) as stream:
+            pickle.dump({'version': self.formatVersion,
+                         'checkpoint': self.checkpointFileID,
+                         'journal': self.journalFileIDs},
+                        stream, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def restore(cls, jobStore):
+        """
+        Rebuild the leader's job cache from the last checkpoint and journal.
+
+        :param toil.jobStores.abstractJobStore.AbstractJobStore jobStore:
+
+        :return: A map from jobStoreID to JobDescription for the jobs from the
+                 root down to the ones that were issued, with the issued jobs
+                 as they now are in the job store, suitable for passing to
+                 clean() with partialCache=True. None if there is no usable
+                 checkpoint.
+        :rtype: dict[str,toil.job.JobDescription] or None
+        """
+        try:
+            with jobStore.readSharedFileStream(cls.sharedFileName) as stream:
+                indexData = stream.read()
+        except NoSuchFileException:
+            logger.debug('No leader checkpoint to restart from.')
+            return None
+        try:
+            index = pickle.loads(indexData)
+            if index['version'] != cls.formatVersion:
+                raise ValueError('unsupported checkpoint version %s' % index['version'])
+            with jobStore.readFileStream(index['checkpoint']) as stream:
+                checkpoint = safeUnpickleFromStream(stream)
+            staleJobStoreIDs = set(checkpoint['stale'])
+            for fileID in index['journal']:
+                with jobStore.readFileStream(fileID) as stream:
+                    staleJobStoreIDs.update(safeUnpickleFromStream(stream))
+        except Exception as e:
+            # A checkpoint is only an optimization; never let a bad one stop a restart.
+            logger.warning('Could not read the leader checkpoint, so all jobs will be loaded: %s', e)
+            return None
+
+        jobCache = {}
+        for jobDesc in checkpoint['jobs']:
+            # Pickling drops the config, as it would for a job store
+            jobDesc.assignConfig(jobStore.config)
+            jobCache[jobDesc.jobStoreID] = jobDesc
+        for jobStoreID in staleJobStoreIDs:
+            jobCache.pop(jobStoreID, None)
+        jobCache.update(jobStore.loadExisting(staleJobStoreIDs))
+        logger.info('Restored %i jobs from the leader checkpoint, having reloaded %i that may have changed.',
+                    len(jobCache), len(staleJobStoreIDs))
+        return jobCache
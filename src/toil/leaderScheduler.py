@@ -0,0 +1,134 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ReadyJobQueue(object):
+    """
+    Holds the jobs the leader has decided to run until it issues them to the
+    batch system, and decides the order they are issued in. This one issues
+    them in the order they became ready.
+    """
+
+    def __init__(self):
+        # Heap of (negated priority, arrival number, JobDescription)
+        self._heap = []
+        self._arrivals = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, jobDesc):
+        """
+        Queue a job to be issued.
+
+        :param toil.job.JobDescription jobDesc:
+        """
+        heapq.heappush(self._heap, (-self.priority(jobDesc), next(self._arrivals), jobDesc))
+
+    def pop(self):
+        """
+        :return: The queued job to issue next.
+        :rtype: toil.job.JobDescription
+        """
+        return heapq.heappop(self._heap)[2]
+
+    def jobs(self):
+        """
+        :return: The queued jobs, in no particular order.
+        :rtype: Iterator[toil.job.JobDescription]
+        """
+        return (jobDesc for _, _, jobDesc in self._heap)
+
+    def priority(self, jobDesc):
+        """
+        :return: How urgently the given job should be issued. Jobs of equal
+                 priority are issued in the order they were queued.
+        :rtype: float
+        """
+        return 0
+
+    def addSuccessors(self, predecessor, successors):
+        """
+        Note that the given successors of a job are being run, whether or not
+        they are ready yet.
+
+        :param toil.job.JobDescription predecessor:
+        :param list[toil.job.JobDescription] successors:
+        """
+        pass
+
+    def forget(self, jobStoreID):
+        """
+        Drop anything remembered about a job that is done.
+
+        :param str jobStoreID:
+        """
+        pass
+
+
+class CriticalPathQueue(ReadyJobQueue):
+    """
+    Issues first the jobs with the most time estimated to be left on the
+    critical path through them, so that long chains of jobs are not stuck
+    behind wide sets of short leaves.
+
+    Only part of the job graph is known to the leader, so the path through a
+    job is estimated as the job's own average runtime, plus a level of work
+    for each level of successors on its stack, plus the work estimated to be
+    left after the job's level in the jobs it came after. A level of work is
+    estimated as the average runtime of all the jobs completed so far.
+    """
+
+    def __init__(self, runtimes):
+        """
+        :param toil.provisioners.clusterScaler.JobRuntimes runtimes: The
+               runtimes of the jobs completed so far.
+        """
+        super(CriticalPathQueue, self).__init__()
+        self.runtimes = runtimes
+        # Map from jobStoreID to the estimated time left on the critical path
+        # after the job and its own successors are done, for jobs that came
+        # after jobs we have run
+        self.pathAfter = {}
+
+    def _levelsTime(self, jobDesc):
+        """
+        :return: The estimated time to run the levels of successors on the
+                 given job's stack.
+        :rtype: float
+        """
+        levels = sum(1 for successorIDs in jobDesc.stack if successorIDs)
+        return levels * self.runtimes.getAverageRuntime(None)
+
+    def priority(self, jobDesc):
+        return (self.runtimes.getAverageRuntime(jobDesc.jobName) +
+                self._levelsTime(jobDesc) +
+                self.pathAfter.get(jobDesc.jobStoreID, 0))
+
+    def addSuccessors(self, predecessor, successors):
+        # The levels under the one being run will have to wait for it
+        pathAfter = (self.pathAfter.get(predecessor.jobStoreID, 0) +
+                     self._levelsTime(predecessor) - self.runtimes.getAverageRuntime(None))
+        for successor in successors:
+            # A job with several predecessors is on the longest of their paths
+            self.pathAfter[successor.jobStoreID] = max(pathAfter, self.pathAfter.get(successor.jobStoreID, 0))
+
+    def forget(self, jobStoreID):
+        self.pathAfter.pop(jobStoreID, None)
@@ -3,12 +3,17 @@ from __future__ import absolute_import
 
 import docker
 import base64
+import fcntl
+import hashlib
+import json
 import requests
 import logging
 import os
 import re
 import struct
-from shlex import quote
+import time
+from contextlib import contextmanager
+from shlex import quote, split
 from docker.utils.socket import consume_socket_output, demux_adaptor
 from docker.errors import create_api_error_from_http_exception
 from docker.errors import ContainerError
@@ -21,6 +26,15 @@ FORGO = 0
 STOP = 1
 RM = 2
 
+# Where, under the workflow's directory on each node, the pool of warm
+# containers used by apiDockerCall(reuseContainer=True) keeps its state
+CONTAINER_POOL_DIR = 'dockerPool'
+# The most containers the pool keeps on a node at once. Containers in use are
+# never removed, so the pool can go over this while they are all busy.
+CONTAINER_POOL_SIZE = 4
+# How long, in seconds, a pooled container is kept with nothing running in it
+CONTAINER_POOL_IDLE_TIMEOUT = 300
+
 
 def dockerCheckOutput(*args, **kwargs):
     raise RuntimeError("dockerCheckOutput() using subprocess.check_output() has been removed, "
@@ -57,6 +71,7 @@ def apiDockerCall(job,
                   demux=False,
                   streamfile=None,
                   timeout=365 * 24 * 60 * 60,
+                  reuseContainer=False,
                   **kwargs):
     """
     A toil wrapper for the python docker API.
@@ -139,6 +154,24 @@ def apiDockerCall(job,
                         not always able to abort ongoing reads and writes in order
                         to respect the timeout. Defaults to 1 year (i.e. wait
                         essentially indefinitely).
+    :param bool reuseContainer: Run the command with "docker exec" in a
+                        long-lived container shared with other calls on this
+                        node that use the same image, volumes and run
+                        arguments, instead of in a container of its own. This
+                        saves starting a container for each call, but the
+                        command's processes and files outside the volumes
+                        are seen by later calls. The image must have a
+                        /bin/sh. The container has the workflow's directory
+                        on the node mounted at the same path, so volumes in
+                        it, like the default one for working_dir, are not
+                        mounted at their bind paths but are found at their
+                        own paths, and the command runs in working_dir
+                        there. Cannot be used with detach=True, and
+                        containerName, deferParam, remove and auto_remove
+                        are ignored: the pool removes its containers once
+                        they have been idle for a while, and when the
+                        workflow is cleaned up on the node.
+                        (default: False)
     :param kwargs: Additional keyword arguments supplied to the docker API's
                    run command.  The list is 75 keywords total, for examples
                    and full documentation see:
@@ -209,6 +242,15 @@ def apiDockerCall(job,
 
     client = docker.from_env(version='auto', timeout=timeout)
 
+    if reuseContainer:
+        assert not detach, 'A reused container cannot be run detached.'
+        if stdout is None:
+            stdout = True
+        if log_config is not None:
+            kwargs['log_config'] = log_config
+        return _pooledDockerCall(job, client, image, command, entrypoint, volumes, working_dir,
+                                 user, environment, stdout, stderr, stream, demux, kwargs)
+
     if deferParam == STOP:
         job.defer(dockerStop, containerName)
 
@@ -314,6 +356,251 @@ def apiDockerCall(job,
         raise create_api_error_from_http_exception(e)
 
 
+def _pooledDockerCall(job, client, image, command, entrypoint, volumes, working_dir,
+                      user, environment, stdout, stderr, stream, demux, runArgs):
+    """
+    Run a command for apiDockerCall in a container from the node's pool.
+    """
+    workflowDir = os.path.abspath(job.fileStore.workFlowDir)
+    poolDir = os.path.join(workflowDir, CONTAINER_POOL_DIR)
+    # Whatever happens to this job, look for containers to clean up after it.
+    job.defer(evictPooledContainers, poolDir)
+    pool = ContainerPool(poolDir, client)
+
+    # Each job's directories are in the workflow's directory, so mounting that
+    # instead of them lets jobs share containers.
+    poolVolumes = {workflowDir: {'bind': workflowDir, 'mode': 'rw'}}
+    for hostPath, bind in volumes.items():
+        hostPath = os.path.abspath(hostPath)
+        if hostPath != workflowDir and not hostPath.startswith(workflowDir + os.sep):
+            poolVolumes[hostPath] = bind
+
+    def commandArgv():
+        config = client.images.get(image).attrs['Config']
+        if entrypoint is None:
+            argv = list(config.get('Entrypoint') or [])
+        elif isinstance(entrypoint, str):
+            argv = split(entrypoint)
+        else:
+            argv = list(entrypoint)
+        if command is None:
+            argv += list(config.get('Cmd') or [])
+        elif isinstance(command, str):
+            # Split the command the way the docker module does for a new container
+            argv += split(command)
+        else:
+            argv += command
+        return argv
+
+    if not stream:
+        with pool.container(image, poolVolumes, runArgs) as container:
+            argv = commandArgv()
+            logger.debug('Running %r in pooled container %s', argv, container.name)
+            result = container.exec_run(argv, stdout=stdout, stderr=stderr, demux=demux,
+                                        workdir=working_dir, user=user, environment=environment)
+            if result.exit_code:
+                logger.error("Docker had non-zero exit.  Check your command: " + repr(command))
+                output = result.output[1] if demux else result.output
+                raise ContainerError(container, result.exit_code, argv, image, output)
+            return result.output
+
+    def streamOutput():
+        # Keep the container from being removed until the output is all read.
+        with pool.container(image, poolVolumes, runArgs) as container:
+            argv = commandArgv()
+            logger.debug('Streaming %r in pooled container %s', argv, container.name)
+            # exec_run() can't tell us how a streamed command exited, so talk
+            # to the API ourselves.
+            execID = client.api.exec_create(container.id, argv, stdout=stdout, stderr=stderr,
+                                            user=user or '', environment=environment,
+                                            workdir=working_dir)['Id']
+            for chunk in client.api.exec_start(execID, stream=True, demux=demux):
+                yield chunk
+            exitCode = client.api.exec_inspect(execID)['ExitCode']
+            if exitCode:
+                logger.error("Docker had non-zero exit.  Check your command: " + repr(command))
+                raise ContainerError(container, exitCode, argv, image, None)
+    return streamOutput()
+
+
+class ContainerPool(object):
+    """
+    Long-lived containers on a node, to run commands in with "docker exec",
+    shared by the workers of a workflow on that node.
+
+    Each container has a file in the pool directory, whose modification time
+    is when it was last used. Users of a container hold a shared lock on its
+    file, so that it can only be removed once nobody is using it. Finding,
+    starting and removing containers is done under an exclusive lock on the
+    pool directory's lock file.
+    """
+
+    LOCK_FILE = 'lock'
+
+    # Keeps a container running until we remove it
+    keeper = ['/bin/sh', '-c', 'while true; do sleep 3600; done']
+
+    def __init__(self, poolDir, client, maxContainers=None, idleTimeout=None):
+        self.poolDir = poolDir
+        self.client = client
+        self.maxContainers = CONTAINER_POOL_SIZE if maxContainers is None else maxContainers
+        self.idleTimeout = CONTAINER_POOL_IDLE_TIMEOUT if idleTimeout is None else idleTimeout
+        os.makedirs(poolDir, exist_ok=True)
+
+    def containerName(self, image, volumes, runArgs):
+        """
+        Get the name of the pool's container for the given image, volumes and
+        other arguments to the docker module's run().
+        """
+        key = json.dumps([self.poolDir, image, volumes, runArgs], sort_keys=True, default=repr)
+        return 'toil-pool-' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.poolDir, self.LOCK_FILE), 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            yield
+
+    @contextmanager
+    def container(self, image, volumes, runArgs):
+        """
+        Get a running container for the given image, volumes and other
+        arguments to the docker module's run(), starting one if the pool has
+        none.
+
+        :rtype: docker.models.containers.Container
+        """
+        name = self.containerName(image, volumes, runArgs)
+        path = os.path.join(self.poolDir, name)
+        with self._lock():
+            usage = open(path, 'a')
+            try:
+                fcntl.flock(usage, fcntl.LOCK_SH)
+                self._evict(keep=name)
+                self._touch(path)
+                try:
+                    container = self.client.containers.get(name)
+                    if container.status != 'running':
+                        container.remove(force=True)
+                        container = None
+                except NotFound:
+                    container = None
+                if container is None:
+                    logger.debug('Starting pooled container %s for image %s', name, image)
+                    container = self.client.containers.run(image=image, entrypoint=self.keeper,
+                                                           command=[], name=name, detach=True,
+                                                           volumes=volumes, **runArgs)
+            except:
+                usage.close()
+                raise
+        try:
+            yield container
+        finally:
+            self._touch(path)
+            usage.close()
+
+    @staticmethod
+    def _touch(path):
+        # Use our own clock, since the file system's may be too coarse to
+        # tell uses apart
+        now = time.time()
+        os.utime(path, (now, now))
+
+    def evict(self):
+        """
+        Remove the containers that have been idle too long.
+        """
+        with self._lock():
+            self._evict()
+
+    def _evict(self, keep=None):
+        """
+        Remove the containers that have been idle too long, and then the least
+        recently used idle containers until there is room for the given one.
+        Must be called with the pool locked.
+        """
+        now = time.time()
+        idle = []
+        others = 0
+        for name in os.listdir(self.poolDir):
+            if name == self.LOCK_FILE or name == keep:
+                continue
+            path = os.path.join(self.poolDir, name)
+            try:
+                lastUsed = os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            if now - lastUsed >= self.idleTimeout:
+                self._remove(name)
+            else:
+                idle.append((lastUsed, name))
+                others += 1
+        # Make room for the container to keep
+        idle.sort()
+        while keep is not None and idle and others + 1 > self.maxContainers:
+            _, name = idle.pop(0)
+            if self._remove(name):
+                others -= 1
+
+    def _remove(self, name):
+        """
+        Remove a container, unless it is in use.
+
+        :return: True if it was removed.
+        :rtype: bool
+        """
+        path = os.path.join(self.poolDir, name)
+        with open(path, 'a') as usage:
+            try:
+                fcntl.flock(usage, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            logger.debug('Removing pooled container %s', name)
+            try:
+                self.client.containers.get(name).remove(force=True)
+            except NotFound:
+                pass
+            os.unlink(path)
+        return True
+
+
+def evictPooledContainers(poolDir, idleTimeout=None, timeout=365 * 24 * 60 * 60):
+    """
+    Remove the containers in a node's pool that have been idle too long.
+    Deferred by every job that uses the pool.
+
+    :param str poolDir: The pool's directory.
+    :param int idleTimeout: How long a container may be idle before it is
+           removed. Defaults to :data:`CONTAINER_POOL_IDLE_TIMEOUT`.
+    :param int timeout: Use the given timeout in seconds for interactions with
+                        the Docker daemon.
+    """
+    if not os.path.exists(poolDir):
+        return
+    client = docker.from_env(version='auto', timeout=timeout)
+    ContainerPool(poolDir, client, idleTimeout=idleTimeout).evict()
+
+
+def cleanupContainerPool(workflowDir):
+    """
+    Remove all of the containers in a node's pool, and the pool itself. Called
+    when the workflow is cleaned up on the node.
+
+    :param str workflowDir: The workflow's directory on this node.
+    """
+    poolDir = os.path.join(workflowDir, CONTAINER_POOL_DIR)
+    if not os.path.exists(poolDir):
+        return
+    evictPooledContainers(poolDir, idleTimeout=0)
+    names = os.listdir(poolDir)
+    if names in ([], [ContainerPool.LOCK_FILE]):
+        for name in names:
+            os.unlink(os.path.join(poolDir, name))
+        os.rmdir(poolDir)
+    else:
+        logger.warning('Could not remove pooled containers %s, as they are still in use', names)
+
+
 def dockerKill(container_name, gentleKill=False, timeout=365 * 24 * 60 * 60):
     """
     Immediately kills a container.  Equivalent to "docker kill":
@@ -280,6 +280,55 @@ def binPacking(nodeShapes, jobShapes, goalTime):
     bpf.binPack(jobShapes)
     return bpf.getRequiredNodes()
 
+class JobRuntimes(object):
+    """
+    Running averages of the wall times of completed jobs, overall and by job
+    name, used to estimate how long jobs that have yet to run will take.
+    """
+    def __init__(self):
+        self.jobNameToAvgRuntime = {}
+        self.jobNameToNumCompleted = {}
+        self.totalAvgRuntime = 0.0
+        self.totalJobsCompleted = 0
+
+    def getAverageRuntime(self, jobName):
+        """
+        :param str jobName: The name of the jobs to estimate the runtime of,
+               or None to get the average over all jobs.
+        :return: The estimated runtime in seconds.
+        :rtype: float
+        """
+        if jobName in self.jobNameToAvgRuntime:
+            #Have seen jobs of this type before, so estimate
+            #the runtime based on average of previous jobs of this type
+            return self.jobNameToAvgRuntime[jobName]
+        elif self.totalAvgRuntime > 0:
+            #Haven't seen this job yet, so estimate its runtime as
+            #the average runtime of all completed jobs
+            return self.totalAvgRuntime
+        else:
+            #Have no information whatsoever
+            return 1.0
+
+    def addCompletedJob(self, job, wallTime):
+        """
+        :param toil.job.JobDescription job: The description of the completed job
+        :param int wallTime: The wall-time taken to complete the job in seconds.
+        """
+        #Adjust average runtimes to include this job.
+        if job.jobName in self.jobNameToAvgRuntime:
+            prevAvg = self.jobNameToAvgRuntime[job.jobName]
+            prevNum = self.jobNameToNumCompleted[job.jobName]
+            self.jobNameToAvgRuntime[job.jobName] = float(prevAvg*prevNum + wallTime)/(prevNum + 1)
+            self.jobNameToNumCompleted[job.jobName] += 1
+        else:
+            self.jobNameToAvgRuntime[job.jobName] = wallTime
+            self.jobNameToNumCompleted[job.jobName] = 1
+
+        self.totalJobsCompleted += 1
+        self.totalAvgRuntime = float(self.totalAvgRuntime * (self.totalJobsCompleted - 1) + \
+                                     wallTime)/self.totalJobsCompleted
+
 class ClusterScaler(object):
     def __init__(self, provisioner, leader, config):
         """
@@ -294,12 +343,9 @@ class ClusterScaler(object):
         self.config = config
         self.static = {}
 
-        # Dictionary of job names to their average runtime, used to estimate wall time of queued
-        # jobs for bin-packing
-        self.jobNameToAvgRuntime = {}
-        self.jobNameToNumCompleted = {}
-        self.totalAvgRuntime = 0.0
-        self.totalJobsCompleted = 0
+        # Average runtimes of completed jobs, used to estimate wall time of queued
+        # jobs for bin-packing. The leader records completed jobs in it.
+        self.runtimes = JobRuntimes()
 
         self.targetTime = config.targetTime
         if self.targetTime <= 0:
@@ -407,39 +453,7 @@ class ClusterScaler(object):
             # and a deadlock, because often multiple services need to
             # be running at once for any actual work to get done.
             return self.targetTime * 24 + 3600
-        if jobName in self.jobNameToAvgRuntime:
-            #Have seen jobs of this type before, so estimate
-            #the runtime based on average of previous jobs of this type
-            return self.jobNameToAvgRuntime[jobName]
-        elif self.totalAvgRuntime > 0:
-            #Haven't seen this job yet, so estimate its runtime as
-            #the average runtime of all completed jobs
-            return self.totalAvgRuntime
-        else:
-            #Have no information whatsoever
-            return 1.0
-
-    def addCompletedJob(self, job, wallTime):
-        """
-        Adds the shape of a completed job to the queue, allowing the scalar to use the last N
-        completed jobs in factoring how many nodes are required in the cluster.
-        :param toil.job.JobDescription job: The description of the completed job
-        :param int wallTime: The wall-time taken to complete the job in seconds.
-        """
-
-        #Adjust average runtimes to include this job.
-        if job.jobName in self.jobNameToAvgRuntime:
-            prevAvg = self.jobNameToAvgRuntime[job.jobName]
-            prevNum = self.jobNameToNumCompleted[job.jobName]
-            self.jobNameToAvgRuntime[job.jobName] = float(prevAvg*prevNum + wallTime)/(prevNum + 1)
-            self.jobNameToNumCompleted[job.jobName] += 1
-        else:
-            self.jobNameToAvgRuntime[job.jobName] = wallTime
-            self.jobNameToNumCompleted[job.jobName] = 1
-
-        self.totalJobsCompleted += 1
-        self.totalAvgRuntime = float(self.totalAvgRuntime * (self.totalJobsCompleted - 1) + \
-                                     wallTime)/self.totalJobsCompleted
+        return self.runtimes.getAverageRuntime(jobName)
 
     def setStaticNodes(self, nodes, preemptable):
         """
@@ -859,9 +873,6 @@ class ScalerThread(ExceptionalThread):
             self.stats.shutDownStats()
         self.join()
 
-    def addCompletedJob(self, job, wallTime):
-        self.scaler.addCompletedJob(job, wallTime)
-
     def tryRun(self):
         while not self.stop:
             with throttle(self.scaler.config.scaleInterval):
@@ -32,12 +32,21 @@ class ServiceManager( object ):
     """
     Manages the scheduling of services.
     """
-    def __init__(self, jobStore, toilState):
+    def __init__(self, jobStore, toilState, wakeUp=None):
+        """
+        :param toil.jobStores.abstractJobStore.AbstractJobStore jobStore:
+        :param toil.toilState.ToilState toilState:
+        :param wakeUp: Function, taking no arguments, to call whenever
+               something is put on one of the output queues, so the leader
+               can sleep until there is something to collect. May be None.
+        """
         logger.debug("Initializing service manager")
         self.jobStore = jobStore
         
         self.toilState = toilState
 
+        self._wakeUp = wakeUp if wakeUp is not None else (lambda: None)
+
         self.jobDescriptionsWithServicesBeingStarted = set()
 
         self._terminate = Event() # This is used to terminate the thread associated
@@ -69,7 +78,7 @@ class ServiceManager( object ):
                                             self._jobDescriptionsWithServicesThatHaveStarted,
                                             self._jobDescriptionsWithServicesThatHaveFailedToStart,
                                             self.serviceJobDescriptionsToStart, self._terminate,
-                                            self.jobStore),
+                                            self.jobStore, self._wakeUp),
                                       daemon=True)
                                       
                         
@@ -200,7 +209,7 @@ class ServiceManager( object ):
                        jobDescriptionsWithServicesThatHaveStarted,
                        jobDescriptionsWithServicesThatHaveFailedToStart,
                        serviceJobsToStart,
-                       terminate, jobStore):
+                       terminate, jobStore, wakeUp):
         """
         Thread used to schedule services.
         """
@@ -227,7 +236,7 @@ class ServiceManager( object ):
                         blockUntilServiceGroupIsStarted(jobDesc,
                                                         jobDescriptionsWithServicesThatHaveStarted,
                                                         jobDescriptionsWithServicesThatHaveFailedToStart,
-                                                        serviceJobsToStart, terminate, jobStore)
+                                                        serviceJobsToStart, terminate, jobStore, wakeUp)
                         continue
                     # Found a new job that needs to schedule its services.
                     for onlyBatch in jobDesc.serviceHostIDsInBatches():
@@ -245,6 +254,7 @@ class ServiceManager( object ):
                             # Send the service JobDescription off to be started
                             logger.debug('Service manager is starting service job: %s, start ID: %s', serviceJobDesc, serviceJobDesc.startJobStoreID)
                             serviceJobsToStart.put(serviceJobDesc)
+                            wakeUp()
                 except Empty:
                     # No new jobs that need services scheduled.
                     pass
@@ -277,11 +287,12 @@ class ServiceManager( object ):
                         else:
                             logger.debug('Job %s has all its services started', jobDesc)
                             jobDescriptionsWithServicesThatHaveStarted.put(jobDesc)
+                        wakeUp()
                         jobDescriptionsToRemove.add(jobDesc)
                 for jobDesc in jobDescriptionsToRemove:
                     del servicesRemainingToStartForJob[jobDesc]
 
-def blockUntilServiceGroupIsStarted(jobDesc, jobDescriptionsWithServicesThatHaveStarted, jobDescriptionsWithServicesThatHaveFailedToStart, serviceJobsToStart, terminate, jobStore):
+def blockUntilServiceGroupIsStarted(jobDesc, jobDescriptionsWithServicesThatHaveStarted, jobDescriptionsWithServicesThatHaveFailedToStart, serviceJobsToStart, terminate, jobStore, wakeUp):
     
     # Keep the user informed, but not too informed, as services start up
     logLimiter = LocalThrottle(60)
@@ -299,6 +310,7 @@ def blockUntilServiceGroupIsStarted(jobDesc, jobDescriptionsWithServicesThatHave
             assert jobStore.fileExists(serviceJobDesc.startJobStoreID)
             # At this point the terminateJobStoreID and errorJobStoreID could have been deleted!
             serviceJobsToStart.put(serviceJobDesc)
+            wakeUp()
             # Save for the waiting loop
             waitOn.append(serviceJobDesc)
 
@@ -328,3 +340,4 @@ def blockUntilServiceGroupIsStarted(jobDesc, jobDescriptionsWithServicesThatHave
 
     # Add the JobDescription to the output queue of jobs whose services have been started
     jobDescriptionsWithServicesThatHaveStarted.put(jobDesc)
+    wakeUp()
@@ -34,9 +34,15 @@ class StatsAndLogging( object ):
     Class manages a thread that aggregates statistics and logging information on a toil run.
     """
 
-    def __init__(self, jobStore, config):
+    def __init__(self, jobStore, config, wakeUp=None):
+        """
+        :param wakeUp: Function, taking no arguments, to call when the
+               aggregator thread stops for any reason, so the leader can
+               notice promptly. May be None.
+        """
         self._stop = Event()
-        self._worker = Thread(target=self.statsAndLoggingAggregator,
+        self._wakeUp = wakeUp
+        self._worker = Thread(target=self._aggregate,
                               args=(jobStore, self._stop, config),
                               daemon=True)
 
@@ -145,6 +151,16 @@ class StatsAndLogging( object ):
             if not os.path.exists(name):
                 os.symlink(os.path.relpath(fullName, path), name)
 
+    def _aggregate(self, jobStore, stop, config):
+        """
+        Run the aggregator, and tell whoever is listening when it stops.
+        """
+        try:
+            self.statsAndLoggingAggregator(jobStore, stop, config)
+        finally:
+            if self._wakeUp is not None:
+                self._wakeUp()
+
     @classmethod
     def statsAndLoggingAggregator(cls, jobStore, stop, config):
         """
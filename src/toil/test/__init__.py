@@ -342,6 +342,16 @@ def needs_kubernetes(test_item):
     return test_item
 
 
+def needs_kubernetes_installed(test_item):
+    """Use as a decorator before test classes or methods to run only if the Kubernetes module is installed."""
+    test_item = _mark_test('kubernetes', test_item)
+    try:
+        import kubernetes
+    except ImportError:
+        return unittest.skip("Install Toil with the 'kubernetes' extra to include this test.")(test_item)
+    return test_item
+
+
 def needs_mesos(test_item):
     """Use as a decorator before test classes or methods to run only if Mesos is installed."""
     test_item = _mark_test('mesos', test_item)
@@ -355,6 +365,16 @@ def needs_mesos(test_item):
     return test_item
 
 
+def needs_mesos_installed(test_item):
+    """Use as a decorator before test classes or methods to run only if the Mesos Python modules are installed."""
+    test_item = _mark_test('mesos', test_item)
+    try:
+        import pymesos
+    except ImportError:
+        return unittest.skip("Install Toil with the 'mesos' extra to include this test.")(test_item)
+    return test_item
+
+
 def needs_parasol(test_item):
     """Use as decorator so tests are only run if Parasol is installed."""
     test_item = _mark_test('parasol', test_item)
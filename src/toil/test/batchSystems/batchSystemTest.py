@@ -26,14 +26,22 @@ import logging
 import os
 import fcntl
 import itertools
+import json
+import threading
 import tempfile
 from textwrap import dedent
+from types import SimpleNamespace
 import time
+import signal
 import sys
 import subprocess
 from unittest import skipIf
 
-from toil.common import Config
+from mock import patch
+from six.moves.queue import Empty, Queue
+
+from toil import resolveEntryPoint
+from toil.common import Config, Toil
 # Don't import any batch systems here that depend on extras
 # in order to import properly. Import them later, in tests 
 # protected by annotations.
@@ -41,14 +49,20 @@ from toil.batchSystems.mesos.test import MesosTestSupport
 from toil.batchSystems.parasolTestSupport import ParasolTestSupport
 from toil.batchSystems.parasol import ParasolBatchSystem
 from toil.batchSystems.singleMachine import SingleMachineBatchSystem
+from toil.batchSystems import MemoryString
 from toil.batchSystems.abstractBatchSystem import (InsufficientSystemResources,
-                                                   BatchSystemSupport)
+                                                   BatchJobExitReason,
+                                                   BatchSystemSupport,
+                                                   EXIT_STATUS_UNAVAILABLE_VALUE)
+from toil.batchSystems.abstractGridEngineBatchSystem import AbstractGridEngineBatchSystem
+from toil.batchSystems.pilot import PilotAgent
 from toil.job import Job, JobDescription
 from toil.lib.threading import cpu_count
 from toil.test import (ToilTest,
                        needs_aws_s3,
                        needs_lsf,
                        needs_kubernetes,
+                       needs_kubernetes_installed,
                        needs_fetchable_appliance,
                        needs_mesos,
                        needs_parasol,
@@ -381,6 +395,344 @@ class KubernetesBatchSystemTest(hidden.AbstractBatchSystemTest):
         return KubernetesBatchSystem(config=self.config,
                                      maxCores=numCores, maxMemory=1e9, maxDisk=2001)
 
+class FakeWatchResponse(object):
+    """
+    Stands in for the streaming HTTP response to a Kubernetes watch request.
+    """
+
+    def __init__(self, events):
+        self.events = events
+
+    def read_chunked(self, decode_content=False):
+        for event in self.events:
+            yield (json.dumps(event) + '\n').encode('utf-8')
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class FakeKubernetesApi(object):
+    """
+    Stands in for the Kubernetes BatchV1Api and CoreV1Api. Lists the objects
+    it has been given to list, and replays recorded watch streams, one
+    connection at a time. Deleting a job adds a connection reporting that it
+    was deleted.
+
+    Creating jobs waits for createGate to be set, and raises createError if
+    it is set.
+    """
+
+    def __init__(self):
+        # Map from kind to the raw objects to list, and the resourceVersion
+        # to list them at
+        self.listed = {'job': [], 'pod': []}
+        self.listedVersion = '100'
+        # Map from kind to a queue of lists of raw watch events, one list per
+        # connection
+        self.streams = {'job': Queue(), 'pod': Queue()}
+        # (kind, kwargs) for each list and watch request
+        self.calls = []
+        self.created = []
+        self.createdJobs = []
+        self.deleted = []
+        self.resourceVersion = 1000
+        self.createGate = threading.Event()
+        self.createGate.set()
+        self.createError = None
+        self.lock = threading.Lock()
+        # How many jobs are being created now, and the most there have been
+        self.creating = 0
+        self.maxCreating = 0
+
+    def _list(self, kind, listType, namespace, **kwargs):
+        from kubernetes.client import ApiClient
+        self.calls.append((kind, kwargs))
+        if kwargs.get('watch'):
+            try:
+                events = self.streams[kind].get(timeout=0.1)
+            except Empty:
+                events = []
+            return FakeWatchResponse(events)
+        response = {'metadata': {'resourceVersion': self.listedVersion}, 'items': self.listed[kind]}
+        return ApiClient().deserialize(SimpleNamespace(data=json.dumps(response)), listType)
+
+    def list_namespaced_job(self, namespace, **kwargs):
+        """
+        :return: V1JobList
+        """
+        return self._list('job', 'V1JobList', namespace, **kwargs)
+
+    def list_namespaced_pod(self, namespace, **kwargs):
+        """
+        :return: V1PodList
+        """
+        return self._list('pod', 'V1PodList', namespace, **kwargs)
+
+    def create_namespaced_job(self, namespace, job):
+        with self.lock:
+            self.creating += 1
+            self.maxCreating = max(self.maxCreating, self.creating)
+        try:
+            self.createGate.wait()
+            if self.createError is not None:
+                raise self.createError
+            with self.lock:
+                self.created.append(job.metadata.name)
+                self.createdJobs.append(job)
+        finally:
+            with self.lock:
+                self.creating -= 1
+
+    def delete_namespaced_job(self, name, namespace, **kwargs):
+        from kubernetes.client.rest import ApiException
+        if name not in self.created:
+            raise ApiException(status=404)
+        self.deleted.append(name)
+        self.resourceVersion += 1
+        self.streams['job'].put([kubernetesJobEvent('DELETED', name, self.resourceVersion)])
+
+    def delete_collection_namespaced_job(self, namespace, **kwargs):
+        pass
+
+    def read_namespaced_pod_log(self, name, namespace):
+        return ''
+
+
+def kubernetesJobEvent(eventType, name, resourceVersion, succeeded=None, failed=None):
+    return {'type': eventType,
+            'object': {'apiVersion': 'batch/v1', 'kind': 'Job',
+                       'metadata': {'name': name, 'resourceVersion': str(resourceVersion)},
+                       'status': {'startTime': '2021-01-01T00:00:00Z',
+                                  'succeeded': succeeded, 'failed': failed}}}
+
+
+def kubernetesPodEvent(eventType, jobName, resourceVersion, phase, exitCode=None, waitingReason=None):
+    if exitCode is not None:
+        state = {'terminated': {'exitCode': exitCode, 'finishedAt': '2021-01-01T00:00:10Z'}}
+    elif waitingReason is not None:
+        state = {'waiting': {'reason': waitingReason}}
+    else:
+        state = {'running': {'startedAt': '2021-01-01T00:00:00Z'}}
+    return {'type': eventType,
+            'object': {'apiVersion': 'v1', 'kind': 'Pod',
+                       'metadata': {'name': jobName + '-pod', 'resourceVersion': str(resourceVersion),
+                                    'labels': {'job-name': jobName}},
+                       'status': {'phase': phase, 'startTime': '2021-01-01T00:00:00Z',
+                                  'containerStatuses': [{'name': 'runner-container', 'image': 'toil',
+                                                         'imageID': '', 'ready': True, 'restartCount': 0,
+                                                         'state': state}]}}}
+
+
+class KubernetesTestSupport(ToilTest):
+    """
+    Runs the Kubernetes batch system against a fake Kubernetes API.
+    """
+
+    def _createConfig(self):
+        config = Config()
+        config.workflowID = 'test'
+        config.workDir = self._createTempDir()
+        config.jobStore = 'file:' + self._createTempDir('jobStore')
+        return config
+
+    def setUp(self):
+        super(KubernetesTestSupport, self).setUp()
+        from toil.batchSystems.kubernetes import KubernetesBatchSystem
+        self.api = FakeKubernetesApi()
+        apis = {'namespace': 'default', 'batch': self.api, 'core': self.api}
+        for patcher in (patch.object(KubernetesBatchSystem, '_api', lambda _, kind: apis[kind]),
+                        patch('toil.batchSystems.kubernetes.applianceSelf', lambda: 'quay.io/ucsc_cgl/toil')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.batchSystem = KubernetesBatchSystem(self._createConfig(), maxCores=numCores, maxMemory=1e9,
+                                                 maxDisk=1e9)
+        self.prefix = self.batchSystem.jobPrefix
+
+    def tearDown(self):
+        self.batchSystem.shutdown()
+        self.batchSystem.jobInformer.thread.join()
+        self.batchSystem.podInformer.thread.join()
+        super(KubernetesTestSupport, self).tearDown()
+
+    def _issue(self):
+        jobDesc = JobDescription(command='true', requirements=dict(cores=1, memory=1000, disk=1000),
+                                 jobName='test')
+        jobDesc.jobStoreID = 'test'
+        return self.batchSystem.issueBatchJob(jobDesc)
+
+    def _waitForCreated(self, count):
+        while len(self.api.created) < count:
+            time.sleep(0.01)
+
+    def _replay(self, kind, *events):
+        """
+        Send the events down a watch connection, and wait for the batch
+        system to take them in.
+        """
+        self.api.streams[kind].put(list(events))
+        informer = self.batchSystem.jobInformer if kind == 'job' else self.batchSystem.podInformer
+        resourceVersion = events[-1]['object']['metadata']['resourceVersion']
+        while informer.resourceVersion != resourceVersion:
+            time.sleep(0.01)
+
+    def _listCount(self, kind):
+        return len([call for call in self.api.calls if call[0] == kind and not call[1].get('watch')])
+
+
+@needs_kubernetes_installed
+@travis_test
+class KubernetesWatchTest(KubernetesTestSupport):
+    """
+    Tests that the Kubernetes batch system follows its jobs by watching them,
+    against a fake Kubernetes API that replays recorded watch streams.
+    """
+
+    def testJobsFinish(self):
+        jobIDs = [self._issue(), self._issue()]
+        names = [self.prefix + str(jobID) for jobID in jobIDs]
+        self._waitForCreated(2)
+        self.assertEqual(sorted(self.api.created), sorted(names))
+        self._replay('job', kubernetesJobEvent('ADDED', names[0], 101), kubernetesJobEvent('ADDED', names[1], 102))
+        self._replay('pod', kubernetesPodEvent('ADDED', names[0], 103, 'Running'),
+                     kubernetesPodEvent('ADDED', names[1], 104, 'Running'))
+        self.assertEqual(set(self.batchSystem.getRunningBatchJobIDs()), set(jobIDs))
+
+        # The job says it succeeded before its pod says it has stopped
+        self._replay('job', kubernetesJobEvent('MODIFIED', names[0], 105, succeeded=1))
+        self.assertIsNone(self.batchSystem.getUpdatedBatchJob(maxWait=0))
+        self._replay('pod', kubernetesPodEvent('MODIFIED', names[0], 106, 'Succeeded', exitCode=0),
+                     kubernetesPodEvent('MODIFIED', names[1], 107, 'Failed', exitCode=1))
+        self._replay('job', kubernetesJobEvent('MODIFIED', names[1], 108, failed=1))
+        updates = [self.batchSystem.getUpdatedBatchJob(maxWait=5) for _ in jobIDs]
+        self.assertEqual({update.jobID: update.exitStatus for update in updates}, {jobIDs[0]: 0, jobIDs[1]: 1})
+        self.assertEqual([update.wallTime for update in updates], [10, 10])
+        self.assertEqual(sorted(self.api.deleted), sorted(names))
+        self.assertEqual(self.batchSystem.getIssuedBatchJobIDs(), [])
+
+        # All that took one listing of each kind of object
+        self.assertEqual(self._listCount('job'), 1)
+        self.assertEqual(self._listCount('pod'), 1)
+
+    def testResume(self):
+        jobID = self._issue()
+        name = self.prefix + str(jobID)
+        self._waitForCreated(1)
+        self._replay('job', kubernetesJobEvent('ADDED', name, 101))
+        # The next watch picks up where the last one left off
+        while not any(call[1].get('resource_version') == '101' for call in self.api.calls):
+            time.sleep(0.01)
+        self._replay('pod', kubernetesPodEvent('ADDED', name, 102, 'Succeeded', exitCode=0))
+        self.assertIsNone(self.batchSystem.getUpdatedBatchJob(maxWait=0))
+
+        # If the API server can't resume the watch, we list the jobs again,
+        # and find out what we missed.
+        self.api.listed['job'] = [kubernetesJobEvent('ADDED', name, 110, succeeded=1)['object']]
+        self.api.listedVersion = '110'
+        self.api.streams['job'].put([{'type': 'ERROR',
+                                      'object': {'kind': 'Status', 'apiVersion': 'v1', 'metadata': {},
+                                                 'status': 'Failure', 'reason': 'Expired',
+                                                 'message': 'too old resource version', 'code': 410}}])
+        update = self.batchSystem.getUpdatedBatchJob(maxWait=5)
+        self.assertEqual((update.jobID, update.exitStatus), (jobID, 0))
+        self.assertEqual(self._listCount('job'), 2)
+        self.assertEqual(self._listCount('pod'), 1)
+
+    def testStuck(self):
+        jobID = self._issue()
+        self._replay('pod', kubernetesPodEvent('ADDED', self.prefix + str(jobID), 101, 'Pending',
+                                               waitingReason='ImagePullBackOff'))
+        update = self.batchSystem.getUpdatedBatchJob(maxWait=5)
+        self.assertEqual((update.jobID, update.exitStatus), (jobID, EXIT_STATUS_UNAVAILABLE_VALUE))
+
+    def testVanished(self):
+        jobID = self._issue()
+        name = self.prefix + str(jobID)
+        self._replay('job', kubernetesJobEvent('ADDED', name, 101), kubernetesJobEvent('DELETED', name, 102))
+        update = self.batchSystem.getUpdatedBatchJob(maxWait=5)
+        self.assertEqual((update.jobID, update.exitReason), (jobID, BatchJobExitReason.LOST))
+        # Someone else already deleted it
+        self.assertEqual(self.api.deleted, [])
+
+    def testKill(self):
+        jobIDs = [self._issue(), self._issue()]
+        names = [self.prefix + str(jobID) for jobID in jobIDs]
+        self._waitForCreated(2)
+        self._replay('job', kubernetesJobEvent('ADDED', names[0], 101), kubernetesJobEvent('ADDED', names[1], 102))
+        self._replay('pod', kubernetesPodEvent('ADDED', names[0], 103, 'Succeeded', exitCode=0))
+        # Kill one job that is running, and one that has finished but not
+        # been reported on
+        self.batchSystem.killBatchJobs(jobIDs)
+        self.assertEqual(sorted(self.api.deleted), sorted(names))
+        self.assertEqual(self.batchSystem.jobInformer.objects, {})
+        self.assertEqual(self.batchSystem.getIssuedBatchJobIDs(), [])
+        self.assertIsNone(self.batchSystem.getUpdatedBatchJob(maxWait=0))
+
+
+@needs_kubernetes_installed
+@travis_test
+class KubernetesSubmissionTest(KubernetesTestSupport):
+    """
+    Tests creating Kubernetes jobs in the background.
+    """
+
+    def _createConfig(self):
+        config = super(KubernetesSubmissionTest, self)._createConfig()
+        config.kubernetesSubmitThreads = 2
+        config.kubernetesSubmitRate = 20
+        return config
+
+    def testIssueDoesNotWait(self):
+        self.api.createGate.clear()
+        jobIDs = [self._issue() for _ in range(4)]
+        self.assertEqual(sorted(self.batchSystem.getIssuedBatchJobIDs()), sorted(jobIDs))
+        while self.api.creating < 2:
+            time.sleep(0.01)
+        self.assertEqual(self.api.created, [])
+        self.api.createGate.set()
+        self._waitForCreated(4)
+        self.assertEqual(self.api.maxCreating, 2)
+        # Jobs of the same shape share their resource requirements
+        resources = {id(job.spec.template.spec.containers[0].resources) for job in self.api.createdJobs}
+        self.assertEqual(len(resources), 1)
+
+    def testRateLimit(self):
+        start = time.time()
+        for _ in range(10):
+            self._issue()
+        self._waitForCreated(10)
+        # Tokens come every 1/20th of a second
+        self.assertGreaterEqual(time.time() - start, 0.45)
+
+    def testCreateFails(self):
+        self.api.createError = ValueError('Bad job')
+        jobID = self._issue()
+        update = self.batchSystem.getUpdatedBatchJob(maxWait=5)
+        self.assertEqual((update.jobID, update.exitStatus, update.exitReason),
+                         (jobID, EXIT_STATUS_UNAVAILABLE_VALUE, BatchJobExitReason.ERROR))
+        self.assertEqual(self.batchSystem.getIssuedBatchJobIDs(), [])
+
+    def testKillBeforeCreated(self):
+        self.api.createGate.clear()
+        jobIDs = [self._issue() for _ in range(3)]
+        while self.api.creating < 2:
+            time.sleep(0.01)
+        # Kill a job being created, and one still waiting to be
+        self.batchSystem.killBatchJobs(jobIDs[1:])
+        self.api.createGate.set()
+        self._waitForCreated(2)
+        names = [self.prefix + str(jobID) for jobID in jobIDs]
+        # The one that was being created gets deleted once it is made
+        while len(self.api.deleted) < 1:
+            time.sleep(0.01)
+        self.assertIn(names[0], self.api.created)
+        self.assertNotIn(names[2], self.api.created)
+        self.assertEqual(self.api.deleted, [names[1]])
+        self.assertEqual(self.batchSystem.getIssuedBatchJobIDs(), [jobIDs[0]])
+
+
 @slow
 @needs_mesos
 class MesosBatchSystemTest(hidden.AbstractBatchSystemTest, MesosTestSupport):
@@ -438,6 +790,30 @@ class SingleMachineBatchSystemTest(hidden.AbstractBatchSystemTest):
         return SingleMachineBatchSystem(config=self.config,
                                         maxCores=numCores, maxMemory=1e9, maxDisk=2001)
 
+    def testLongWaitingJobIsNotStarved(self):
+        """
+        Test that once a job has waited long enough, jobs issued after it that
+        would fit in first have to wait for it.
+        """
+        batchSystem = SingleMachineBatchSystem(config=self.config, maxCores=1, maxMemory=1e9, maxDisk=2001)
+        batchSystem.reservationDelay = 0
+        try:
+            def issue(command, cores):
+                return batchSystem.issueBatchJob(self._mockJobDescription(
+                    command=command, jobName=command, unitName=None, jobStoreID=command,
+                    requirements=dict(cores=cores, memory=1000, disk=1000, preemptable=preemptable)))
+            first = issue('sleep 2', 0.5)
+            while first not in batchSystem.getRunningBatchJobIDs():
+                time.sleep(0.1)
+            # The big job can't start until the first one is done, and the
+            # last one could start now, but would delay the big one.
+            big = issue('sleep 0', 1)
+            last = issue('sleep 1', 0.5)
+            finished = [batchSystem.getUpdatedBatchJob(maxWait=30).jobID for _ in range(3)]
+            self.assertEqual(finished, [first, big, last])
+        finally:
+            batchSystem.shutdown()
+
 
 @slow
 class MaxCoresSingleMachineBatchSystemTest(ToilTest):
@@ -687,6 +1063,97 @@ class ParasolBatchSystemTest(hidden.AbstractBatchSystemTest, ParasolTestSupport)
         return [self._parseBatchString(line) for line in batchLines[1:] if line]
 
 
+fakeParasolScript = dedent("""
+    #!{python}
+    # Stands in for parasol: records its arguments, and adds jobs without running them.
+    import os, sys
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, 'calls'), 'a') as f:
+        f.write(' '.join(sys.argv[1:]) + '\\n')
+    if 'add' in sys.argv:
+        count = os.path.join(here, 'count')
+        jobID = int(open(count).read()) + 1 if os.path.exists(count) else 1
+        with open(count, 'w') as f:
+            f.write(str(jobID))
+        print('your job %i running' % jobID)
+    """).lstrip()
+
+
+@travis_test
+class ParasolResultsTest(ToilTest):
+    """
+    Tests how the Parasol batch system keeps track of its jobs, with a fake
+    parasol command and results written by the test.
+    """
+
+    def setUp(self):
+        super(ParasolResultsTest, self).setUp()
+        self.parasolDir = self._createTempDir()
+        command = os.path.join(self.parasolDir, 'parasol')
+        with open(command, 'w') as f:
+            f.write(fakeParasolScript.format(python=sys.executable))
+        os.chmod(command, 0o755)
+        config = Config()
+        config.workflowID = 'test'
+        config.jobStore = self._createTempDir('jobStore')
+        config.parasolCommand = command
+        config.parasolMaxBatches = 10
+        self.batchSystem = ParasolBatchSystem(config, maxCores=numCores, maxMemory=sys.maxsize, maxDisk=1001)
+
+    def tearDown(self):
+        self.batchSystem.running = False
+        self.batchSystem.worker.join()
+        super(ParasolResultsTest, self).tearDown()
+
+    def _issue(self, memory=int(100e6)):
+        # Small enough for all of them to be issued at once, on any machine
+        requirements = dict(defaultRequirements, cores=0.1, memory=memory)
+        return self.batchSystem.issueBatchJob(JobDescription(command='true', jobName='test',
+                                                             requirements=requirements))
+
+    def _calls(self, command):
+        with open(os.path.join(self.parasolDir, 'calls')) as f:
+            return [line for line in f if command in line]
+
+    def _resultsLine(self, jobID, status=0):
+        return '%i host %i exe 3 4 100 100 100 user err true\n' % (status << 8, jobID)
+
+    def _writeResults(self, jobID, data):
+        with open(self.batchSystem.issuedJobs[jobID], 'a') as f:
+            f.write(data)
+
+    def testResultsAreTailed(self):
+        jobIDs = [self._issue() for _ in range(3)]
+        self.assertEqual(sorted(self.batchSystem.getIssuedBatchJobIDs()), jobIDs)
+        line = self._resultsLine(jobIDs[0], status=3)
+        # Half a line isn't read until the rest of it is written.
+        self._writeResults(jobIDs[0], line[:10])
+        self.assertIsNone(self.batchSystem.getUpdatedBatchJob(maxWait=0.5))
+        self._writeResults(jobIDs[0], line[10:] + self._resultsLine(jobIDs[1]))
+        updates = [self.batchSystem.getUpdatedBatchJob(maxWait=5) for _ in range(2)]
+        self.assertEqual([(item.jobID, item.exitStatus, item.wallTime) for item in updates],
+                         [(jobIDs[0], 3, 0.07), (jobIDs[1], 0, 0.07)])
+        self.assertEqual(self.batchSystem.getIssuedBatchJobIDs(), jobIDs[2:])
+        # Nothing is read twice.
+        self.assertIsNone(self.batchSystem.getUpdatedBatchJob(maxWait=0.5))
+        # Keeping track didn't need Parasol's job list.
+        self.assertEqual(self._calls('list jobs'), [])
+
+    def testBatches(self):
+        small, big = self._issue(), self._issue(memory=int(200e6))
+        smallResults = self.batchSystem.issuedJobs[small]
+        self.assertNotEqual(smallResults, self.batchSystem.issuedJobs[big])
+        self.assertEqual(self.batchSystem.getJobIDsForResultsFile(smallResults), {small})
+
+    def testKilledJobsAreNotReported(self):
+        jobIDs = [self._issue() for _ in range(2)]
+        self.batchSystem.killBatchJobs(jobIDs[:1])
+        self.assertEqual(len(self._calls('list jobs')), 1)
+        self.assertEqual(self.batchSystem.getIssuedBatchJobIDs(), jobIDs[1:])
+        self._writeResults(jobIDs[1], self._resultsLine(jobIDs[0]) + self._resultsLine(jobIDs[1]))
+        self.assertEqual(self.batchSystem.getUpdatedBatchJob(maxWait=5).jobID, jobIDs[1])
+
+
 @slow
 @needs_gridengine
 class GridEngineBatchSystemTest(hidden.AbstractGridEngineBatchSystemTest):
@@ -779,6 +1246,454 @@ class HTCondorBatchSystemTest(hidden.AbstractGridEngineBatchSystemTest):
     def tearDown(self):
         super(HTCondorBatchSystemTest, self).tearDown()
 
+class FakeGridEngineBoss(object):
+    """
+    Stands in for the batch system that owns a grid engine worker thread, so
+    the worker can be tested without a scheduler.
+    """
+    formatStdOutErrPath = BatchSystemSupport.formatStdOutErrPath
+
+    def __init__(self, config):
+        self.config = config
+        self.environment = {}
+
+    def getWaitDuration(self):
+        return 0
+
+    def with_retries(self, operation, *args, **kwargs):
+        return operation(*args, **kwargs)
+
+
+class GridEngineWorkerTestSupport(ToilTest):
+    """
+    Support for testing the worker threads of grid engine batch systems
+    without a scheduler
+    """
+
+    def setUp(self):
+        super(GridEngineWorkerTestSupport, self).setUp()
+        self.config = Config()
+        self.config.workflowID = 'test'
+        self.config.workDir = self._createTempDir()
+        self.config.maxLocalJobs = 100
+        self.config.noStdOutErr = False
+
+    def _createWorker(self, workerClass):
+        return workerClass(Queue(), Queue(), Queue(), Queue(), FakeGridEngineBoss(self.config))
+
+
+@travis_test
+class GridEngineArrayJobTest(GridEngineWorkerTestSupport):
+    """
+    Tests the submission of jobs that need the same resources as array jobs,
+    against canned scheduler output
+    """
+
+    def _queueJobs(self, worker):
+        # Three jobs that can share an array job, and one that can't
+        worker.waitingJobs = [(1, 1, 1000, 'echo one', 'a'),
+                              (2, 2, 1000, 'echo two', 'b'),
+                              (3, 1, 1000, 'echo three', 'a'),
+                              (4, 1, 1000, 'echo four', 'a')]
+
+    def testSlurmArrayJob(self):
+        from toil.batchSystems.slurm import SlurmBatchSystem
+        worker = self._createWorker(SlurmBatchSystem.Worker)
+        self._queueJobs(worker)
+        calls = []
+
+        def fakeCallCommand(cmd, input=None, **kwargs):
+            calls.append((cmd, input))
+            return 'Submitted batch job %i\n' % (100 + len(calls))
+
+        with patch('toil.batchSystems.slurm.call_command', fakeCallCommand):
+            self.assertTrue(worker.createJobs(None))
+            self.assertEqual(worker.waitingJobs, [])
+            (arrayLine, script), (singleLine, singleInput) = calls
+            self.assertIn('--array=1-3', arrayLine)
+            self.assertIn('--wrap=echo two', singleLine)
+            self.assertIsNone(singleInput)
+            # Each element maps back to its own Toil job
+            self.assertEqual([worker.getBatchSystemID(jobID) for jobID in (1, 3, 4, 2)],
+                             ['101_1', '101_2', '101_3', '102'])
+            worker.killJob(3)
+            self.assertEqual(calls[-1][0], ['scancel', '101_2'])
+
+        # The second element runs the second job, and writes its own output
+        env = dict(os.environ, SLURM_ARRAY_JOB_ID='101', SLURM_ARRAY_TASK_ID='2')
+        subprocess.check_call(['sh', '-c', script], env=env)
+        with open(worker.boss.formatStdOutErrPath(3, 'slurm', '101_2', 'std_output')) as f:
+            self.assertEqual(f.read(), 'three\n')
+        env['SLURM_ARRAY_TASK_ID'] = '4'
+        self.assertNotEqual(subprocess.call(['sh', '-c', script], env=env), 0)
+
+    def testMaxArrayJobSize(self):
+        from toil.batchSystems.slurm import SlurmBatchSystem
+        self.config.maxArrayJobSize = 1
+        worker = self._createWorker(SlurmBatchSystem.Worker)
+        self._queueJobs(worker)
+        calls = []
+
+        def fakeCallCommand(cmd, input=None, **kwargs):
+            calls.append(cmd)
+            return 'Submitted batch job %i\n' % (100 + len(calls))
+
+        with patch('toil.batchSystems.slurm.call_command', fakeCallCommand):
+            worker.createJobs(None)
+        self.assertEqual(len(calls), 4)
+        self.assertFalse(any('--array' in arg for cmd in calls for arg in cmd))
+
+    def testGridEngineArrayElements(self):
+        from toil.batchSystems.gridengine import GridEngineBatchSystem
+        worker = self._createWorker(GridEngineBatchSystem.Worker)
+        worker.batchJobIDs = {1: (7, 1), 2: (7, 2), 3: (7, 3), 4: (8, None)}
+        worker.runningJobs = {1, 2, 3, 4}
+        qstat = dedent("""\
+            job-ID  prior   name       user         state submit/start at     queue                          slots ja-task-ID
+            -----------------------------------------------------------------------------------------------------------------
+                  7 0.55500 toil_job_a user         r     01/01/2021 10:00:00 all.q@node1                        1 1
+                  7 0.55500 toil_job_a user         qw    01/01/2021 09:59:00                                    1 3-5:2
+                  8 0.55500 toil_job_4 user         r     01/01/2021 10:00:00 all.q@node2                        1
+            """)
+
+        def fakeCallCommand(cmd, input=None, **kwargs):
+            self.assertEqual(cmd, ['qstat'])
+            return qstat
+
+        with patch('toil.batchSystems.gridengine.call_command', fakeCallCommand):
+            self.assertEqual(set(worker.getRunningJobIDs()), {1, 4})
+
+
+@travis_test
+class GridEngineStatusPollingTest(GridEngineWorkerTestSupport):
+    """
+    Tests that grid engine batch systems check on all their running jobs with
+    one scheduler command, against fake scheduler commands that print canned
+    output
+    """
+
+    def _fakeCommands(self, **commands):
+        """
+        Put fake scheduler commands first on the PATH for the rest of the test.
+
+        :param commands: Map from command name to what it should print, or to a
+               tuple of what it should print to standard output and standard
+               error, and its exit status.
+        """
+        binDir = self._createTempDir()
+        self.commandLog = os.path.join(binDir, 'calls.log')
+        for name, output in commands.items():
+            stdout, stderr, status = (output, '', 0) if isinstance(output, str) else output
+            path = os.path.join(binDir, name)
+            with open(path, 'w') as f:
+                f.write(dedent("""\
+                    #!/bin/sh
+                    echo "{name} $*" >> {log}
+                    cat <<'EOF'
+                    {stdout}EOF
+                    cat >&2 <<'EOF'
+                    {stderr}EOF
+                    exit {status}
+                    """).format(name=name, log=self.commandLog, status=status, stdout=stdout, stderr=stderr))
+            os.chmod(path, 0o755)
+        pathPatch = patch.dict(os.environ, {'PATH': binDir + os.pathsep + os.environ['PATH']})
+        pathPatch.start()
+        self.addCleanup(pathPatch.stop)
+
+    def _calls(self, name):
+        with open(self.commandLog) as f:
+            return [line.split()[1:] for line in f if line.split()[0] == name]
+
+    def _checkOnJobs(self, worker, batchJobIDs):
+        """
+        Have the worker check on the given jobs.
+
+        :param dict batchJobIDs: Map from Toil job ID to batch job ID and array index
+        :return: Map from Toil job ID to the exit status reported, for the jobs
+                 that finished
+        """
+        worker.batchJobIDs = dict(batchJobIDs)
+        worker.runningJobs = set(batchJobIDs)
+        self.assertTrue(worker.checkOnJobs())
+        updates = {}
+        while not worker.updatedJobsQueue.empty():
+            update = worker.updatedJobsQueue.get()
+            updates[update.jobID] = update.exitStatus
+        self.assertEqual(worker.runningJobs, set(batchJobIDs) - set(updates))
+        return updates
+
+    def testSlurm(self):
+        from toil.batchSystems.slurm import SlurmBatchSystem
+        self._fakeCommands(sacct=dedent("""\
+            101_1|COMPLETED|0:0
+            101_1.batch|COMPLETED|0:0
+            101_2|RUNNING|0:0
+            102|FAILED|3:0
+            102.batch|FAILED|3:0
+            103|CANCELLED by 1000|0:9
+            """))
+        worker = self._createWorker(SlurmBatchSystem.Worker)
+        updates = self._checkOnJobs(worker, {1: (101, 1), 2: (101, 2), 3: (102, None), 4: (103, None)})
+        self.assertEqual(updates, {1: 0, 3: 3, 4: 137})
+        calls = self._calls('sacct')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(set(calls[0][calls[0].index('-j') + 1].split(',')), {'101_1', '101_2', '102', '103'})
+
+    def testSlurmWithoutAccounting(self):
+        from toil.batchSystems.slurm import SlurmBatchSystem
+        self._fakeCommands(sacct=('', 'sacct: error: Slurm accounting storage is disabled\n', 1),
+                           scontrol=dedent("""\
+            JobId=201 ArrayJobId=200 ArrayTaskId=1 JobName=toil_job_array_1 JobState=COMPLETED Reason=None ExitCode=0:0
+            JobId=202 ArrayJobId=200 ArrayTaskId=2 JobName=toil_job_array_1 JobState=RUNNING Reason=None ExitCode=0:0
+            JobId=203 JobName=toil_job_3 JobState=FAILED Reason=NonZeroExitCode ExitCode=2:0
+            JobId=999 JobName=someone_else JobState=FAILED Reason=NonZeroExitCode ExitCode=1:0
+            """))
+        worker = self._createWorker(SlurmBatchSystem.Worker)
+        updates = self._checkOnJobs(worker, {1: (200, 1), 2: (200, 2), 3: (203, None)})
+        self.assertEqual(updates, {1: 0, 3: 2})
+        self.assertEqual(len(self._calls('scontrol')), 1)
+
+    def testGridEngine(self):
+        from toil.batchSystems.gridengine import GridEngineBatchSystem
+        self._fakeCommands(qstat=dedent("""\
+            <?xml version='1.0'?>
+            <job_info  xmlns:xsd="http://arc.liv.ac.uk/repos/darcs/sge/source/dist/util/resources/schemas/qstat/qstat.xsd">
+              <queue_info>
+                <job_list state="running">
+                  <JB_job_number>7</JB_job_number>
+                  <state>r</state>
+                  <tasks>1</tasks>
+                </job_list>
+              </queue_info>
+              <job_info>
+                <job_list state="pending">
+                  <JB_job_number>7</JB_job_number>
+                  <state>qw</state>
+                  <tasks>3-5:2</tasks>
+                </job_list>
+                <job_list state="pending">
+                  <JB_job_number>9</JB_job_number>
+                  <state>qw</state>
+                </job_list>
+              </job_info>
+            </job_info>
+            """), qacct=dedent("""\
+            ==============================================================
+            qname        all.q
+            failed       0
+            exit_status  3
+            """))
+        worker = self._createWorker(GridEngineBatchSystem.Worker)
+        updates = self._checkOnJobs(worker, {1: (7, 1), 2: (7, 2), 3: (7, 3), 4: (9, None)})
+        self.assertEqual(updates, {2: 3})
+        self.assertEqual(self._calls('qstat'), [['-xml']])
+        # Only the job that left the queue is looked up in the accounting
+        self.assertEqual(self._calls('qacct'), [['-j', '7', '-t', '2']])
+
+    def testLSF(self):
+        from toil.batchSystems.lsf import LSFBatchSystem
+        self._fakeCommands(bjobs=dedent("""\
+            {
+              "COMMAND":"bjobs",
+              "JOBS":4,
+              "RECORDS":[
+                {"JOBID":"31", "JOBINDEX":"1", "USER":"me", "EXIT_CODE":"", "STAT":"DONE", "EXIT_REASON":"", "PEND_REASON":""},
+                {"JOBID":"31", "JOBINDEX":"2", "USER":"me", "EXIT_CODE":"", "STAT":"RUN", "EXIT_REASON":"", "PEND_REASON":""},
+                {"JOBID":"32", "JOBINDEX":"0", "USER":"me", "EXIT_CODE":"4", "STAT":"EXIT", "EXIT_REASON":"", "PEND_REASON":""},
+                {"JOBID":"33", "ERROR":"Job <33> is not found"}
+              ]
+            }
+            """), bacct=dedent("""\
+            Job <33>, User <me>, Project <default>, Status <DONE>
+            """))
+        worker = self._createWorker(LSFBatchSystem.Worker)
+        updates = self._checkOnJobs(worker, {1: (31, 1), 2: (31, 2), 3: (32, None), 4: (33, None)})
+        self.assertEqual(updates, {1: 0, 3: 4, 4: 0})
+        statusCalls = [call for call in self._calls('bjobs') if call[0] == '-json']
+        self.assertEqual(len(statusCalls), 1)
+        self.assertEqual(statusCalls[0][-4:], ['31[1]', '31[2]', '32', '33'])
+        # Only the job bjobs has forgotten is looked up in the accounting
+        self.assertEqual(self._calls('bacct'), [['-l', '33']])
+
+    def testTorque(self):
+        from toil.batchSystems.torque import TorqueBatchSystem
+        self._fakeCommands(pbsnodes='Version: 6.1.2\n', qstat=(dedent("""\
+            Job Id: 41.server.example.com
+                Job_Name = toil_job_1
+                job_state = C
+                exit_status = 0
+            Job Id: 42[1].server.example.com
+                Job_Name = toil_job_array_2-1
+                job_state = R
+            Job Id: 42[2].server.example.com
+                Job_Name = toil_job_array_2-2
+                job_state = C
+                exit_status = 5
+            """), 'qstat: Unknown Job Id 43.server.example.com\n', 153))
+        worker = self._createWorker(TorqueBatchSystem.Worker)
+        updates = self._checkOnJobs(worker, {1: ('41.server.example.com', None),
+                                             2: ('42[].server.example.com', 1),
+                                             3: ('42[].server.example.com', 2),
+                                             4: ('43.server.example.com', None)})
+        # The job Torque has forgotten is assumed to have succeeded
+        self.assertEqual(updates, {1: 0, 3: 5, 4: 0})
+        calls = self._calls('qstat')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(calls[0][1:]), ['41', '42[1]', '42[2]', '43'])
+
+
+class LocalGridEngineBatchSystem(AbstractGridEngineBatchSystem):
+    """
+    A grid engine batch system whose scheduler runs each job it is given at
+    once, as a local process. Counts the jobs submitted to it.
+    """
+
+    pilotIdleTimeout = 2
+
+    class Worker(AbstractGridEngineBatchSystem.Worker):
+
+        def __init__(self, *args, **kwargs):
+            super(LocalGridEngineBatchSystem.Worker, self).__init__(*args, **kwargs)
+            # Map from batch job ID to Popen
+            self.processes = {}
+            self.submitted = []
+
+        def prepareSubmission(self, cpu, memory, jobID, command, jobName):
+            return command
+
+        def submitJob(self, subLine):
+            batchJobID = len(self.submitted)
+            self.submitted.append(subLine)
+            self.processes[batchJobID] = subprocess.Popen(subLine, shell=True, start_new_session=True,
+                                                          env=dict(os.environ, **self.boss.environment))
+            return batchJobID
+
+        def getRunningJobIDs(self):
+            return {}
+
+        def killJob(self, jobID):
+            os.killpg(self.processes[self.batchJobIDs[jobID][0]].pid, signal.SIGKILL)
+
+        def getJobExitCode(self, batchJobID):
+            return self.processes[int(batchJobID)].poll()
+
+    @classmethod
+    def obtainSystemConstants(cls):
+        return 2, MemoryString('1G')
+
+
+@travis_test
+class PilotJobTest(ToilTest):
+    """
+    Tests running jobs in pilot jobs, on a grid engine batch system whose
+    scheduler runs jobs locally
+    """
+
+    def setUp(self):
+        super(PilotJobTest, self).setUp()
+        self.config = Config()
+        self.config.workflowID = 'test'
+        self.config.workDir = self._createTempDir()
+        self.config.jobStore = 'file:' + self._createTempDir('jobStore')
+        self.config.statePollingWait = 0.1
+        self.config.pilotJobs = 2
+        self.config.pilotCores = 1
+        self.config.maxLocalJobs = 2
+        self.batchSystem = LocalGridEngineBatchSystem(self.config, maxCores=2, maxMemory=1e9, maxDisk=1e9)
+
+    def tearDown(self):
+        self.batchSystem.shutdown()
+        super(PilotJobTest, self).tearDown()
+
+    def _issue(self, command, cores=1):
+        jobDesc = JobDescription(command=command, requirements=dict(cores=cores, memory=1000, disk=1000),
+                                 jobName='test')
+        jobDesc.jobStoreID = 'test'
+        return self.batchSystem.issueBatchJob(jobDesc)
+
+    def _waitForUpdates(self, count):
+        updates = {}
+        while len(updates) < count:
+            update = self.batchSystem.getUpdatedBatchJob(maxWait=10)
+            self.assertIsNotNone(update)
+            updates[update.jobID] = update.exitStatus
+        return updates
+
+    def testJobsRunInPilots(self):
+        jobIDs = [self._issue('exit %i' % i, cores=0.5) for i in range(8)]
+        self.assertEqual(set(self.batchSystem.getIssuedBatchJobIDs()), set(jobIDs))
+        updates = self._waitForUpdates(len(jobIDs))
+        self.assertEqual(updates, {jobID: i for i, jobID in enumerate(jobIDs)})
+        self.assertEqual(self.batchSystem.getIssuedBatchJobIDs(), [])
+        # The eight jobs only needed two allocations
+        submitted = self.batchSystem.worker.submitted
+        self.assertEqual(len(submitted), 2)
+        self.assertTrue(all('_toil_pilot' in command for command in submitted))
+
+    def testSecretNotSubmitted(self):
+        from toil.batchSystems.gridengine import GridEngineBatchSystem
+        from toil.batchSystems.slurm import SlurmBatchSystem
+        self._issue('true')
+        self._waitForUpdates(1)
+        pilots = self.batchSystem.pilots
+        command, = self.batchSystem.worker.submitted
+        self.assertNotIn(pilots.secret, command)
+        self.assertNotIn(pilots.secret, self.batchSystem.environment.values())
+        # Only we can read where the pilots get it from
+        self.assertEqual(os.stat(pilots.secretPath).st_mode & 0o777, 0o600)
+        # Nor does it end up in what real schedulers are given
+        boss = FakeGridEngineBoss(self.config)
+        boss.environment = self.batchSystem.environment
+        for workerClass in (GridEngineBatchSystem.Worker, SlurmBatchSystem.Worker):
+            worker = workerClass(Queue(), Queue(), Queue(), Queue(), boss)
+            argv = worker.prepareSubmission(1, 1000, 1, command, 'toil_pilot')
+            self.assertFalse(any(pilots.secret in arg for arg in argv), argv)
+
+    def testBigJobsRunOnTheirOwn(self):
+        jobID = self._issue('exit 3', cores=2)
+        self.assertEqual(self._waitForUpdates(1), {jobID: 3})
+        self.assertEqual(self.batchSystem.worker.submitted, ['exit 3'])
+
+    def testKill(self):
+        jobID = self._issue('sleep 1000')
+        while jobID not in self.batchSystem.getRunningBatchJobIDs():
+            self.assertIsNone(self.batchSystem.getUpdatedBatchJob(maxWait=0.1))
+        self.batchSystem.killBatchJobs([jobID])
+        self.assertEqual(self.batchSystem.getIssuedBatchJobIDs(), [])
+        self.assertEqual(self.batchSystem.getRunningBatchJobIDs(), {})
+        # Killed jobs aren't reported as finished, and the pilot stays up for more work
+        otherJobID = self._issue('true')
+        self.assertEqual(self._waitForUpdates(1), {otherJobID: 0})
+        self.assertEqual(len(self.batchSystem.worker.submitted), 1)
+
+    def testRequestsNeedSecret(self):
+        pilots = self.batchSystem.pilots
+        pilots.issueJob(1, 1, 1000, 'true')
+
+        def request(secret):
+            agent = PilotAgent(pilots.address, secret, 100, 1, 1000, 0)
+            return agent._request({'secret': secret, 'agent': 100, 'finished': [[1, 0, 1]],
+                                   'freeCores': 1, 'freeMemory': 1000})
+
+        # Nobody without the secret can take jobs
+        for secret in ('wrong', None):
+            with self.assertRaises(ValueError):
+                request(secret)
+        self.assertEqual(pilots.getRunningJobIDs(), {})
+        self.assertEqual([job['jobID'] for job in request(pilots.secret)['start']], [1])
+
+    def testIdlePilotsStop(self):
+        jobID = self._issue('true')
+        self.assertEqual(self._waitForUpdates(1), {jobID: 0})
+        # The pilot gives back its allocation once it has had no work for a while
+        while self.batchSystem.pilotIDs:
+            self.assertIsNone(self.batchSystem.getUpdatedBatchJob(maxWait=0.5))
+        # And a new one is submitted when there is work again
+        jobID = self._issue('true')
+        self.assertEqual(self._waitForUpdates(1), {jobID: 0})
+        self.assertEqual(len(self.batchSystem.worker.submitted), 2)
+
+
 @travis_test
 class SingleMachineBatchSystemJobTest(hidden.AbstractBatchSystemJobTest):
     """
@@ -905,6 +1820,63 @@ def _resourceBlockTestAuxFn(outFile, sleepTime, writeVal):
     time.sleep(sleepTime)
 
 
+@travis_test
+class ForkedWorkerSingleMachineTest(ToilTest):
+    """
+    Tests the single machine batch system with workers forked from a forkserver
+    """
+
+    def getOptions(self):
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        options.forkWorkers = True
+        return options
+
+    def testWorkflow(self):
+        # The workers are children of the forkserver, not of us.
+        root = Job.wrapJobFn(_forkedChildParentPID)
+        self.assertNotEqual(Job.Runner.startToil(root, self.getOptions()), os.getpid())
+
+    def testKill(self):
+        pidFile = os.path.join(self._createTempDir(), 'pid')
+        options = self.getOptions()
+        with Toil(options) as toil:
+            # Do what Toil.start() would before running a job
+            toil._serialiseEnv()
+            jobDesc = Job.wrapFn(_writePIDAndSleep, pidFile, memory='100M', disk='1M').saveAsRootJob(toil._jobStore)
+            jobDesc.command = ' '.join([resolveEntryPoint('_toil_worker'), jobDesc.jobName,
+                                        options.jobStore, jobDesc.jobStoreID])
+            batchSystem = SingleMachineBatchSystem(toil.config, maxCores=1, maxMemory=1e9, maxDisk=1e9)
+            try:
+                jobID = batchSystem.issueBatchJob(jobDesc)
+                while not os.path.exists(pidFile):
+                    self.assertIsNone(batchSystem.getUpdatedBatchJob(maxWait=0.1))
+                with open(pidFile) as f:
+                    pid = int(f.read())
+                batchSystem.killBatchJobs([jobID])
+                self.assertEqual(batchSystem.getRunningBatchJobIDs(), {})
+                # Killed jobs aren't reported as finished
+                self.assertIsNone(batchSystem.getUpdatedBatchJob(maxWait=1))
+                # And the process is gone
+                self.assertRaises(ProcessLookupError, os.kill, pid, 0)
+            finally:
+                batchSystem.shutdown()
+
+
+def _forkedChildParentPID(job):
+    return job.addChildFn(_parentPID).rv()
+
+
+def _parentPID():
+    return os.getppid()
+
+
+def _writePIDAndSleep(pidFile):
+    with open(pidFile + '.tmp', 'w') as f:
+        f.write(str(os.getpid()))
+    os.rename(pidFile + '.tmp', pidFile)
+    time.sleep(1000)
+
+
 @slow
 @needs_mesos
 class MesosBatchSystemJobTest(hidden.AbstractBatchSystemJobTest, MesosTestSupport):
@@ -0,0 +1,134 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import time
+from queue import Empty
+from uuid import uuid4
+
+from toil.batchSystems.singleMachine import SingleMachineBatchSystem
+from toil.common import Config
+from toil.job import JobDescription
+from toil.test import ToilTest, slow, travis_test
+
+logger = logging.getLogger(__name__)
+
+
+class PollingSingleMachineBatchSystem(SingleMachineBatchSystem):
+    """
+    A single machine batch system that schedules the way it did before it
+    was event-driven, to compare against: it starts jobs from the input queue
+    in order, putting any that don't fit at the back, and checks on its
+    children and sleeps 10ms between passes.
+    """
+
+    def daddy(self):
+        try:
+            while not self.shuttingDown.is_set():
+                while not self.shuttingDown.is_set():
+                    try:
+                        args = self.inputQueue.get_nowait()
+                    except Empty:
+                        break
+                    jobCommand, jobID, jobCores, jobMemory, jobDisk, environment = args
+                    if self._startChild(jobCommand, jobID, int(jobCores // self.minCores),
+                                        jobMemory, jobDisk, environment) is None:
+                        # Requeue last, and wait for something to finish.
+                        self.inputQueue.put(args)
+                        break
+                for done_pid in self._pollForDoneChildrenIn(self.children):
+                    self._handleChild(done_pid)
+                time.sleep(0.01)
+
+            for popen in self.children.values():
+                popen.kill()
+            for popen in self.children.values():
+                popen.wait()
+        except Exception as e:
+            self.daddyException = e
+            raise
+
+    def _watchChild(self, popen):
+        # Children are only ever polled for.
+        pass
+
+
+class SingleMachineBenchmarkTest(ToilTest):
+    """
+    Measures how quickly the single machine batch system gets through small
+    jobs, against the scheduling loop it used to have.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.jobCount = int(os.environ.get('TOIL_TEST_SINGLE_MACHINE_BENCHMARK_JOBS', 500))
+
+    def _createBatchSystem(self, batchSystemClass):
+        config = Config()
+        config.workflowID = str(uuid4())
+        config.cleanWorkDir = 'always'
+        return batchSystemClass(config=config, maxCores=1, maxMemory=1e9, maxDisk=1e9)
+
+    def _issue(self, batchSystem, cores):
+        jobDesc = JobDescription(requirements=dict(cores=cores, memory=1000, disk=1000, preemptable=False),
+                                 jobName='true', unitName=None)
+        jobDesc.command = 'true'
+        jobDesc.jobStoreID = 'true'
+        return batchSystem.issueBatchJob(jobDesc)
+
+    def _waitFor(self, batchSystem, count):
+        for _ in range(count):
+            update = batchSystem.getUpdatedBatchJob(maxWait=60)
+            self.assertIsNotNone(update)
+            self.assertEqual(update.exitStatus, 0)
+
+    @slow
+    @travis_test
+    def testThroughput(self):
+        rates = {}
+        for batchSystemClass in (PollingSingleMachineBatchSystem, SingleMachineBatchSystem):
+            batchSystem = self._createBatchSystem(batchSystemClass)
+            try:
+                start = time.time()
+                # Lots of jobs at once, more than fit on the machine together
+                for _ in range(self.jobCount):
+                    self._issue(batchSystem, 0.1)
+                self._waitFor(batchSystem, self.jobCount)
+                rates[batchSystemClass] = self.jobCount / (time.time() - start)
+            finally:
+                batchSystem.shutdown()
+            logger.info('Single machine benchmark throughput with %s: %.1f jobs/sec',
+                        batchSystemClass.__name__, rates[batchSystemClass])
+        self.assertGreater(rates[SingleMachineBatchSystem], rates[PollingSingleMachineBatchSystem])
+
+    @slow
+    @travis_test
+    def testLatency(self):
+        latencies = {}
+        for batchSystemClass in (PollingSingleMachineBatchSystem, SingleMachineBatchSystem):
+            batchSystem = self._createBatchSystem(batchSystemClass)
+            try:
+                start = time.time()
+                # One job at a time, so every job waits on the scheduler
+                for _ in range(self.jobCount // 10):
+                    self._issue(batchSystem, 1)
+                    self._waitFor(batchSystem, 1)
+                latencies[batchSystemClass] = (time.time() - start) / (self.jobCount // 10)
+            finally:
+                batchSystem.shutdown()
+            logger.info('Single machine benchmark latency with %s: %.1f ms/job',
+                        batchSystemClass.__name__, latencies[batchSystemClass] * 1000)
+        # The polling loop notices a job finishing only once it wakes up.
+        self.assertLess(latencies[SingleMachineBatchSystem], latencies[PollingSingleMachineBatchSystem])
@@ -0,0 +1,114 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import builtins
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from mock import patch
+
+from toil.common import Config
+from toil.job import JobDescription
+from toil.jobStores.fileJobStore import FileJobStore
+from toil.test import ToilTest, slow, travis_test
+
+logger = logging.getLogger(__name__)
+
+
+class FileJobStoreBenchmarkTest(ToilTest):
+    """
+    Counts the file system metadata operations the file job store makes to
+    create jobs, one at a time and in a batch.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.jobCount = int(os.environ.get('TOIL_TEST_FILE_JOB_STORE_BENCHMARK_JOBS', 500))
+
+    def _createJobs(self, batched):
+        """
+        Create jobs in a new job store, counting the files created, renamed
+        and removed while the jobs are written.
+
+        :return: The operations done, and the seconds they took.
+        :rtype: tuple(dict, float)
+        """
+        jobStore = FileJobStore(self._getTestJobStorePath())
+        jobStore.initialize(Config())
+        jobs = []
+        for i in range(self.jobCount):
+            job = JobDescription(command='job%d' % i, requirements=dict(cores=1, memory=1000, disk=1000),
+                                 jobName='bench', unitName=None)
+            # Directories for the jobs are made when their IDs are assigned,
+            # whether they are batched or not.
+            jobStore.assignID(job)
+            jobs.append(job)
+
+        counts = {'create': 0, 'rename': 0, 'remove': 0}
+        realOpen, realOSOpen = builtins.open, os.open
+        realRename, realRemove = os.rename, os.remove
+
+        def countingOpen(file, mode='r', *args, **kwargs):
+            if any(c in mode for c in 'wxa'):
+                counts['create'] += 1
+            return realOpen(file, mode, *args, **kwargs)
+
+        def countingOSOpen(path, flags, *args, **kwargs):
+            if flags & os.O_CREAT:
+                counts['create'] += 1
+            return realOSOpen(path, flags, *args, **kwargs)
+
+        def counting(name, function):
+            def wrapper(*args, **kwargs):
+                counts[name] += 1
+                return function(*args, **kwargs)
+            return wrapper
+
+        @contextmanager
+        def maybeBatch():
+            if batched:
+                with jobStore.batch():
+                    yield
+            else:
+                yield
+
+        with patch('builtins.open', countingOpen), patch('os.open', countingOSOpen), \
+                patch('os.rename', counting('rename', realRename)), \
+                patch('os.remove', counting('remove', realRemove)):
+            start = time.time()
+            with maybeBatch():
+                for job in jobs:
+                    jobStore.create(job)
+            elapsed = time.time() - start
+        for job in jobs:
+            self.assertTrue(jobStore.exists(job.jobStoreID))
+        jobStore.destroy()
+        return counts, elapsed
+
+    @slow
+    @travis_test
+    def testBatchMetadataOperations(self):
+        operations = {}
+        for batched in (False, True):
+            counts, elapsed = self._createJobs(batched)
+            operations[batched] = sum(counts.values())
+            logger.info('File job store benchmark %s: %s for %d jobs, %.2f per job, in %.2f seconds',
+                        'batched' if batched else 'unbatched', counts, self.jobCount,
+                        operations[batched] / self.jobCount, elapsed)
+        # Each job on its own is written to a temporary file and renamed into
+        # place. A batch writes each job once, plus a segment file per batch.
+        self.assertEqual(operations[False], 2 * self.jobCount)
+        self.assertLessEqual(operations[True], self.jobCount + 3)
@@ -30,9 +30,11 @@ import threading
 import os
 import sys
 import shutil
+import subprocess
 import tempfile
 import time
 import uuid
+from mock import patch
 from stubserver import FTPStubServer
 from abc import abstractmethod, ABCMeta
 from itertools import chain, islice
@@ -54,6 +56,7 @@ from toil.job import Job, JobDescription, TemporaryID
 from toil.jobStores.abstractJobStore import (NoSuchJobException,
                                              NoSuchFileException)
 from toil.jobStores.fileJobStore import FileJobStore
+from toil.jobStores.packedFileJobStore import PackedFileJobStore
 from toil.statsAndLogging import StatsAndLogging
 from toil.test import (ToilTest,
                        needs_aws_s3,
@@ -556,6 +559,123 @@ class AbstractJobStoreTest(object):
             for job in jobs:
                 self.assertTrue(jobstore.exists(job.jobStoreID))
 
+        @travis_test
+        def testBatchFilesAndJobs(self):
+            """Test that a batch writes its files and jobs together, and nothing on failure."""
+            jobstore = self.jobstore_initialized
+            jobs = []
+            fileIDs = []
+            with jobstore.batch():
+                for i in range(20):
+                    job = JobDescription(command='job%d' % i,
+                                         requirements=self.parentJobReqs,
+                                         jobName='test-batchFiles', unitName='onJobStore')
+                    jobstore.assignID(job)
+                    with jobstore.writeFileStream(job.jobStoreID, cleanup=True) as (f, fileID):
+                        f.write(('body%d' % i).encode('utf-8'))
+                    fileIDs.append(fileID)
+                    jobstore.create(job)
+                    jobs.append(job)
+            loaded = jobstore.loadMany(job.jobStoreID for job in jobs)
+            for i, (job, fileID) in enumerate(zip(jobs, fileIDs)):
+                self.assertEqual(loaded[job.jobStoreID].command, job.command)
+                with jobstore.readFileStream(fileID) as f:
+                    self.assertEqual(f.read(), ('body%d' % i).encode('utf-8'))
+
+            abandoned = self.arbitraryJob()
+            with self.assertRaises(RuntimeError):
+                with jobstore.batch():
+                    jobstore.assignID(abandoned)
+                    jobstore.create(abandoned)
+                    raise RuntimeError('abandon the batch')
+            self.assertFalse(jobstore.exists(abandoned.jobStoreID))
+            # The job store goes back to writing straight away.
+            jobstore.create(abandoned)
+            self.assertTrue(jobstore.exists(abandoned.jobStoreID))
+
+        @travis_test
+        def testLoadMany(self):
+            """Test loading many jobs at once, and through a different job store instance."""
+            jobstore = self.jobstore_initialized
+            jobs = []
+            for i in range(45):
+                job = JobDescription(command='job%d' % i,
+                                     requirements=self.parentJobReqs,
+                                     jobName='test-loadMany', unitName='onJobStore')
+                jobstore.assignID(job)
+                jobstore.create(job)
+                jobs.append(job)
+            loaded = self.jobstore_resumed_noconfig.loadMany(job.jobStoreID for job in jobs)
+            self.assertEqual(set(loaded), {job.jobStoreID for job in jobs})
+            for job in jobs:
+                self.assertEqual(loaded[job.jobStoreID].command, job.command)
+            self.assertEqual(jobstore.loadMany([]), {})
+            self.assertEqual({job.jobStoreID for job in jobstore.jobs()}, {job.jobStoreID for job in jobs})
+
+            # Jobs that are gone are left out rather than raising
+            for job in jobs[::2]:
+                jobstore.delete(job.jobStoreID)
+            with self.assertRaises(NoSuchJobException):
+                jobstore.loadMany(job.jobStoreID for job in jobs)
+            loaded = self.jobstore_resumed_noconfig.loadExisting(job.jobStoreID for job in jobs)
+            self.assertEqual(set(loaded), {job.jobStoreID for job in jobs[1::2]})
+
+        @travis_test
+        def testDeleteMany(self):
+            """Test deleting many jobs at once, along with the files they own."""
+            jobstore = self.jobstore_initialized
+            jobs = []
+            for i in range(30):
+                job = self.arbitraryJob()
+                jobstore.assignID(job)
+                jobstore.create(job)
+                jobs.append(job)
+            ownedFileID = jobstore.getEmptyFileStoreID(jobs[0].jobStoreID, cleanup=True)
+            # Jobs that are already gone are skipped
+            jobstore.delete(jobs[1].jobStoreID)
+            jobstore.deleteMany(job.jobStoreID for job in jobs[:20])
+            self.assertEqual({job.jobStoreID for job in jobstore.jobs()}, {job.jobStoreID for job in jobs[20:]})
+            self.assertFalse(jobstore.fileExists(ownedFileID))
+            jobstore.deleteMany([])
+
+        @slow
+        def testCleanOrphans(self):
+            """Test that clean() deletes unreachable jobs and repairs reachable ones."""
+            jobstore = self.jobstore_initialized
+            rootJob = self.arbitraryJob()
+            jobstore.assignID(rootJob)
+            jobstore.create(rootJob)
+            child = self.arbitraryJob()
+            jobstore.assignID(child)
+            # Make it look like the child has been tried before
+            child.remainingTryCount = 1
+            jobstore.create(child)
+            rootJob.addChild(child.jobStoreID)
+            rootJob.command = None
+            jobstore.update(rootJob)
+            jobstore.setRootJob(rootJob.jobStoreID)
+            # Make more orphans than go in one batch
+            orphans = []
+            for i in range(jobstore.jobsPerCleanBatch + 10):
+                orphan = self.arbitraryJob()
+                jobstore.assignID(orphan)
+                jobstore.create(orphan)
+                orphans.append(orphan)
+            ownedFileID = jobstore.getEmptyFileStoreID(orphans[0].jobStoreID, cleanup=True)
+
+            jobstore.clean()
+            self.assertEqual({job.jobStoreID for job in jobstore.jobs()}, {rootJob.jobStoreID, child.jobStoreID})
+            self.assertFalse(jobstore.fileExists(ownedFileID))
+            self.assertEqual(jobstore.load(child.jobStoreID).remainingTryCount, self.config.retryCount + 1)
+
+            # Clean again from a cache, with a new orphan
+            orphan = self.arbitraryJob()
+            jobstore.assignID(orphan)
+            jobstore.create(orphan)
+            jobstore.clean({job.jobStoreID: job for job in jobstore.jobs()})
+            self.assertFalse(jobstore.exists(orphan.jobStoreID))
+            self.assertTrue(jobstore.exists(child.jobStoreID))
+
         @travis_test
         def testGrowingAndShrinkingJob(self):
             """Make sure jobs update correctly if they grow/shrink."""
@@ -1035,6 +1155,49 @@ class AbstractJobStoreTest(object):
             finally:
                 os.unlink(path)
 
+        @travis_test
+        def testDeduplicateFiles(self):
+            """Test that files with the same content stay independent when deduplicated."""
+            jobstore = self.jobstore_initialized
+            jobstore.config.deduplicateFiles = True
+            job = self.arbitraryJob()
+            jobstore.assignID(job)
+            jobstore.create(job)
+            path = os.path.join(self._createTempDir(), 'file')
+            with open(path, 'wb') as f:
+                f.write(b'same content')
+            fileIDs = [jobstore.writeFile(path, job.jobStoreID, cleanup=True), jobstore.writeFile(path)]
+            with jobstore.writeFileStream() as (stream, streamedID):
+                stream.write(b'same content')
+            fileIDs.append(streamedID)
+            for fileID in fileIDs:
+                with jobstore.readFileStream(fileID) as stream:
+                    self.assertEqual(stream.read(), b'same content')
+
+            # Changing a file doesn't change the others
+            with jobstore.updateFileStream(fileIDs[2]) as stream:
+                stream.write(b'other content')
+            for fileID in fileIDs[:2]:
+                with jobstore.readFileStream(fileID) as stream:
+                    self.assertEqual(stream.read(), b'same content')
+            # Nor does deleting one, directly or with its job
+            jobstore.deleteFile(fileIDs[1])
+            self.assertFalse(jobstore.fileExists(fileIDs[1]))
+            with jobstore.readFileStream(fileIDs[0]) as stream:
+                self.assertEqual(stream.read(), b'same content')
+            jobstore.delete(job.jobStoreID)
+            self.assertFalse(jobstore.fileExists(fileIDs[0]))
+            with jobstore.readFileStream(fileIDs[2]) as stream:
+                self.assertEqual(stream.read(), b'other content')
+            # Content written again after its last user is gone comes back
+            with open(path, 'wb') as f:
+                f.write(b'same content')
+            jobstore.updateFile(fileIDs[2], path)
+            with jobstore.readFileStream(fileIDs[2]) as stream:
+                self.assertEqual(stream.read(), b'same content')
+            jobstore.deleteFile(fileIDs[2])
+            self.assertFalse(jobstore.fileExists(fileIDs[2]))
+
         def _largeLogEntrySize(self):
             """
             Sub-classes may want to override these in order to maximize test coverage
@@ -1144,6 +1307,243 @@ class FileJobStoreTest(AbstractJobStoreTest.Test):
         finally:
             os.unlink(path)
 
+    @travis_test
+    def testBatchSegmentRecovery(self):
+        """Test that jobs from a batch whose writer died while unpacking it are recovered."""
+        jobstore = self.jobstore_initialized
+        jobs = []
+        for i in range(5):
+            job = JobDescription(command='job%d' % i,
+                                 requirements=self.parentJobReqs,
+                                 jobName='test-segment', unitName='onJobStore')
+            jobstore.assignID(job)
+            jobs.append(job)
+
+        # Stop the writer after it has committed the segment.
+        with patch.object(FileJobStore, '_unpackJobSegment'):
+            with jobstore.batch():
+                for job in jobs:
+                    jobstore.create(job)
+        for job in jobs:
+            self.assertFalse(jobstore.exists(job.jobStoreID))
+        # Also leave an incomplete segment, which should just go away.
+        with open(os.path.join(jobstore.segmentsDir, 'segment-incomplete.new'), 'wb') as f:
+            f.write(b'junk')
+
+        self.assertEqual({job.jobStoreID for job in self.jobstore_resumed_noconfig.jobs()},
+                         {job.jobStoreID for job in jobs})
+        self.assertEqual(os.listdir(jobstore.segmentsDir), [])
+        for job in jobs:
+            self.assertEqual(jobstore.load(job.jobStoreID).command, job.command)
+
+    @travis_test
+    def testBatchSegmentRecoveryKeepsNewerJobs(self):
+        """Test that recovering a batch finishes half-written jobs but doesn't undo updates."""
+        jobstore = self.jobstore_initialized
+        jobs = []
+        for i in range(3):
+            job = JobDescription(command='job%d' % i,
+                                 requirements=self.parentJobReqs,
+                                 jobName='test-segment', unitName='onJobStore')
+            jobstore.assignID(job)
+            jobs.append(job)
+        with patch.object(FileJobStore, '_unpackJobSegment'):
+            with jobstore.batch():
+                for job in jobs:
+                    jobstore.create(job)
+        # Update a job after the segment was written, as if it had been
+        # unpacked before the writer died and then run on.
+        jobs[0].command = 'updated'
+        jobstore.update(jobs[0])
+        # And leave another half written, as if the writer died writing it.
+        with open(jobstore._getJobFileName(jobs[1].jobStoreID), 'wb') as f:
+            f.write(jobstore._serializeJob(jobs[1])[:10])
+
+        self.assertEqual(len(list(self.jobstore_resumed_noconfig.jobs())), 3)
+        self.assertEqual(jobstore.load(jobs[0].jobStoreID).command, 'updated')
+        self.assertEqual(jobstore.load(jobs[1].jobStoreID).command, 'job1')
+        self.assertEqual(jobstore.load(jobs[2].jobStoreID).command, 'job2')
+
+    @travis_test
+    def testBatchSegmentRecoverySkipsLiveWriters(self):
+        """Test that a segment still being written by a live process is left alone."""
+        jobstore = self.jobstore_initialized
+        os.makedirs(jobstore.segmentsDir, exist_ok=True)
+        segmentPath = os.path.join(jobstore.segmentsDir, 'segment-live.new')
+        holder = subprocess.Popen([sys.executable, '-c',
+                                   'import fcntl, os, sys\n'
+                                   'fd = os.open(sys.argv[1], os.O_WRONLY | os.O_CREAT)\n'
+                                   'fcntl.lockf(fd, fcntl.LOCK_EX)\n'
+                                   'print("locked", flush=True)\n'
+                                   'sys.stdin.read()\n', segmentPath],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            self.assertEqual(holder.stdout.readline().strip(), b'locked')
+            list(self.jobstore_resumed_noconfig.jobs())
+            self.assertTrue(os.path.exists(segmentPath))
+        finally:
+            holder.stdin.close()
+            holder.wait()
+        # Once its writer is gone it is cleaned up.
+        list(self.jobstore_resumed_noconfig.jobs())
+        self.assertFalse(os.path.exists(segmentPath))
+
+    @travis_test
+    def testDeduplicatedFilesShareContent(self):
+        """Test that files with the same content share one stored copy."""
+        jobstore = self.jobstore_initialized
+        jobstore.config.deduplicateFiles = True
+        job = self.arbitraryJob()
+        jobstore.assignID(job)
+        jobstore.create(job)
+        path = os.path.join(self._createTempDir(), 'file')
+        with open(path, 'wb') as f:
+            f.write(b'same content')
+        fileIDs = [jobstore.writeFile(path, job.jobStoreID, cleanup=True), jobstore.writeFile(path)]
+        with jobstore.writeFileStream() as (stream, streamedID):
+            stream.write(b'same content')
+        fileIDs.append(streamedID)
+        contentPath = jobstore._getContentPath(hashlib.sha256(b'same content').hexdigest())
+        for fileID in fileIDs:
+            self.assertTrue(os.path.samefile(jobstore._getFilePathFromId(fileID), contentPath))
+
+        # The content stays until nothing uses it
+        jobstore.deleteFile(fileIDs[1])
+        jobstore.delete(job.jobStoreID)
+        self.assertTrue(os.path.exists(contentPath))
+        jobstore.deleteFile(fileIDs[2])
+        self.assertFalse(os.path.exists(contentPath))
+        self.assertFalse(os.path.exists(contentPath + '.refs'))
+        self.assertEqual([name for name in os.listdir(jobstore.contentDir) if name.startswith('tmp')], [])
+
+    @travis_test
+    def testMutableReadOfDeduplicatedFile(self):
+        """Test that changing a file read from the store leaves files with the same content alone."""
+        jobstore = self.jobstore_initialized
+        jobstore.config.deduplicateFiles = True
+        tempDir = self._createTempDir()
+        path = os.path.join(tempDir, 'file')
+        with open(path, 'wb') as f:
+            f.write(b'same content')
+        fileIDs = [jobstore.writeFile(path), jobstore.writeFile(path)]
+        localPath = os.path.join(tempDir, 'read')
+        jobstore.readFile(fileIDs[0], localPath, symlink=False)
+        with open(localPath, 'r+b') as f:
+            f.write(b'SAME')
+        for fileID in fileIDs:
+            with jobstore.readFileStream(fileID) as stream:
+                self.assertEqual(stream.read(), b'same content')
+
+
+class PackedFileJobStoreTest(FileJobStoreTest):
+    def _createJobStore(self):
+        return PackedFileJobStore(self.namePrefix, fanOut=2)
+
+    def _makeJobs(self, jobstore, count, name):
+        jobs = []
+        for i in range(count):
+            job = JobDescription(command='%s%d' % (name, i),
+                                 requirements=self.parentJobReqs,
+                                 jobName=name, unitName='onJobStore')
+            jobstore.assignID(job)
+            jobs.append(job)
+        return jobs
+
+    # The packed store keeps its segments under an index instead, and they
+    # are covered by testBatchSegmentRecovery.
+    testBatchSegmentRecoveryKeepsNewerJobs = None
+    testBatchSegmentRecoverySkipsLiveWriters = None
+
+    @travis_test
+    def testBatchSegmentRecovery(self):
+        """Test that a batch whose writer died before indexing it leaves no jobs behind."""
+        jobstore = self.jobstore_initialized
+        survivor = self._makeJobs(jobstore, 1, 'survivor')[0]
+        jobstore.create(survivor)
+        jobs = self._makeJobs(jobstore, 5, 'test-segment')
+        # Die after the records are appended but before the index is committed.
+        appendRecords = PackedFileJobStore._appendRecords
+
+        def appendAndDie(store, connection, records):
+            appendRecords(store, connection, records)
+            raise RuntimeError('killed')
+
+        with patch.object(PackedFileJobStore, '_appendRecords', appendAndDie):
+            with self.assertRaises(RuntimeError):
+                with jobstore.batch():
+                    for job in jobs:
+                        jobstore.create(job)
+        for job in jobs:
+            self.assertFalse(jobstore.exists(job.jobStoreID))
+        # Leave a torn record at the end, as a crash during an append would.
+        segment, = jobstore._segmentFiles()
+        with open(jobstore._segmentPath(segment), 'ab') as f:
+            f.write(b'\x01\x02\x03')
+        # Nothing but the survivor comes back even when the index is rebuilt.
+        os.remove(jobstore.indexPath)
+        resumed = self._createJobStore()
+        resumed.resume()
+        self.assertEqual([job.jobStoreID for job in resumed.jobs()], [survivor.jobStoreID])
+        resumed.create(jobs[0])
+        self.assertEqual(len(list(resumed.jobs())), 2)
+
+    @travis_test
+    def testIndexRecovery(self):
+        """Test that the latest version of each job survives losing the index."""
+        jobstore = self.jobstore_initialized
+        jobs = self._makeJobs(jobstore, 10, 'test-index')
+        with jobstore.batch():
+            for job in jobs:
+                jobstore.create(job)
+        jobs[0].command = 'updated'
+        jobstore.update(jobs[0])
+        jobstore.delete(jobs[1].jobStoreID)
+        with open(jobstore.indexPath, 'r+b') as f:
+            f.write(b'not an index at all')
+
+        resumed = self._createJobStore()
+        resumed.resume()
+        self.assertEqual({job.jobStoreID for job in resumed.jobs()}, {job.jobStoreID for job in jobs[:1] + jobs[2:]})
+        self.assertEqual(resumed.load(jobs[0].jobStoreID).command, 'updated')
+        self.assertFalse(resumed.exists(jobs[1].jobStoreID))
+        # New writes don't get older sequence numbers than what was recovered.
+        jobs[0].command = 'updated again'
+        resumed.update(jobs[0])
+        os.remove(resumed.indexPath)
+        again = self._createJobStore()
+        again.resume()
+        self.assertEqual(again.load(jobs[0].jobStoreID).command, 'updated again')
+
+    @travis_test
+    def testCompaction(self):
+        """Test that compaction keeps live jobs and gets rid of dead records."""
+        writer = self.jobstore_initialized
+        jobs = self._makeJobs(writer, 20, 'test-compact')
+        with writer.batch():
+            for job in jobs:
+                writer.create(job)
+        for job in jobs[5:]:
+            writer.delete(job.jobStoreID)
+        before = sum(os.path.getsize(writer._segmentPath(name)) for name in writer._segmentFiles())
+
+        compactor = self._createJobStore()
+        compactor.resume()
+        self.assertGreater(compactor.compact(), 0)
+        after = sum(os.path.getsize(writer._segmentPath(name)) for name in writer._segmentFiles())
+        self.assertLess(after, before)
+        self.assertEqual({job.jobStoreID for job in compactor.jobs()}, {job.jobStoreID for job in jobs[:5]})
+
+        # The writer notices its segment is gone and carries on in a new one.
+        jobs[0].command = 'after compaction'
+        writer.update(jobs[0])
+        self.assertEqual(compactor.load(jobs[0].jobStoreID).command, 'after compaction')
+        os.remove(writer.indexPath)
+        rebuilt = self._createJobStore()
+        rebuilt.resume()
+        self.assertEqual(rebuilt.load(jobs[0].jobStoreID).command, 'after compaction')
+        self.assertEqual(len(list(rebuilt.jobs())), 5)
+
+
 @needs_google
 class GoogleJobStoreTest(AbstractJobStoreTest.Test):
     projectID = os.getenv('TOIL_GOOGLE_PROJECTID')
@@ -1204,6 +1604,29 @@ class AWSJobStoreTest(AbstractJobStoreTest.Test):
         assert isinstance(self.jobstore_initialized, AWSJobStore)  # type hinting
         self.jobstore_initialized.destroy()
 
+    def testConnectionsPerThread(self):
+        """Test that each thread talks to AWS through connections of its own."""
+        jobStore = self.jobstore_initialized
+        job = self.arbitraryJob()
+        jobStore.assignID(job)
+        jobStore.create(job)
+        seen = {}
+
+        def useJobStore():
+            seen['db'], seen['s3'] = jobStore.db, jobStore.s3
+            seen['jobsDomain'], seen['filesBucket'] = jobStore.jobsDomain, jobStore.filesBucket
+            seen['job'] = jobStore.load(job.jobStoreID)
+
+        thread = Thread(target=useJobStore)
+        thread.start()
+        thread.join()
+        self.assertIsNot(seen['db'], jobStore.db)
+        self.assertIsNot(seen['s3'], jobStore.s3)
+        self.assertIs(seen['jobsDomain'].connection, seen['db'])
+        self.assertIs(seen['filesBucket'].connection, seen['s3'])
+        self.assertEqual(seen['jobsDomain'].name, jobStore.jobsDomain.name)
+        self.assertEqual(seen['job'].jobStoreID, job.jobStoreID)
+
     def testSDBDomainsDeletedOnFailedJobstoreBucketCreation(self):
         """
         This test ensures that SDB domains bound to a jobstore are deleted if the jobstore bucket
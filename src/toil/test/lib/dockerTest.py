@@ -19,13 +19,16 @@ import sys
 import uuid
 import docker
 from threading import Thread
-from docker.errors import ContainerError
+from types import SimpleNamespace
+from unittest.mock import patch
+from docker.errors import ContainerError, NotFound
 
 from toil.job import Job
 from toil.leader import FailedJobsException
-from toil.test import ToilTest, slow, needs_docker
+from toil.test import ToilTest, slow, needs_docker, travis_test
 from toil.lib.docker import apiDockerCall, containerIsRunning, dockerKill
 from toil.lib.docker import FORGO, STOP, RM
+from toil.lib.docker import ContainerPool, cleanupContainerPool, evictPooledContainers
 
 
 logger = logging.getLogger(__name__)
@@ -321,6 +324,177 @@ class DockerTest(ToilTest):
         self.testDockerLogs(stream=True, demux=True)
 
 
+    def testDockerPool(self, disableCaching=True):
+        options = Job.Runner.getDefaultOptions(os.path.join(self.tempDir, 'jobstore'))
+        options.logLevel = self.dockerTestLogLevel
+        options.workDir = self.tempDir
+        options.clean = 'always'
+        options.disableCaching = disableCaching
+        A = Job.wrapJobFn(_testDockerPoolFn, working_dir=self.tempDir)
+        self.assertEqual(Job.Runner.startToil(A, options), 1)
+        client = docker.from_env(version='auto')
+        self.assertEqual(client.containers.list(all=True, filters={'name': 'toil-pool-'}), [])
+
+
+class FakeContainer(object):
+    def __init__(self, client, name, kwargs):
+        self.client = client
+        self.id = self.name = name
+        self.kwargs = kwargs
+        self.status = 'running'
+        self.execs = []
+        self.exitCode = 0
+
+    def exec_run(self, argv, **kwargs):
+        self.execs.append((argv, kwargs))
+        return SimpleNamespace(exit_code=self.exitCode, output=b'out')
+
+    def remove(self, force=False):
+        del self.client.containers.byName[self.name]
+
+
+class FakeContainers(object):
+    def __init__(self, client):
+        self.client = client
+        self.byName = {}
+        self.started = []
+
+    def get(self, name):
+        try:
+            return self.byName[name]
+        except KeyError:
+            raise NotFound(name)
+
+    def run(self, name, **kwargs):
+        assert name not in self.byName
+        self.byName[name] = FakeContainer(self.client, name, kwargs)
+        self.started.append(name)
+        return self.byName[name]
+
+
+class FakeAPIClient(object):
+    def __init__(self, client):
+        self.client = client
+        # Map from exec ID to the container it runs in
+        self.execs = {}
+
+    def exec_create(self, containerID, argv, **kwargs):
+        container = self.client.containers.get(containerID)
+        container.execs.append((argv, kwargs))
+        execID = str(len(self.execs))
+        self.execs[execID] = container
+        return {'Id': execID}
+
+    def exec_start(self, execID, stream=False, demux=False):
+        return iter([b'o', b'ut'])
+
+    def exec_inspect(self, execID):
+        return {'ExitCode': self.execs[execID].exitCode}
+
+
+class FakeDockerClient(object):
+    """
+    Stands in for the client from the docker module, with containers that only
+    remember what was run in them.
+    """
+
+    def __init__(self):
+        self.containers = FakeContainers(self)
+        self.api = FakeAPIClient(self)
+        self.images = SimpleNamespace(get=lambda image: SimpleNamespace(
+            attrs={'Config': {'Entrypoint': ['/entry'], 'Cmd': ['default']}}))
+
+
+@travis_test
+class ContainerPoolTest(ToilTest):
+    """
+    Tests the pool of warm containers against a fake Docker.
+    """
+
+    def setUp(self):
+        super(ContainerPoolTest, self).setUp()
+        self.workflowDir = self._createTempDir()
+        self.poolDir = os.path.join(self.workflowDir, 'dockerPool')
+        self.client = FakeDockerClient()
+        self.volumes = {self.workflowDir: {'bind': '/data', 'mode': 'rw'}}
+
+    def _pool(self, **kwargs):
+        return ContainerPool(self.poolDir, self.client, **kwargs)
+
+    def testReuse(self):
+        pool = self._pool()
+        with pool.container('ubuntu', self.volumes, {}) as first:
+            pass
+        with pool.container('ubuntu', self.volumes, {}) as second:
+            pass
+        with pool.container('ubuntu', self.volumes, {'privileged': True}) as third:
+            pass
+        self.assertIs(first, second)
+        self.assertIsNot(first, third)
+        self.assertEqual(len(self.client.containers.started), 2)
+
+    def testIdleEviction(self):
+        pool = self._pool(idleTimeout=0)
+        with pool.container('ubuntu', self.volumes, {}):
+            # Containers in use are never removed.
+            pool.evict()
+            self.assertEqual(len(self.client.containers.byName), 1)
+        pool.evict()
+        self.assertEqual(self.client.containers.byName, {})
+
+    def testSizeLimit(self):
+        pool = self._pool(maxContainers=2)
+        names = []
+        for image in ('a', 'b', 'a', 'c'):
+            with pool.container(image, self.volumes, {}) as container:
+                names.append(container.name)
+        # The least recently used container made room for the last one.
+        self.assertEqual(sorted(self.client.containers.byName), sorted([names[0], names[3]]))
+
+    def testCleanup(self):
+        with self._pool().container('ubuntu', self.volumes, {}):
+            pass
+        with patch('docker.from_env', return_value=self.client):
+            evictPooledContainers(self.poolDir)
+            self.assertEqual(len(self.client.containers.byName), 1)
+            cleanupContainerPool(self.workflowDir)
+        self.assertEqual(self.client.containers.byName, {})
+        self.assertFalse(os.path.exists(self.poolDir))
+
+    def testApiDockerCall(self):
+        deferred = []
+        job = SimpleNamespace(description='job',
+                              fileStore=SimpleNamespace(workFlowDir=self.workflowDir),
+                              defer=lambda function, *args: deferred.append((function, args)))
+        # Each call has its own working directory, like jobs do
+        workingDirs = [os.path.join(self.workflowDir, 'job%i' % i) for i in range(4)]
+        with patch('docker.from_env', return_value=self.client):
+            for workingDir in workingDirs[:2]:
+                out = apiDockerCall(job, image='ubuntu', working_dir=workingDir,
+                                    parameters=['echo', 'hello world'], reuseContainer=True)
+                self.assertEqual(out, b'out')
+            apiDockerCall(job, image='ubuntu', working_dir=workingDirs[2], reuseContainer=True)
+            container, = self.client.containers.byName.values()
+            self.assertEqual([argv for argv, _ in container.execs],
+                             [['/entry', 'echo', 'hello world']] * 2 + [['/entry', 'default']])
+            self.assertEqual([kwargs['workdir'] for _, kwargs in container.execs], workingDirs[:3])
+            # The container sees the working directories through the workflow directory
+            self.assertEqual(container.kwargs['volumes'],
+                             {self.workflowDir: {'bind': self.workflowDir, 'mode': 'rw'}})
+            self.assertEqual(b''.join(apiDockerCall(job, image='ubuntu', working_dir=workingDirs[3],
+                                                    parameters=['cat'], reuseContainer=True,
+                                                    stream=True)), b'out')
+            container.exitCode = 1
+            with self.assertRaises(ContainerError):
+                apiDockerCall(job, image='ubuntu', working_dir=workingDirs[0],
+                              parameters=['false'], reuseContainer=True)
+            with self.assertRaises(ContainerError):
+                list(apiDockerCall(job, image='ubuntu', working_dir=workingDirs[0],
+                                   parameters=['false'], reuseContainer=True, stream=True))
+            self.assertEqual(len(self.client.containers.started), 1)
+        self.assertEqual(deferred[0], (evictPooledContainers, (self.poolDir,)))
+
+
 def _testDockerCleanFn(job,
                        working_dir,
                        detached=None,
@@ -361,6 +535,18 @@ def _testDockerCleanFn(job,
                   privileged=True)
 
 
+def _testDockerPoolFn(job, working_dir):
+    """Return how many containers ran two commands. Should be 1."""
+    for _ in range(2):
+        apiDockerCall(job,
+                      image='ubuntu:latest',
+                      working_dir=working_dir,
+                      parameters=['hostname'],
+                      reuseContainer=True)
+    client = docker.from_env(version='auto')
+    return len(client.containers.list(filters={'name': 'toil-pool-'}))
+
+
 def _testDockerPipeChainFn(job):
     """Return the result of a simple pipe chain.  Should be 2."""
     parameters = [['printf', 'x\n y\n'], ['wc', '-l']]
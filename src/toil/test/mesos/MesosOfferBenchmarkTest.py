@@ -0,0 +1,164 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import os
+import time
+from unittest.mock import patch
+
+from toil.common import Config
+from toil.job import JobDescription
+from toil.test import ToilTest, needs_mesos_installed, slow, travis_test
+
+logger = logging.getLogger(__name__)
+
+MiB = 1024 * 1024
+
+
+class FakeDriver(object):
+    """
+    Stands in for the Mesos scheduler driver, and remembers what the batch
+    system did with each offer.
+    """
+
+    def __init__(self):
+        # Map from offer ID to the tasks launched with it
+        self.launched = {}
+        self.declined = []
+
+    def launchTasks(self, offerID, tasks):
+        self.launched[offerID.value] = tasks
+
+    def declineOffer(self, offerID):
+        self.declined.append(offerID.value)
+
+
+@needs_mesos_installed
+class MesosOfferTest(ToilTest):
+    """
+    Drives the Mesos batch system's offer callback with synthetic offers, to
+    check how it packs jobs into them and to time it.
+    """
+
+    def setUp(self):
+        super().setUp()
+        from toil.batchSystems.mesos.batchSystem import MesosBatchSystem
+        config = Config()
+        config.workflowID = 'test'
+        config.workDir = self._createTempDir()
+        config.jobStore = 'file:' + self._createTempDir('jobStore')
+        config.mesosMasterAddress = 'localhost:5050'
+        with patch.object(MesosBatchSystem, '_startDriver'):
+            self.batchSystem = MesosBatchSystem(config, maxCores=64, maxMemory=256 * 1024 * MiB,
+                                                maxDisk=1024 * 1024 * MiB)
+        self.driver = FakeDriver()
+        self.offerCount = 0
+
+    def _issue(self, count, cores=1, memory=MiB * 1024, disk=MiB * 1024, preemptable=False):
+        job = JobDescription(requirements=dict(cores=cores, memory=memory, disk=disk,
+                                               preemptable=preemptable),
+                             jobName='bench', command='do nothing')
+        return [self.batchSystem.issueBatchJob(job) for _ in range(count)]
+
+    def _offer(self, cores, memory, disk, preemptable=False):
+        """
+        Make an offer, with memory and disk in MiB.
+        """
+        import addict
+        self.offerCount += 1
+        offer = addict.Dict()
+        offer.id.value = 'offer-%i' % self.offerCount
+        offer.agent_id.value = 'agent-%i' % self.offerCount
+        offer.hostname = 'localhost'
+        offer.resources = []
+        for name, value in (('cpus', cores), ('mem', memory), ('disk', disk)):
+            resource = addict.Dict()
+            resource.name = name
+            resource.type = 'SCALAR'
+            resource.scalar.value = value
+            offer.resources.append(resource)
+        attribute = addict.Dict()
+        attribute.name = 'preemptable'
+        attribute.text.value = str(preemptable)
+        offer.attributes = [attribute]
+        return offer
+
+    def _launchedIDs(self, offer):
+        return [int(task.task_id.value) for task in self.driver.launched.get(offer.id.value, [])]
+
+    @travis_test
+    def testPacking(self):
+        big = self._issue(2, cores=4)
+        small = self._issue(10, cores=1)
+        offer = self._offer(cores=7, memory=64 * 1024, disk=64 * 1024)
+        self.batchSystem.resourceOffers(self.driver, [offer])
+        # The big jobs go first, and the small ones fill in the space they
+        # leave, oldest first.
+        self.assertEqual(self._launchedIDs(offer), big[:1] + small[:3])
+        self.assertEqual(sorted(self.batchSystem.getIssuedBatchJobIDs()), sorted(big + small))
+        self.assertEqual(sorted(self.batchSystem.runningJobMap), sorted(big[:1] + small[:3]))
+
+    @travis_test
+    def testMemoryLimits(self):
+        jobs = self._issue(10, cores=0.5, memory=3 * 1024 * MiB)
+        offer = self._offer(cores=8, memory=10 * 1024, disk=64 * 1024)
+        self.batchSystem.resourceOffers(self.driver, [offer])
+        self.assertEqual(self._launchedIDs(offer), jobs[:3])
+
+    @travis_test
+    def testPreemptableOffers(self):
+        nonPreemptable = self._issue(2, cores=1)
+        preemptable = self._issue(2, cores=1, preemptable=True)
+        offer = self._offer(cores=8, memory=64 * 1024, disk=64 * 1024, preemptable=True)
+        self.batchSystem.resourceOffers(self.driver, [offer])
+        self.assertEqual(self._launchedIDs(offer), preemptable)
+        offer = self._offer(cores=8, memory=64 * 1024, disk=64 * 1024)
+        self.batchSystem.resourceOffers(self.driver, [offer])
+        self.assertEqual(self._launchedIDs(offer), nonPreemptable)
+
+    @travis_test
+    def testDeclineUnusable(self):
+        self._issue(1, cores=16)
+        offer = self._offer(cores=8, memory=64 * 1024, disk=64 * 1024)
+        self.batchSystem.resourceOffers(self.driver, [offer])
+        self.assertEqual(self.driver.declined, [offer.id.value])
+
+    @slow
+    @travis_test
+    def testOfferThroughput(self):
+        jobCount = int(os.environ.get('TOIL_TEST_MESOS_OFFER_BENCHMARK_JOBS', 20000))
+        # Jobs of a few shapes, as a real workflow would have
+        shapes = [dict(cores=1, memory=MiB * 1024), dict(cores=2, memory=MiB * 4096),
+                  dict(cores=0.5, memory=MiB * 512), dict(cores=1, memory=MiB * 2048, preemptable=True)]
+        for shape in shapes:
+            self._issue(jobCount // len(shapes), **shape)
+        queued = len(self.batchSystem.getIssuedBatchJobIDs())
+
+        offers = 0
+        start = time.time()
+        while self.batchSystem.jobQueues.jobTypes() and offers < jobCount:
+            batch = [self._offer(cores=32, memory=128 * 1024, disk=1024 * 1024, preemptable=i % 2 == 0)
+                     for i in range(10)]
+            self.batchSystem.resourceOffers(self.driver, batch)
+            offers += len(batch)
+        elapsed = max(time.time() - start, 1e-6)
+
+        launched = sum(len(tasks) for tasks in self.driver.launched.values())
+        logger.info('Handled %i offers in %.2f seconds (%.1f offers/sec), launching %i tasks '
+                    '(%.1f tasks/sec)', offers, elapsed, offers / elapsed, launched, launched / elapsed)
+        self.assertEqual(launched, queued)
+        self.assertEqual(len(self.batchSystem.runningJobMap), queued)
+        # No offer was given more than it had
+        for tasks in self.driver.launched.values():
+            self.assertLessEqual(sum(task.resources[0].scalar.value for task in tasks), 32)
+            self.assertLessEqual(sum(task.resources[2].scalar.value for task in tasks), 128 * 1024)
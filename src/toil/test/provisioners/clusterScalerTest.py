@@ -512,7 +512,7 @@ class ScalerThreadTest(ToilTest):
                                                 disk=random.choice(list(range(1, x.disk))),
                                                 preemptable=preemptable),
                                             jobName='testClusterScaling', unitName='')
-                        clusterScaler.addCompletedJob(iJ, random.choice(list(range(1, x.wallTime))))
+                        clusterScaler.scaler.runtimes.addCompletedJob(iJ, random.choice(list(range(1, x.wallTime))))
 
             startTime = time.time()
             # Wait while the cluster processes the jobs
@@ -617,7 +617,7 @@ class ScalerThreadTest(ToilTest):
                                         disk=largeNode.cores,
                                         preemptable=False),
                                     jobName='testClusterScaling', unitName='')
-                clusterScaler.addCompletedJob(iJ, random.choice(range(1, 10)))
+                clusterScaler.scaler.runtimes.addCompletedJob(iJ, random.choice(range(1, 10)))
 
             while mock.getNumberOfJobsIssued() > 0 or mock.getNumberOfNodes() > 0:
                 logger.debug("%i nodes currently provisioned" % mock.getNumberOfNodes())
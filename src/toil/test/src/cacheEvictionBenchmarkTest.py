@@ -0,0 +1,180 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import os
+import random
+import sqlite3
+
+from toil.fileStores import FileID
+from toil.fileStores.cachingFileStore import (CacheEvictionPolicy,
+                                              CachingFileStore,
+                                              evictionPolicies)
+from toil.test import ToilTest, slow, travis_test
+
+logger = logging.getLogger(__name__)
+
+MiB = 1024 * 1024
+
+
+class ArbitraryEvictionPolicy(CacheEvictionPolicy):
+    """
+    Evicts files in whatever order the database has them, as the cache did
+    before it had eviction policies.
+    """
+    name = 'arbitrary'
+    order = 'files.rowid'
+
+
+class CacheSimulator(object):
+    """
+    Replays file store access logs against a cache database of a fixed size,
+    using the same SQL as the caching file store to choose what to evict.
+    """
+
+    def __init__(self, policy, cacheSize):
+        self.policy = policy
+        self.cacheSize = cacheSize
+        self.con = sqlite3.connect(':memory:')
+        self.cur = self.con.cursor()
+        CachingFileStore._ensureTables(self.con)
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _write(self, operations):
+        CachingFileStore._staticWrite(self.con, self.cur, operations)
+
+    def cachedBytes(self):
+        self.cur.execute('SELECT TOTAL(size) FROM files')
+        return int(self.cur.fetchone()[0])
+
+    def isCached(self, fileID):
+        self.cur.execute('SELECT NULL FROM files WHERE id = ?', (fileID,))
+        return self.cur.fetchone() is not None
+
+    def access(self, fileID):
+        """
+        Read a file through the cache.
+
+        :param FileID fileID: The file to read, which knows its size.
+        """
+        self.clock += 1
+        if self.isCached(fileID):
+            self.hits += 1
+        else:
+            self.misses += 1
+            if fileID.size > self.cacheSize:
+                # It would never fit
+                return
+            neededBytes = self.cachedBytes() + fileID.size - self.cacheSize
+            if neededBytes > 0:
+                victims = CachingFileStore._chooseEvictionVictims(self.cur, self.policy, neededBytes)
+                self.evictions += len(victims)
+                self._write([('DELETE FROM files WHERE id = ?', (victim[0],)) for victim in victims] +
+                            self.policy.evictionOperations(victims))
+            self._write([('INSERT INTO files (id, path, size, state, owner) VALUES (?, ?, ?, ?, ?)',
+                          (fileID, fileID, fileID.size, 'cached', None))])
+        self._write(self.policy.accessOperations(fileID, self.clock))
+
+    def replay(self, accessLog):
+        """
+        Replay an access log, as kept by AbstractFileStore.logAccess.
+        """
+        for item in accessLog:
+            self.access(item[0])
+
+    def hitRate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+class CacheEvictionTest(ToilTest):
+    """
+    Tests the cache eviction policies, and compares their hit rates on a
+    simulated workload.
+    """
+
+    def _simulate(self, policyName, cacheSize, accessLog):
+        simulator = CacheSimulator(evictionPolicies[policyName](), cacheSize)
+        simulator.replay(accessLog)
+        return simulator
+
+    @travis_test
+    def testLRU(self):
+        a, b, c = FileID('a', MiB), FileID('b', MiB), FileID('c', MiB)
+        simulator = self._simulate('lru', 2 * MiB, [(a,), (b,), (a, '/tmp/a'), (c,)])
+        self.assertTrue(simulator.isCached('a'))
+        self.assertFalse(simulator.isCached('b'))
+        self.assertTrue(simulator.isCached('c'))
+
+    @travis_test
+    def testLFU(self):
+        a, b, c = FileID('a', MiB), FileID('b', MiB), FileID('c', MiB)
+        simulator = self._simulate('lfu', 2 * MiB, [(a,), (a,), (a,), (b,), (c,)])
+        self.assertTrue(simulator.isCached('a'))
+        self.assertFalse(simulator.isCached('b'))
+        self.assertTrue(simulator.isCached('c'))
+
+    @travis_test
+    def testGreedyDualSize(self):
+        # A popular small file outlasts a big one used more recently
+        small, big, other = FileID('small', MiB), FileID('big', 8 * MiB), FileID('other', 2 * MiB)
+        simulator = self._simulate('gdsf', 10 * MiB, [(small,), (small,), (big,), (other,)])
+        self.assertTrue(simulator.isCached('small'))
+        self.assertFalse(simulator.isCached('big'))
+        self.assertTrue(simulator.isCached('other'))
+        # Files evicted later are worth no less than the ones evicted before
+        simulator.cur.execute("SELECT value FROM properties WHERE name = 'gdClock'")
+        self.assertGreater(simulator.cur.fetchone()[0], 0)
+
+    @travis_test
+    def testBatchEviction(self):
+        simulator = CacheSimulator(evictionPolicies['lru'](), 100 * MiB)
+        for i in range(10):
+            simulator.access(FileID(str(i), MiB))
+        # A file in use can't be evicted
+        simulator._write([('INSERT INTO refs VALUES (?, ?, ?, ?)', ('/tmp/0', '0', 'job', 'immutable'))])
+        victims = CachingFileStore._chooseEvictionVictims(simulator.cur, simulator.policy, int(2.5 * MiB))
+        self.assertEqual([victim[0] for victim in victims], ['1', '2', '3'])
+        # Something is always chosen, if anything can be
+        victims = CachingFileStore._chooseEvictionVictims(simulator.cur, simulator.policy, 0)
+        self.assertEqual([victim[0] for victim in victims], ['1'])
+        # And everything is chosen if that's still not enough
+        victims = CachingFileStore._chooseEvictionVictims(simulator.cur, simulator.policy, 100 * MiB)
+        self.assertEqual(len(victims), 9)
+
+    @slow
+    @travis_test
+    def testHitRates(self):
+        accessCount = int(os.environ.get('TOIL_TEST_CACHE_BENCHMARK_ACCESSES', 20000))
+        fileCount = int(os.environ.get('TOIL_TEST_CACHE_BENCHMARK_FILES', 1000))
+        rng = random.Random(4)
+        # A few big reference files that every job reads, and many smaller
+        # intermediate files, read with a long-tailed popularity.
+        files = [FileID('reference%i' % i, 512 * MiB) for i in range(4)]
+        files += [FileID('file%i' % i, int(rng.lognormvariate(0, 1.5) * MiB) + 1) for i in range(fileCount)]
+        weights = [1.0 / (rank + 1) for rank in range(len(files))]
+        rng.shuffle(weights)
+        for i in range(4):
+            weights[i] = 2.0
+        accessLog = [(fileID, '/tmp/%s' % fileID) for fileID in rng.choices(files, weights, k=accessCount)]
+        cacheSize = sum(fileID.size for fileID in files) // 10
+
+        policies = dict(evictionPolicies, arbitrary=ArbitraryEvictionPolicy)
+        for name, policy in sorted(policies.items()):
+            simulator = CacheSimulator(policy(), cacheSize)
+            simulator.replay(accessLog)
+            logger.info('Policy %s: hit rate %.3f with %i evictions', name, simulator.hitRate(),
+                        simulator.evictions)
+            self.assertLessEqual(simulator.cachedBytes(), cacheSize)
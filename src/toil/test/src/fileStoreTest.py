@@ -23,6 +23,7 @@ from abc import abstractmethod, ABCMeta
 from struct import pack, unpack
 from uuid import uuid4
 
+from toil.common import Toil
 from toil.job import Job
 from toil.fileStores import FileID
 from toil.fileStores.cachingFileStore import IllegalDeletionCacheError, CacheUnbalancedError, CachingFileStore
@@ -579,6 +580,90 @@ class hidden(object):
             job.fileStore.logToMaster('Reading the written file')
             job.fileStore.readGlobalFile(fsID)
 
+        @travis_test
+        def testParallelUploads(self):
+            """
+            Write many files to the cache in one job, and read them back from the job store in a
+            job chained after it, which may run while the first job's files are still uploading.
+            """
+            A = Job.wrapJobFn(self._writeManyFiles, count=50)
+            B = Job.wrapJobFn(self._readManyFilesFromJobStore, fsIDs=A.rv())
+            A.addChild(B)
+            Job.Runner.startToil(A, self.options)
+
+        @staticmethod
+        def _writeManyFiles(job, count):
+            """
+            Write the given number of small files into the cache.
+
+            :return: Job store file IDs for the files, in order
+            """
+            fsIDs = []
+            for i in range(count):
+                with open(os.path.join(job.fileStore.getLocalTempDir(), str(i)), 'w') as f:
+                    f.write(str(i))
+                fsIDs.append(job.fileStore.writeGlobalFile(f.name))
+            return fsIDs
+
+        @staticmethod
+        def _readManyFilesFromJobStore(job, fsIDs):
+            """
+            Read back the files written by _writeManyFiles, bypassing the cache.
+            """
+            for i, fsID in enumerate(fsIDs):
+                with job.fileStore.readGlobalFileStream(fsID) as f:
+                    assert f.read().decode('utf-8') == str(i)
+                assert job.fileStore.getUploadFuture(fsID).done()
+
+        @travis_test
+        def testFailedUploadStaysFailed(self):
+            """
+            Make sure that waiting on a file whose upload failed raises every time, until the
+            upload is tried again.
+            """
+            fileID = str(uuid4())
+            CachingFileStore._uploadPending(fileID)
+            CachingFileStore._uploadFinished(fileID, RuntimeError('upload failed'))
+            for _ in range(2):
+                with self.assertRaises(RuntimeError):
+                    CachingFileStore._uploadFutures[fileID].result()
+            # Trying again gives waiters a new future
+            CachingFileStore._uploadPending(fileID)
+            future = CachingFileStore._uploadFutures[fileID]
+            self.assertFalse(future.done())
+            CachingFileStore._uploadFinished(fileID)
+            self.assertEqual(future.result(), fileID)
+            self.assertNotIn(fileID, CachingFileStore._uploadFutures)
+            # Deleting a file whose upload failed forgets it
+            CachingFileStore._uploadPending(fileID)
+            CachingFileStore._uploadFinished(fileID, RuntimeError('upload failed'))
+            CachingFileStore._uploadFinished(fileID)
+            self.assertNotIn(fileID, CachingFileStore._uploadFutures)
+
+        @travis_test
+        def testPrefetch(self):
+            """
+            Pass an imported file to a job, and make sure the worker fetched it into the cache
+            while loading the job.
+            """
+            workdir = self._createTempDir(purpose='prefetch')
+            with open(os.path.join(workdir, 'input'), 'w') as f:
+                f.write('prefetched')
+            with Toil(self.options) as toil:
+                fsID = toil.importFile('file://' + f.name)
+                toil.start(Job.wrapJobFn(self._readPrefetchedFile, fsID=fsID))
+
+        @staticmethod
+        def _readPrefetchedFile(job, fsID):
+            """
+            Check that a file passed to the job was prefetched, and read it.
+            """
+            assert fsID in job.description.inputFileIDs
+            assert job.fileStore._prefetches[fsID].result()
+            assert job.fileStore.fileIsCached(fsID)
+            with open(job.fileStore.readGlobalFile(fsID)) as f:
+                assert f.read() == 'prefetched'
+
         # writeGlobalFile tests
         
         @travis_test
@@ -0,0 +1,96 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gc
+import logging
+import os
+import pickle
+import time
+import tracemalloc
+
+from toil.job import JobDescription
+from toil.test import ToilTest, slow, travis_test
+
+logger = logging.getLogger(__name__)
+
+
+def makeJobDescriptions(count):
+    """
+    Make a list of JobDescriptions shaped like the ones the leader holds for a
+    wide workflow.
+    """
+    jobs = []
+    for i in range(count):
+        j = JobDescription(command=f'_toil files/for-job/kind-noop/instance-{i}/file-noop /tmp/module',
+                           requirements={'memory': 2**30, 'cores': 1, 'disk': 2**31},
+                           jobName='noop', unitName='', displayName='noop')
+        j.jobStoreID = f'kind-noop/instance-{i}'
+        j.addChild(f'kind-noop/instance-{i}-child')
+        j.predecessorNumber = 1
+        jobs.append(j)
+    return jobs
+
+
+class JobDescriptionBenchmarkTest(ToilTest):
+    """
+    Compares the memory footprint of JobDescriptions and the speed of the
+    binary format against pickling.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.jobCount = int(os.environ.get('TOIL_TEST_JOB_DESCRIPTION_BENCHMARK_JOBS', 20000))
+
+    def _timeEach(self, fn, items):
+        start = time.time()
+        results = [fn(item) for item in items]
+        return max(time.time() - start, 1e-6), results
+
+    @slow
+    @travis_test
+    def testMemoryFootprint(self):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            jobs = makeJobDescriptions(self.jobCount)
+            inMemory = tracemalloc.get_traced_memory()[0] - before
+            # Decoded jobs should not take more room than freshly made ones.
+            before = tracemalloc.get_traced_memory()[0]
+            decoded = [JobDescription.fromBinary(j.toBinary()) for j in jobs]
+            loaded = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        logger.info('JobDescription benchmark: %.0f bytes per job in memory, %.0f bytes per decoded job',
+                    inMemory / self.jobCount, loaded / self.jobCount)
+        self.assertEqual(len(decoded), self.jobCount)
+        self.assertGreater(inMemory, 0)
+
+    @slow
+    @travis_test
+    def testSerializationThroughput(self):
+        jobs = makeJobDescriptions(self.jobCount)
+
+        pickleDumpTime, pickles = self._timeEach(lambda j: pickle.dumps(j, protocol=pickle.HIGHEST_PROTOCOL), jobs)
+        pickleLoadTime, _ = self._timeEach(pickle.loads, pickles)
+        binaryDumpTime, binaries = self._timeEach(JobDescription.toBinary, jobs)
+        binaryLoadTime, _ = self._timeEach(JobDescription.fromBinary, binaries)
+
+        for name, dumpTime, loadTime, data in (('pickle', pickleDumpTime, pickleLoadTime, pickles),
+                                               ('binary', binaryDumpTime, binaryLoadTime, binaries)):
+            logger.info('JobDescription benchmark %s: %.0f encodes/sec, %.0f decodes/sec, %.0f bytes per job',
+                        name, self.jobCount / dumpTime, self.jobCount / loadTime,
+                        sum(len(d) for d in data) / self.jobCount)
+        # The binary format exists to be smaller than pickle.
+        self.assertLess(sum(len(d) for d in binaries), sum(len(d) for d in pickles))
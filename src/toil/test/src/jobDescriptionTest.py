@@ -13,10 +13,13 @@
 # limitations under the License.
 
 from __future__ import absolute_import
+import copy
 import os
+import pickle
 from argparse import ArgumentParser
 from toil.common import Toil
-from toil.job import Job, JobDescription, TemporaryID
+from toil.fileStores import FileID
+from toil.job import Job, JobDescription, ServiceJobDescription, CheckpointJobDescription, TemporaryID
 from toil.test import ToilTest, travis_test
 
 class JobDescriptionTest(ToilTest):
@@ -96,4 +99,119 @@ class JobDescriptionTest(ToilTest):
         # empty list. Nothing left to do!
         j.filterSuccessors(lambda jID: jID != 'followOn')
         self.assertEqual(j.nextSuccessors(), None)
-        
+
+    def _makeBinaryTestJobs(self):
+        """
+        Make one of each kind of JobDescription, with every field filled in.
+        """
+        j = JobDescription(command='_toil abc /some/module', requirements={'memory': '1G', 'cores': 1.5},
+                           jobName='testJob', unitName='unit', displayName='Test Job')
+        j.jobStoreID = 'a/b/jobxyz'
+        j.addChild('child1')
+        j.addChild('child2')
+        j.addFollowOn('followOn')
+        j.addServiceHostJob('service1')
+        j.addServiceHostJob('service2', parentServiceID='service1')
+        j.predecessorNumber = 3
+        j.predecessorsFinished.add('pred')
+        j.filesToDelete.append('file1')
+        j.jobsToDelete.append('deadJob')
+        j.remainingTryCount = 2
+        j.logJobStoreFileID = 'log'
+        j.chainedJobs = ['testJob', 'chained']
+        j.inputFileIDs = [FileID('input1', 0), FileID('input2', 2**40)]
+
+        s = ServiceJobDescription(requirements={'disk': 2**40, 'preemptable': False},
+                                  jobName='service', unitName='s\u00e9rvice')
+        s.jobStoreID = 'service1'
+        s.startJobStoreID = 'start'
+        s.terminateJobStoreID = 'terminate'
+
+        c = CheckpointJobDescription(requirements={'cores': 2, 'preemptable': True}, jobName='checkpoint')
+        c.jobStoreID = 'checkpoint1'
+        c.checkpoint = '_toil def'
+        c.checkpointFilesToDelete.append('checkpointFile')
+        return [j, s, c]
+
+    @travis_test
+    def testBinaryRoundTrip(self):
+        """
+        Tests that JobDescriptions survive encoding in the binary format.
+        """
+        for j in self._makeBinaryTestJobs():
+            data = j.toBinary()
+            self.assertTrue(JobDescription.isBinary(data))
+            self.assertFalse(JobDescription.isBinary(pickle.dumps(j)))
+            j2 = JobDescription.fromBinary(data)
+            self.assertIs(type(j2), type(j))
+            self.assertEqual(j2.__getstate__(), j.__getstate__())
+            self.assertEqual(type(j2._cores), type(j._cores))
+            # Binary and pickle should agree
+            self.assertEqual(pickle.loads(pickle.dumps(j)).__getstate__(), j2.__getstate__())
+            # Names should be interned
+            self.assertIs(j2.jobName, j.jobName)
+            # Input files should keep their sizes
+            self.assertEqual([fileID.size for fileID in j2.inputFileIDs],
+                             [fileID.size for fileID in j.inputFileIDs])
+
+    @travis_test
+    def testBinaryRejects(self):
+        """
+        Tests that the binary format refuses what it cannot represent.
+        """
+        j = JobDescription(requirements={}, jobName='unregistered')
+        # No real ID yet
+        self.assertRaises(TypeError, j.toBinary)
+        j.jobStoreID = 'registered'
+        data = j.toBinary()
+        # Unknown version
+        self.assertRaises(ValueError, JobDescription.fromBinary, data[:3] + bytes([255]) + data[4:])
+        # Truncated
+        self.assertRaises(ValueError, JobDescription.fromBinary, data[:-1])
+        # Ad hoc attributes
+        j.foo_attribute = 'foo'
+        self.assertRaises(TypeError, j.toBinary)
+
+    @travis_test
+    def testCopyAndLegacyPickle(self):
+        """
+        Tests copying and loading state pickled before JobDescriptions had slots.
+        """
+        j = self._makeBinaryTestJobs()[0]
+        j.assignConfig(self.toil.config)
+        for clone in (copy.copy(j), copy.deepcopy(j)):
+            self.assertEqual(clone.__getstate__(), j.__getstate__())
+            self.assertEqual(clone.memory, j.memory)
+        self.assertIs(copy.copy(j).childIDs, j.childIDs)
+        self.assertIsNot(copy.deepcopy(j).childIDs, j.childIDs)
+
+        state = j.__getstate__()
+        legacy = {k: v for k, v in state.items() if k not in ('_cores', '_memory', '_disk', '_preemptable', 'chainedJobs')}
+        legacy['_requirementOverrides'] = {'memory': j.memory, 'cores': 1.5}
+        old = JobDescription.__new__(JobDescription)
+        old.__setstate__(legacy)
+        self.assertEqual(old.requirements, {'memory': j.memory, 'cores': 1.5})
+        self.assertEqual(old.chainedJobs, None)
+
+    @travis_test
+    def testJobStoreBinaryFormat(self):
+        """
+        Tests that the job store can save and load JobDescriptions in the binary format.
+        """
+        jobStore = self.toil._jobStore
+        jobStore.config.jobDescriptionFormat = 'binary'
+        j = JobDescription(command='command', requirements={'memory': 100}, jobName='stored')
+        jobStore.assignID(j)
+        jobStore.create(j)
+        self.assertTrue(JobDescription.isBinary(jobStore._serializeJob(j)))
+        loaded = jobStore.load(j.jobStoreID)
+        self.assertEqual(loaded.command, 'command')
+        self.assertEqual(loaded.memory, 100)
+        # The default comes from the config
+        self.assertEqual(loaded.disk, self.toil.config.defaultDisk)
+
+        # Pickled jobs can still be read
+        jobStore.config.jobDescriptionFormat = 'pickle'
+        jobStore.update(loaded)
+        self.assertFalse(JobDescription.isBinary(jobStore._serializeJob(loaded)))
+        self.assertEqual(jobStore.load(j.jobStoreID).memory, 100)
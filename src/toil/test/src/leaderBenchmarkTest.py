@@ -0,0 +1,165 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import pickle
+import time
+from argparse import ArgumentParser
+
+from toil.common import Toil
+from toil.job import Job
+from toil.leader import Leader, WakeupReason
+from toil.test import ToilTest, slow, travis_test
+from toil.utils.toilBench import BenchService, NoOpBatchSystem, noop
+
+logger = logging.getLogger(__name__)
+
+
+class CountingLeader(Leader):
+    """
+    A leader that counts how often it waited for something to happen and
+    nothing did.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.idleWaits = 0
+
+    def _waitForWakeups(self, timeout):
+        wakeups = super()._waitForWakeups(timeout)
+        if timeout > 0 and not wakeups:
+            self.idleWaits += 1
+        return wakeups
+
+
+class PollingLeader(CountingLeader):
+    """
+    A leader that waits the way the leader did before it had a wakeup queue,
+    to compare against: it blocks for a whole polling interval unless the
+    batch system has an update for it, and only notices what the service
+    manager has done once it stops.
+    """
+
+    def _waitForWakeups(self, timeout):
+        deadline = time.time() + timeout
+        wakeups = []
+        while True:
+            wakeups.extend(super()._waitForWakeups(max(deadline - time.time(), 0)))
+            if time.time() >= deadline or any(reason in (WakeupReason.BATCH_UPDATE, WakeupReason.ERROR)
+                                              for reason, _ in wakeups):
+                return wakeups
+
+
+class LeaderBenchmarkTest(ToilTest):
+    """
+    Measures how many jobs per second the leader can get through when the
+    batch system costs nothing.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.jobStorePath = self._getTestJobStorePath()
+        self.jobCount = int(os.environ.get('TOIL_TEST_LEADER_BENCHMARK_JOBS', 500))
+
+    def _runLeader(self, rootJob, leaderClass=CountingLeader):
+        """
+        Run the leader on the given job graph with a NoOpBatchSystem.
+
+        :param type leaderClass: The CountingLeader subclass to run.
+        :return: the batch system, for its timings, and the leader.
+        :rtype: tuple(NoOpBatchSystem, CountingLeader)
+        """
+        parser = ArgumentParser()
+        Job.Runner.addToilOptions(parser)
+        options = parser.parse_args(args=[self.jobStorePath])
+        options.disableCaching = True
+        options.disableProgress = True
+        with Toil(options) as toil:
+            jobStore = toil._jobStore
+            # Nothing will actually run the root job, so give the leader a return value to find.
+            with jobStore.writeSharedFileStream('rootJobReturnValue') as fH:
+                pickle.dump(None, fH, protocol=pickle.HIGHEST_PROTOCOL)
+            rootJobDescription = rootJob.saveAsRootJob(jobStore)
+            batchSystem = NoOpBatchSystem(toil.config, 1, 1, 1)
+            leader = leaderClass(config=toil.config, batchSystem=batchSystem, provisioner=None,
+                                 jobStore=jobStore, rootJob=rootJobDescription)
+            leader.run()
+        return batchSystem, leader
+
+    def _report(self, name, batchSystem):
+        elapsed = max(batchSystem.lastUpdateTime - batchSystem.firstIssueTime, 1e-6)
+        rate = batchSystem.completedCount / elapsed
+        logger.info('Leader benchmark %s: %d jobs in %.2f seconds, %.1f jobs/sec',
+                    name, batchSystem.completedCount, elapsed, rate)
+        return rate
+
+    @slow
+    @travis_test
+    def testFanOutThroughput(self):
+        root = Job.wrapJobFn(noop)
+        for _ in range(self.jobCount):
+            root.addChildJobFn(noop)
+        batchSystem, leader = self._runLeader(root)
+        # The root runs, then all its children, then the root again to clean up.
+        self.assertEqual(batchSystem.completedCount, self.jobCount + 2)
+        self._report('fan-out', batchSystem)
+        # Jobs finish as soon as they are issued, so the leader never has to
+        # sit out a polling interval.
+        self.assertEqual(leader.idleWaits, 0)
+
+    @slow
+    @travis_test
+    def testChainThroughput(self):
+        root = Job.wrapJobFn(noop)
+        tail = root
+        for _ in range(self.jobCount // 10):
+            tail = tail.addFollowOnJobFn(noop)
+        batchSystem, leader = self._runLeader(root)
+        self.assertGreaterEqual(batchSystem.completedCount, self.jobCount // 10 + 1)
+        self._report('chain', batchSystem)
+        self.assertEqual(leader.idleWaits, 0)
+
+    @slow
+    @travis_test
+    def testServiceWakeups(self):
+        serviceCount = int(os.environ.get('TOIL_TEST_LEADER_BENCHMARK_SERVICES', 3))
+
+        def makeWorkflow():
+            # Jobs with services, one after the other
+            root = Job.wrapJobFn(noop)
+            tail = root
+            for _ in range(serviceCount):
+                tail = tail.addFollowOnJobFn(noop)
+                tail.addService(BenchService())
+            return root
+
+        times = {}
+        idleWaits = {}
+        for leaderClass in (PollingLeader, CountingLeader):
+            start = time.time()
+            batchSystem, leader = self._runLeader(makeWorkflow(), leaderClass)
+            times[leaderClass] = time.time() - start
+            idleWaits[leaderClass] = leader.idleWaits
+            self.assertGreaterEqual(batchSystem.completedCount, 2 * serviceCount + 1)
+            logger.info('Leader benchmark services with %s: %d services in %.2f seconds, %d idle waits',
+                        leaderClass.__name__, serviceCount, times[leaderClass], leader.idleWaits)
+        # The polling leader finds out about each service being handed to it
+        # and each service starting only once it stops waiting on the batch
+        # system, so it sits out a polling interval for each. The event-driven
+        # leader is woken up for them.
+        self.assertGreaterEqual(idleWaits[PollingLeader], serviceCount)
+        self.assertEqual(idleWaits[CountingLeader], 0)
+        self.assertLess(times[CountingLeader] + serviceCount * leader.idleWakeupInterval / 2,
+                        times[PollingLeader])
@@ -0,0 +1,122 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+
+from mock import Mock, patch
+
+from toil.common import Toil
+from toil.job import Job
+from toil.jobStores.fileJobStore import FileJobStore
+from toil.leader import FailedJobsException, Leader
+from toil.leaderCheckpoint import LeaderCheckpoint
+from toil.test import ToilTest, slow
+
+
+class LeaderCheckpointTest(ToilTest):
+    """
+    Tests restarting a workflow from the leader's checkpoint rather than a
+    scan of the whole job store.
+    """
+
+    def setUp(self):
+        super(LeaderCheckpointTest, self).setUp()
+        self.tempDir = self._createTempDir(purpose='tempDir')
+        self.options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        self.options.retryCount = 0
+        self.options.clean = 'never'
+        self.options.logLevel = 'DEBUG'
+
+    def _runUntilFailure(self, sleep=0):
+        root = Job.wrapJobFn(fanOut, 10, self.tempDir, sleep)
+        with Toil(self.options) as toil:
+            self.assertRaises(FailedJobsException, toil.start, root)
+        self.options.restart = True
+
+    def _restart(self):
+        with Toil(self.options) as toil:
+            return toil.restart()
+
+    @slow
+    def testRestartFromCheckpoint(self):
+        self._runUntilFailure()
+        # The restart must not need to list every job in the store
+        with patch.object(FileJobStore, 'jobs', side_effect=AssertionError('scanned all jobs')):
+            self.assertEqual(self._restart(), sum(range(10)))
+
+    @slow
+    def testRestartFromFrequentCheckpoints(self):
+        # Make the leader take checkpoints with jobs in flight
+        self.options.leaderCheckpointInterval = 1
+        with patch.object(LeaderCheckpoint, 'minCompactionJobs', 1):
+            self._runUntilFailure(sleep=1)
+        with patch.object(FileJobStore, 'jobs', side_effect=AssertionError('scanned all jobs')):
+            self.assertEqual(self._restart(), sum(range(10)))
+
+    @slow
+    def testCheckpointOnlyRetakenForLongJournal(self):
+        self.options.leaderCheckpointInterval = 1
+        with patch.object(LeaderCheckpoint, 'save', autospec=True, side_effect=LeaderCheckpoint.save) as save:
+            self._runUntilFailure(sleep=1)
+        # Only the checkpoint taken at the start; the few jobs since are journaled
+        self.assertEqual(save.call_count, 1)
+        with patch.object(FileJobStore, 'jobs', side_effect=AssertionError('scanned all jobs')):
+            self.assertEqual(self._restart(), sum(range(10)))
+
+    @slow
+    def testJournalFlushedOnExit(self):
+        leaders = []
+        innerLoop = Leader.innerLoop
+
+        def innerLoopWithoutJournaling(leader):
+            # Leave the journal to be flushed only once the loop is done
+            leader.journalThrottler = Mock(**{'throttle.return_value': False})
+            leaders.append(leader)
+            return innerLoop(leader)
+
+        with patch.object(Leader, 'innerLoop', innerLoopWithoutJournaling):
+            self._runUntilFailure()
+        leader, = leaders
+        self.assertEqual(leader.checkpointer.unjournaled, [])
+
+    @slow
+    def testRestartWithBadCheckpoint(self):
+        self._runUntilFailure()
+        jobStore = Toil.resumeJobStore(self.options.jobStore)
+        with jobStore.writeSharedFileStream(LeaderCheckpoint.sharedFileName) as stream:
+            stream.write(b'not a checkpoint')
+        # We should fall back on loading everything
+        with patch.object(FileJobStore, 'jobs', autospec=True, side_effect=FileJobStore.jobs) as jobs:
+            self.assertEqual(self._restart(), sum(range(10)))
+        self.assertTrue(jobs.called)
+
+
+def leaf(job, i, tempDir, sleep):
+    time.sleep(sleep)
+    # Fail once, the first time through
+    flagFile = os.path.join(tempDir, 'failed')
+    if i == 7 and not os.path.exists(flagFile):
+        open(flagFile, 'w').close()
+        raise RuntimeError('Planned failure')
+    return i
+
+
+def fanOut(job, n, tempDir, sleep):
+    values = [job.addChildJobFn(leaf, i, tempDir, sleep).rv() for i in range(n)]
+    return job.addFollowOnJobFn(total, values).rv()
+
+
+def total(job, values):
+    return sum(values)
@@ -0,0 +1,120 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pickle
+from argparse import ArgumentParser
+
+from toil.common import Toil
+from toil.job import Job, JobDescription
+from toil.leader import Leader
+from toil.leaderScheduler import CriticalPathQueue, ReadyJobQueue
+from toil.provisioners.clusterScaler import JobRuntimes
+from toil.test import ToilTest, slow, travis_test
+from toil.utils.toilBench import NoOpBatchSystem, noop
+
+
+def makeJob(name, children=False, followOns=False):
+    job = JobDescription(requirements={'memory': 1, 'cores': 1, 'disk': 1}, jobName=name)
+    job.jobStoreID = name
+    if children:
+        job.addChild(name + '-child')
+    if followOns:
+        job.addFollowOn(name + '-followOn')
+    return job
+
+
+class CountingBatchSystem(NoOpBatchSystem):
+    """
+    A NoOpBatchSystem that remembers the most jobs it has had issued at once.
+    """
+
+    def __init__(self, config, maxCores, maxMemory, maxDisk):
+        super().__init__(config, maxCores, maxMemory, maxDisk)
+        self.maxIssued = 0
+
+    def issueBatchJob(self, jobDesc):
+        self.maxIssued = max(self.maxIssued, len(self.issued) + 1)
+        return super().issueBatchJob(jobDesc)
+
+
+class LeaderSchedulerTest(ToilTest):
+    """
+    Tests the orders the leader can issue ready jobs in, and the limit on
+    how many it issues.
+    """
+
+    @travis_test
+    def testFifoOrder(self):
+        queue = ReadyJobQueue()
+        jobs = [makeJob('leaf'), makeJob('chain', children=True, followOns=True), makeJob('other')]
+        for job in jobs:
+            queue.push(job)
+        self.assertEqual([queue.pop() for _ in jobs], jobs)
+        self.assertEqual(len(queue), 0)
+
+    @travis_test
+    def testCriticalPathOrder(self):
+        runtimes = JobRuntimes()
+        queue = CriticalPathQueue(runtimes)
+        leaf = makeJob('leaf')
+        chain = makeJob('chain', children=True, followOns=True)
+        runtimes.addCompletedJob(makeJob('slow'), 100)
+        runtimes.addCompletedJob(makeJob('leaf'), 1)
+        slowJob = makeJob('slow')
+        for job in (leaf, slowJob, chain):
+            queue.push(job)
+        # The job with two levels of successors to come has the longest path
+        # ahead of it, and slower jobs come before faster ones.
+        self.assertEqual([queue.pop() for _ in range(3)], [chain, slowJob, leaf])
+
+    @travis_test
+    def testCriticalPathInherited(self):
+        queue = CriticalPathQueue(JobRuntimes())
+        # A job with follow-ons still to run after its children
+        predecessor = makeJob('predecessor', children=True, followOns=True)
+        child = makeJob('child')
+        queue.addSuccessors(predecessor, [child])
+        otherChild = makeJob('otherChild')
+        queue.push(otherChild)
+        queue.push(child)
+        self.assertIs(queue.pop(), child)
+        queue.forget(child.jobStoreID)
+        self.assertEqual(queue.priority(child), queue.priority(otherChild))
+
+    def _runLeader(self, rootJob, *args):
+        parser = ArgumentParser()
+        Job.Runner.addToilOptions(parser)
+        options = parser.parse_args(args=list(args) + [self._getTestJobStorePath()])
+        options.disableCaching = True
+        options.disableProgress = True
+        with Toil(options) as toil:
+            jobStore = toil._jobStore
+            # Nothing will actually run the root job, so give the leader a return value to find.
+            with jobStore.writeSharedFileStream('rootJobReturnValue') as fH:
+                pickle.dump(None, fH, protocol=pickle.HIGHEST_PROTOCOL)
+            rootJobDescription = rootJob.saveAsRootJob(jobStore)
+            batchSystem = CountingBatchSystem(toil.config, 1, 1, 1)
+            Leader(config=toil.config, batchSystem=batchSystem, provisioner=None,
+                   jobStore=jobStore, rootJob=rootJobDescription).run()
+        return batchSystem
+
+    @slow
+    def testMaxIssuedJobs(self):
+        root = Job.wrapJobFn(noop)
+        for _ in range(20):
+            root.addChildJobFn(noop).addChildJobFn(noop)
+        batchSystem = self._runLeader(root, '--jobScheduler', 'criticalPath', '--maxIssuedJobs', '2')
+        # Each child runs again to clean up after its own child, as does the root.
+        self.assertEqual(batchSystem.completedCount, 62)
+        self.assertLessEqual(batchSystem.maxIssued, 2)
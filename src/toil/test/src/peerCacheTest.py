@@ -0,0 +1,177 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import sqlite3
+import time
+import urllib.error
+import urllib.request
+
+from toil.common import Config, Toil
+from toil.fileStores.cachingFileStore import CachingFileStore
+from toil.job import Job
+from toil.fileStores.peerCache import (SECRET_HEADER,
+                                       SERVER_ADDRESS,
+                                       SERVER_LOCK,
+                                       PeerCacheClient,
+                                       startPeerCacheServer,
+                                       stopPeerCacheServer)
+from toil.test import ToilTest, travis_test
+
+
+class PeerCacheTest(ToilTest):
+    """
+    Runs peer cache servers for a few caches on this machine, each standing in
+    for a node, and fetches files between them.
+    """
+
+    def setUp(self):
+        super().setUp()
+        config = Config()
+        self.locator = 'file:' + self._getTestJobStorePath()
+        config.jobStore = self.locator
+        Toil.getJobStore(self.locator).initialize(config)
+        self.cacheDirs = []
+
+    def tearDown(self):
+        for cacheDir in self.cacheDirs:
+            stopPeerCacheServer(cacheDir)
+        super().tearDown()
+
+    def _startNode(self):
+        """
+        Make an empty cache and serve it.
+
+        :return: The cache directory.
+        """
+        cacheDir = self._createTempDir('cache')
+        dbPath = os.path.join(cacheDir, 'cache-0.db')
+        con = sqlite3.connect(dbPath)
+        CachingFileStore._ensureTables(con)
+        con.close()
+        startPeerCacheServer(dbPath, self.locator, publishInterval=0.2)
+        self.cacheDirs.append(cacheDir)
+        self._waitFor(lambda: os.path.exists(os.path.join(cacheDir, SERVER_ADDRESS)))
+        return cacheDir
+
+    def _cache(self, cacheDir, fileID, data):
+        """
+        Put a file in a cache.
+
+        :return: The path to the cached copy.
+        """
+        path = os.path.join(cacheDir, fileID.replace('/', '_'))
+        with open(path, 'wb') as f:
+            f.write(data)
+        con = sqlite3.connect(os.path.join(cacheDir, 'cache-0.db'))
+        CachingFileStore._staticWrite(con, con.cursor(), [
+            ('INSERT INTO files (id, path, size, state, owner) VALUES (?, ?, ?, ?, ?)',
+             (fileID, path, len(data), 'cached', None))])
+        con.close()
+        return path
+
+    def _waitFor(self, condition, timeout=30):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.1)
+
+    @travis_test
+    def testFetchFromPeer(self):
+        nodeA, nodeB = self._startNode(), self._startNode()
+        data = os.urandom(3 * 1024 * 1024 + 5)
+        self._cache(nodeA, 'files/for-job/a/file', data)
+        client = PeerCacheClient(nodeB)
+        self._waitFor(lambda: client.peers('files/for-job/a/file'))
+        path = os.path.join(nodeB, 'fetched')
+        self.assertTrue(client.fetch('files/for-job/a/file', path))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        # Nobody has anything else
+        self.assertFalse(client.fetch('files/for-job/a/other', os.path.join(nodeB, 'other')))
+
+    @travis_test
+    def testChecksumMismatch(self):
+        nodeA, nodeB = self._startNode(), self._startNode()
+        cachedPath = self._cache(nodeA, 'file', b'good data')
+        client = PeerCacheClient(nodeB)
+        self._waitFor(lambda: client.peers('file'))
+        # Damage the copy without the server seeing
+        stat = os.stat(cachedPath)
+        with open(cachedPath, 'wb') as f:
+            f.write(b'bad! data')
+        os.utime(cachedPath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        path = os.path.join(nodeB, 'fetched')
+        self.assertFalse(client.fetch('file', path))
+        self.assertFalse(os.path.exists(path))
+        # The bad copy isn't left lying around
+        self.assertEqual([name for name in os.listdir(nodeB) if name.startswith('tmp')], [])
+
+    @travis_test
+    def testSecretRequired(self):
+        nodeA, nodeB = self._startNode(), self._startNode()
+        self._cache(nodeA, 'file', b'data')
+        client = PeerCacheClient(nodeB)
+        self._waitFor(lambda: client.peers('file'))
+        with open(os.path.join(nodeA, SERVER_ADDRESS)) as f:
+            server = json.load(f)
+        # Both nodes use the workflow's secret
+        self.assertEqual(client._server()['secret'], server['secret'])
+        for kind in ('files', 'peers'):
+            for headers in ({}, {SECRET_HEADER: 'wrong'}):
+                request = urllib.request.Request('http://%s/%s/file' % (server['address'], kind),
+                                                 headers=headers)
+                with self.assertRaises(urllib.error.HTTPError) as e:
+                    urllib.request.urlopen(request, timeout=10)
+                self.assertEqual(e.exception.code, 403)
+        self.assertTrue(client.fetch('file', os.path.join(nodeB, 'fetched')))
+
+    @travis_test
+    def testPeerGone(self):
+        nodeA, nodeB = self._startNode(), self._startNode()
+        self._cache(nodeA, 'file', b'data')
+        client = PeerCacheClient(nodeB)
+        self._waitFor(lambda: client.peers('file'))
+        stopPeerCacheServer(nodeA)
+        # It withdraws its index as it stops, but we might hear of the file
+        # before we hear of that.
+        self.assertFalse(client.fetch('file', os.path.join(nodeB, 'fetched')))
+        self._waitFor(lambda: not client.peers('file'))
+
+    @travis_test
+    def testWorkflow(self):
+        # Nothing else is caching, so everything comes from the job store
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        options.workDir = self._createTempDir('work')
+        options.peerCaching = True
+        Job.Runner.startToil(Job.wrapJobFn(_writeAndRead), options)
+        # The batch system's cleanup stopped the server
+        for name in os.listdir(options.workDir):
+            self.assertFalse(name.startswith('toil-'), 'Workflow directory %s was left behind' % name)
+
+
+def _writeAndRead(job):
+    path = job.fileStore.getLocalTempFile()
+    with open(path, 'w') as f:
+        f.write('data')
+    fileID = job.fileStore.writeGlobalFile(path)
+    job.addChildJobFn(_read, fileID)
+
+
+def _read(job, fileID):
+    with open(job.fileStore.readGlobalFile(fileID, cache=True)) as f:
+        assert f.read() == 'data'
+    # The node is serving its cache
+    assert job.fileStore.peerCache is not None
+    assert os.path.exists(os.path.join(job.fileStore.localCacheDir, SERVER_LOCK))
@@ -11,10 +11,11 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
 import pickle
 
 from toil.common import Config
-from toil.job import JobDescription, CheckpointJobDescription
+from toil.job import Job, JobDescription, CheckpointJobDescription
 from toil.jobStores.fileJobStore import FileJobStore
 from toil.test import ToilTest, travis_test
 from toil.worker import nextChainable
@@ -93,3 +94,85 @@ class WorkerTests(ToilTest):
             jobDesc2 = createTestJobDesc(1, 2, 3, False, True)
             getattr(jobDesc1, successorType)(jobDesc2.jobStoreID)
             self.assertEqual(None, nextChainable(jobDesc1, self.jobStore, self.config))
+
+    @travis_test
+    def testLocalExecutionStack(self):
+        """
+        Make sure a worker runs small children that fit together itself, and
+        that a child failing there fails the worker's attempt at the job it
+        was issued, and is then retried by the leader.
+        """
+        recordDir = self._createTempDir()
+        logDir = self._createTempDir()
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        options.retryCount = 1
+        options.writeLogs = logDir
+        root = Job.wrapJobFn(recordRun, recordDir, 'root', cores=1, memory='400M', disk='400M')
+        for i in range(3):
+            child = root.addChildJobFn(recordRun, recordDir, 'child%d' % i, cores=0.25, memory='100M', disk='100M')
+            child.addChildJobFn(recordRun, recordDir, 'grandchild%d' % i, cores=0.25, memory='100M', disk='100M')
+        root.addChildJobFn(recordRun, recordDir, 'flaky', fail=True, cores=0.25, memory='100M', disk='100M')
+        root.addFollowOnJobFn(recordRun, recordDir, 'followOn', cores=0.25, memory='100M', disk='100M')
+        Job.Runner.startToil(root, options)
+
+        runs = {}
+        for name in os.listdir(recordDir):
+            with open(os.path.join(recordDir, name)) as f:
+                runs[name] = [tuple(map(int, line.split())) for line in f]
+        self.assertEqual(len(runs), 9)
+        rootPID = runs['root'][0][0]
+        for name in ('child0', 'child1', 'child2'):
+            self.assertEqual(len(runs[name]), 1)
+            # Each ran in a fork of the root's worker
+            self.assertEqual(runs[name][0][1], rootPID)
+        # The flaky job failed in the root's worker and then passed on its own.
+        self.assertEqual(len(runs['flaky']), 2)
+        self.assertEqual(runs['flaky'][0][1], rootPID)
+        self.assertNotEqual(runs['flaky'][1][1], rootPID)
+        # Everything after that was left to the leader.
+        for name in ('grandchild0', 'grandchild1', 'grandchild2', 'followOn'):
+            self.assertEqual(len(runs[name]), 1)
+        # The leader got the failure, with the log of the root's worker.
+        failedLogs = [name for name in os.listdir(logDir) if name.startswith('failed_')]
+        self.assertGreater(len(failedLogs), 0)
+        for name in failedLogs:
+            with open(os.path.join(logDir, name)) as f:
+                self.assertIn('Failing on purpose', f.read())
+
+    @travis_test
+    def testLocalExecutionStackFollowOns(self):
+        """
+        Make sure a worker runs a whole graph of small successors that fit in
+        its allocation, through children and then follow-ons.
+        """
+        recordDir = self._createTempDir()
+        options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+        root = Job.wrapJobFn(recordRun, recordDir, 'root', cores=1, memory='200M', disk='200M')
+        for i in range(2):
+            child = root.addChildJobFn(recordRun, recordDir, 'child%d' % i, cores=0.5, memory='100M', disk='100M')
+            child.addChildJobFn(recordRun, recordDir, 'grandchild%d' % i, cores=0.5, memory='100M', disk='100M')
+        followOn = root.addFollowOnJobFn(recordRun, recordDir, 'followOn', cores=0.5, memory='100M', disk='100M')
+        followOn.addFollowOnJobFn(recordRun, recordDir, 'followOn2', cores=0.5, memory='100M', disk='100M')
+        Job.Runner.startToil(root, options)
+
+        runs = {}
+        for name in os.listdir(recordDir):
+            with open(os.path.join(recordDir, name)) as f:
+                runs[name] = [tuple(map(int, line.split())) for line in f]
+        self.assertEqual(len(runs), 7)
+        rootPID = runs['root'][0][0]
+        for name in ('child0', 'child1', 'grandchild0', 'grandchild1', 'followOn', 'followOn2'):
+            self.assertEqual(runs[name], [runs[name][0]])
+            self.assertEqual(runs[name][0][1], rootPID)
+
+def recordRun(job, recordDir, name, fail=False):
+    """
+    Record the process and parent process this job ran in, and fail the first
+    time if asked to.
+    """
+    path = os.path.join(recordDir, name)
+    firstRun = not os.path.exists(path)
+    with open(path, 'a') as f:
+        f.write('%d %d\n' % (os.getpid(), os.getppid()))
+    if fail and firstRun:
+        raise RuntimeError('Failing on purpose')
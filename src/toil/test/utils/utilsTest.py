@@ -13,6 +13,7 @@
 # limitations under the License.
 from __future__ import absolute_import
 from builtins import str
+import json
 import os
 import sys
 import uuid
@@ -354,6 +355,20 @@ class UtilsTest(ToilTest):
         os.remove(os.path.join(self.toilDir, 'files/shared/pid.log'))
         self.check_status('QUEUED', status_fn=ToilStatus.getPIDStatus)
     
+    @travis_test
+    def testKillPackedFileJobStore(self):
+        """Test that toil kill finds the leader of a workflow with a packed file job store."""
+        locator = 'packedfile:' + self.toilDir
+        config = Config()
+        config.jobStore = locator
+        jobStore = Toil.getJobStore(locator)
+        jobStore.initialize(config)
+        leader = subprocess.Popen(['sleep', '60'])
+        with jobStore.writeSharedFileStream('pid.log') as f:
+            f.write(str(leader.pid).encode('utf-8'))
+        system([self.toilMain, 'kill', locator])
+        self.assertEqual(leader.wait(timeout=10), -9)
+
     @travis_test
     def testGetStatusFailedToilWF(self):
         """
@@ -407,6 +422,21 @@ class UtilsTest(ToilTest):
         args, kwargs = mock_print.call_args
         self.assertIn('invalidcommand', args[0])
     
+    @slow
+    def testBenchInProcess(self):
+        """Test that toil bench runs every workload and reports on it as JSON."""
+        reportFile = os.path.join(self.tempDir, 'bench.json')
+        system([self.toilMain, 'bench', self.toilDir, '--inProcess', '--size=4',
+                '--clean=always', '--output', reportFile])
+        with open(reportFile) as f:
+            report = json.load(f)
+        self.assertEqual(report['batchSystem'], 'inProcess')
+        self.assertEqual(report['jobs'], 30)
+        self.assertGreater(report['jobsPerSecond'], 0)
+        self.assertGreater(report['leaderPeakRssBytes'], 0)
+        self.assertGreater(report['leaderJobStoreOps']['create'], 0)
+        self.assertFalse(os.path.exists(self.toilDir))
+
     def testRestartAttribute(self):
         """
         Test that the job store is only destroyed when we observe a succcessful workflow run.
@@ -109,102 +109,139 @@ class ToilState():
             assert isinstance(item, JobDescription)
             yield item
         
-    def _buildToilState(self, jobDesc, jobStore, jobCache=None):
+    def _buildToilState(self, rootJob, jobStore, jobCache=None):
         """
-        Traverses tree of jobs from the root JobDescription (rootJob) building the
-        ToilState class.
+        Traverses the graph of jobs from the root JobDescription (rootJob),
+        building the ToilState class.
+
+        The traversal is iterative and proceeds a frontier at a time: all the
+        not-yet-seen successors of the jobs in the current frontier are
+        fetched with a single call to
+        :meth:`toil.jobStores.abstractJobStore.AbstractJobStore.loadMany`, so
+        restarting a large workflow does not cost one job store round trip
+        per job.
 
         If jobCache is passed, it must be a dict from job ID to JobDescription
         object. Jobs will be loaded from the cache (which can be downloaded from
-        the jobStore in a batch) instead of piecemeal when recursed into.
+        the jobStore in a batch) instead of from the job store.
 
-        :param jobDesc: Object representing a job.
+        :param toil.job.JobDescription rootJob: The root of the job graph.
         :param jobStore: Object inheriting toil.jobStores.abstractJobStore.AbstractJobStore.
-        :param jobCache:
-        :return:
+        :param dict jobCache: Optional map from jobStoreID to JobDescription.
         """
+        frontier = [rootJob]
+        while frontier:
+            # Pairs of (predecessor JobDescription, successor jobStoreID) for
+            # every edge out of the frontier, in order.
+            edges = []
+            # Successors we have not seen before and so have to load
+            toLoad = []
+
+            for jobDesc in frontier:
+                if self._isReady(jobDesc):
+                    self._addReadyJob(jobDesc)
+                    continue
+
+                # There exist successors
+                logger.debug("Adding job: %s to the state with %s successors",
+                             jobDesc.jobStoreID, len(jobDesc.nextSuccessors()))
+
+                # Record the number of successors
+                self.successorCounts[jobDesc.jobStoreID] = len(jobDesc.nextSuccessors())
+
+                for successorJobStoreID in jobDesc.nextSuccessors():
+                    edges.append((jobDesc, successorJobStoreID))
+                    # If the successor does not yet point back at a predecessor
+                    # we have not yet considered it, and so must load it.
+                    if successorJobStoreID not in self.successorJobStoreIDToPredecessorJobs:
+                        self.successorJobStoreIDToPredecessorJobs[successorJobStoreID] = []
+                        toLoad.append(successorJobStoreID)
+
+            loaded = self._loadJobs(toLoad, jobStore, jobCache)
+
+            frontier = []
+            for jobDesc, successorJobStoreID in edges:
+                # Add the job as a predecessor
+                predecessors = self.successorJobStoreIDToPredecessorJobs[successorJobStoreID]
+                assert jobDesc not in predecessors
+                predecessors.append(jobDesc)
+
+                if successorJobStoreID in loaded:
+                    # This is the first time we have seen the successor
+                    successor = loaded.pop(successorJobStoreID)
 
-        def getJob(jobId):
-            if jobCache is not None:
-                if jobId in jobCache:
-                    return jobCache[jobId]
-            return jobStore.load(jobId)
-        
-        # If the job description has a command, is a checkpoint, has services
-        # or is ready to be deleted it is ready to be processed
-        if jobDesc.command is not None or (isinstance(jobDesc, CheckpointJobDescription) and jobDesc.checkpoint is not None) or len(jobDesc.services) > 0 or jobDesc.nextSuccessors() is None:
-            logger.debug('Found job to run: %s, with command: %s, with checkpoint: %s, '
-                         'with  services: %s, with no next successors: %s', jobDesc.jobStoreID,
-                         jobDesc.command is not None, isinstance(jobDesc, CheckpointJobDescription) and jobDesc.checkpoint is not None,
-                         len(jobDesc.services) > 0, jobDesc.nextSuccessors() is None)
-            self.updatedJobs[jobDesc.jobStoreID] = (jobDesc, 0)
-
-            if isinstance(jobDesc, CheckpointJobDescription) and jobDesc.checkpoint is not None:
-                jobDesc.command = jobDesc.checkpoint
-
-        else: # There exist successors
-            logger.debug("Adding job: %s to the state with %s successors" % (jobDesc.jobStoreID, len(jobDesc.nextSuccessors())))
-            
-            # Record the number of successors
-            self.successorCounts[jobDesc.jobStoreID] = len(jobDesc.nextSuccessors())
-
-            def processSuccessorWithMultiplePredecessors(successor):
-                # If jobDesc is not reported as complete by the successor
-                if jobDesc.jobStoreID not in successor.predecessorsFinished:
-
-                    # Update the successor's status to mark the predecessor complete
-                    successor.predecessorsFinished.add(jobDesc.jobStoreID)
-
-                # If the successor has no predecessors to finish
-                assert len(successor.predecessorsFinished) <= successor.predecessorNumber
-                if len(successor.predecessorsFinished) == successor.predecessorNumber:
-                    
-                    # It is ready to be run, so remove it from the cache
-                    self.jobsToBeScheduledWithMultiplePredecessors.pop(successorJobStoreID)
-                    
-                    # Recursively consider the successor
-                    self._buildToilState(successor, jobStore, jobCache=jobCache)
-            
-            # For each successor
-            for successorJobStoreID in jobDesc.nextSuccessors():
-                
-                # If the successor does not yet point back at a
-                # predecessor we have not yet considered it
-                if successorJobStoreID not in self.successorJobStoreIDToPredecessorJobs:
-
-                    # Add the job as a predecessor
-                    self.successorJobStoreIDToPredecessorJobs[successorJobStoreID] = [jobDesc]
-                    
-                    # We load the successor job
-                    successor = getJob(successorJobStoreID)
-                    
-                    # If predecessor number > 1 then the successor has multiple predecessors
                     if successor.predecessorNumber > 1:
-                        
-                        # We put the successor job in the cache of successor jobs with multiple predecessors
+                        # We put the successor job in the cache of successor
+                        # jobs with multiple predecessors
                         assert successorJobStoreID not in self.jobsToBeScheduledWithMultiplePredecessors
                         self.jobsToBeScheduledWithMultiplePredecessors[successorJobStoreID] = successor
-                        
-                        # Process successor
-                        processSuccessorWithMultiplePredecessors(successor)
-                            
                     else:
                         # The successor has only this job as a predecessor so
-                        # recursively consider the successor
-                        self._buildToilState(successor, jobStore, jobCache=jobCache)
-                
-                else:
-                    # We've already seen the successor
-                    
-                    # Add the job as a predecessor
-                    assert jobDesc not in self.successorJobStoreIDToPredecessorJobs[successorJobStoreID]
-                    self.successorJobStoreIDToPredecessorJobs[successorJobStoreID].append(jobDesc)
-                    
-                    # If the successor has multiple predecessors
-                    if successorJobStoreID in self.jobsToBeScheduledWithMultiplePredecessors:
-                        
-                        # Get the successor from cache
-                        successor = self.jobsToBeScheduledWithMultiplePredecessors[successorJobStoreID]
-                        
-                        # Process successor
-                        processSuccessorWithMultiplePredecessors(successor)
+                        # consider it in the next frontier
+                        frontier.append(successor)
+                        continue
+
+                # If the successor has multiple predecessors and is still
+                # waiting on some of them
+                successor = self.jobsToBeScheduledWithMultiplePredecessors.get(successorJobStoreID)
+                if successor is not None:
+                    # Update the successor's status to mark the predecessor complete
+                    successor.predecessorsFinished.add(jobDesc.jobStoreID)
+
+                    # If the successor has no predecessors to finish
+                    assert len(successor.predecessorsFinished) <= successor.predecessorNumber
+                    if len(successor.predecessorsFinished) == successor.predecessorNumber:
+                        # It is ready to be run, so remove it from the cache
+                        # and consider it in the next frontier
+                        self.jobsToBeScheduledWithMultiplePredecessors.pop(successorJobStoreID)
+                        frontier.append(successor)
+
+    @staticmethod
+    def _isReady(jobDesc):
+        """
+        If the job description has a command, is a checkpoint, has services or
+        is ready to be deleted it is ready to be processed.
+
+        :param toil.job.JobDescription jobDesc:
+        :rtype: bool
+        """
+        return (jobDesc.command is not None or
+                (isinstance(jobDesc, CheckpointJobDescription) and jobDesc.checkpoint is not None) or
+                len(jobDesc.services) > 0 or
+                jobDesc.nextSuccessors() is None)
+
+    def _addReadyJob(self, jobDesc):
+        """
+        Records a job that is ready to be processed by the leader.
+
+        :param toil.job.JobDescription jobDesc:
+        """
+        isCheckpoint = isinstance(jobDesc, CheckpointJobDescription) and jobDesc.checkpoint is not None
+        logger.debug('Found job to run: %s, with command: %s, with checkpoint: %s, '
+                     'with  services: %s, with no next successors: %s', jobDesc.jobStoreID,
+                     jobDesc.command is not None, isCheckpoint,
+                     len(jobDesc.services) > 0, jobDesc.nextSuccessors() is None)
+        self.updatedJobs[jobDesc.jobStoreID] = (jobDesc, 0)
+
+        if isCheckpoint:
+            jobDesc.command = jobDesc.checkpoint
+
+    @staticmethod
+    def _loadJobs(jobStoreIDs, jobStore, jobCache=None):
+        """
+        Gets the JobDescriptions for the given IDs, from the jobCache where
+        possible and otherwise from the job store in bulk.
+
+        :param list jobStoreIDs: IDs of the jobs to get.
+        :param jobStore: Object inheriting toil.jobStores.abstractJobStore.AbstractJobStore.
+        :param dict jobCache: Optional map from jobStoreID to JobDescription.
+        :return: Map from jobStoreID to JobDescription.
+        :rtype: dict
+        """
+        if jobCache is None:
+            jobCache = {}
+        loaded = {jobStoreID: jobCache[jobStoreID] for jobStoreID in jobStoreIDs if jobStoreID in jobCache}
+        missing = [jobStoreID for jobStoreID in jobStoreIDs if jobStoreID not in loaded]
+        if missing:
+            loaded.update(jobStore.loadMany(missing))
+        return loaded
@@ -0,0 +1,350 @@
+# Copyright (C) 2015-2021 Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Run a synthetic workflow and report how fast Toil got through it, as JSON
+"""
+import collections
+import json
+import logging
+import pickle
+import resource
+import sys
+import time
+from queue import Empty, Queue
+from threading import Lock
+
+from toil.batchSystems.abstractBatchSystem import BatchSystemSupport, UpdatedBatchJobInfo
+from toil.common import Toil
+from toil.job import Job, ServiceJobDescription
+from toil.leader import Leader
+from toil.version import version
+
+logger = logging.getLogger(__name__)
+
+# Keep the jobs small, so that many of them fit on one machine at once
+jobRequirements = dict(cores=0.1, memory=32 * 1024 * 1024, disk=1024 * 1024)
+
+
+def noop(job):
+    pass
+
+
+def square(job, i):
+    return i * i
+
+
+def total(job, values):
+    return sum(values)
+
+
+class BenchService(Job.Service):
+    """
+    A service that does nothing but stay up until it is told to stop.
+    """
+
+    def start(self, job):
+        return None
+
+    def check(self):
+        return True
+
+    def stop(self, job):
+        pass
+
+
+def addFanOut(root, size):
+    for _ in range(size):
+        root.addChildJobFn(noop, **jobRequirements)
+    return size
+
+
+def addChain(root, size):
+    tail = root.addChildJobFn(noop, **jobRequirements)
+    for _ in range(size - 1):
+        tail = tail.addFollowOnJobFn(noop, **jobRequirements)
+    return size
+
+
+def addDiamonds(root, size, width=10):
+    # Each diamond is a job, then width jobs, then one job that comes after
+    # all of them.
+    count = 0
+    while count < size:
+        top = root.addChildJobFn(noop, **jobRequirements)
+        join = Job.wrapJobFn(noop, **jobRequirements)
+        for _ in range(width):
+            top.addChildJobFn(noop, **jobRequirements).addChild(join)
+        count += width + 2
+    return count
+
+
+def addServices(root, size):
+    # Each job that uses a service is one job, and its service is another.
+    for _ in range(max(size // 2, 1)):
+        client = root.addChildJobFn(noop, **jobRequirements)
+        client.addService(BenchService(**jobRequirements))
+    return max(size // 2, 1) * 2
+
+
+def addPromises(root, size):
+    values = [root.addChildJobFn(square, i, **jobRequirements).rv() for i in range(size)]
+    root.addFollowOnJobFn(total, values, **jobRequirements)
+    return size + 1
+
+
+workloads = collections.OrderedDict([('fanout', addFanOut),
+                                     ('chain', addChain),
+                                     ('diamond', addDiamonds),
+                                     ('services', addServices),
+                                     ('promises', addPromises)])
+
+
+def makeWorkflow(workloadNames, size):
+    """
+    Make a synthetic workflow.
+
+    :param list[str] workloadNames: The shapes of job graph to put under the
+           root job, from the keys of :data:`workloads`.
+    :param int size: The rough number of jobs in each of them.
+
+    :return: The root job, and the number of jobs in the workflow.
+    :rtype: tuple[toil.job.Job, int]
+    """
+    root = Job.wrapJobFn(noop, **jobRequirements)
+    count = 1
+    for name in workloadNames:
+        count += workloads[name](root, size)
+    return root, count
+
+
+class NoOpBatchSystem(BatchSystemSupport):
+    """
+    A batch system that runs every job instantly, in the leader process, by
+    doing only the job store bookkeeping a worker would do for a job whose
+    body does nothing. Used to time the leader on its own.
+
+    Services are started as soon as they are issued, and finish once the
+    leader tells them to stop.
+    """
+
+    @classmethod
+    def supportsAutoDeployment(cls):
+        return False
+
+    @classmethod
+    def supportsWorkerCleanup(cls):
+        return False
+
+    def __init__(self, config, maxCores, maxMemory, maxDisk):
+        super().__init__(config, maxCores, maxMemory, maxDisk)
+        self.jobStore = Toil.resumeJobStore(config.jobStore)
+        self.jobIndex = 0
+        self.jobIndexLock = Lock()
+        self.issued = set()
+        self.updatedJobsQueue = Queue()
+        # Map from batch system ID to ServiceJobDescription for the services
+        # we have started
+        self.runningServices = {}
+        # Timing and counts for the benchmark
+        self.firstIssueTime = None
+        self.lastUpdateTime = None
+        self.completedCount = 0
+
+    def issueBatchJob(self, jobDesc):
+        with self.jobIndexLock:
+            jobID = self.jobIndex
+            self.jobIndex += 1
+        if self.firstIssueTime is None:
+            self.firstIssueTime = time.time()
+        self.issued.add(jobID)
+
+        # Do what the worker would do for a job with an empty body.
+        jobDesc = self.jobStore.load(jobDesc.jobStoreID)
+        if isinstance(jobDesc, ServiceJobDescription) and jobDesc.command is not None:
+            # Tell the leader the service is up
+            self.jobStore.deleteFile(jobDesc.startJobStoreID)
+            with self.jobIndexLock:
+                self.runningServices[jobID] = jobDesc
+            return jobID
+        self._finish(jobID, jobDesc)
+        return jobID
+
+    def _finish(self, jobID, jobDesc):
+        if jobDesc.command is None:
+            jobDesc.filterSuccessors(self.jobStore.exists)
+            jobDesc.filterServiceHosts(self.jobStore.exists)
+        jobDesc.command = None
+        if next(jobDesc.successorsAndServiceHosts(), None) is None:
+            self.jobStore.delete(jobDesc.jobStoreID)
+        else:
+            self.jobStore.update(jobDesc)
+
+        self.updatedJobsQueue.put(UpdatedBatchJobInfo(jobID=jobID, exitStatus=0, exitReason=None, wallTime=None))
+
+    def _stopServices(self):
+        with self.jobIndexLock:
+            services = list(self.runningServices.items())
+        for jobID, jobDesc in services:
+            if (not self.jobStore.fileExists(jobDesc.terminateJobStoreID) or
+                    not self.jobStore.fileExists(jobDesc.errorJobStoreID)):
+                with self.jobIndexLock:
+                    del self.runningServices[jobID]
+                self._finish(jobID, jobDesc)
+
+    def killBatchJobs(self, jobIDs):
+        # Everything but services finishes as soon as it is issued.
+        with self.jobIndexLock:
+            for jobID in jobIDs:
+                self.runningServices.pop(jobID, None)
+                self.issued.discard(jobID)
+
+    def getIssuedBatchJobIDs(self):
+        return list(self.issued)
+
+    def getRunningBatchJobIDs(self):
+        return {}
+
+    def getUpdatedBatchJob(self, maxWait):
+        if self.runningServices:
+            # Look in on the services every so often
+            self._stopServices()
+            maxWait = min(maxWait, 0.1)
+        try:
+            item = self.updatedJobsQueue.get(timeout=maxWait)
+        except Empty:
+            return None
+        self.issued.discard(item.jobID)
+        self.completedCount += 1
+        self.lastUpdateTime = time.time()
+        return item
+
+    def shutdown(self):
+        pass
+
+
+class JobStoreOpCounter(object):
+    """
+    Counts the calls made to a job store object's methods, by wrapping them
+    on the instance.
+    """
+
+    methods = ('create', 'update', 'load', 'loadMany', 'loadExisting', 'exists', 'delete', 'deleteMany',
+               'jobs', 'writeFile', 'writeFileStream', 'readFile', 'readFileStream', 'updateFile',
+               'updateFileStream', 'deleteFile', 'fileExists', 'getEmptyFileStoreID',
+               'writeSharedFileStream', 'readSharedFileStream', 'writeStatsAndLogging',
+               'readStatsAndLogging')
+
+    def __init__(self, jobStore):
+        """
+        :param toil.jobStores.abstractJobStore.AbstractJobStore jobStore:
+        """
+        self.counts = collections.Counter()
+        self.lock = Lock()
+        for name in self.methods:
+            method = getattr(jobStore, name, None)
+            if method is not None:
+                setattr(jobStore, name, self._counted(name, method))
+
+    def _counted(self, name, method):
+        def counted(*args, **kwargs):
+            with self.lock:
+                self.counts[name] += 1
+            return method(*args, **kwargs)
+        return counted
+
+
+def runBenchmark(options, workloadNames, size, inProcess=False):
+    """
+    Run a synthetic workflow, and measure it.
+
+    :param options: The Toil options to run the workflow with.
+    :param list[str] workloadNames: The shapes of job graph to include.
+    :param int size: The rough number of jobs in each shape.
+    :param bool inProcess: If True, run the jobs in the leader with a
+           :class:`NoOpBatchSystem` rather than with the configured batch system.
+
+    :return: The measurements, ready to be written out as JSON.
+    :rtype: dict
+    """
+    root, jobCount = makeWorkflow(workloadNames, size)
+    startUsage = resource.getrusage(resource.RUSAGE_SELF)
+    startChildUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    with Toil(options) as toil:
+        jobStore = toil._jobStore
+        counter = JobStoreOpCounter(jobStore)
+        if inProcess:
+            batchSystemName = 'inProcess'
+            # Nothing will actually run the root job, so give the leader a
+            # return value to find.
+            with jobStore.writeSharedFileStream('rootJobReturnValue') as fH:
+                pickle.dump(None, fH, protocol=pickle.HIGHEST_PROTOCOL)
+            root.prepareForPromiseRegistration(jobStore)
+            rootJobDescription = root.saveAsRootJob(jobStore)
+            batchSystem = NoOpBatchSystem(toil.config, 1, 1, 1)
+            Leader(config=toil.config, batchSystem=batchSystem, provisioner=None,
+                   jobStore=jobStore, rootJob=rootJobDescription).run()
+        else:
+            batchSystemName = toil.config.batchSystem
+            toil.start(root)
+        jobStoreName = type(jobStore).__name__
+    elapsed = max(time.time() - start, 1e-6)
+    endUsage = resource.getrusage(resource.RUSAGE_SELF)
+    endChildUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    # Linux gives the peak resident set size in kilobytes, and macOS in bytes
+    peakRss = endUsage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return {'toilVersion': version,
+            'workloads': list(workloadNames),
+            'size': size,
+            'batchSystem': batchSystemName,
+            'jobStore': jobStoreName,
+            'jobs': jobCount,
+            'seconds': elapsed,
+            'jobsPerSecond': jobCount / elapsed,
+            'leaderCpuSeconds': (endUsage.ru_utime - startUsage.ru_utime +
+                                 endUsage.ru_stime - startUsage.ru_stime),
+            'workerCpuSeconds': (endChildUsage.ru_utime - startChildUsage.ru_utime +
+                                 endChildUsage.ru_stime - startChildUsage.ru_stime),
+            'leaderPeakRssBytes': peakRss,
+            'leaderJobStoreOps': dict(counter.counts)}
+
+
+def main():
+    parser = Job.Runner.getDefaultArgumentParser()
+    parser.add_argument('--workload', dest='workloads', action='append', choices=list(workloads),
+                        help='A shape of job graph to include in the workflow. May be given more '
+                             'than once. default=all of them')
+    parser.add_argument('--size', type=int, default=100,
+                        help='The rough number of jobs in each shape of job graph. default=%(default)s')
+    parser.add_argument('--inProcess', action='store_true', default=False,
+                        help='Run the jobs in the leader process, doing only the job store work '
+                             'their workers would do, instead of with the batch system. This '
+                             'times the leader and the job store on their own.')
+    parser.add_argument('--output', default=None,
+                        help='File to write the JSON report to. default=standard output')
+    options = parser.parse_args()
+    if options.size < 1:
+        parser.error('--size must be at least 1')
+
+    report = runBenchmark(options, options.workloads or list(workloads), options.size,
+                          inProcess=options.inProcess)
+    logger.info('Ran %i jobs in %.2f seconds (%.1f jobs/sec)',
+                report['jobs'], report['seconds'], report['jobsPerSecond'])
+    if options.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
@@ -35,10 +35,10 @@ def main():
     options = parseBasicOptions(parser)
     config = Config()
     config.setOptions(options)
-    config.jobStore = config.jobStore[5:] if config.jobStore.startswith('file:') else config.jobStore
+    jobStoreType, _ = Toil.parseLocator(config.jobStore)
 
-    # ':' means an aws/google jobstore; use the old (broken?) method
-    if ':' in config.jobStore:
+    # An aws/google jobstore; use the old (broken?) method
+    if jobStoreType not in ('file', 'packedfile'):
         jobStore = Toil.resumeJobStore(config.jobStore)
         logger.info("Starting routine to kill running jobs in the toil workflow: %s", config.jobStore)
         # TODO: This behaviour is now broken src: https://github.com/DataBiosphere/toil/commit/a3d65fc8925712221e4cda116d1825d4a1e963a1
@@ -48,9 +48,9 @@ def main():
         logger.info("All jobs SHOULD have been killed")
     # otherwise, kill the pid recorded in the jobstore
     else:
-        pid_log = os.path.join(os.path.abspath(config.jobStore), 'pid.log')
-        with open(pid_log, 'r') as f:
-            pid2kill = f.read().strip()
+        jobStore = Toil.resumeJobStore(config.jobStore)
+        with jobStore.readSharedFileStream('pid.log') as f:
+            pid2kill = f.read().decode().strip()
         try:
             os.kill(int(pid2kill), signal.SIGKILL)
             logger.info("Toil process %s successfully terminated." % str(pid2kill))
@@ -39,7 +39,8 @@ def loadModules():
                             toilSshCluster,
                             toilRsyncCluster,
                             toilDebugFile,
-                            toilDebugJob)
+                            toilDebugJob,
+                            toilBench)
     return {"-".join([i.lower() for i in re.findall('[A-Z][^A-Z]*', name)]): module for name, module in locals().items()}
 
 
@@ -29,6 +29,7 @@ import json
 import tempfile
 import traceback
 import time
+import uuid
 import signal
 import socket
 import logging
@@ -39,7 +40,8 @@ from toil.lib.expando import MagicExpando
 from toil.common import Toil, safeUnpickleFromStream
 from toil.fileStores.abstractFileStore import AbstractFileStore
 from toil import logProcessContext
-from toil.job import Job, CheckpointJobDescription
+from toil.job import Job, CheckpointJobDescription, Requirer
+from toil.jobStores.abstractJobStore import NoSuchJobException
 from toil.lib.bioio import configureRootLogger
 from toil.lib.bioio import setLogLevel
 from toil.lib.bioio import getTotalCpuTime
@@ -127,13 +129,314 @@ def nextChainable(predecessor, jobStore, config):
     # Made it through! This job is chainable.
     return successor
 
-def workerScript(jobStore, config, jobName, jobStoreID, redirectOutputToLogFile=True):
+def runJobBody(jobDesc, jobStore, config, localWorkerTempDir, blockFn, statsDict, deferredFunctionManager):
+    """
+    Load and run the body of the job with the given JobDescription, and start
+    committing the updated JobDescription to the job store.
+
+    :param toil.job.JobDescription jobDesc: Description of the job to run. Must have a command.
+    :param toil.jobStores.abstractJobStore.AbstractJobStore jobStore: The JobStore to load the job from.
+    :param toil.common.Config config: The configuration for the current run.
+    :param str localWorkerTempDir: The worker's temporary directory.
+    :param blockFn: Function that waits for the previous job's commit.
+    :param toil.lib.expando.MagicExpando statsDict: Stats and log messages
+           to report to the leader, which are added to.
+    :param toil.deferred.DeferredFunctionManager deferredFunctionManager: Manager
+           to register the job's deferred functions with.
+    :return: Function that waits for this job's commit.
+    """
+    assert jobDesc.command.startswith("_toil ")
+    logger.debug("Got a command to run: %s" % jobDesc.command)
+
+    # Create a fileStore object for the job, and have it start fetching the
+    # job's input files while we load the job.
+    fileStore = AbstractFileStore.createFileStore(jobStore, jobDesc, localWorkerTempDir, blockFn,
+                                                  caching=not config.disableCaching)
+    if not getattr(config, 'disablePrefetch', False):
+        fileStore.prefetch(jobDesc.inputFileIDs or [])
+
+    # Load the job. It will use the same JobDescription we have been using.
+    job = Job.loadJob(jobStore, jobDesc)
+    if isinstance(jobDesc, CheckpointJobDescription):
+        # If it is a checkpoint job, save the command
+        jobDesc.checkpoint = jobDesc.command
+
+    logger.info("Loaded body %s from description %s", job, jobDesc)
+
+    with job._executor(stats=statsDict if config.stats else None,
+                       fileStore=fileStore):
+        with deferredFunctionManager.open() as defer:
+            with fileStore.open(job):
+                # Run the job, save new successors, and set up
+                # locally (but don't commit) successor
+                # relationships and job completion.
+                # Pass everything as name=value because Cactus
+                # likes to override _runner when it shouldn't and
+                # it needs some hope of finding the arguments it
+                # wants across multiple Toil versions. We also
+                # still pass a jobGraph argument to placate old
+                # versions of Cactus.
+                job._runner(jobGraph=None, jobStore=jobStore, fileStore=fileStore, defer=defer)
+
+    # Accumulate messages from this job & any subsequent chained jobs
+    statsDict.workers.logsToMaster += fileStore.loggingMessages
+    
+    logger.info("Completed body for %s", jobDesc)
+
+    # Get the next block function to wait on committing this job
+    return fileStore.waitForCommit
+
+class LocalExecutionStack:
+    """
+    Runs the successors of a job that has finished in this worker, for as long
+    as they fit in the worker's resource allocation, so that the leader does
+    not have to schedule each of them.
+
+    Successors are explored depth-first, children before follow-ons, as the
+    leader would run them. All the ready successors of a job are run at the
+    same time, each in a forked copy of the worker, if they fit in the
+    allocation together. A job whose successors all finish here is removed
+    from its predecessor and deleted, as its own worker would have done.
+
+    As soon as some successors can't run here, the worker stops and reports
+    back on the job it was issued. Jobs that have run but have unfinished
+    successors are left in the job store with their bodies done, for the
+    leader to pick up. If a successor fails, the worker's attempt at the job
+    it was issued fails, as it would if the successor had been chained.
+    """
+
+    def __init__(self, jobStore, config, allocation, localWorkerTempDir, statsDict, listOfJobs):
+        """
+        :param toil.jobStores.abstractJobStore.AbstractJobStore jobStore: The JobStore to use.
+        :param toil.common.Config config: The configuration for the current run.
+        :param toil.job.Requirer allocation: The resources the worker was given.
+        :param str localWorkerTempDir: The worker's temporary directory.
+        :param toil.lib.expando.MagicExpando statsDict: Stats and log messages
+               to report to the leader.
+        :param list listOfJobs: Names of the jobs run by the worker, which is added to.
+        """
+        self.jobStore = jobStore
+        self.config = config
+        self.allocation = allocation
+        self.localWorkerTempDir = localWorkerTempDir
+        self.statsDict = statsDict
+        self.listOfJobs = listOfJobs
+        # How many more jobs we may run
+        self.jobsLeft = getattr(config, 'maxChainedJobs', 0)
+        # Successors run in forked copies of the worker, so that one failing
+        # doesn't take the rest of the worker down with it. We can't fork the
+        # leader, which is where debug workers run.
+        self.canFork = hasattr(os, 'fork') and not config.debugWorker
+
+    def isRunnable(self, successor):
+        """
+        Return True if the given successor can run in this worker right now.
+
+        :param toil.job.JobDescription successor: The successor to check.
+        :rtype: bool
+        """
+        if successor.command is None:
+            logger.debug("Successor %s has no body to run; leaving it for the leader.", successor)
+            return False
+        if successor.predecessorNumber > 1:
+            logger.debug("Successor %s has multiple predecessors; leaving it for the leader.", successor)
+            return False
+        if len(successor.services) > 0:
+            logger.debug("Successor %s needs services; leaving it for the leader.", successor)
+            return False
+        if isinstance(successor, CheckpointJobDescription):
+            logger.debug("Successor %s is a checkpoint; leaving it for the leader.", successor)
+            return False
+        if (successor.memory > self.allocation.memory or successor.cores > self.allocation.cores or
+                successor.disk > self.allocation.disk):
+            logger.debug("Successor %s needs more resources than we have; leaving it for the leader.", successor)
+            return False
+        if self.allocation.preemptable and not successor.preemptable:
+            logger.debug("Successor %s can't run on a preemptable node; leaving it for the leader.", successor)
+            return False
+        return True
+
+    def run(self, rootDesc, blockFn):
+        """
+        Run as much as possible of the successor graph of the given job.
+
+        :param toil.job.JobDescription rootDesc: Description of the job the
+               worker was issued, whose body has been run and is being committed.
+        :param blockFn: Function that waits for the commit of the job's body.
+        :return: The up to date description of the issued job, and a function
+                 that waits for all outstanding commits.
+        :rtype: tuple(toil.job.JobDescription, function)
+        """
+        if (self.jobsLeft <= 0 or not self.canFork or len(rootDesc.services) > 0 or
+                (isinstance(rootDesc, CheckpointJobDescription) and rootDesc.checkpoint is not None)):
+            return rootDesc, blockFn
+        
+        # We are going to change the job, and fork, so let its commit finish first.
+        blockFn()
+
+        # Pairs of a job whose successors we are working through and the
+        # predecessor it came from. The predecessor is always further down.
+        frames = [(rootDesc, None)]
+        while len(frames) > 0:
+            current, predecessor = frames[-1]
+            ready = current.nextSuccessors()
+            if ready is None:
+                # All the job's successors are done
+                frames.pop()
+                if predecessor is not None:
+                    self._finish(current, predecessor)
+                continue
+            batch = self._nextBatch(ready)
+            if batch is None:
+                # The leader needs to schedule some of these, and the sooner
+                # it hears about them the better. Everything we haven't
+                # finished stays in the job store for it.
+                logger.debug("Leaving the successors of %s to the leader", current)
+                break
+            self.jobsLeft -= len(batch)
+            succeeded = self._runBatch(batch, current)
+            if len(succeeded) < len(batch):
+                # The worker's attempt at its job has failed, as it would
+                # have if the failed jobs had been chained on to it. The
+                # leader charges the job a try and runs what is left itself.
+                raise RuntimeError("%d successor(s) of %s failed while running in this worker" %
+                                   (len(batch) - len(succeeded), current))
+            frames.extend((successor, current) for successor in reversed(succeeded))
+        return rootDesc, lambda: True
+
+    def _nextBatch(self, readyIDs):
+        """
+        Load the successors with the given IDs and decide if they can all run
+        here at the same time.
+
+        We don't run some of them here and leave the rest for later, because
+        on a bigger allocation elsewhere the leader could have run them all
+        at once.
+
+        :return: The successors to run, or None if the leader must schedule them.
+        :rtype: list(toil.job.JobDescription) or None
+        """
+        readyIDs = list(readyIDs)
+        if len(readyIDs) > self.jobsLeft:
+            logger.debug("Not enough of our job limit left to run %d successors", len(readyIDs))
+            return None
+        try:
+            successors = self.jobStore.loadMany(readyIDs)
+        except NoSuchJobException as e:
+            logger.warning("Could not load successors to run locally: %s", e)
+            return None
+        batch = [successors[jobStoreID] for jobStoreID in readyIDs]
+        if not all(self.isRunnable(successor) for successor in batch):
+            return None
+        if (sum(successor.cores for successor in batch) > self.allocation.cores or
+                sum(successor.memory for successor in batch) > self.allocation.memory or
+                sum(successor.disk for successor in batch) > self.allocation.disk):
+            logger.debug("The %d ready successors don't fit in our allocation together", len(batch))
+            return None
+        return batch
+
+    def _finish(self, jobDesc, predecessor):
+        """
+        Clean up a job whose successors have all finished, and remove it from
+        its predecessor.
+        """
+        logger.debug("Successor %s is done; removing it from %s", jobDesc, predecessor)
+        predecessor.filterSuccessors(lambda jID: jID != jobDesc.jobStoreID)
+        # If we die before deleting it, deleting the predecessor will.
+        predecessor.jobsToDelete.append(jobDesc.jobStoreID)
+        self.jobStore.update(predecessor)
+        # Do what the job's own worker would have done at the end.
+        for otherID in jobDesc.jobsToDelete:
+            self.jobStore.delete(otherID)
+        self.jobStore.delete(jobDesc.jobStoreID)
+
+    def _runBatch(self, batch, predecessor):
+        """
+        Run the bodies of the given jobs at the same time, each in a forked
+        copy of the worker, and wait for them to commit.
+
+        A job that fails is left as it was in the job store.
+
+        :return: The committed descriptions of the jobs that succeeded.
+        :rtype: list(toil.job.JobDescription)
+        """
+        children = {}
+        for jobDesc in batch:
+            logger.info("Running successor %s of %s in this worker", jobDesc, predecessor)
+            self.listOfJobs.append(str(jobDesc))
+            resultPath = os.path.join(self.localWorkerTempDir, 'local-%s.json' % uuid.uuid4())
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                # We are the child. Never return from here.
+                os._exit(self._runForked(jobDesc, resultPath))
+            children[pid] = (jobDesc, resultPath)
+
+        succeeded = []
+        for pid, (jobDesc, resultPath) in children.items():
+            _, status = os.waitpid(pid, 0)
+            result = {}
+            if os.path.exists(resultPath):
+                with open(resultPath) as resultFile:
+                    result = json.load(resultFile)
+                os.unlink(resultPath)
+            self.statsDict.jobs += result.get('jobs', [])
+            self.statsDict.workers.logsToMaster += result.get('logsToMaster', [])
+            if status == 0:
+                succeeded.append(jobDesc.jobStoreID)
+            else:
+                # The traceback is already in the worker log, which goes to
+                # the leader with the failed attempt.
+                logger.error("Job %s failed while running in the worker for %s (wait status %d)",
+                             jobDesc, self.listOfJobs[0], status)
+        return [self.jobStore.load(jobStoreID) for jobStoreID in succeeded]
+
+    def _runForked(self, jobDesc, resultPath):
+        """
+        Run the body of the given job in a forked child of the worker, and
+        write the stats and log messages it produced to the given file.
+
+        :return: The exit code for the child.
+        :rtype: int
+        """
+        jobsBefore = len(self.statsDict.jobs)
+        logsBefore = len(self.statsDict.workers.logsToMaster)
+        result = {}
+        try:
+            # The worker's lock on its deferred function state doesn't carry
+            # over into the child, so get our own.
+            deferredFunctionManager = DeferredFunctionManager(os.path.dirname(self.localWorkerTempDir))
+            runJobBody(jobDesc, self.jobStore, self.config, self.localWorkerTempDir, lambda: True,
+                       self.statsDict, deferredFunctionManager)()
+            del deferredFunctionManager
+            if AbstractFileStore._terminateEvent.isSet():
+                raise RuntimeError("The termination flag is set")
+            exitCode = 0
+        except:
+            traceback.print_exc()
+            exitCode = 1
+        try:
+            result['jobs'] = self.statsDict.jobs[jobsBefore:]
+            result['logsToMaster'] = self.statsDict.workers.logsToMaster[logsBefore:]
+            with open(resultPath, 'w') as resultFile:
+                json.dump(result, resultFile)
+        except:
+            traceback.print_exc()
+            exitCode = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        return exitCode
+
+def workerScript(jobStore, config, jobName, jobStoreID, redirectOutputToLogFile=True, environment=None):
     """
     Worker process script, runs a job. 
     
     :param str jobName: The "job name" (a user friendly name) of the job to be run
     :param str jobStoreLocator: Specifies the job store to use
     :param str jobStoreID: The job store ID of the job to be run
+    :param dict environment: The environment the leader saved for the job, if
+           the caller has already read it from the job store
     
     :return int: 1 if a job failed, or 0 if all jobs succeeded
     """
@@ -187,8 +490,9 @@ def workerScript(jobStore, config, jobName, jobStoreID, redirectOutputToLogFile=
     ##########################################
     
     #First load the environment for the job.
-    with jobStore.readSharedFileStream("environment.pickle") as fileHandle:
-        environment = safeUnpickleFromStream(fileHandle)
+    if environment is None:
+        with jobStore.readSharedFileStream("environment.pickle") as fileHandle:
+            environment = safeUnpickleFromStream(fileHandle)
     env_reject = {
         "TMPDIR",
         "TMP",
@@ -288,7 +592,6 @@ def workerScript(jobStore, config, jobName, jobStoreID, redirectOutputToLogFile=
     statsDict.workers.logsToMaster = []
     blockFn = lambda : True
     listOfJobs = [jobName]
-    job = None
     try:
 
         #Put a message at the top of the log, just to make sure it's working.
@@ -309,6 +612,11 @@ def workerScript(jobStore, config, jobName, jobStoreID, redirectOutputToLogFile=
         jobDesc = jobStore.load(jobStoreID)
         listOfJobs[0] = str(jobDesc)
         logger.debug("Parsed job description")
+
+        # Remember the resources we were given to run in, for running
+        # successors locally.
+        allocation = Requirer({'memory': jobDesc.memory, 'cores': jobDesc.cores,
+                               'disk': jobDesc.disk, 'preemptable': jobDesc.preemptable})
         
         ##########################################
         #Cleanup from any earlier invocation of the job
@@ -369,42 +677,8 @@ def workerScript(jobStore, config, jobName, jobStoreID, redirectOutputToLogFile=
             logger.info("Working on job %s", jobDesc)
             
             if jobDesc.command is not None:
-                assert jobDesc.command.startswith("_toil ")
-                logger.debug("Got a command to run: %s" % jobDesc.command)
-                # Load the job. It will use the same JobDescription we have been using.
-                job = Job.loadJob(jobStore, jobDesc)
-                if isinstance(jobDesc, CheckpointJobDescription):
-                    # If it is a checkpoint job, save the command
-                    jobDesc.checkpoint = jobDesc.command
-
-                logger.info("Loaded body %s from description %s", job, jobDesc)
-
-                # Create a fileStore object for the job
-                fileStore = AbstractFileStore.createFileStore(jobStore, jobDesc, localWorkerTempDir, blockFn,
-                                                              caching=not config.disableCaching)
-                with job._executor(stats=statsDict if config.stats else None,
-                                   fileStore=fileStore):
-                    with deferredFunctionManager.open() as defer:
-                        with fileStore.open(job):
-                            # Get the next block function to wait on committing this job
-                            blockFn = fileStore.waitForCommit
-                            
-                            # Run the job, save new successors, and set up
-                            # locally (but don't commit) successor
-                            # relationships and job completion.
-                            # Pass everything as name=value because Cactus
-                            # likes to override _runner when it shouldn't and
-                            # it needs some hope of finding the arguments it
-                            # wants across multiple Toil versions. We also
-                            # still pass a jobGraph argument to placate old
-                            # versions of Cactus.
-                            job._runner(jobGraph=None, jobStore=jobStore, fileStore=fileStore, defer=defer)
-
-                # Accumulate messages from this job & any subsequent chained jobs
-                statsDict.workers.logsToMaster += fileStore.loggingMessages
-                
-                logger.info("Completed body for %s", jobDesc)
-
+                blockFn = runJobBody(jobDesc, jobStore, config, localWorkerTempDir, blockFn,
+                                     statsDict, deferredFunctionManager)
             else:
                 #The command may be none, in which case
                 #the JobDescription is either a shell ready to be deleted or has
@@ -425,6 +699,13 @@ def workerScript(jobStore, config, jobName, jobStoreID, redirectOutputToLogFile=
                 logger.info("Not chaining from job %s", jobDesc)
                 
                 # TODO: Somehow the commit happens even if we don't start it here. 
+
+                if not config.disableChaining:
+                    # Run as much of the job's successor graph as fits here,
+                    # instead of sending it all back to the leader.
+                    localStack = LocalExecutionStack(jobStore, config, allocation, localWorkerTempDir,
+                                                     statsDict, listOfJobs)
+                    jobDesc, blockFn = localStack.run(jobDesc, blockFn)
                 
                 break
                 